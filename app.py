@@ -1,53 +1,207 @@
 from datetime import timezone
-from flask import Flask, request, jsonify, render_template, Response
-import joblib
+from flask import Flask, request, jsonify, render_template, Response, g
 import json
 import logging
+import numpy as np
 import os
 import pandas as pd
-import xgboost as xgb
+import time
 
 # Import custom code
-from src.constants import LOCAL_TIMEZONE, ROOT_DIR, MODELS_DIR, WEATHER_CONDITIONS
-from src.trip_functions import get_bus_lines, get_bus_directions, get_bus_stops, get_weather_info, get_trip_info
+from src.artifact_bundle import BundleReloader, ServingArtifacts
+from src.constants import LOCAL_TIMEZONE, ROOT_DIR, DATA_DIR, PREDICTION_GRID_DIR, PREDICT_BATCH_MAX_QUERIES, DEPARTURES_DEFAULT_COUNT, DEPARTURES_MAX_COUNT, WEATHER_REFRESH_INTERVAL, PREDICTION_MODE, SERVING_PRELOAD
+from src.metrics import REQUEST_SECONDS, RESPONSES, get_metrics, get_server_timing, pop_request_spans, start_request_spans
+from src.prediction_cache import PredictionCache
+from src.prediction_grid import PredictionGrid, get_schedule_fingerprint
+from src.prediction import format_prediction, get_predictions, get_time_error, predict_batch, predict_departures, use_forecast
+from src.profiler import SamplingProfiler, should_profile
+from src.schedule_metadata import ResponseBody
+from src.trip_functions import get_weather_info, get_trip_info, bundles_path, hist_delays_path, serving_artifacts, weather_store
+from src.weather_store import WeatherRefresher
 
 app = Flask(__name__)
 
 # File paths
-model_dir = os.path.join(ROOT_DIR, MODELS_DIR)
-model_path = os.path.join(model_dir, 'regression_model.pkl')
-min_time_path = os.path.join(model_dir, 'min_time.pkl')
+prediction_grid_path = os.path.join(ROOT_DIR, DATA_DIR, PREDICTION_GRID_DIR)
 
-# Load data
-model = joblib.load(model_path)
-min_time_local = joblib.load(min_time_path)
+# Keep the forecast and recent archive in the weather store
+weather_refresher = None
 
-@app.route('/')
-def home():
+def start_weather_refresher() -> None:
+    global weather_refresher
+    if WEATHER_REFRESH_INTERVAL > 0 and weather_refresher is None:
+        weather_refresher = WeatherRefresher(weather_store)
+        weather_refresher.start()
+
+# Threads do not survive a fork, gunicorn.conf.py starts the refresher in each worker instead
+if not SERVING_PRELOAD:
+    start_weather_refresher()
+
+def render_home(artifacts:ServingArtifacts) -> ResponseBody:
   date_format = '%Y-%m-%dT%H:%M'
   result = {
-    'bus_lines': get_bus_lines(),
-    'min_time': min_time_local.strftime(date_format),
-    'max_time': pd.Timestamp('2025-06-15 23:59:59-0400').strftime(date_format) # end of GTFS schedule
+    'bus_lines': artifacts.schedule_metadata.bus_lines,
+    'min_time': artifacts.min_time_local.strftime(date_format),
+    'max_time': artifacts.schedule_end.strftime(date_format) # end of GTFS schedule
   }
-  return render_template('index.html', result=result)
+  with app.app_context():
+    return ResponseBody(render_template('index.html', result=result).encode(), content_type='text/html; charset=utf-8')
+
+def warm_up(artifacts:ServingArtifacts|None=None) -> None:
+    '''
+    Runs a schedule lookup and model predictions once, so that the workers
+    forked from a preloaded app share what they initialize on first use, and
+    a new bundle is ready before it is swapped in
+    '''
+    artifacts = artifacts or bundle_reloader.artifacts
+    schedule_index = artifacts.schedule_index
+    now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE)
+    schedule_index.find_next_departures(int(schedule_index.stop_ids[0]), now_local, DEPARTURES_DEFAULT_COUNT)
+    for n_rows in [1, artifacts.model.evaluator_max_rows + 1]:
+        artifacts.model.predict(np.zeros((n_rows, len(artifacts.feature_plan.feature_names)), dtype='float32'))
+
+def prepare_artifacts(artifacts:ServingArtifacts) -> None:
+    '''Adds what the app serves with a version, before it is served'''
+    # Predictions precomputed by scripts/build_prediction_grid.py (empty if it was not run or built for another version)
+    artifacts.prediction_grid = PredictionGrid(prediction_grid_path, get_schedule_fingerprint(artifacts.schedule_index), artifacts.model.version,
+                                               artifacts.feature_plan.feature_names, artifacts.scheduled_probability)
+
+    # Predictions of repeated queries (only in expected mode, sampled predictions change on every call)
+    artifacts.prediction_cache = PredictionCache() if PREDICTION_MODE == 'expected' else None
+
+    # The home page only changes with the schedule
+    artifacts.home_page = render_home(artifacts)
+    warm_up(artifacts)
+
+# Versions published by scripts/build_bundle.py are loaded in the background and swapped in without a restart
+prepare_artifacts(serving_artifacts)
+bundle_reloader = BundleReloader(bundles_path, serving_artifacts, hist_delays_path, prepare=prepare_artifacts)
+
+@app.before_request
+def get_request_artifacts():
+    # Every step of a request uses the same version
+    g.artifacts = bundle_reloader.get_artifacts()
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    start_request_spans()
+
+    # Requests sampled by PROFILE_SAMPLE_RATE, or asking with X-Profile: 1 (see README, Metrics and Profiling)
+    if should_profile(request.headers.get('X-Profile')):
+        g.profiler = SamplingProfiler().start()
+
+@app.after_request
+def add_version_header(response:Response) -> Response:
+    if 'artifacts' in g:
+        response.headers['X-Artifact-Version'] = g.artifacts.version
+    return response
+
+def get_endpoint_label() -> str:
+    '''Returns the route of the request (a bounded set of labels, unlike its path)'''
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.after_request
+def record_request_metrics(response:Response) -> Response:
+    endpoint = get_endpoint_label()
+    if 'request_start' in g:
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    RESPONSES.labels(endpoint, str(response.status_code)).inc()
+
+    spans = pop_request_spans()
+    if spans:
+        response.headers['Server-Timing'] = get_server_timing(spans)
+    return response
+
+@app.teardown_request
+def write_request_profile(error:BaseException|None=None) -> None:
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        path = profiler.write(get_endpoint_label().strip('/').replace('/', '_').replace('-', '_') or 'home')
+        if path:
+            logging.info('Profile of %s (%.1f ms) written in %s', request.path, profiler.seconds * 1000, path)
+
+@app.route('/metrics')
+def metrics():
+    body, content_type = get_metrics()
+    return Response(body, content_type=content_type)
+
+def get_metadata_response(body:ResponseBody) -> Response:
+    '''
+    Returns a precomputed body, gzipped if the client accepts it, or 304 Not
+    Modified to a GET request whose If-None-Match has the body's ETag.
+    '''
+    use_gzip = 'gzip' in request.accept_encodings
+    etag = f'{body.etag}-gzip' if use_gzip else body.etag
+
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif use_gzip:
+        response = Response(body.gzip_body, content_type=body.content_type)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body.body, content_type=body.content_type)
 
-@app.route('/get-directions', methods=['POST'])
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache' # revalidate, the schedule can change
+    return response
+
+def get_metadata_params() -> dict:
+    '''Returns the query string of a GET request or the JSON body of a POST request'''
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        return body if isinstance(body, dict) else {}
+    return request.args
+
+@app.route('/')
+def home():
+    return get_metadata_response(g.artifacts.home_page)
+
+@app.route('/get-directions', methods=['GET', 'POST'])
 def get_directions():
-    bus_line = request.json.get('bus_line')
-    directions = jsonify(get_bus_directions(bus_line))
-    return directions
+    try:
+        route_id = int(get_metadata_params().get('bus_line'))
+    except (TypeError, ValueError):
+        return Response(json.dumps({'message': 'bus_line should be an integer.'}), status=400, content_type='application/json')
+
+    return get_metadata_response(g.artifacts.schedule_metadata.get_directions(route_id))
 
-@app.route('/get-stops', methods=['POST'])
+@app.route('/get-stops', methods=['GET', 'POST'])
 def get_stops():
-    bus_line = request.json.get('bus_line')
-    direction = request.json.get('direction')
-    stops = get_bus_stops(bus_line, direction)
-    return jsonify(stops)
+    params = get_metadata_params()
+    try:
+        route_id = int(params.get('bus_line'))
+    except (TypeError, ValueError):
+        return Response(json.dumps({'message': 'bus_line should be an integer.'}), status=400, content_type='application/json')
+
+    stops = g.artifacts.schedule_metadata.get_stops(route_id, params.get('direction'))
+    if stops is None:
+        error = {
+            'message': 'This bus line has no trips in this direction.'
+        }
+        return Response(json.dumps(error), status=404, content_type='application/json')
+
+    return get_metadata_response(stops)
+
+@app.route('/health')
+def health():
+    artifacts = g.artifacts
+    result = {
+        'artifacts': bundle_reloader.get_state(),
+        'weather_breaker': weather_store.breaker.get_state(),
+        'prediction_grid': artifacts.prediction_grid.get_state(),
+        'hist_delays': artifacts.hist_delays_reloader.get_state(),
+        'prediction_cache': artifacts.prediction_cache.get_state() if artifacts.prediction_cache is not None else None,
+    }
+    return jsonify(result)
 
 @app.route('/predict', methods=['POST'])
 def predict():
     try:
+        artifacts = g.artifacts
+
         # Get data from form
         route_id = int(request.form['bus_line'])
         direction = request.form['direction']
@@ -56,24 +210,18 @@ def predict():
 
         # Get dates
         chosen_time_local = pd.Timestamp(chosen_time_str, tz=LOCAL_TIMEZONE)
-        chosen_time_utc = chosen_time_local.tz_convert(tz=timezone.utc)
         now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE)
-        now_utc = now_local.tz_convert(tz=timezone.utc)
-        three_days_before_utc = now_utc - pd.Timedelta(days=3)
-        two_weeks_later_utc = now_utc + pd.Timedelta(weeks=2) # the weather forecast only goes 2 weeks from now
-        min_time_utc = min_time_local.tz_convert(tz=timezone.utc)
-        two_weeks_later_local = two_weeks_later_utc.tz_convert(tz=LOCAL_TIMEZONE)
 
         # Do not allow time earlier than the minimum date of the preprocessed data and later than two weeks from now
-        if (chosen_time_utc < min_time_utc) | (chosen_time_utc > two_weeks_later_utc):
-            dt_format = '%Y-%m-%d'
+        time_error = get_time_error(chosen_time_local, artifacts.min_time_local, now_local)
+        if time_error:
             error = {
-                'message': f'The date should not be earlier than {min_time_local.strftime(dt_format)} or later than {two_weeks_later_local.strftime(dt_format)}'
+                'message': time_error
             }
             return Response(json.dumps(error), status=400, content_type='application/json')
 
         # Get trip data
-        trip_result = get_trip_info(route_id, direction, stop_id, chosen_time_local)
+        trip_result = get_trip_info(route_id, direction, stop_id, chosen_time_local, artifacts=artifacts)
 
         if not trip_result:
             error = {
@@ -81,47 +229,16 @@ def predict():
             }
             return Response(json.dumps(error), status=404, content_type='application/json')
       
-        trip_data = trip_result['trip_data']
         next_arrival_time = trip_result['next_arrival_time']
         next_arrival_time_utc = next_arrival_time.tz_convert(tz=timezone.utc)
 
         # Get weather data
-        weather_data = {}
-        if next_arrival_time_utc <= three_days_before_utc:
-            weather_data = get_weather_info(next_arrival_time_utc)
-        elif next_arrival_time_utc <= two_weeks_later_utc:
-            weather_data = get_weather_info(next_arrival_time_utc, forecast=True)
-
-        # Make prediction
-        input_df = get_input_matrix(weather_data, trip_data)
-        prediction = model.predict(input_df)[0]
-        predicted_time = next_arrival_time + pd.Timedelta(seconds=prediction)
-        rounded_predicted_time = predicted_time.round('min')
-        predicted_time_str = rounded_predicted_time.strftime('%Y-%m-%d %H:%M')
-
-        # Initialize result JSON
-        result = {}
-
-        ## Weather data
-        weathercode = int(weather_data['weathercode'])
-        weather_condition = WEATHER_CONDITIONS[weathercode]
-        temperature = weather_data['temperature_2m']
-        result['weather_condition'] = weather_condition
-        result['temperature'] = temperature
-        
-        ## Trip data
-        rounded_next_arrival_time = next_arrival_time.round('min')
-        next_arrival_time_str = rounded_next_arrival_time.strftime('%Y-%m-%d %H:%M')
-        result['next_arrival_time'] = next_arrival_time_str
-        result['predicted_time'] = predicted_time_str
-        result['hist_avg_delay'] = trip_result['hist_avg_delay']
-        
-        if rounded_predicted_time < rounded_next_arrival_time:
-            result['status'] = 'Early'
-        elif rounded_predicted_time > rounded_next_arrival_time:
-            result['status'] = 'Late'
-        else:
-            result['status'] = 'On Time'
+        weather_data = get_weather_info(next_arrival_time_utc, forecast=use_forecast(next_arrival_time_utc, now_local))
+
+        # Make prediction (from the prediction grid or cache if they have this arrival and weather)
+        prediction = float(get_predictions([trip_result], [weather_data], artifacts.model, artifacts.feature_plan, artifacts.prediction_grid,
+                                           artifacts.prediction_cache, artifacts.scheduled_probability)[0])
+        result = format_prediction(trip_result, weather_data, prediction)
         
         logging.info('/predict - Route: %d | Direction: %s | Stop: %d | Time: %s | Delay: %s', route_id, direction, stop_id, chosen_time_str, round(prediction, 2))
 
@@ -131,40 +248,89 @@ def predict():
        
         return Response(json.dumps({'message': 'An error occured.'}), status=500, content_type='application/json')
     
-def get_input_matrix(weather_data:dict, trip_data:dict):
-    merged_data = {**weather_data, **trip_data}
-
-    input_data = {
-        'arrivals_per_hour hist_avg_delay' : [merged_data['arrivals_per_hour'] * merged_data['hist_avg_delay']],
-        'arrivals_per_hour route_bearing' : [merged_data['arrivals_per_hour'] * merged_data['route_bearing']],
-        'cloud_cover exp_trip_duration' : [merged_data['cloud_cover'] * merged_data['exp_trip_duration']],
-        'cloud_cover schedule_relationship_Scheduled': [merged_data['cloud_cover'] * merged_data['schedule_relationship_Scheduled']],
-        'exp_trip_duration relative_humidity_2m': [merged_data['exp_trip_duration'] * merged_data['relative_humidity_2m']],
-        'exp_trip_duration route_bearing' : [merged_data['exp_trip_duration'] * merged_data['route_bearing']],
-        'exp_trip_duration schedule_relationship_Scheduled' : [merged_data['exp_trip_duration'] * merged_data['schedule_relationship_Scheduled']],
-        'exp_trip_duration stop_cluster': [merged_data['exp_trip_duration'] * merged_data['stop_cluster']],
-        'exp_trip_duration temperature_2m' : [merged_data['exp_trip_duration'] * merged_data['temperature_2m']],
-        'exp_trip_duration wind_direction_10m' : [merged_data['exp_trip_duration'] * merged_data['wind_direction_10m']],
-        'exp_trip_duration wind_speed_10m' : [merged_data['exp_trip_duration'] * merged_data['wind_speed_10m']],
-        'hist_avg_delay' : [merged_data['hist_avg_delay']],
-        'hist_avg_delay route_bearing' : [merged_data['hist_avg_delay'] * merged_data['route_bearing']],
-        'hist_avg_delay stop_cluster': [merged_data['hist_avg_delay'] * merged_data['stop_cluster']],
-        'hist_avg_delay wind_direction_10m' : [merged_data['hist_avg_delay'] * merged_data['wind_speed_10m']],
-        'hist_avg_delay wind_speed_10m' : [merged_data['hist_avg_delay'] * merged_data['wind_speed_10m']],
-        'relative_humidity_2m schedule_relationship_Scheduled' : [merged_data['relative_humidity_2m'] * merged_data['schedule_relationship_Scheduled']],
-        'route_bearing' : [merged_data['route_bearing']],
-        'route_bearing stop_cluster' : [merged_data['route_bearing'] * merged_data['stop_cluster']],
-        'route_bearing temperature_2m' : [merged_data['route_bearing'] * merged_data['temperature_2m']],
-        'route_bearing wind_direction_10m' : [merged_data['route_bearing'] * merged_data['wind_direction_10m']],
-        'route_bearing wind_speed_10m' : [merged_data['route_bearing'] * merged_data['wind_speed_10m']],
-        'schedule_relationship_Scheduled temperature_2m': [merged_data['schedule_relationship_Scheduled'] * merged_data['temperature_2m']],
-        'stop_cluster temperature_2m': [merged_data['stop_cluster'] * merged_data['temperature_2m']],
-        'stop_cluster wind_direction_10m': [merged_data['stop_cluster'] * merged_data['wind_direction_10m']]
-    }
-    
-    # Create input matrix
-    input_df = pd.DataFrame(input_data)
-    return xgb.DMatrix(input_df, enable_categorical=False)
-  
+@app.route('/predict-batch', methods=['POST'])
+def predict_batch_route():
+    try:
+        artifacts = g.artifacts
+        body = request.get_json(silent=True)
+        queries = body.get('queries') if isinstance(body, dict) else None
+
+        if not isinstance(queries, list):
+            error = {
+                'message': 'The request body should be a JSON object with a list of queries.'
+            }
+            return Response(json.dumps(error), status=400, content_type='application/json')
+
+        if len(queries) > PREDICT_BATCH_MAX_QUERIES:
+            error = {
+                'message': f'A batch should not have more than {PREDICT_BATCH_MAX_QUERIES} queries.'
+            }
+            return Response(json.dumps(error), status=400, content_type='application/json')
+
+        results = predict_batch(queries, artifacts.model, artifacts.feature_plan, artifacts.min_time_local, prediction_grid=artifacts.prediction_grid,
+                                prediction_cache=artifacts.prediction_cache, artifacts=artifacts)
+        n_errors = sum(result['status_code'] != 200 for result in results)
+        logging.info('/predict-batch - Queries: %d | Errors: %d', len(queries), n_errors)
+
+        return jsonify({'results': results})
+    except Exception as e:
+        logging.error('An error occured: %s', repr(e))
+
+        return Response(json.dumps({'message': 'An error occured.'}), status=500, content_type='application/json')
+
+@app.route('/departures')
+def departures():
+    try:
+        artifacts = g.artifacts
+
+        # Get data from query string
+        try:
+            stop_id = int(request.args['stop_id'])
+            n = int(request.args.get('n', DEPARTURES_DEFAULT_COUNT))
+            now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE)
+            chosen_time_str = request.args.get('time')
+            chosen_time_local = pd.Timestamp(chosen_time_str, tz=LOCAL_TIMEZONE) if chosen_time_str else now_local.floor('min')
+        except Exception:
+            error = {
+                'message': 'stop_id and n should be integers and time a local date and time.'
+            }
+            return Response(json.dumps(error), status=400, content_type='application/json')
+
+        if not 1 <= n <= DEPARTURES_MAX_COUNT:
+            error = {
+                'message': f'n should be between 1 and {DEPARTURES_MAX_COUNT}.'
+            }
+            return Response(json.dumps(error), status=400, content_type='application/json')
+
+        time_error = get_time_error(chosen_time_local, artifacts.min_time_local, now_local)
+        if time_error:
+            error = {
+                'message': time_error
+            }
+            return Response(json.dumps(error), status=400, content_type='application/json')
+
+        # Get the next arrivals of all routes at the stop and their predictions
+        departures = predict_departures(stop_id, chosen_time_local, n, artifacts.model, artifacts.feature_plan, now_local, prediction_grid=artifacts.prediction_grid,
+                                        prediction_cache=artifacts.prediction_cache, artifacts=artifacts)
+
+        if departures is None:
+            error = {
+                'message': 'No bus serves this stop.'
+            }
+            return Response(json.dumps(error), status=404, content_type='application/json')
+
+        result = {
+            'stop_id': stop_id,
+            'time': chosen_time_local.strftime('%Y-%m-%d %H:%M'),
+            'departures': departures,
+        }
+        logging.info('/departures - Stop: %d | Time: %s | Departures: %d', stop_id, result['time'], len(departures))
+
+        return jsonify(result)
+    except Exception as e:
+        logging.error('An error occured: %s', repr(e))
+
+        return Response(json.dumps({'message': 'An error occured.'}), status=500, content_type='application/json')
+
 if __name__ == '__main__':
     app.run(host='localhost', port=5000, debug=True)
@@ -0,0 +1,33 @@
+import gc
+import os
+import tempfile
+
+# The app is loaded once in the master and the workers are forked from it, so
+# they share the memory-mapped schedule index and the model instead of each
+# building their own copy (see README, Serving with several workers)
+os.environ['SERVING_PRELOAD'] = '1'
+preload_app = True
+wsgi_app = 'app:app'
+bind = os.getenv('SERVING_BIND', '127.0.0.1:5000')
+workers = int(os.getenv('SERVING_WORKERS', 4))
+threads = int(os.getenv('SERVING_THREADS', 1))
+
+# Each worker writes its metrics to this directory and /metrics sums them,
+# whichever worker answers. It must be set before the app is loaded.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='stm-metrics-'))
+
+def when_ready(server):
+  from app import warm_up
+  warm_up()
+
+  # Objects allocated so far are never collected, so collections in the
+  # workers do not write to (and copy) the pages they share with the master
+  gc.freeze()
+
+def post_fork(server, worker):
+  from app import start_weather_refresher
+  start_weather_refresher()
+
+def child_exit(server, worker):
+  from prometheus_client import multiprocess
+  multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,51 @@
+import numpy as np
+import os
+import pandas as pd
+import time
+
+# Serve the weather from the local Open-Meteo stand-in (before app.py reads the settings)
+from src.open_meteo_stub import start_stub_server
+stub = start_stub_server()
+os.environ['OPEN_METEO_ARCHIVE_URL'] = f'http://127.0.0.1:{stub.server_port}/v1/archive'
+os.environ['OPEN_METEO_FORECAST_URL'] = f'http://127.0.0.1:{stub.server_port}/v1/forecast'
+os.environ['WEATHER_REFRESH_INTERVAL'] = '0'
+
+# Import custom code
+from app import app
+from src.constants import LOCAL_TIMEZONE
+from src.trip_functions import schedule_index
+
+client = app.test_client()
+
+# Busiest stops, at times over the next 3 days
+n_calls = 200
+now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE).floor('h')
+stop_counts = np.diff(schedule_index.stop_offsets)
+busy_stops = schedule_index.arrival_stop_ids[np.argsort(stop_counts)[::-1][:50]]
+times = [(now_local + pd.Timedelta(minutes=(i * 37) % (3 * 24 * 60))).strftime('%Y-%m-%dT%H:%M') for i in range(n_calls)]
+
+# Warm up the weather store
+for stop_id, chosen_time in zip(busy_stops, times):
+  client.get(f'/departures?stop_id={stop_id}&time={chosen_time}&n=50')
+
+def get_latency(function) -> float:
+  start = time.perf_counter()
+  for i in range(n_calls):
+    function(int(busy_stops[i % len(busy_stops)]), times[i])
+  return (time.perf_counter() - start) / n_calls * 1000
+
+def get_departures(n:int):
+  return lambda stop_id, chosen_time: client.get(f'/departures?stop_id={stop_id}&time={chosen_time}&n={n}')
+
+# Route and direction lookups for /predict are done before timing
+routes = {int(stop_id): next((route_id, direction) for route_id, direction, key_stop_id in schedule_index._key_codes if key_stop_id == stop_id) for stop_id in busy_stops}
+def run_predict(stop_id:int, chosen_time:str) -> None:
+  route_id, direction = routes[stop_id]
+  client.post('/predict', data={'bus_line': route_id, 'direction': direction, 'stop': stop_id, 'chosen_time': chosen_time})
+
+print(f'{"":<32}{"ms/call":>10}')
+print(f'{"/predict (1 arrival)":<32}{get_latency(run_predict):>10.2f}')
+for n in [1, 10, 50]:
+  print(f'{f"/departures (n={n})":<32}{get_latency(get_departures(n)):>10.2f}')
+
+stub.shutdown()
@@ -0,0 +1,72 @@
+import numpy as np
+import os
+import pandas as pd
+import time
+import xgboost as xgb
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR
+from src.feature_plan import load_feature_plan
+
+plan = load_feature_plan(os.path.join(ROOT_DIR, MODELS_DIR, 'best_features.pkl'))
+
+def legacy_get_input_matrix(weather_data:dict, trip_data:dict):
+  '''Hand-written feature function previously used by app.py (kept for comparison)'''
+  merged_data = {**weather_data, **trip_data}
+  input_data = {}
+  for feature in plan.feature_names:
+    factors = feature.split(' ')
+    value = merged_data[factors[0]]
+    for factor in factors[1:]:
+      value = value * merged_data[factor]
+    input_data[feature] = [value]
+
+  # Reproduce the old mix-up of wind speed and wind direction
+  input_data['hist_avg_delay wind_direction_10m'] = [merged_data['hist_avg_delay'] * merged_data['wind_speed_10m']]
+
+  input_df = pd.DataFrame(input_data)
+  return xgb.DMatrix(input_df, enable_categorical=False)
+
+# Random base features
+rng = np.random.default_rng(42)
+n_rows = 10000
+records = [{feature: float(value) for feature, value in zip(plan.base_features, row)} for row in rng.random((n_rows, len(plan.base_features))) * 100]
+
+def get_rate(function, n_calls:int) -> float:
+  start = time.perf_counter()
+  function(n_calls)
+  return n_calls / (time.perf_counter() - start)
+
+def run_legacy(n_calls:int) -> None:
+  for record in records[:n_calls]:
+    legacy_get_input_matrix(record, {})
+
+def run_plan_single(n_calls:int) -> None:
+  out = np.empty((1, len(plan.feature_names)), dtype='float32')
+  for record in records[:n_calls]:
+    plan.transform_records([record], out=out)
+
+def run_plan_single_dmatrix(n_calls:int) -> None:
+  for record in records[:n_calls]:
+    xgb.DMatrix(plan.transform_records([record]), feature_names=plan.feature_names)
+
+def run_plan_batch(n_calls:int) -> None:
+  plan.transform_records(records[:n_calls])
+
+results = {
+  'legacy (DataFrame + DMatrix, 1 row)': get_rate(run_legacy, 1000),
+  'plan (1 row)': get_rate(run_plan_single, n_rows),
+  'plan + DMatrix (1 row)': get_rate(run_plan_single_dmatrix, 1000),
+  f'plan ({n_rows} rows batch)': get_rate(run_plan_batch, n_rows),
+}
+
+print(f'{"":<40}{"rows/sec":>14}')
+for name, rate in results.items():
+  print(f'{name:<40}{rate:>14,.0f}')
+
+# Check that both functions agree (except for the fixed wind direction feature)
+legacy = legacy_get_input_matrix(records[0], {}).get_data().toarray()[0]
+features = plan.transform_records([records[0]])[0]
+fixed_index = plan.feature_names.index('hist_avg_delay wind_direction_10m')
+mask = np.arange(len(features)) != fixed_index
+print(f'Max difference with legacy features: {np.abs(legacy[mask] - features[mask]).max()}')
@@ -0,0 +1,53 @@
+import json
+import os
+import subprocess
+import sys
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, DOWNLOAD_DIR, SNAPSHOT_DIR
+
+data_path = os.path.join(ROOT_DIR, DATA_DIR)
+download_path = os.path.join(data_path, DOWNLOAD_DIR)
+snapshot_path = os.path.join(data_path, SNAPSHOT_DIR)
+
+# Each loader runs in a fresh interpreter so that startup time and RSS are not shared
+loader_code = '''
+import json, psutil, sys, time
+start = time.perf_counter()
+from src.gtfs_snapshot import INDEX_DIR, GtfsSnapshot, load_csv_tables
+from src.schedule_index import ScheduleIndex, localize_calendar
+import os
+
+mode, download_path, data_path, snapshot_path = sys.argv[1:]
+if mode == 'csv':
+  tables = load_csv_tables(download_path, data_path)
+else:
+  tables = GtfsSnapshot(snapshot_path).load_tables()
+load_time = time.perf_counter() - start
+load_rss = psutil.Process().memory_info().rss
+
+# The index saved with the snapshot is mapped instead of built
+if mode == 'index':
+  ScheduleIndex.load(os.path.join(snapshot_path, INDEX_DIR), tables['hist_avg_delays'])
+else:
+  ScheduleIndex(tables['trips'], tables['stop_times'], tables['stops'], localize_calendar(tables['calendar']), tables['hist_avg_delays'])
+startup_time = time.perf_counter() - start
+
+print(json.dumps({
+  'load_time': load_time,
+  'load_rss_mb': load_rss / 2**20,
+  'startup_time': startup_time,
+  'startup_rss_mb': psutil.Process().memory_info().rss / 2**20,
+}))
+'''
+
+results = {}
+for mode in ['csv', 'snapshot', 'index']:
+  completed = subprocess.run(
+    [sys.executable, '-c', loader_code, mode, download_path, data_path, snapshot_path],
+    capture_output=True, text=True, check=True, cwd=ROOT_DIR)
+  results[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+print(f'{"":<10}{"load (s)":>12}{"load RSS (MB)":>16}{"startup (s)":>14}{"startup RSS (MB)":>19}')
+for mode, result in results.items():
+  print(f'{mode:<10}{result["load_time"]:>12.2f}{result["load_rss_mb"]:>16.1f}{result["startup_time"]:>14.2f}{result["startup_rss_mb"]:>19.1f}')
@@ -0,0 +1,87 @@
+import argparse
+import numpy as np
+import pandas as pd
+import time
+import warnings
+
+# Import custom code
+from src.constants import LOCAL_TIMEZONE
+from src.helper_functions import gtfs_time_to_seconds, parse_gtfs_time
+
+parser = argparse.ArgumentParser(description='Compare the GTFS time parser with the previous str.split implementation')
+parser.add_argument('--sizes', type=int, nargs='+', default=[1000000, 10000000], help='rows')
+parser.add_argument('--repeat', type=int, default=1, help='runs of each function, the fastest is reported')
+args = parser.parse_args()
+
+def previous_gtfs_time_to_seconds(time_series:pd.Series) -> pd.Series:
+  split_cols = time_series.str.split(':', expand=True).apply(pd.to_numeric)
+  return (split_cols[0] * 3600) + (split_cols[1] * 60) + split_cols[2]
+
+def previous_parse_gtfs_time(df:pd.DataFrame, date_column:str, time_column:str) -> pd.Series:
+  seconds_delta = previous_gtfs_time_to_seconds(df[time_column])
+  start_seconds = df[date_column].astype('int64') / 10**9
+  return pd.to_datetime(start_seconds + seconds_delta, origin='unix', unit='s').dt.tz_localize(LOCAL_TIMEZONE)
+
+def get_gtfs_times(n_rows:int, rng:np.random.Generator) -> pd.Series:
+  '''Random 'HH:MM:SS' strings up to 27:59:59, built as bytes'''
+  seconds = rng.integers(0, 28 * 3600, n_rows)
+  chars = np.full((n_rows, 8), ord(':'), dtype='uint8')
+  for column, value in zip([0, 1, 3, 4, 6, 7], [seconds // 36000, seconds // 3600 % 10, seconds // 600 % 6, seconds // 60 % 10, seconds // 10 % 6, seconds % 10]):
+    chars[:, column] = ord('0') + value
+  return pd.Series(chars.view('S8').ravel().astype('U8').astype(object))
+
+def get_best_time(function, *function_args) -> tuple:
+  best_seconds = float('inf')
+  for _ in range(args.repeat):
+    start = time.perf_counter()
+    result = function(*function_args)
+    best_seconds = min(best_seconds, time.perf_counter() - start)
+  return best_seconds, result
+
+rng = np.random.default_rng(0)
+print(f'{"rows":>12}{"function":>22}{"previous s":>12}{"new s":>10}{"speedup":>9}')
+for n_rows in args.sizes:
+  # Service dates without a time change, where the previous parser is defined
+  df = pd.DataFrame({
+    'start_date': pd.Timestamp('2025-06-02') + pd.to_timedelta(rng.integers(0, 60, n_rows), unit='D'),
+    'arrival_time': get_gtfs_times(n_rows, rng),
+  })
+
+  previous_seconds, expected = get_best_time(previous_gtfs_time_to_seconds, df['arrival_time'])
+  new_seconds, result = get_best_time(gtfs_time_to_seconds, df['arrival_time'])
+  assert result.dtype == 'int32' and (result.to_numpy() == expected.to_numpy()).all()
+  print(f'{n_rows:>12,}{"gtfs_time_to_seconds":>22}{previous_seconds:>12.3f}{new_seconds:>10.3f}{previous_seconds / new_seconds:>8.1f}x')
+
+  previous_seconds, expected = get_best_time(previous_parse_gtfs_time, df, 'start_date', 'arrival_time')
+  new_seconds, result = get_best_time(parse_gtfs_time, df, 'start_date', 'arrival_time')
+  assert result.equals(expected)
+  print(f'{n_rows:>12,}{"parse_gtfs_time":>22}{previous_seconds:>12.3f}{new_seconds:>10.3f}{previous_seconds / new_seconds:>8.1f}x')
+
+  # Seconds parsed once per schedule (as the cleaning pipeline does), converted per service date
+  df['arrival_time'] = gtfs_time_to_seconds(df['arrival_time'])
+  new_seconds, _ = get_best_time(parse_gtfs_time, df, 'start_date', 'arrival_time')
+  print(f'{n_rows:>12,}{"from int32 seconds":>22}{"":>12}{new_seconds:>10.3f}')
+  del df, expected, result
+
+# Strings other than 'HH:MM:SS' are split: the result stays int32 without missing times, float64 with NaN otherwise
+with warnings.catch_warnings():
+  warnings.simplefilter('error')
+  mixed_times = pd.Series(['05:30:00', '5:30:00', '25:00:01', '7:05:09', '23:59:59'])
+  result = gtfs_time_to_seconds(mixed_times)
+  assert result.dtype == 'int32' and result.tolist() == previous_gtfs_time_to_seconds(mixed_times).tolist(), result
+  result = gtfs_time_to_seconds(pd.Series(['05:30:00', None, '5:30:00']))
+  assert result.dtype == 'float64' and np.isnan(result[1]) and result[[0, 2]].tolist() == [19800, 19800], result
+print('Mixed formats: int32 without missing times, float64 with NaN')
+
+# Times of the service dates with a time change are measured from noon minus 12h
+df = pd.DataFrame({
+  'start_date': pd.to_datetime(['2025-03-09', '2025-03-09', '2025-03-09', '2025-11-02', '2025-11-02', '2025-11-02']),
+  'arrival_time': ['01:30:00', '02:30:00', '03:30:00', '00:30:00', '01:30:00', '24:30:00'],
+})
+df['parsed_time'] = parse_gtfs_time(df, 'start_date', 'arrival_time')
+for start_date, arrival_time, parsed_time in df.itertuples(index=False):
+  try:
+    previous_time = previous_parse_gtfs_time(pd.DataFrame({'start_date': [start_date], 'arrival_time': [arrival_time]}), 'start_date', 'arrival_time')[0]
+  except Exception as e:
+    previous_time = type(e).__name__
+  print(f'{start_date.date()} {arrival_time}: {parsed_time} (previously {previous_time})')
@@ -0,0 +1,86 @@
+import gzip
+import json
+import os
+import pandas as pd
+import time
+
+os.environ['WEATHER_REFRESH_INTERVAL'] = '0'
+
+# Import custom code
+from app import app
+from src.schedule_metadata import ScheduleMetadata
+from src.trip_functions import routes_df, trips_df, stop_times_df, stops_df
+
+# Previous implementations, which filtered the DataFrames on every request
+def legacy_get_bus_lines() -> list:
+  bus_lines_df = routes_df[routes_df['route_type'] == 3]
+  bus_lines_df = bus_lines_df[['route_id', 'route_long_name', 'route_color', 'route_text_color']]
+  return bus_lines_df.to_dict(orient='records')
+
+def legacy_get_bus_directions(bus_line:str) -> list:
+  route_id = int(bus_line)
+  trip_headsign = trips_df[trips_df['route_id'] == route_id]['trip_headsign']
+  directions_fr = trip_headsign.sort_values().unique().tolist()
+
+  directions = []
+  for direction in directions_fr:
+    data = {}
+    data['direction_fr'] = direction
+    if 'Nord' in direction:
+      data['direction_en'] = direction.replace('Nord', 'North')
+    elif 'Sud' in direction:
+      data['direction_en'] = direction.replace('Sud', 'South')
+    elif 'Ouest' in direction:
+      data['direction_en'] = direction.replace('Ouest', 'West')
+    elif 'Est' in direction:
+      data['direction_en'] = direction.replace('Est', 'East')
+    directions.append(data)
+  return directions
+
+def legacy_get_bus_stops(bus_line:str, direction:str) -> list:
+  route_id = int(bus_line)
+  trip_id = trips_df[(trips_df['route_id'] == route_id) & (trips_df['trip_headsign'] == direction)].iloc[0]['trip_id']
+  trip_stops_df = stop_times_df[stop_times_df['trip_id'] == trip_id][['stop_id', 'stop_sequence']]
+  stops_df_reduced = stops_df[['stop_id', 'stop_name']]
+  merged_stops_df = pd.merge(trip_stops_df, stops_df_reduced, how='inner', on='stop_id')
+  return merged_stops_df.to_dict(orient='records')
+
+start = time.perf_counter()
+schedule_metadata = ScheduleMetadata(routes_df, trips_df, stop_times_df, stops_df)
+print(f'Build: {time.perf_counter() - start:.2f} s for {len(schedule_metadata.directions)} routes and {len(schedule_metadata.stops)} directions')
+
+# The precomputed bodies are the previous responses
+assert schedule_metadata.bus_lines == legacy_get_bus_lines()
+for route_id, body in schedule_metadata.directions.items():
+  assert json.loads(body.body) == legacy_get_bus_directions(str(route_id))
+  assert gzip.decompress(body.gzip_body) == body.body
+for (route_id, direction), body in schedule_metadata.stops.items():
+  assert json.loads(body.body) == legacy_get_bus_stops(str(route_id), direction)
+print('All directions and stop lists match the previous implementation')
+
+client = app.test_client()
+route_directions = list(schedule_metadata.stops)[:200]
+
+def get_latency(function) -> float:
+  start = time.perf_counter()
+  for route_id, direction in route_directions:
+    function(route_id, direction)
+  return (time.perf_counter() - start) / len(route_directions) * 1000
+
+def get_stops(headers:dict):
+  return lambda route_id, direction: client.get('/get-stops', query_string={'bus_line': route_id, 'direction': direction}, headers=headers)
+
+def get_stops_revalidated(route_id:int, direction:str) -> None:
+  etag = schedule_metadata.get_stops(route_id, direction).etag
+  assert client.get('/get-stops', query_string={'bus_line': route_id, 'direction': direction}, headers={'If-None-Match': f'"{etag}"'}).status_code == 304
+
+print(f'{"":<40}{"ms/call":>10}')
+print(f'{"get_bus_directions (DataFrame)":<40}{get_latency(lambda route_id, direction: legacy_get_bus_directions(route_id)):>10.3f}')
+print(f'{"get_bus_stops (DataFrame)":<40}{get_latency(lambda route_id, direction: legacy_get_bus_stops(route_id, direction)):>10.3f}')
+print(f'{"Stops lookup":<40}{get_latency(schedule_metadata.get_stops):>10.4f}')
+print(f'{"GET /get-stops":<40}{get_latency(get_stops({})):>10.3f}')
+print(f'{"GET /get-stops (gzip)":<40}{get_latency(get_stops({"Accept-Encoding": "gzip"})):>10.3f}')
+print(f'{"GET /get-stops (304)":<40}{get_latency(get_stops_revalidated):>10.3f}')
+
+sizes = [(len(body.body), len(body.gzip_body)) for body in schedule_metadata.stops.values()]
+print(f'Stop lists: {sum(size for size, _ in sizes) / len(sizes):.0f} bytes on average, {sum(size for _, size in sizes) / len(sizes):.0f} gzipped')
@@ -0,0 +1,51 @@
+import os
+import pandas as pd
+import time
+
+# Serve the weather from the local Open-Meteo stand-in (before app.py reads the settings)
+from src.open_meteo_stub import start_stub_server
+stub = start_stub_server()
+os.environ['OPEN_METEO_ARCHIVE_URL'] = f'http://127.0.0.1:{stub.server_port}/v1/archive'
+os.environ['OPEN_METEO_FORECAST_URL'] = f'http://127.0.0.1:{stub.server_port}/v1/forecast'
+os.environ['WEATHER_REFRESH_INTERVAL'] = '0'
+
+# Import custom code
+from app import app
+from src.constants import LOCAL_TIMEZONE
+from src.trip_functions import schedule_index
+
+client = app.test_client()
+
+# Queries on stops served by the schedule, over the next 3 days
+n_queries = 1000
+now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE).floor('h')
+route_stops = list(schedule_index._key_codes)
+queries = []
+for i in range(n_queries):
+  route_id, direction, stop_id = route_stops[(i * 7919) % len(route_stops)]
+  chosen_time = now_local + pd.Timedelta(minutes=(i * 37) % (3 * 24 * 60))
+  queries.append({'bus_line': route_id, 'direction': direction, 'stop': stop_id, 'chosen_time': chosen_time.strftime('%Y-%m-%dT%H:%M')})
+
+# Warm up the weather store
+client.post('/predict-batch', json={'queries': queries})
+
+def run_single(queries:list) -> None:
+  for query in queries:
+    client.post('/predict', data=query)
+
+def run_batch(queries:list, batch_size:int) -> None:
+  for start in range(0, len(queries), batch_size):
+    response = client.post('/predict-batch', json={'queries': queries[start:start + batch_size]})
+    assert response.status_code == 200
+
+def get_rate(function, *args) -> float:
+  start = time.perf_counter()
+  function(*args)
+  return n_queries / (time.perf_counter() - start)
+
+print(f'{"":<32}{"queries/sec":>14}')
+print(f'{"/predict (one per query)":<32}{get_rate(run_single, queries):>14,.0f}')
+for batch_size in [1, 10, 100, 1000]:
+  print(f'{f"/predict-batch ({batch_size})":<32}{get_rate(run_batch, queries, batch_size):>14,.0f}')
+
+stub.shutdown()
@@ -0,0 +1,75 @@
+import numpy as np
+import os
+import pandas as pd
+import time
+
+# Serve the weather from the local Open-Meteo stand-in (before the settings are read)
+from src.open_meteo_stub import start_stub_server
+stub = start_stub_server()
+os.environ['OPEN_METEO_ARCHIVE_URL'] = f'http://127.0.0.1:{stub.server_port}/v1/archive'
+os.environ['OPEN_METEO_FORECAST_URL'] = f'http://127.0.0.1:{stub.server_port}/v1/forecast'
+os.environ['PREDICTION_MODE'] = 'expected'
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR, LOCAL_TIMEZONE
+from src.feature_plan import load_feature_plan
+from src.inference import load_delay_model
+from src.prediction import get_predictions, predict_delays, use_forecast
+from src.prediction_cache import PredictionCache
+from src.trip_functions import get_trip_info, get_weather_info, schedule_index, scheduled_probability
+
+model_dir = os.path.join(ROOT_DIR, MODELS_DIR)
+model = load_delay_model(model_dir)
+feature_plan = load_feature_plan(os.path.join(model_dir, 'best_features.pkl'))
+now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE)
+
+# Queries on the routes and stops of the schedule over the next 2 days
+rng = np.random.default_rng(0)
+trip_results, weather_results = [], []
+for key_index in rng.choice(len(schedule_index.key_route_ids), size=500, replace=False):
+  route_id, direction, stop_id = schedule_index.key_route_ids[key_index], schedule_index.key_headsigns[key_index], schedule_index.key_stop_ids[key_index]
+  chosen_time_local = (now_local + pd.Timedelta(minutes=int(rng.integers(0, 2 * 24 * 60)))).floor('min')
+  try:
+    trip_result = get_trip_info(int(route_id), direction, int(stop_id), chosen_time_local)
+  except KeyError:
+    continue
+  if trip_result:
+    arrival_time_utc = trip_result['next_arrival_time'].tz_convert('UTC')
+    trip_results.append(trip_result)
+    weather_results.append(get_weather_info(arrival_time_utc, forecast=use_forecast(arrival_time_utc, now_local)))
+
+# The expected delay is the weighted mean of the predictions with schedule_relationship_Scheduled at 1 and 0
+records = [{**weather_data, **trip_result['trip_data']} for trip_result, weather_data in zip(trip_results, weather_results)]
+expected = predict_delays(records, model, feature_plan)
+scheduled = model.predict(feature_plan.transform_records([{**record, 'schedule_relationship_Scheduled': 1} for record in records]))
+not_scheduled = model.predict(feature_plan.transform_records([{**record, 'schedule_relationship_Scheduled': 0} for record in records]))
+weighted = scheduled_probability * scheduled.astype('float64') + (1 - scheduled_probability) * not_scheduled.astype('float64')
+assert np.allclose(expected, weighted, rtol=1e-5, atol=1e-3)
+assert np.array_equal(expected, predict_delays(records, model, feature_plan))
+print(f'{len(records)} queries: expected delays match the weighted predictions and are the same on every call')
+
+# Latency of single predictions, without and with the cache
+def get_latency(prediction_cache:PredictionCache|None) -> float:
+  start = time.perf_counter()
+  for trip_result, weather_data in zip(trip_results, weather_results):
+    get_predictions([trip_result], [weather_data], model, feature_plan, prediction_cache=prediction_cache)
+  return (time.perf_counter() - start) / len(trip_results) * 1e6
+
+prediction_cache = PredictionCache()
+print(f'{"":<28}{"us/prediction":>14}')
+get_latency(None) # warm up
+print(f'{"No cache":<28}{get_latency(None):>14.1f}')
+print(f'{"Cache, first request":<28}{get_latency(prediction_cache):>14.1f}')
+print(f'{"Cache, repeated request":<28}{get_latency(prediction_cache):>14.1f}')
+print(prediction_cache.get_state())
+
+# Cached predictions are the ones the model returns (single rows go through the tree evaluator, so up to float32 rounding)
+cached = get_predictions(trip_results, weather_results, model, feature_plan, prediction_cache=prediction_cache)
+assert np.allclose(cached, expected, rtol=1e-5, atol=1e-3)
+
+# A smaller cache evicts the least recently used predictions
+small_cache = PredictionCache(max_size=100)
+get_predictions(trip_results, weather_results, model, feature_plan, prediction_cache=small_cache)
+print(small_cache.get_state())
+
+stub.shutdown()
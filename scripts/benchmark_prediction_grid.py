@@ -0,0 +1,61 @@
+import os
+import pandas as pd
+import shutil
+import tempfile
+import time
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR, LOCAL_TIMEZONE, WEATHER_DB_FILE, WEATHER_ATTRIBUTES
+from src.feature_plan import load_feature_plan
+from src.inference import load_delay_model
+from src.prediction_grid import PredictionGrid, get_schedule_fingerprint, refresh_prediction_grid
+from src.trip_functions import schedule_index, scheduled_probability
+from src.weather_store import WeatherStore, FORECAST
+
+model_dir = os.path.join(ROOT_DIR, MODELS_DIR)
+model = load_delay_model(model_dir, n_threads=os.cpu_count())
+feature_plan = load_feature_plan(os.path.join(model_dir, 'best_features.pkl'))
+today = pd.Timestamp.now(tz=LOCAL_TIMEZONE).date()
+
+# Work on a copy of the weather store so the forecast can be changed
+work_path = tempfile.mkdtemp()
+shutil.copy(WEATHER_DB_FILE, os.path.join(work_path, 'weather.sqlite'))
+weather_store = WeatherStore(os.path.join(work_path, 'weather.sqlite'))
+grid_path = os.path.join(work_path, 'grid')
+
+def print_stats(name:str, stats:dict) -> None:
+  print(f'{name:<36}{stats["seconds"]:>8.2f} s{stats["rows"]:>12,} arrivals{stats["computed_rows"]:>12,} predicted')
+
+print_stats('Full build', refresh_prediction_grid(grid_path, schedule_index, weather_store, model, feature_plan, today, full=True))
+print_stats('Refresh, forecast unchanged', refresh_prediction_grid(grid_path, schedule_index, weather_store, model, feature_plan, today))
+
+# A forecast update that changes 6 hours of the third day
+changed_times = [(pd.Timestamp(today) + pd.Timedelta(days=2, hours=12 + hour)).strftime('%Y-%m-%dT%H:%M') for hour in range(6)]
+changed_weather = []
+for weather_time in changed_times:
+  weather = weather_store.get(FORECAST, weather_time)
+  if weather is not None:
+    changed_weather.append({**weather, 'temperature_2m': weather['temperature_2m'] + 5})
+weather_store.put_many(FORECAST, changed_weather)
+print_stats(f'Refresh, {len(changed_weather)} forecast hours changed', refresh_prediction_grid(grid_path, schedule_index, weather_store, model, feature_plan, today))
+
+# Lookup latency
+grid = PredictionGrid(grid_path, get_schedule_fingerprint(schedule_index), model.version, feature_plan.feature_names, scheduled_probability)
+day_key = int(today.strftime('%Y%m%d'))
+day = grid.days[day_key]
+lookups = []
+for index in range(0, len(day['arrival_index']), max(1, len(day['arrival_index']) // 1000)):
+  weather_time, weather_values = grid.weather[int(day['weather_hour'][index])]
+  trip_result = {
+    'arrival_key': (day_key, int(day['arrival_index'][index])),
+    'trip_data': {'arrivals_per_hour': int(day['arrivals_per_hour'][index]), 'schedule_relationship_Scheduled': None},
+  }
+  weather_data = {'time': weather_time, **dict(zip(WEATHER_ATTRIBUTES, weather_values))}
+  lookups.append((trip_result, weather_data))
+
+start = time.perf_counter()
+for trip_result, weather_data in lookups:
+  assert grid.lookup(trip_result, weather_data) is not None
+print(f'{"Lookup":<36}{(time.perf_counter() - start) / len(lookups) * 1e6:>8.1f} us')
+
+shutil.rmtree(work_path)
@@ -0,0 +1,201 @@
+import argparse
+from datetime import datetime, timezone
+import json
+import numpy as np
+import os
+import pandas as pd
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR, DOWNLOAD_DIR, LOCAL_TIMEZONE
+from src.synthetic_data import format_gtfs_times, train_stand_in_model, write_synthetic_gtfs
+
+parser = argparse.ArgumentParser(description='Measure the hot paths of the app on a synthetic schedule and compare them with a saved baseline')
+parser.add_argument('--data', help='data directory written by scripts/generate_synthetic_gtfs.py --model (generated in a temporary directory if missing)')
+parser.add_argument('--routes', type=int, default=60, help='routes of the generated schedule (235 for the STM size)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the generated schedule and of the queries')
+parser.add_argument('--calls', type=int, default=2000, help='timed calls of each benchmark')
+parser.add_argument('--only', nargs='+', help='benchmarks to run')
+parser.add_argument('--save', help='write the results to this JSON baseline')
+parser.add_argument('--compare', help='compare the results with this JSON baseline')
+parser.add_argument('--tolerance', type=float, default=0.25, help='relative increase of the median latency or peak memory reported as a regression')
+parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+# Benchmarks run in a separate process, started below with DATA_DIR and MODELS_DIR set to the synthetic data
+if args.run:
+  start = time.perf_counter()
+  from src.helper_functions import get_route_bearing, parse_gtfs_time
+  import src.trip_functions as trip_functions
+  startup_seconds = time.perf_counter() - start
+
+  artifacts = trip_functions.serving_artifacts
+  schedule_index = artifacts.schedule_index
+  schedule_metadata = artifacts.schedule_metadata
+  rng = np.random.default_rng(args.seed)
+
+  # Queries on random (route, direction, stop) keys, at random times of the next two weeks
+  key_codes = rng.integers(0, len(schedule_index.key_route_ids), args.calls)
+  now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE).floor('min')
+  chosen_times = now_local + pd.to_timedelta(rng.integers(0, 14 * 24 * 60, args.calls), unit='min')
+  queries = [
+    (int(schedule_index.key_route_ids[key_code]), schedule_index.key_headsigns[key_code], int(schedule_index.key_stop_ids[key_code]), chosen_time)
+    for key_code, chosen_time in zip(key_codes, chosen_times)
+  ]
+
+  # Model records: trip data from the schedule with random weather
+  weather = {
+    'cloud_cover': rng.uniform(0, 100, args.calls), 'relative_humidity_2m': rng.uniform(20, 100, args.calls),
+    'temperature_2m': rng.uniform(-25, 30, args.calls), 'wind_direction_10m': rng.uniform(0, 360, args.calls),
+    'wind_speed_10m': rng.uniform(0, 50, args.calls), 'weathercode': rng.integers(0, 4, args.calls),
+  }
+  # Trip data of the first 500 queries, or of as many as needed to find an arrival
+  trip_results = []
+  for position, query in enumerate(queries):
+    if position >= 500 and trip_results:
+      break
+    trip_result = trip_functions.get_trip_info(*query, artifacts=artifacts)
+    if trip_result:
+      trip_results.append(trip_result)
+  if not trip_results:
+    sys.exit(f'None of the {len(queries)} queries found an arrival: use more --routes or --calls, or a schedule whose calendar covers the next two weeks')
+  records = [
+    {**{attribute: values[position] for attribute, values in weather.items()}, **trip_results[position % len(trip_results)]['trip_data'], 'schedule_relationship_Scheduled': 1}
+    for position in range(args.calls)
+  ]
+  features = artifacts.feature_plan.transform_records(records)
+  batch_features = np.tile(features, (max(1, 10000 // len(features)) + 1, 1))[:10000]
+
+  # Stop times of the schedule on random service dates, as the cleaning pipeline parses them
+  stop_times_df = artifacts.tables['stop_times']
+  positions = rng.integers(0, len(stop_times_df), 10000)
+  if 'arrival_secs' in stop_times_df.columns:
+    arrival_times = format_gtfs_times(stop_times_df['arrival_secs'].to_numpy()[positions]).astype(object)
+  else:
+    arrival_times = stop_times_df['arrival_time'].to_numpy()[positions]
+  gtfs_times_df = pd.DataFrame({
+    'start_date': pd.Timestamp(now_local.date()) + pd.to_timedelta(rng.integers(0, 60, 10000), unit='D'),
+    'arrival_time': arrival_times,
+  })
+
+  coords = rng.uniform([-73.97, -73.97, 45.41, 45.41], [-73.48, -73.48, 45.70, 45.70], (args.calls, 4)).tolist()
+  stop_keys = list(schedule_metadata.stops)
+  stop_keys = [stop_keys[position] for position in rng.integers(0, len(stop_keys), args.calls)]
+
+  # Name: (function called with the position of the call, items processed per call)
+  benchmarks = {
+    'get_trip_info': (lambda i: trip_functions.get_trip_info(*queries[i], artifacts=artifacts), 1),
+    'get_stops': (lambda i: schedule_metadata.get_stops(*stop_keys[i]), 1),
+    'parse_gtfs_time_10k': (lambda i: parse_gtfs_time(gtfs_times_df, 'start_date', 'arrival_time'), len(gtfs_times_df)),
+    'transform_records_1': (lambda i: artifacts.feature_plan.transform_records(records[i:i + 1]), 1),
+    'transform_records_100': (lambda i: artifacts.feature_plan.transform_records(records[i % (len(records) - 99):i % (len(records) - 99) + 100]), 100),
+    'model_predict_1': (lambda i: artifacts.model.predict(features[i:i + 1]), 1),
+    'model_predict_10k': (lambda i: artifacts.model.predict_batch(batch_features), len(batch_features)),
+    'get_route_bearing': (lambda i: get_route_bearing(*coords[i]), 1),
+  }
+  batch_calls = {'parse_gtfs_time_10k': 50, 'model_predict_10k': 50}
+
+  results = {'startup': {'seconds': startup_seconds, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}
+  for name, (function, items) in benchmarks.items():
+    if args.only and name not in args.only:
+      continue
+    n_calls = min(args.calls, batch_calls.get(name, args.calls))
+    for i in range(min(n_calls, 20)):
+      function(i)
+
+    latencies = np.empty(n_calls, dtype='int64')
+    start = time.perf_counter()
+    for i in range(n_calls):
+      call_start = time.perf_counter_ns()
+      function(i)
+      latencies[i] = time.perf_counter_ns() - call_start
+    total_seconds = time.perf_counter() - start
+
+    # Memory allocated by the calls (Python objects and NumPy arrays), measured apart from the timings
+    tracemalloc.start()
+    for i in range(min(n_calls, 100)):
+      function(i)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(latencies / 1000, [50, 95, 99])
+    results[name] = {
+      'calls': n_calls, 'p50_us': p50, 'p95_us': p95, 'p99_us': p99,
+      'throughput': n_calls * items / total_seconds, 'peak_kb': peak_bytes / 1024,
+    }
+
+  results['startup']['end_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  print(json.dumps(results))
+  sys.exit()
+
+work_path = None
+data_path = args.data
+if data_path is None:
+  work_path = tempfile.mkdtemp()
+  data_path = os.path.join(work_path, 'data')
+  print(f'Generating a schedule of {args.routes} routes')
+  rows = write_synthetic_gtfs(data_path, n_routes=args.routes, seed=args.seed, start_date=pd.Timestamp.now().strftime('%Y%m01'))
+  train_stand_in_model(os.path.join(data_path, MODELS_DIR), seed=args.seed)
+else:
+  rows = {'stop_times': len(pd.read_csv(os.path.join(data_path, DOWNLOAD_DIR, 'stop_times.txt'), usecols=['trip_id']))}
+
+try:
+  env = dict(os.environ, DATA_DIR=os.path.abspath(data_path), MODELS_DIR=os.path.abspath(os.path.join(data_path, MODELS_DIR)), WEATHER_REFRESH_INTERVAL='0')
+  command = [sys.executable, __file__, '--run', '--seed', str(args.seed), '--calls', str(args.calls)] + (['--only', *args.only] if args.only else [])
+  completed = subprocess.run(command, env=env, cwd=ROOT_DIR, capture_output=True, text=True)
+  if completed.returncode:
+    sys.exit(completed.stderr.strip() or f'The benchmarks failed with exit status {completed.returncode}')
+  results = json.loads(completed.stdout.strip().splitlines()[-1])
+finally:
+  if work_path:
+    shutil.rmtree(work_path)
+
+startup = results.pop('startup')
+print(f'Schedule of {rows["stop_times"]:,} stop times: startup {startup["seconds"]:.1f} s, {startup["max_rss_mb"]:.0f} MB RSS ({startup["end_rss_mb"]:.0f} MB at the end)')
+print(f'{"benchmark":<24}{"p50 us":>10}{"p95 us":>10}{"p99 us":>10}{"items/s":>14}{"peak KB":>10}')
+for name, result in results.items():
+  print(f'{name:<24}{result["p50_us"]:>10.1f}{result["p95_us"]:>10.1f}{result["p99_us"]:>10.1f}{result["throughput"]:>14,.0f}{result["peak_kb"]:>10.1f}')
+
+baseline = {
+  'created_at': datetime.now(timezone.utc).isoformat(),
+  'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+  'schedule': {'routes': args.routes if args.data is None else None, 'stop_times': rows['stop_times'], 'seed': args.seed},
+  'startup': startup,
+  'results': results,
+}
+
+regressions = []
+if args.compare:
+  with open(args.compare) as f:
+    previous = json.load(f)
+  if previous['schedule'] != baseline['schedule'] or previous['machine'] != baseline['machine']:
+    print(f'The baseline was measured on another schedule or machine: {previous["schedule"]}, {previous["machine"]}')
+
+  print(f'\nCompared with {args.compare} ({previous["created_at"]}), tolerance {args.tolerance:.0%}:')
+  print(f'{"benchmark":<24}{"p50 us":>10}{"was":>10}{"change":>9}{"peak KB":>10}{"was":>10}')
+  for name, result in results.items():
+    if name not in previous['results']:
+      continue
+    was = previous['results'][name]
+    latency_change = result['p50_us'] / was['p50_us'] - 1
+    memory_change = result['peak_kb'] / was['peak_kb'] - 1 if was['peak_kb'] else 0
+    flags = [label for label, change in [('latency', latency_change), ('memory', memory_change)] if change > args.tolerance]
+    regressions += [f'{name} {label}' for label in flags]
+    print(f'{name:<24}{result["p50_us"]:>10.1f}{was["p50_us"]:>10.1f}{latency_change:>+9.0%}{result["peak_kb"]:>10.1f}{was["peak_kb"]:>10.1f}'
+          f'  {"REGRESSION " + ", ".join(flags) if flags else ""}')
+
+if args.save:
+  with open(args.save, 'w') as f:
+    json.dump(baseline, f, indent=2)
+  print(f'Baseline saved in {args.save}')
+
+if regressions:
+  print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+  sys.exit(1)
@@ -0,0 +1,80 @@
+import argparse
+import joblib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR
+from src.synthetic_data import write_synthetic_preprocessed
+
+models_path = os.path.join(ROOT_DIR, MODELS_DIR)
+
+parser = argparse.ArgumentParser(description='Compare the peak memory of the streamed training with the in-memory training of the modeling notebook, by data size')
+parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 2000000, 4000000], help='rows of the synthetic preprocessed datasets')
+parser.add_argument('--days', type=int, default=30, help='service date partitions of each dataset')
+parser.add_argument('--rounds', type=int, default=20, help='boosting rounds of each training')
+parser.add_argument('--modes', nargs='+', choices=['notebook', 'streamed', 'external'], default=['notebook', 'streamed', 'external'])
+parser.add_argument('--run', nargs=2, metavar=('MODE', 'DATA'), help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+# Each training runs in its own process, so that its peak memory is measured alone
+if args.run:
+  mode, data_path = args.run
+  from src.cleaning_pipeline import get_peak_rss
+  from src.feature_plan import load_feature_plan
+  feature_plan = load_feature_plan(os.path.join(models_path, 'best_features.pkl'))
+  hyperparams = joblib.load(os.path.join(models_path, 'best_hyperparams.pkl'))
+  start = time.perf_counter()
+
+  if mode == 'notebook':
+    import pandas as pd
+    from sklearn.model_selection import train_test_split
+    import xgboost as xgb
+
+    # Steps of the modeling notebook, with only the selected features computed
+    df = pd.read_parquet(data_path)
+    df['delay_quantile'] = pd.qcut(df['delay'], q=10, labels=False, duplicates='drop')
+    df_train, df_temp = train_test_split(df, test_size=0.2, stratify=df['delay_quantile'], random_state=42)
+    df_val, df_test = train_test_split(df_temp, test_size=0.5, stratify=df_temp['delay_quantile'], random_state=42)
+    dtrain = xgb.DMatrix(feature_plan.transform_frame(df_train), df_train['delay'])
+    dval = xgb.DMatrix(feature_plan.transform_frame(df_val), df_val['delay'])
+    params = {**hyperparams, 'objective': 'reg:squarederror', 'tree_method': 'hist', 'seed': 42}
+    xgb.train(params, dtrain, num_boost_round=args.rounds, evals=[(dtrain, 'train'), (dval, 'validation')], verbose_eval=False)
+  else:
+    from src.training import train_model
+    model_dir = tempfile.mkdtemp()
+    try:
+      train_model(data_path, model_dir, feature_plan, hyperparams, num_boost_round=args.rounds, early_stopping_rounds=args.rounds,
+                  external_memory=mode == 'external', cache_dir=os.path.join(model_dir, 'cache'), verbose_eval=False)
+    finally:
+      shutil.rmtree(model_dir)
+
+  print(json.dumps({'seconds': time.perf_counter() - start, 'peak_mb': get_peak_rss()}))
+  sys.exit()
+
+work_path = tempfile.mkdtemp()
+try:
+  print(f'{"rows":>12}{"Parquet MB":>12}' + ''.join(f'{mode + " MB":>16}{"s":>8}' for mode in args.modes))
+  for n_rows in args.rows:
+    data_path = os.path.join(work_path, f'preprocessed_{n_rows}')
+    write_synthetic_preprocessed(data_path, n_rows, n_days=args.days)
+    data_mb = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(data_path) for name in names) / 2**20
+
+    line = f'{n_rows:>12,}{data_mb:>12.0f}'
+    for mode in args.modes:
+      completed = subprocess.run([sys.executable, __file__, '--rounds', str(args.rounds), '--run', mode, data_path],
+                                 cwd=ROOT_DIR, capture_output=True, text=True)
+      if completed.returncode:
+        line += f'{"failed":>16}{"":>8}'
+        continue
+      result = json.loads(completed.stdout.strip().splitlines()[-1])
+      line += f'{result["peak_mb"]:>16.0f}{result["seconds"]:>8.1f}'
+    print(line, flush=True)
+    shutil.rmtree(data_path)
+finally:
+  shutil.rmtree(work_path)
@@ -0,0 +1,90 @@
+import argparse
+from datetime import datetime, timezone
+from google.transit import gtfs_realtime_pb2
+import glob
+import os
+import pandas as pd
+import shutil
+import tempfile
+import time
+
+# Import custom code
+from src.helper_functions import export_to_csv
+from src.trip_update_collector import TripUpdateChanges, TripUpdateCollector, replay_snapshots
+
+parser = argparse.ArgumentParser(description='Replay saved trip update snapshots with the CSV cron job and the Parquet collector')
+parser.add_argument('snapshot_dir', help='directory of .pb snapshots (e.g. saved with fetch_stm_trip_updates.py --collect --snapshot-dir)')
+args = parser.parse_args()
+
+snapshot_paths = sorted(glob.glob(os.path.join(args.snapshot_dir, '*.pb')))
+work_path = tempfile.mkdtemp()
+
+def get_size(path:str) -> int:
+  if os.path.isfile(path):
+    return os.path.getsize(path)
+  return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+# Previous cron job: a timestamp per stop and a CSV append per feed entity
+def legacy_export(content:bytes, csv_path:str) -> None:
+  feed = gtfs_realtime_pb2.FeedMessage()
+  feed.ParseFromString(content)
+
+  for entity in feed.entity:
+    trip = entity.trip_update.trip
+    trip_updates = []
+    for stop_time_update in entity.trip_update.stop_time_update:
+      current_time = datetime.now(timezone.utc)
+      trip_updates.append({
+          'current_time': current_time.timestamp(),
+          'trip_id': trip.trip_id,
+          'route_id': trip.route_id,
+          'start_date': trip.start_date,
+          'stop_id': stop_time_update.stop_id,
+          'arrival_time': stop_time_update.arrival.time,
+          'departure_time': stop_time_update.departure.time,
+          'schedule_relationship': stop_time_update.schedule_relationship,
+      })
+    export_to_csv(trip_updates, csv_path)
+
+csv_path = os.path.join(work_path, 'fetched_stm_trip_updates.csv')
+start = time.perf_counter()
+for snapshot_path in snapshot_paths:
+  with open(snapshot_path, 'rb') as file:
+    legacy_export(file.read(), csv_path)
+csv_seconds = time.perf_counter() - start
+
+parquet_path = os.path.join(work_path, 'trip_updates')
+start = time.perf_counter()
+stats = replay_snapshots(TripUpdateCollector(parquet_path), snapshot_paths)
+parquet_seconds = time.perf_counter() - start
+
+changes_path = os.path.join(work_path, 'trip_update_changes')
+start = time.perf_counter()
+changes_stats = replay_snapshots(TripUpdateCollector(changes_path, changes=TripUpdateChanges()), snapshot_paths, end_versions=True)
+changes_seconds = time.perf_counter() - start
+
+print(f'{len(snapshot_paths)} snapshots, {stats["updates"]:,} stop time updates')
+print(f'{"":<28}{"s/snapshot":>12}{"rows":>12}{"MB":>10}')
+print(f'{"CSV (per entity)":<28}{csv_seconds / len(snapshot_paths):>12.3f}{stats["updates"]:>12,}{get_size(csv_path) / 1e6:>10.1f}')
+print(f'{"Parquet, every poll":<28}{parquet_seconds / len(snapshot_paths):>12.3f}{stats["rows"]:>12,}{get_size(parquet_path) / 1e6:>10.1f}')
+print(f'{"Parquet, changes only":<28}{changes_seconds / len(snapshot_paths):>12.3f}{changes_stats["rows"]:>12,}{get_size(changes_path) / 1e6:>10.1f}')
+print(f'Reduction: {stats["rows"] / changes_stats["rows"]:.1f}x rows, {get_size(parquet_path) / get_size(changes_path):.1f}x bytes')
+
+# Downstream: the cleaning notebook drops the duplicates of every poll, changes are already unique
+subset = ['trip_id', 'route_id', 'start_date', 'stop_id', 'arrival_time', 'departure_time', 'schedule_relationship']
+start = time.perf_counter()
+trip_updates_df = pd.read_csv(csv_path, low_memory=False, dtype={'trip_id': str, 'route_id': str, 'start_date': str, 'stop_id': str})
+trip_updates_df = trip_updates_df.drop_duplicates(subset=subset, keep='last')
+csv_cleaning_seconds = time.perf_counter() - start
+
+start = time.perf_counter()
+changes_df = pd.read_parquet(changes_path)
+changes_seconds = time.perf_counter() - start
+print(f'Load and deduplicate: {csv_cleaning_seconds:.2f} s from the CSV, {changes_seconds:.2f} s to load the changes')
+
+# The same predictions are kept (a prediction that comes back after a change is a new row)
+versions = set(changes_df[subset].itertuples(index=False, name=None))
+assert versions == set(trip_updates_df[subset].itertuples(index=False, name=None))
+print(f'{len(versions):,} distinct predictions in both')
+
+shutil.rmtree(work_path)
@@ -0,0 +1,189 @@
+import argparse
+import gc
+import numpy as np
+import os
+import pandas as pd
+import psutil
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, DOWNLOAD_DIR, SNAPSHOT_DIR, LOCAL_TIMEZONE
+from src.gtfs_snapshot import INDEX_DIR, SNAPSHOT_TABLES, build_snapshot
+from src.helper_functions import gtfs_time_to_seconds
+
+parser = argparse.ArgumentParser(description='Compare the memory of N serving workers that each build the schedule index with N workers forked from a preloaded app')
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16], help='worker counts')
+parser.add_argument('--scale', type=int, default=6, help='copies of the trips in the generated schedule')
+parser.add_argument('--requests', type=int, default=100, help='requests served by each worker before it is measured')
+parser.add_argument('--min-available', type=int, default=500, help='MB of available memory to keep, workers past it are not started')
+parser.add_argument('--data', help='existing scaled data directory (generated in a temporary directory if missing)')
+parser.add_argument('--serve', choices=['current', 'preload'], help=argparse.SUPPRESS)
+parser.add_argument('--count', type=int, default=1, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+def get_requests(n_requests:int, seed:int) -> list[tuple]:
+  '''Home page, stops, predictions and departures requests on random keys of the schedule index'''
+  rng = np.random.default_rng(seed)
+  schedule_index = app.bundle_reloader.artifacts.schedule_index
+  chosen_time = (pd.Timestamp.now(tz=LOCAL_TIMEZONE) + pd.Timedelta(days=1)).strftime('%Y-%m-%dT%H:%M')
+  requests = []
+  for key_code in rng.integers(0, len(schedule_index.key_route_ids), n_requests):
+    route_id = int(schedule_index.key_route_ids[key_code])
+    direction = schedule_index.key_headsigns[key_code]
+    stop_id = int(schedule_index.key_stop_ids[key_code])
+    requests += [
+      ('get', '/', None),
+      ('get', f'/get-stops?bus_line={route_id}&direction={direction}', None),
+      ('post', '/predict', {'bus_line': route_id, 'direction': direction, 'stop': stop_id, 'chosen_time': chosen_time}),
+      ('get', f'/departures?stop_id={stop_id}&time={chosen_time}', None),
+    ]
+  return requests[:n_requests]
+
+def serve_requests(seed:int) -> None:
+  client = app.app.test_client()
+  for method, url, form in get_requests(args.requests, seed):
+    response = getattr(client, method)(url, data=form)
+    assert response.status_code < 500, (url, response.status_code)
+
+def wait_for_stdin() -> None:
+  '''Tells the benchmark that the workers are ready and keeps them alive until it is done measuring'''
+  print('ready', flush=True)
+  sys.stdin.read()
+
+# Worker processes, started by the benchmark below
+if args.serve == 'current':
+  # As before: every worker imports the app and builds its own schedule index
+  import app
+  serve_requests(os.getpid())
+  wait_for_stdin()
+  sys.exit()
+
+if args.serve == 'preload':
+  # As gunicorn.conf.py: import and warm up once, freeze, then fork the workers
+  import app
+  app.warm_up()
+  gc.freeze()
+  ready_read, ready_write = os.pipe()
+  pids = []
+  for worker in range(args.count):
+    pid = os.fork()
+    if pid == 0:
+      serve_requests(worker)
+      os.write(ready_write, b'1')
+      signal.pause() # until the master stops it
+    pids.append(pid)
+
+  # Wait until every worker served its requests
+  for _ in pids:
+    os.read(ready_read, 1)
+  print(' '.join(map(str, pids)), flush=True)
+  wait_for_stdin()
+  for pid in pids:
+    os.kill(pid, 9)
+    os.waitpid(pid, 0)
+  sys.exit()
+
+def write_scaled_schedule(data_path:str) -> None:
+  '''Copies the schedule with each trip repeated args.scale times, every copy a minute after the previous one'''
+  source_data_path = os.path.join(ROOT_DIR, DATA_DIR)
+  download_path = os.path.join(data_path, DOWNLOAD_DIR)
+  os.makedirs(download_path)
+  for table, (folder, file_name, _) in SNAPSHOT_TABLES.items():
+    source_path = os.path.join(source_data_path, DOWNLOAD_DIR if folder == 'download' else '', file_name)
+    shutil.copy(source_path, os.path.join(download_path if folder == 'download' else data_path, file_name))
+
+  trips_df = pd.read_csv(os.path.join(download_path, 'trips.txt'))
+  stop_times_df = pd.read_csv(os.path.join(download_path, 'stop_times.txt'))
+  trip_offset = int(trips_df['trip_id'].max()) + 1
+  arrival_secs = gtfs_time_to_seconds(stop_times_df['arrival_time'])
+
+  scaled_trips = [trips_df]
+  scaled_stop_times = [stop_times_df]
+  for copy in range(1, args.scale):
+    scaled_trips.append(trips_df.assign(trip_id=trips_df['trip_id'] + copy * trip_offset))
+    secs = arrival_secs + copy * 60
+    times = (secs // 3600).astype('str').str.zfill(2) + ':' + (secs // 60 % 60).astype('str').str.zfill(2) + ':' + (secs % 60).astype('str').str.zfill(2)
+    time_columns = {column: times for column in ['arrival_time', 'departure_time'] if column in stop_times_df}
+    scaled_stop_times.append(stop_times_df.assign(trip_id=stop_times_df['trip_id'] + copy * trip_offset, **time_columns))
+
+  pd.concat(scaled_trips).to_csv(os.path.join(download_path, 'trips.txt'), index=False)
+  pd.concat(scaled_stop_times).to_csv(os.path.join(download_path, 'stop_times.txt'), index=False)
+
+def get_memory(pid:int) -> dict:
+  memory = psutil.Process(pid).memory_full_info()
+  return {'rss': memory.rss / 2**20, 'uss': memory.uss / 2**20, 'pss': memory.pss / 2**20}
+
+def start_process(layout:str, data_path:str, count:int=1) -> subprocess.Popen:
+  env = dict(os.environ, DATA_DIR=data_path, WEATHER_REFRESH_INTERVAL='0', SERVING_PRELOAD='1' if layout == 'preload' else '0')
+  return subprocess.Popen([sys.executable, __file__, '--serve', layout, '--count', str(count), '--requests', str(args.requests)],
+                          env=env, cwd=ROOT_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+def stop_processes(processes:list[subprocess.Popen]) -> None:
+  for process in processes:
+    process.stdin.close()
+  for process in processes:
+    process.wait()
+
+def measure_current(data_path:str, n_workers:int) -> dict|None:
+  '''Starts the workers one at a time, returns None if the next one could exhaust the memory'''
+  processes = []
+  try:
+    for _ in range(n_workers):
+      if processes and psutil.virtual_memory().available / 2**20 - worker_uss < args.min_available:
+        return None
+      processes.append(start_process('current', data_path))
+      assert processes[-1].stdout.readline().strip() == 'ready'
+      worker_uss = get_memory(processes[-1].pid)['uss']
+
+    workers = [get_memory(process.pid) for process in processes]
+    return {'workers': workers, 'master': None}
+  finally:
+    stop_processes(processes)
+
+def measure_preload(data_path:str, n_workers:int) -> dict:
+  process = start_process('preload', data_path, n_workers)
+  try:
+    pids = [int(pid) for pid in process.stdout.readline().split()]
+    assert process.stdout.readline().strip() == 'ready'
+    return {'workers': [get_memory(pid) for pid in pids], 'master': get_memory(process.pid)}
+  finally:
+    stop_processes([process])
+
+work_path = None
+data_path = args.data
+if data_path is None:
+  work_path = tempfile.mkdtemp()
+  data_path = os.path.join(work_path, 'data')
+  write_scaled_schedule(data_path)
+
+# Preloaded workers map the index saved with the snapshot, the current ones build it from the tables
+start = time.perf_counter()
+build_snapshot(os.path.join(data_path, DOWNLOAD_DIR), data_path, os.path.join(data_path, SNAPSHOT_DIR))
+stop_times_rows = len(pd.read_csv(os.path.join(data_path, DOWNLOAD_DIR, 'stop_times.txt'), usecols=['trip_id']))
+print(f'Schedule of {stop_times_rows:,} stop times, snapshot and index built in {time.perf_counter() - start:.1f} s')
+current_data_path = f'{data_path}_current'
+shutil.rmtree(current_data_path, ignore_errors=True)
+shutil.copytree(data_path, current_data_path, copy_function=os.link)
+shutil.rmtree(os.path.join(current_data_path, SNAPSHOT_DIR, INDEX_DIR))
+
+print(f'{"layout":>8}{"workers":>9}{"RSS/worker":>12}{"USS/worker":>12}{"PSS/worker":>12}{"master PSS":>12}{"total PSS":>11}{"sum RSS":>10}  (MB)')
+for n_workers in args.workers:
+  for layout in ['current', 'preload']:
+    result = measure_current(current_data_path, n_workers) if layout == 'current' else measure_preload(data_path, n_workers)
+    if result is None:
+      print(f'{layout:>8}{n_workers:>9}  skipped, fewer than {args.min_available} MB would be left')
+      continue
+
+    workers_df = pd.DataFrame(result['workers'])
+    master_pss = result['master']['pss'] if result['master'] else 0
+    print(f'{layout:>8}{n_workers:>9}{workers_df["rss"].mean():>12.0f}{workers_df["uss"].mean():>12.0f}{workers_df["pss"].mean():>12.0f}'
+          f'{master_pss:>12.0f}{workers_df["pss"].sum() + master_pss:>11.0f}{workers_df["rss"].sum():>10.0f}')
+
+shutil.rmtree(current_data_path)
+if work_path:
+  shutil.rmtree(work_path)
@@ -0,0 +1,34 @@
+import argparse
+import os
+
+# Import custom code
+from src.artifact_bundle import build_bundle, prune_bundles, publish_bundle, read_current_version, verify_bundle
+from src.constants import ROOT_DIR, DATA_DIR, DOWNLOAD_DIR, MODELS_DIR, BUNDLES_DIR
+
+data_path = os.path.join(ROOT_DIR, DATA_DIR)
+bundles_path = os.path.join(data_path, BUNDLES_DIR)
+
+parser = argparse.ArgumentParser(description='Build a versioned bundle of the schedule and model, and publish it to the serving processes')
+parser.add_argument('--version', help='name of the new version (default: the UTC build time)')
+parser.add_argument('--publish', action='store_true', help='serve the new version once it is built')
+parser.add_argument('--activate', metavar='VERSION', help='publish an existing version instead of building one (e.g. to roll back)')
+parser.add_argument('--keep', type=int, default=3, help='versions kept on disk, the published one is never removed')
+args = parser.parse_args()
+
+if args.activate:
+  manifest = verify_bundle(os.path.join(bundles_path, args.activate))
+  version = args.activate
+else:
+  manifest = build_bundle(bundles_path, os.path.join(data_path, DOWNLOAD_DIR), data_path, os.path.join(ROOT_DIR, MODELS_DIR), args.version)
+  version = manifest['version']
+  print(f'Built bundle {version}: {len(manifest["files"])} files, model {manifest["model_version"]}, '
+        f'schedule {manifest["schedule"]["start"]} to {manifest["schedule"]["end"]}')
+
+# The serving processes load it within BUNDLE_RELOAD_INTERVAL seconds
+if args.publish or args.activate:
+  previous_version = read_current_version(bundles_path)
+  publish_bundle(bundles_path, version)
+  print(f'Published bundle {version} (previously {previous_version})')
+
+for removed_version in prune_bundles(bundles_path, args.keep):
+  print(f'Removed bundle {removed_version}')
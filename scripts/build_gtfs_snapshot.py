@@ -0,0 +1,14 @@
+import os
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, DOWNLOAD_DIR, SNAPSHOT_DIR
+from src.gtfs_snapshot import build_snapshot
+
+data_path = os.path.join(ROOT_DIR, DATA_DIR)
+download_path = os.path.join(data_path, DOWNLOAD_DIR)
+snapshot_path = os.path.join(data_path, SNAPSHOT_DIR)
+
+manifest = build_snapshot(download_path, data_path, snapshot_path)
+
+for table, schema in manifest['tables'].items():
+  print(f'{table}: {schema["rows"]} rows')
@@ -0,0 +1,27 @@
+import argparse
+import os
+import pandas as pd
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, LOCAL_TIMEZONE, PREDICTION_GRID_DIR, PREDICTION_GRID_DAYS
+from src.inference import load_delay_model
+from src.prediction_grid import refresh_prediction_grid
+from src.trip_functions import schedule_index, serving_artifacts, weather_store
+
+parser = argparse.ArgumentParser(description='Precompute the predictions of every scheduled arrival in the forecast window')
+parser.add_argument('--full', action='store_true', help='recompute every arrival instead of the ones whose forecast changed')
+parser.add_argument('--days', type=int, default=PREDICTION_GRID_DAYS)
+args = parser.parse_args()
+
+# Model of the published bundle (or of the models directory), as served
+model = load_delay_model(serving_artifacts.model_dir, n_threads=os.cpu_count())
+feature_plan = serving_artifacts.feature_plan
+
+# Pull the latest forecast first
+weather_store.refresh()
+
+grid_path = os.path.join(ROOT_DIR, DATA_DIR, PREDICTION_GRID_DIR)
+today = pd.Timestamp.now(tz=LOCAL_TIMEZONE).date()
+stats = refresh_prediction_grid(grid_path, schedule_index, weather_store, model, feature_plan, today, n_days=args.days, full=args.full)
+
+print(f'{stats["days"]} days | {stats["rows"]:,} arrivals | {stats["computed_rows"]:,} predicted | {stats["changed_hours"]} forecast hours changed | {stats["seconds"]:.2f} s')
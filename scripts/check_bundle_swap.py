@@ -0,0 +1,108 @@
+import argparse
+import os
+import pandas as pd
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, DOWNLOAD_DIR, MODELS_DIR, BUNDLES_DIR, SNAPSHOT_DIR, PREDICTION_GRID_DIR, LOCAL_TIMEZONE
+
+parser = argparse.ArgumentParser(description='Swap artifact bundles under load in a copy of the data directory')
+parser.add_argument('--threads', type=int, default=4, help='threads sending requests during the swaps')
+parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.serve:
+  import app
+  from src.artifact_bundle import build_bundle, publish_bundle
+
+  data_path = os.path.join(ROOT_DIR, DATA_DIR)
+  bundles_path = os.path.join(data_path, BUNDLES_DIR)
+  download_path = os.path.join(data_path, DOWNLOAD_DIR)
+  model_dir = os.path.join(ROOT_DIR, MODELS_DIR)
+  reloader = app.bundle_reloader
+  client = app.app.test_client()
+  assert reloader.artifacts.version == 'v1', reloader.artifacts.version
+  schedule_index = reloader.artifacts.schedule_index
+  query = {'bus_line': int(schedule_index.key_route_ids[0]), 'direction': schedule_index.key_headsigns[0], 'stop': int(schedule_index.key_stop_ids[0])}
+
+  # Requests keep arriving while the next versions are loaded and swapped in
+  responses = []
+  stop_event = threading.Event()
+  def send_requests() -> None:
+    thread_client = app.app.test_client()
+    while not stop_event.is_set():
+      chosen_time = (pd.Timestamp.now(tz=LOCAL_TIMEZONE) + pd.Timedelta(hours=2)).strftime('%Y-%m-%dT%H:%M')
+      response = thread_client.post('/predict', data={**query, 'chosen_time': chosen_time})
+      responses.append((response.status_code, response.headers.get('X-Artifact-Version')))
+
+  threads = [threading.Thread(target=send_requests) for _ in range(args.threads)]
+  for thread in threads:
+    thread.start()
+
+  # The second version ends its schedule a week later
+  calendar_path = os.path.join(download_path, 'calendar.txt')
+  calendar_df = pd.read_csv(calendar_path)
+  calendar_df['end_date'] = (pd.to_datetime(calendar_df['end_date'].astype(str)) + pd.Timedelta(days=7)).dt.strftime('%Y%m%d').astype(int)
+  calendar_df.to_csv(calendar_path, index=False)
+  build_bundle(bundles_path, download_path, data_path, model_dir, 'v2')
+
+  previous_artifacts = reloader.artifacts
+  publish_bundle(bundles_path, 'v2')
+  reloader.reload_if_changed(force=True, wait=True)
+  assert reloader.artifacts.version == 'v2' and reloader.stats['swaps'] == 1
+  assert reloader.artifacts.schedule_end == previous_artifacts.schedule_end + pd.Timedelta(days=7)
+  home_page = client.get('/').data.decode()
+  assert reloader.artifacts.schedule_end.strftime('%Y-%m-%dT%H:%M') in home_page
+  print(f'v2 swapped in: the schedule now ends at {reloader.artifacts.schedule_end}, as the home page shows')
+
+  # A request that started on v1 finishes on it
+  trip_result = app.get_trip_info(query['bus_line'], query['direction'], query['stop'], pd.Timestamp.now(tz=LOCAL_TIMEZONE), artifacts=previous_artifacts)
+  assert trip_result and previous_artifacts.schedule_index is not reloader.artifacts.schedule_index
+
+  # A bundle whose files changed after it was built is not swapped in
+  build_bundle(bundles_path, download_path, data_path, model_dir, 'v3')
+  with open(os.path.join(bundles_path, 'v3', 'model', 'min_time.pkl'), 'ab') as f:
+    f.write(b'\0')
+  try:
+    publish_bundle(bundles_path, 'v3')
+    raise AssertionError('v3 was published')
+  except ValueError as e:
+    print(f'v3 was not published: {e}')
+
+  with open(os.path.join(bundles_path, 'CURRENT'), 'w') as f:
+    f.write('v3')
+  reloader.reload_if_changed(force=True, wait=True)
+  assert reloader.artifacts.version == 'v2' and reloader.stats['errors'] == 1
+
+  # Back to v1
+  publish_bundle(bundles_path, 'v1')
+  reloader.reload_if_changed(force=True, wait=True)
+  assert reloader.artifacts.version == 'v1'
+
+  stop_event.set()
+  for thread in threads:
+    thread.join()
+  statuses = pd.DataFrame(responses, columns=['status', 'version']).value_counts().sort_index()
+  print(f'{len(responses)} requests during the swaps:')
+  print(statuses.to_string())
+  assert set(status for status, _ in statuses.index) <= {200, 404}
+  print('State:', client.get('/health').get_json()['artifacts'])
+  sys.exit()
+
+# Serve from a copy of the data directory, with v1 built from the current files and published
+work_path = tempfile.mkdtemp()
+data_path = os.path.join(work_path, 'data')
+source_data_path = os.path.join(ROOT_DIR, DATA_DIR)
+shutil.copytree(source_data_path, data_path, ignore=shutil.ignore_patterns(SNAPSHOT_DIR, PREDICTION_GRID_DIR, BUNDLES_DIR, 'weather.sqlite*'))
+shutil.copy(os.path.join(source_data_path, 'weather.sqlite'), data_path)
+
+env = dict(os.environ, DATA_DIR=data_path, WEATHER_REFRESH_INTERVAL='0')
+subprocess.run([sys.executable, os.path.join(ROOT_DIR, 'scripts', 'build_bundle.py'), '--version', 'v1', '--publish'], env=env, check=True)
+try:
+  subprocess.run([sys.executable, __file__, '--serve', '--threads', str(args.threads)], env=env, check=True)
+finally:
+  shutil.rmtree(work_path)
@@ -0,0 +1,246 @@
+import argparse
+from datetime import date, timedelta, timezone
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+import shutil
+import tempfile
+import time
+
+# Import custom code
+from src.cleaning_pipeline import get_peak_rss, get_stop_distance, read_cleaned_data, reset_peak_rss, run_cleaning_pipeline
+from src.helper_functions import parse_gtfs_time
+from src.open_meteo_stub import get_hourly_value
+from src.trip_update_collector import TRIP_UPDATE_SCHEMA, TripUpdateCollector
+
+parser = argparse.ArgumentParser(description='Compare the cleaning pipeline with the notebook pass on synthetic data and check the incremental runs')
+parser.add_argument('--days', type=int, default=6, help='service dates of trip updates')
+parser.add_argument('--trips', type=int, default=150, help='trips per service date')
+parser.add_argument('--polls', type=int, default=8, help='polls per trip')
+parser.add_argument('--workers', type=int, default=2)
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+work_path = tempfile.mkdtemp()
+weather_attributes = ['temperature_2m', 'relative_humidity_2m', 'precipitation', 'pressure_msl', 'cloud_cover', 'wind_speed_10m', 'wind_direction_10m']
+first_date = date(2025, 3, 5)
+
+# Schedule: trips of 25 stops, some ending after midnight
+n_stops = 60
+stops_df = pd.DataFrame({
+  'stop_id': np.arange(50000, 50000 + n_stops),
+  'stop_name': [f'Stop {i}' for i in range(n_stops)],
+  'neighbourhood': None,
+  'stop_lat': 45.45 + rng.random(n_stops) * 0.15,
+  'stop_lon': -73.70 + rng.random(n_stops) * 0.2,
+  'location_type': 0,
+  'wheelchair_boarding': rng.choice([1, 2], n_stops),
+})
+routes = [10, 18, 51, 121, 355]
+headsigns = ['Nord', 'Sud', 'Est', 'Ouest']
+trips_df = pd.DataFrame({
+  'route_id': [routes[i % len(routes)] for i in range(args.trips)],
+  'service_id': 'WK',
+  'trip_id': np.arange(300000, 300000 + args.trips),
+  'trip_headsign': [f'{headsigns[i % len(headsigns)]}' for i in range(args.trips)],
+  'direction_id': [i % 2 for i in range(args.trips)],
+  'wheelchair_accessible': 1,
+})
+stop_times = []
+for trip_index, trip_id in enumerate(trips_df['trip_id']):
+  stop_ids = rng.choice(stops_df['stop_id'], 25, replace=False)
+  seconds = 5 * 3600 + trip_index * 470 + np.cumsum(rng.integers(60, 180, 25))
+  for sequence, (stop_id, second) in enumerate(zip(stop_ids, seconds), start=1):
+    gtfs_time = f'{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}'
+    stop_times.append((trip_id, gtfs_time, gtfs_time, stop_id, sequence))
+stop_times_df = pd.DataFrame(stop_times, columns=['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+route_types_df = pd.DataFrame({'route_id': routes, 'route_type': ['Day', 'All Day High Frequency', 'Rush Hour High Frequency', 'All Day High Frequency', 'Night']})
+
+schedule_dir = os.path.join(work_path, 'download')
+os.makedirs(schedule_dir)
+stop_times_df.to_csv(os.path.join(schedule_dir, 'stop_times.txt'), index=False)
+trips_df.to_csv(os.path.join(schedule_dir, 'trips.txt'), index=False)
+schedule_paths = {'stop_times': os.path.join(schedule_dir, 'stop_times.txt'), 'trips': os.path.join(schedule_dir, 'trips.txt'), 'stops': os.path.join(work_path, 'stops_cleaned.csv')}
+stops_df.to_csv(schedule_paths['stops'], index=False)
+routes_path = os.path.join(work_path, 'route_types.csv')
+route_types_df.to_csv(routes_path, index=False)
+
+def write_weather(n_days:int, offset:float=0) -> str:
+  weather_path = os.path.join(work_path, 'weather.csv')
+  rows = []
+  for day_index in range(-1, n_days + 2):
+    day = first_date + timedelta(days=day_index)
+    for hour in range(24):
+      row = {'time': f'{day.isoformat()}T{hour:02d}:00'}
+      row.update({attribute: get_hourly_value(attribute, day.toordinal(), hour) + offset for attribute in weather_attributes})
+      rows.append(row)
+  pd.DataFrame(rows).to_csv(weather_path, index=False)
+  return weather_path
+
+def add_trip_updates(collector:TripUpdateCollector, day:date) -> None:
+  '''Every poll of every trip of a service date, with the same prediction repeated over several polls'''
+  start_date = day.strftime('%Y%m%d')
+  midnight = pd.Timestamp(day, tz='Canada/Eastern').timestamp()
+  day_df = stop_times_df.merge(trips_df[['trip_id', 'route_id']], on='trip_id')
+  scheduled = midnight + day_df['arrival_time'].str.split(':', expand=True).astype('int64') @ np.array([3600, 60, 1])
+
+  tables = []
+  for poll in range(args.polls):
+    delays = rng.normal(60, 120, len(day_df)).round() * (poll // 3 + 1)
+    delays[rng.random(len(day_df)) < 0.01] = 40000 # cancelled trips
+    arrival_time = (scheduled + delays).astype('int64')
+    arrival_time[rng.random(len(day_df)) < 0.02] = 0 # unknown arrival
+    schedule_relationship = rng.choice([0, 0, 0, 0, 1, 2], len(day_df)).astype('int8')
+    poll_time = float(midnight + 4 * 3600 + poll * 60)
+    tables.append(pa.Table.from_pydict({
+      'current_time': [poll_time] * len(day_df),
+      'trip_id': day_df['trip_id'].astype(str).tolist(),
+      'route_id': day_df['route_id'].astype(str).tolist(),
+      'start_date': [start_date] * len(day_df),
+      'stop_id': day_df['stop_id'].astype(str).tolist(),
+      'arrival_time': arrival_time.tolist(),
+      'departure_time': (arrival_time * (poll % 2)).tolist(), # departure unknown on every other poll
+      'schedule_relationship': schedule_relationship.tolist(),
+      'first_seen': [poll_time] * len(day_df),
+    }, schema=TRIP_UPDATE_SCHEMA))
+    # Repeat the poll, as when the prediction did not change
+    tables.append(tables[-1].set_column(0, 'current_time', pa.array([poll_time + 30] * len(day_df))))
+  for table in tables:
+    collector.add_table(table, table['current_time'][0].as_py())
+
+def notebook_pass(trip_updates_path:str, weather_path:str) -> pd.DataFrame:
+  '''The data cleaning notebook, in one in-memory pass'''
+  schedules_df = pd.read_csv(schedule_paths['stop_times'])
+  notebook_stops_df = pd.read_csv(schedule_paths['stops'])
+  notebook_trips_df = pd.read_csv(schedule_paths['trips'])
+  trip_updates_df = pd.read_parquet(trip_updates_path).drop(['service_date', 'hour', 'first_seen'], axis=1)
+  trip_updates_df = trip_updates_df.sort_values('current_time', kind='stable').astype({'trip_id': 'int64', 'stop_id': 'int64', 'schedule_relationship': 'int64'})
+  routes_df = pd.read_csv(routes_path)
+  weather_df = pd.read_csv(weather_path)
+
+  schedules_df = schedules_df.sort_values(by=['trip_id', 'stop_sequence'])
+  total_stops = schedules_df.groupby('trip_id')['stop_id'].transform('count')
+  schedules_df['trip_progress'] = schedules_df['stop_sequence'] / total_stops
+  schedules_stops_df = pd.merge(left=schedules_df, right=notebook_stops_df, how='inner', on='stop_id')
+  schedules_stops_df = schedules_stops_df.sort_values(by=['trip_id', 'stop_sequence'])
+  schedules_stops_df['prev_lat'] = schedules_stops_df.groupby('trip_id')['stop_lat'].shift(1)
+  schedules_stops_df['prev_lon'] = schedules_stops_df.groupby('trip_id')['stop_lon'].shift(1)
+  schedules_stops_df['today'] = pd.Timestamp('2025-03-01')
+  schedules_stops_df['parsed_time'] = parse_gtfs_time(schedules_stops_df, 'today', 'arrival_time')
+  schedules_stops_df['trip_start'] = schedules_stops_df.groupby('trip_id')['parsed_time'].transform('min')
+  schedules_stops_df['trip_end'] = schedules_stops_df.groupby('trip_id')['parsed_time'].transform('max')
+  schedules_stops_df['exp_trip_duration'] = (schedules_stops_df['trip_end'] - schedules_stops_df['trip_start']) / pd.Timedelta(seconds=1)
+  stop_id_index = schedules_stops_df.columns.get_loc('stop_id')
+  first_stop_id = schedules_stops_df.groupby('trip_id')['stop_id'].transform('first')
+  last_stop_id = schedules_stops_df.groupby('trip_id')['stop_id'].transform('last')
+  schedules_stops_df.insert(stop_id_index + 1, 'first_stop_id', first_stop_id)
+  schedules_stops_df.insert(stop_id_index + 2, 'last_stop_id', last_stop_id)
+  try:
+    import geopandas as gpd
+    sch_gdf1 = gpd.GeoDataFrame(geometry=gpd.points_from_xy(schedules_stops_df['prev_lon'], schedules_stops_df['prev_lat']), crs='EPSG:4326').to_crs(epsg=3857)
+    sch_gdf2 = gpd.GeoDataFrame(geometry=gpd.points_from_xy(schedules_stops_df['stop_lon'], schedules_stops_df['stop_lat']), crs='EPSG:4326').to_crs(epsg=3857)
+    schedules_stops_df['stop_distance'] = sch_gdf1.distance(sch_gdf2).to_numpy()
+  except ImportError:
+    schedules_stops_df['stop_distance'] = get_stop_distance(schedules_stops_df['prev_lat'], schedules_stops_df['prev_lon'], schedules_stops_df['stop_lat'], schedules_stops_df['stop_lon'])
+  schedules_stops_df['stop_distance'] = schedules_stops_df['stop_distance'].fillna(0)
+  schedules_stops_df = schedules_stops_df.drop(['prev_lat', 'prev_lon', 'parsed_time', 'today', 'trip_start', 'trip_end'], axis=1)
+
+  notebook_trips_df = notebook_trips_df[['trip_id', 'route_id', 'trip_headsign', 'wheelchair_accessible']].rename(columns={'trip_headsign': 'route_direction'})
+  condition_list = [notebook_trips_df['route_direction'].str.contains(name) for name in ['Nord', 'Sud', 'Ouest', 'Est']]
+  notebook_trips_df['route_direction'] = np.select(condition_list, ['North', 'South', 'West', 'East'], default='Metro')
+  scheduled_trips_df = pd.merge(left=schedules_stops_df, right=notebook_trips_df, how='inner', on='trip_id').drop('wheelchair_accessible', axis=1)
+
+  trip_updates_df['route_id'] = trip_updates_df['route_id'].str.extract(r'(\d+)').astype('int64')
+  subset = trip_updates_df.drop('current_time', axis=1).columns
+  trip_updates_df = trip_updates_df.drop_duplicates(subset=subset, keep='last').reset_index(drop=True)
+  trip_updates_df = trip_updates_df.rename(columns={'arrival_time': 'rt_arrival_time', 'departure_time': 'rt_departure_time'})
+  merged_stm_df = pd.merge(left=trip_updates_df, right=scheduled_trips_df, how='inner', on=['trip_id', 'route_id', 'stop_id'])
+  merged_stm_df['start_date_dt'] = pd.to_datetime(merged_stm_df['start_date'], format='%Y%m%d')
+  merged_stm_df['sch_arrival_time'] = parse_gtfs_time(merged_stm_df, 'start_date_dt', 'arrival_time').dt.tz_convert(timezone.utc)
+  merged_stm_df['sch_departure_time'] = parse_gtfs_time(merged_stm_df, 'start_date_dt', 'departure_time').dt.tz_convert(timezone.utc)
+  merged_stm_df['arrival_hour'] = merged_stm_df['sch_arrival_time'].dt.floor('h')
+  merged_stm_df['arrivals_per_hour'] = merged_stm_df.groupby(['route_id', 'route_direction', 'stop_id', 'arrival_hour']).transform('size')
+  merged_stm_df['rt_arrival_time'] = pd.to_datetime(merged_stm_df['rt_arrival_time'].replace({0: np.nan}), origin='unix', unit='s', utc=True)
+  merged_stm_df['rt_departure_time'] = pd.to_datetime(merged_stm_df['rt_departure_time'].replace({0: np.nan}), origin='unix', unit='s', utc=True)
+  merged_stm_df['delay'] = (merged_stm_df['rt_arrival_time'] - merged_stm_df['sch_arrival_time']) / pd.Timedelta(seconds=1)
+  merged_stm_df['delay'] = merged_stm_df['delay'].fillna(((merged_stm_df['rt_departure_time'] - merged_stm_df['sch_departure_time']) / pd.Timedelta(seconds=1)))
+  outlier_mask = (merged_stm_df['delay'] <= merged_stm_df['exp_trip_duration'] * -0.25) | (merged_stm_df['delay'] >= merged_stm_df['exp_trip_duration'])
+  merged_stm_df = merged_stm_df[~outlier_mask].reset_index(drop=True)
+  merged_stm_df['delay'] = merged_stm_df['delay'].fillna(merged_stm_df['delay'].mean())
+  merged_stm_df = merged_stm_df.drop(['current_time', 'start_date', 'start_date_dt', 'arrival_time', 'departure_time', 'arrival_hour'], axis=1)
+
+  stm_df = pd.merge(left=merged_stm_df, right=routes_df, how='inner', on='route_id')
+  stm_df['time'] = stm_df['sch_arrival_time'].dt.round('h').dt.strftime('%Y-%m-%dT%H:%M')
+  df = pd.merge(left=stm_df, right=weather_df, how='inner', on='time').drop('time', axis=1)
+  df = df.loc[:, (df.nunique() > 1) & (df.isna().mean() < 0.5)]
+  df['wheelchair_boarding'] = (df['wheelchair_boarding'] == 1).astype('int64')
+  df['schedule_relationship'] = df['schedule_relationship'].map({0: 'Scheduled', 1: 'Skipped', 2: 'NoData'})
+  return df
+
+def assert_same_rows(df:pd.DataFrame, expected_df:pd.DataFrame) -> None:
+  assert list(df.columns) == list(expected_df.columns), (list(df.columns), list(expected_df.columns))
+  sort_columns = list(expected_df.columns)
+  df = df.sort_values(sort_columns).reset_index(drop=True)
+  expected_df = expected_df.sort_values(sort_columns).reset_index(drop=True)
+  pd.testing.assert_frame_equal(df, expected_df, check_dtype=False, check_exact=False, rtol=1e-9)
+
+def get_summary(report:dict) -> str:
+  return f'{len(report["partitions"])} cleaned, {len(report["skipped"])} skipped, {report["seconds"]:.2f} s'
+
+# Trip updates of every day but the last
+trip_updates_path = os.path.join(work_path, 'trip_updates')
+collector = TripUpdateCollector(trip_updates_path)
+for day_index in range(args.days - 1):
+  add_trip_updates(collector, first_date + timedelta(days=day_index))
+collector.close()
+weather_path = write_weather(args.days)
+output_path = os.path.join(work_path, 'cleaned')
+
+# The workers are forked before the notebook pass, so they do not share its memory
+report = run_cleaning_pipeline(trip_updates_path, schedule_paths, routes_path, weather_path, output_path, max_workers=args.workers)
+assert len(report['partitions']) == args.days - 1
+
+reset_peak_rss()
+start = time.perf_counter()
+expected_df = notebook_pass(trip_updates_path, weather_path)
+notebook_seconds = time.perf_counter() - start
+notebook_peak_mb = get_peak_rss()
+print(f'Notebook pass: {len(expected_df):,} rows, {notebook_seconds:.2f} s, peak {notebook_peak_mb:.1f} MB')
+
+assert_same_rows(read_cleaned_data(output_path), expected_df)
+peak_mb = max(stage['peak_mb'] for partition in report['partitions'] for stage in partition['stages'].values())
+print(f'Pipeline, {args.workers} workers: {get_summary(report)}, worker peak {peak_mb:.1f} MB, same rows as the notebook')
+
+# In one process, with the same output
+single_output_path = os.path.join(work_path, 'cleaned_single')
+report = run_cleaning_pipeline(trip_updates_path, schedule_paths, routes_path, weather_path, single_output_path, max_workers=1)
+assert_same_rows(read_cleaned_data(single_output_path), read_cleaned_data(output_path))
+print(f'Pipeline, 1 process: {get_summary(report)}, same rows')
+
+# Nothing changed
+report = run_cleaning_pipeline(trip_updates_path, schedule_paths, routes_path, weather_path, output_path, max_workers=args.workers)
+assert not report['partitions'] and len(report['skipped']) == args.days - 1
+print(f'Run again: {get_summary(report)}')
+
+# A new day of trip updates
+new_day = first_date + timedelta(days=args.days - 1)
+collector = TripUpdateCollector(trip_updates_path)
+add_trip_updates(collector, new_day)
+collector.close()
+report = run_cleaning_pipeline(trip_updates_path, schedule_paths, routes_path, weather_path, output_path, max_workers=args.workers)
+assert [partition['service_date'] for partition in report['partitions']] == [new_day.strftime('%Y%m%d')]
+assert_same_rows(read_cleaned_data(output_path), notebook_pass(trip_updates_path, weather_path))
+print(f'New service date: {get_summary(report)}, same rows as the notebook')
+
+# Weather revised for the last days only: the service dates joined with those hours are cleaned again
+weather_df = pd.read_csv(weather_path)
+revised_mask = weather_df['time'] >= new_day.isoformat()
+weather_df.loc[revised_mask, 'temperature_2m'] += 1
+weather_df.to_csv(weather_path, index=False)
+report = run_cleaning_pipeline(trip_updates_path, schedule_paths, routes_path, weather_path, output_path, max_workers=args.workers)
+assert len(report['partitions']) == min(3, args.days)
+assert_same_rows(read_cleaned_data(output_path), notebook_pass(trip_updates_path, weather_path))
+print(f'Revised weather: {get_summary(report)}, same rows as the notebook')
+
+shutil.rmtree(work_path)
@@ -0,0 +1,117 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR, LOCAL_TIMEZONE
+
+parser = argparse.ArgumentParser(description='Check the next arrivals and departure boards on the days of a time change against a scan of the schedule')
+parser.add_argument('--routes', type=int, default=20, help='routes of the generated schedule')
+parser.add_argument('--keys', type=int, default=300, help='(route, direction, stop) keys checked at each time')
+parser.add_argument('--stops', type=int, default=20, help='departure boards checked at each time')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+# Spring forward (2:00 -> 3:00) and fall back (2:00 -> 1:00) of 2026, with times on both sides of
+# the change (between midnight and the change too, twice for the repeated hour) and the evening
+# before, when the arrivals after midnight cross it
+TIME_CHANGES = {'2026-03-08': 'spring forward', '2026-11-01': 'fall back'}
+CHECKED_TIMES = ['-1 days +23:59:00', '00:10:00', '00:30:00', '01:30:00', '03:30:00', '08:00:00', '17:00:00', '23:30:00']
+
+# Trips start from midnight, so there are arrivals before the change
+SERVICE_HOURS = (0, 25)
+
+def get_expected_arrival(schedule_index, key_code:int, chosen_time_local:pd.Timestamp) -> pd.Timestamp|None:
+  '''First arrival of a key at or after the chosen instant, over all the arrivals of the active services'''
+  lo, hi = schedule_index.key_offsets[key_code], schedule_index.key_offsets[key_code + 1]
+  active = np.isin(schedule_index.arrival_services[lo:hi], schedule_index.get_active_services(chosen_time_local))
+  secs = pd.Series(schedule_index.arrival_secs[lo:hi][active])
+  service_dates = pd.Series(chosen_time_local.tz_localize(None).normalize(), index=secs.index)
+  arrival_times = gtfs_seconds_to_datetime(service_dates, secs)
+  arrival_times = arrival_times[arrival_times >= chosen_time_local]
+  return arrival_times.min() if len(arrival_times) else None
+
+# The checks run in a separate process, started below with DATA_DIR and MODELS_DIR set to the synthetic data
+if args.run:
+  from src.helper_functions import gtfs_seconds_to_datetime
+  from src.prediction import predict_departures
+  from src.prediction_grid import get_date_arrivals
+  from src.trip_functions import get_departures_info, get_trip_info, serving_artifacts
+
+  artifacts = serving_artifacts
+  schedule_index = artifacts.schedule_index
+  rng = np.random.default_rng(args.seed)
+  busy_stops = schedule_index.arrival_stop_ids[np.argsort(np.diff(schedule_index.stop_offsets))[::-1][:args.stops]]
+  date_arrivals = {}
+
+  for date, name in TIME_CHANGES.items():
+    chosen_times = [
+      (pd.Timestamp(date) + pd.Timedelta(checked_time)).tz_localize(LOCAL_TIMEZONE, ambiguous=first_occurrence)
+      for checked_time in CHECKED_TIMES for first_occurrence in [True, False]
+    ]
+    for chosen_time_local in sorted(set(chosen_times)):
+
+      # Next arrival of random keys, against a scan of their arrivals localized with the noon-minus-12h rule
+      n_grid_rows = 0
+      key_codes = rng.choice(len(schedule_index.key_route_ids), min(args.keys, len(schedule_index.key_route_ids)), replace=False)
+      for key_code in key_codes:
+        query = (int(schedule_index.key_route_ids[key_code]), schedule_index.key_headsigns[key_code], int(schedule_index.key_stop_ids[key_code]))
+        trip_result = get_trip_info(*query, chosen_time_local, artifacts=artifacts)
+        expected = get_expected_arrival(schedule_index, key_code, chosen_time_local)
+        found = trip_result['next_arrival_time'] if trip_result else None
+        assert found == expected, (query, str(chosen_time_local), str(found), str(expected))
+
+        # The prediction grid row of the arrival has the same features and weather hour
+        if trip_result is None:
+          continue
+        service_date, arrival_index = trip_result['arrival_key']
+        if service_date not in date_arrivals:
+          date_arrivals[service_date] = get_date_arrivals(schedule_index, pd.Timestamp(str(service_date)).date()).set_index('arrival_index')
+        if arrival_index in date_arrivals[service_date].index:
+          grid_row = date_arrivals[service_date].loc[arrival_index]
+          weather_hour = found.tz_convert('UTC').round('h').value // (3600 * 10**9)
+          grid_features = (grid_row['hist_avg_delay'], grid_row['arrivals_per_hour'], grid_row['weather_hour'])
+          live_features = (trip_result['trip_data']['hist_avg_delay'], trip_result['trip_data']['arrivals_per_hour'], weather_hour)
+          assert grid_features == live_features, (query, str(chosen_time_local), grid_features, live_features)
+          n_grid_rows += 1
+
+      # Departure boards are sorted by arrival instant (their local times repeat an hour when falling back) and predicted
+      n_departures = 0
+      for stop_id in busy_stops:
+        arrival_times = [trip_result['next_arrival_time'] for trip_result in get_departures_info(int(stop_id), chosen_time_local, 50, artifacts)]
+        assert arrival_times == sorted(arrival_times) and all(arrival_time >= chosen_time_local for arrival_time in arrival_times), (stop_id, str(chosen_time_local))
+        departures = predict_departures(int(stop_id), chosen_time_local, 50, artifacts.model, artifacts.feature_plan, now_local=chosen_time_local, artifacts=artifacts)
+        assert len(departures) == len(arrival_times), (stop_id, str(chosen_time_local))
+        n_departures += len(departures)
+
+      print(f'{date} ({name}) {chosen_time_local}: {len(key_codes)} next arrivals match ({n_grid_rows} in the prediction grid), {n_departures} departures on {len(busy_stops)} boards')
+  print('OK')
+  sys.exit()
+
+from src.open_meteo_stub import start_stub_server
+from src.synthetic_data import train_stand_in_model, write_synthetic_gtfs
+
+# A schedule of 2026, served with the weather of a local stub
+weather_server = start_stub_server()
+weather_url = f'http://127.0.0.1:{weather_server.server_port}'
+work_path = tempfile.mkdtemp()
+try:
+  data_path = os.path.join(work_path, 'data')
+  write_synthetic_gtfs(data_path, n_routes=args.routes, start_date='20260101', n_days=365, service_hours=SERVICE_HOURS, seed=args.seed)
+  train_stand_in_model(os.path.join(data_path, MODELS_DIR), seed=args.seed)
+
+  env = dict(
+    os.environ, DATA_DIR=data_path, MODELS_DIR=os.path.join(data_path, MODELS_DIR), LOG_FILE=os.path.join(work_path, 'app.log'),
+    OPEN_METEO_ARCHIVE_URL=f'{weather_url}/v1/archive', OPEN_METEO_FORECAST_URL=f'{weather_url}/v1/forecast', WEATHER_REFRESH_INTERVAL='0',
+  )
+  command = [sys.executable, __file__, '--run', '--keys', str(args.keys), '--stops', str(args.stops), '--seed', str(args.seed)]
+  subprocess.run(command, env=env, cwd=ROOT_DIR, check=True)
+finally:
+  weather_server.shutdown()
+  shutil.rmtree(work_path)
@@ -0,0 +1,119 @@
+import argparse
+import io
+import numpy as np
+import os
+import psutil
+import requests
+import shutil
+import tempfile
+import time
+import zipfile
+
+# Import custom code
+from src.gtfs_download import DOWNLOAD_STATE_FILE, GTFS_FILES, download_gtfs, read_download_state
+from src.stm_stub import start_stub_server
+
+parser = argparse.ArgumentParser(description='Check the conditional GTFS download against the local STM stub and compare it with the previous download')
+parser.add_argument('--shapes-mb', type=int, default=80, help='size of the shapes.txt added to the archive')
+args = parser.parse_args()
+
+def get_shapes(shapes_mb:int) -> bytes:
+  '''Random shape points, which compress about as well as the real ones'''
+  rng = np.random.default_rng(shapes_mb)
+  n_points = shapes_mb * 2**20 // 36
+  lat = 45.4 + rng.random(n_points) * 0.3
+  lon = -73.9 + rng.random(n_points) * 0.4
+  rows = np.char.add(np.char.add(np.char.mod('%.6f,', lat), np.char.mod('%.6f', lon)), ',1\n')
+  return b'shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n' + ''.join(np.char.add('1,', rows)).encode()
+
+def get_large_gtfs_zip(gtfs_zip:bytes, shapes_mb:int, drop:str|None=None) -> bytes:
+  '''The stub archive with a large shapes.txt, as in the STM archive, and optionally without one of its files'''
+  shapes = get_shapes(shapes_mb)
+  buffer = io.BytesIO()
+  with zipfile.ZipFile(io.BytesIO(gtfs_zip)) as source, zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as target:
+    for info in source.infolist():
+      if info.filename not in ['shapes.txt', drop]:
+        target.writestr(info.filename, source.read(info))
+    target.writestr('shapes.txt', shapes)
+  return buffer.getvalue()
+
+def download_previous(url:str, dest_folder:str) -> None:
+  '''The previous download script: 8 KB chunks synced one by one, every member extracted, then the extra files deleted'''
+  os.makedirs(dest_folder, exist_ok=True)
+  zip_file_path = os.path.join(dest_folder, os.path.basename(url))
+  response = requests.get(url, stream=True)
+  with open(zip_file_path, 'wb') as f:
+    for chunk in response.iter_content(chunk_size=1024*8):
+      if chunk:
+        f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+  with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+    zip_ref.extractall(dest_folder)
+  os.remove(zip_file_path)
+  for file_name in os.listdir(dest_folder):
+    if file_name.removesuffix('.txt') not in GTFS_FILES:
+      os.remove(os.path.join(dest_folder, file_name))
+
+def measure(function, *args) -> tuple:
+  '''Runs function, returns its result, its duration and the bytes it wrote'''
+  start_chars = psutil.Process().io_counters().write_chars
+  start = time.perf_counter()
+  result = function(*args)
+  return result, time.perf_counter() - start, (psutil.Process().io_counters().write_chars - start_chars) / 2**20
+
+server = start_stub_server()
+server.gtfs_zip = get_large_gtfs_zip(server.gtfs_zip, args.shapes_mb)
+url = f'http://127.0.0.1:{server.server_port}/gtfs_stm.zip'
+work_path = tempfile.mkdtemp()
+download_path = os.path.join(work_path, 'download')
+expected_files = sorted([DOWNLOAD_STATE_FILE] + [f'{name}.txt' for name in GTFS_FILES])
+print(f'Archive of {len(server.gtfs_zip) / 2**20:.1f} MB with a {args.shapes_mb} MB shapes.txt')
+
+try:
+  _, previous_seconds, previous_mb = measure(download_previous, url, os.path.join(work_path, 'previous'))
+  print(f'{"":<24}{"seconds":>9}{"MB written":>12}')
+  print(f'{"previous download":<24}{previous_seconds:>9.2f}{previous_mb:>12.1f}')
+
+  # First download: extracted, with the validators of the archive saved
+  updated, seconds, written_mb = measure(download_gtfs, url, download_path)
+  print(f'{"first download":<24}{seconds:>9.2f}{written_mb:>12.1f}')
+  assert updated and sorted(os.listdir(download_path)) == expected_files
+  assert not os.path.exists(os.path.join(work_path, 'gtfs_stm.zip'))
+  state = read_download_state(download_path)
+  assert state['etag'] and state['last_modified'] and state['size'] == len(server.gtfs_zip)
+
+  # Same archive: the server answers 304 and nothing is written
+  updated, seconds, written_mb = measure(download_gtfs, url, download_path)
+  print(f'{"not modified (304)":<24}{seconds:>9.2f}{written_mb:>12.1f}')
+  assert not updated and server.not_modified_count == 1
+
+  # Same archive from a server without validators: downloaded, but not extracted again
+  server.gtfs_validators = False
+  extracted_at = os.stat(os.path.join(download_path, 'stop_times.txt')).st_mtime_ns
+  updated, seconds, written_mb = measure(download_gtfs, url, download_path)
+  print(f'{"same checksum":<24}{seconds:>9.2f}{written_mb:>12.1f}')
+  assert not updated and os.stat(os.path.join(download_path, 'stop_times.txt')).st_mtime_ns == extracted_at
+
+  # A new archive is extracted in place of the previous files
+  server.gtfs_validators = True
+  server.gtfs_zip = get_large_gtfs_zip(server.gtfs_zip, args.shapes_mb + 1)
+  server.gtfs_modified = time.time() + 1
+  updated, seconds, written_mb = measure(download_gtfs, url, download_path)
+  print(f'{"new archive":<24}{seconds:>9.2f}{written_mb:>12.1f}')
+  assert updated and read_download_state(download_path)['size'] == len(server.gtfs_zip)
+  assert sorted(os.listdir(download_path)) == expected_files and not os.path.exists(f'{download_path}.tmp')
+
+  # An archive missing a file used by the app leaves the extracted files as they were
+  server.gtfs_zip = get_large_gtfs_zip(server.gtfs_zip, 1, drop='calendar.txt')
+  server.gtfs_modified = time.time() + 2
+  try:
+    download_gtfs(url, download_path)
+    raise AssertionError('the incomplete archive was extracted')
+  except ValueError as e:
+    print(f'Incomplete archive rejected: {e}')
+  assert sorted(os.listdir(download_path)) == expected_files and not os.path.exists(f'{download_path}.tmp')
+  print('OK')
+finally:
+  server.shutdown()
+  shutil.rmtree(work_path)
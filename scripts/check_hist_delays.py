@@ -0,0 +1,144 @@
+import argparse
+from datetime import date, timedelta
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+import time
+
+# Import custom code
+from src.constants import LOCAL_TIMEZONE
+from src.cleaning_pipeline import read_manifest, write_manifest
+from src.hist_delays import HistDelayAggregator, HistDelayReloader, update_from_cleaned, write_hist_delays
+from src.trip_functions import schedule_index
+
+parser = argparse.ArgumentParser(description='Compare the incremental historical delays with a batch groupby on synthetic cleaned partitions')
+parser.add_argument('--days', type=int, default=20, help='cleaned service dates')
+parser.add_argument('--rows', type=int, default=200000, help='rows per service date')
+parser.add_argument('--half-life', type=float, default=7, help='days, for the decayed averages')
+args = parser.parse_args()
+
+work_path = tempfile.mkdtemp()
+cleaned_path = os.path.join(work_path, 'cleaned')
+first_date = date(2025, 3, 1)
+routes = np.array([10, 18, 51, 55, 80, 121, 139, 165, 193, 355, 360, 368])
+stop_ids = np.arange(50000, 50400)
+
+def write_partition(service_date:date, seed:int) -> pd.DataFrame:
+  '''Writes the cleaned rows of a service date and records it in the cleaning manifest, like run_cleaning_pipeline'''
+  partition_rng = np.random.default_rng(seed)
+  midnight = pd.Timestamp(service_date, tz=LOCAL_TIMEZONE)
+  df = pd.DataFrame({
+    'route_id': partition_rng.choice(routes, args.rows),
+    'stop_id': partition_rng.choice(stop_ids, args.rows),
+    'sch_arrival_time': (midnight + pd.to_timedelta(partition_rng.integers(5 * 3600, 27 * 3600, args.rows), unit='s')).tz_convert('UTC'),
+    'delay': partition_rng.normal(90, 240, args.rows).round(),
+  })
+  df.loc[partition_rng.random(args.rows) < 0.02, 'delay'] = np.nan
+
+  date_key = service_date.strftime('%Y%m%d')
+  partition_path = os.path.join(cleaned_path, f'service_date={date_key}')
+  os.makedirs(partition_path, exist_ok=True)
+  df.to_parquet(os.path.join(partition_path, 'part-0.parquet'), index=False)
+  manifest = read_manifest(cleaned_path)
+  manifest['partitions'][date_key] = {'fingerprint': f'{seed:016x}', 'rows': len(df)}
+  write_manifest(manifest, cleaned_path)
+  return df
+
+def remove_partition(date_key:str) -> None:
+  shutil.rmtree(os.path.join(cleaned_path, f'service_date={date_key}'))
+  manifest = read_manifest(cleaned_path)
+  del manifest['partitions'][date_key]
+  write_manifest(manifest, cleaned_path)
+
+def batch_groupby(partitions:dict, half_life:float|None=None) -> pd.DataFrame:
+  '''hist_avg_delays as computed by the preprocessing notebook, over every row of the partitions'''
+  df = pd.concat(partitions.values(), ignore_index=True)
+  df['hour'] = df['sch_arrival_time'].dt.tz_convert(LOCAL_TIMEZONE).dt.hour
+  df = df.dropna(subset=['delay'])
+  if not half_life:
+    return df.groupby(['route_id', 'stop_id', 'hour'])['delay'].mean().reset_index(name='hist_avg_delay')
+
+  # Weight of each delay by its age at the latest arrival
+  days = df['sch_arrival_time'].astype('int64') / (86400 * 10**9)
+  df['weight'] = np.exp(-np.log(2) * (days.max() - days) / half_life)
+  df['weighted_delay'] = df['delay'] * df['weight']
+  grouped_df = df.groupby(['route_id', 'stop_id', 'hour'])[['weighted_delay', 'weight']].sum()
+  return (grouped_df['weighted_delay'] / grouped_df['weight']).reset_index(name='hist_avg_delay')
+
+def assert_same_table(table_df:pd.DataFrame, expected_df:pd.DataFrame) -> float:
+  '''Checks that two hist_avg_delays tables have the same keys and averages, returns the largest difference'''
+  merged_df = pd.merge(table_df, expected_df, how='outer', on=['route_id', 'stop_id', 'hour'], indicator=True)
+  assert (merged_df['_merge'] == 'both').all(), merged_df['_merge'].value_counts()
+  max_difference = (merged_df['hist_avg_delay_x'] - merged_df['hist_avg_delay_y']).abs().max()
+  assert max_difference < 1e-6, max_difference
+  return max_difference
+
+state_path = os.path.join(work_path, 'state')
+decayed_state_path = os.path.join(work_path, 'decayed_state')
+partitions = {}
+
+# Add the service dates one at a time, loading the saved state as a separate run would
+update_seconds = []
+for day_index in range(args.days):
+  service_date = first_date + timedelta(days=day_index)
+  partitions[service_date.strftime('%Y%m%d')] = write_partition(service_date, day_index)
+  for path, half_life in [(state_path, None), (decayed_state_path, args.half_life)]:
+    aggregator = HistDelayAggregator.load(path, half_life)
+    report = update_from_cleaned(aggregator, path, cleaned_path)
+    assert report['added'] == [service_date.strftime('%Y%m%d')] and not report['replaced']
+    if half_life is None:
+      update_seconds.append(report['seconds'])
+
+aggregator = HistDelayAggregator.load(state_path, None)
+decayed_aggregator = HistDelayAggregator.load(decayed_state_path, args.half_life)
+start = time.perf_counter()
+expected_df = batch_groupby(partitions)
+groupby_seconds = time.perf_counter() - start
+difference = assert_same_table(aggregator.get_table(), expected_df)
+print(f'{args.days} service dates, {len(aggregator):,} keys: same averages as the batch groupby (max difference {difference:.1e})')
+print(f'Update with one new service date: {np.median(update_seconds):.3f} s (median), batch groupby over all of them: {groupby_seconds:.3f} s')
+
+difference = assert_same_table(decayed_aggregator.get_table(decayed=True), batch_groupby(partitions, args.half_life))
+assert_same_table(decayed_aggregator.get_table(), expected_df)
+print(f'Half-life of {args.half_life:g} days: same decayed averages as the weighted groupby (max difference {difference:.1e})')
+
+# A service date cleaned again replaces its previous rows, a removed one is subtracted
+replaced_key = (first_date + timedelta(days=args.days // 2)).strftime('%Y%m%d')
+partitions[replaced_key] = write_partition(first_date + timedelta(days=args.days // 2), 1000)
+removed_key = first_date.strftime('%Y%m%d')
+remove_partition(removed_key)
+del partitions[removed_key]
+
+for path, half_life in [(state_path, None), (decayed_state_path, args.half_life)]:
+  aggregator = HistDelayAggregator.load(path, half_life)
+  report = update_from_cleaned(aggregator, path, cleaned_path)
+  assert report['replaced'] == [replaced_key] and report['removed'] == [removed_key] and not report['added']
+  assert_same_table(aggregator.get_table(), batch_groupby(partitions))
+  if half_life:
+    assert_same_table(aggregator.get_table(decayed=True), batch_groupby(partitions, half_life))
+  assert len(os.listdir(os.path.join(path, 'sources'))) == len(partitions)
+
+  # Nothing changed since the last update
+  report = update_from_cleaned(HistDelayAggregator.load(path, half_life), path, cleaned_path)
+  assert not report['added'] and not report['replaced'] and not report['removed']
+print('Replaced and removed service dates: same averages as the batch groupby')
+
+# The serving process picks up a published table without a restart
+csv_path = os.path.join(work_path, 'hist_avg_delays.csv')
+reloader = HistDelayReloader(csv_path, schedule_index, reload_interval=0)
+hist_delays_df = pd.DataFrame({'route_id': [10, 10], 'stop_id': [52760, 52760], 'hour': [8, 9], 'hist_avg_delay': [123.0, 456.0]})
+write_hist_delays(hist_delays_df, csv_path)
+reloader.reload_if_changed()
+assert schedule_index.get_hist_avg_delay(10, 52760, 8) == 123.0 and len(schedule_index.hist_keys) == 2
+
+hist_delays_df['hist_avg_delay'] = [321.0, 654.0]
+write_hist_delays(hist_delays_df, csv_path)
+os.utime(csv_path, ns=(time.time_ns(), time.time_ns() + 10**9)) # a newer modification time, even on coarse clocks
+reloader.reload_if_changed()
+assert schedule_index.get_hist_avg_delay(10, 52760, 8) == 321.0
+assert reloader.get_state() == {'keys': 2, 'reloads': 2, 'errors': 0}
+print('Published tables are loaded by the schedule index without a restart')
+
+shutil.rmtree(work_path)
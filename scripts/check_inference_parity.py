@@ -0,0 +1,55 @@
+import joblib
+import numpy as np
+import os
+import time
+import xgboost as xgb
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR
+from src.feature_plan import load_feature_plan
+from src.inference import get_model_paths, load_delay_model
+
+# Compare the inference engine with model.predict(DMatrix) as used before in app.py
+model_dir = os.path.join(ROOT_DIR, MODELS_DIR)
+_, pickle_path = get_model_paths(model_dir)
+reference_model = joblib.load(pickle_path)
+delay_model = load_delay_model(model_dir)
+plan = load_feature_plan(os.path.join(model_dir, 'best_features.pkl'))
+
+# Random base features, with some missing values
+rng = np.random.default_rng(42)
+n_rows = 100000
+base = np.ones((n_rows, len(plan.base_features) + 1))
+base[:, :-1] = rng.random((n_rows, len(plan.base_features))) * rng.choice([1, 10, 100, 1000], len(plan.base_features))
+base[rng.random(n_rows) < 0.01, 0] = np.nan
+features = plan.transform(base)
+
+reference = reference_model.predict(xgb.DMatrix(features, feature_names=plan.feature_names))
+single = np.concatenate([delay_model.predict(features[i:i + 1]) for i in range(1000)])
+small = delay_model.predict(features[:max(delay_model.evaluator_max_rows, 1)])
+batch = delay_model.predict(features)
+
+np.testing.assert_allclose(single, reference[:1000], rtol=1e-5, atol=1e-4)
+np.testing.assert_allclose(small, reference[:len(small)], rtol=1e-5, atol=1e-4)
+np.testing.assert_allclose(batch, reference, rtol=1e-5, atol=1e-4)
+print(f'Tree evaluator: {"enabled" if delay_model.tree_evaluator else "not supported by this model"}')
+print(f'Max difference: single rows {np.abs(single - reference[:1000]).max():.2e} | batch {np.abs(batch - reference).max():.2e}')
+
+def get_latency(function, n_calls:int) -> float:
+  start = time.perf_counter()
+  for i in range(n_calls):
+    function(features[i:i + 1])
+  return (time.perf_counter() - start) / n_calls * 1e6
+
+def get_rate(function, n_rows:int) -> float:
+  start = time.perf_counter()
+  function(features[:n_rows])
+  return n_rows / (time.perf_counter() - start)
+
+print(f'{"":<36}{"1 row (us)":>12}{"rows/sec (batch)":>20}')
+for name, function in {
+  'DMatrix + model.predict': lambda x: reference_model.predict(xgb.DMatrix(x, feature_names=plan.feature_names)),
+  'inplace_predict': delay_model.predict_batch,
+  'DelayModel.predict': delay_model.predict,
+}.items():
+  print(f'{name:<36}{get_latency(function, 2000):>12.1f}{get_rate(function, n_rows):>20,.0f}')
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import httpx
+import os
+import pandas as pd
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Import custom code
+from src import open_meteo_stub, stm_stub
+
+parser = argparse.ArgumentParser(description='Run the ingestion jobs against local stub servers and report their metrics')
+parser.add_argument('--seconds', type=float, default=30, help='how long to run the scheduler')
+parser.add_argument('--failure-rate', type=float, default=0.2, help='fraction of stub requests answered with HTTP 503')
+parser.add_argument('--latency', type=float, default=0.05, help='stub response delay (seconds)')
+parser.add_argument('--polls', type=int, default=10, help='polls for the cron comparison')
+args = parser.parse_args()
+
+stm_server = stm_stub.start_stub_server(latency=args.latency, failure_rate=args.failure_rate)
+weather_server = open_meteo_stub.start_stub_server(latency=args.latency, failure_rate=args.failure_rate)
+stm_url = f'http://127.0.0.1:{stm_server.server_port}'
+
+# The weather URL is read by src.constants at import
+os.environ['OPEN_METEO_ARCHIVE_URL'] = f'http://127.0.0.1:{weather_server.server_port}/v1/archive'
+from src.constants import ROOT_DIR
+from src.ingestion import (
+  IngestionJob, IngestionScheduler, get_trip_updates_job, get_historical_weather_job, get_schedule_job,
+  get_route_types_job, get_with_retries, run_job_once
+)
+from src.trip_update_collector import TripUpdateCollector
+
+work_path = tempfile.mkdtemp()
+download_path = os.path.join(work_path, 'download')
+collector = TripUpdateCollector(os.path.join(work_path, 'trip_updates'))
+
+# Short cadences, so every job runs several times (with retries on the stub failures)
+jobs = [
+  get_trip_updates_job(collector, 'key', 1, url=f'{stm_url}/tripUpdates'),
+  get_historical_weather_job(os.path.join(work_path, 'weather.csv'), 3),
+  get_schedule_job(download_path, 5, url=f'{stm_url}/gtfs_stm.zip'),
+  get_route_types_job(os.path.join(work_path, 'route_types.csv'), 5, url=f'{stm_url}/en/info/networks/bus'),
+]
+scheduler = IngestionScheduler(jobs)
+
+async def run_for(seconds:float) -> None:
+  asyncio.get_running_loop().call_later(seconds, scheduler.stop)
+  await scheduler.run(start_jitter=0.5)
+
+asyncio.run(run_for(args.seconds))
+collector.close()
+
+print(f'{args.seconds:.0f} s against the stubs ({args.failure_rate:.0%} failures, {args.latency * 1000:.0f} ms latency), {stm_server.request_count + weather_server.request_count} requests')
+print(f'{"job":<20}{"runs":>6}{"failures":>10}{"retries":>9}{"mean s":>9}{"max s":>9}')
+for name, state in scheduler.get_state().items():
+  mean_seconds = state['mean_seconds'] or 0
+  print(f'{name:<20}{state["runs"]:>6}{state["failures"]:>10}{state["retries"]:>9}{mean_seconds:>9.3f}{state["max_seconds"]:>9.3f}')
+  assert state['runs'] > 0 and state['last_success'] is not None, name
+
+# The outputs of the cron scripts
+assert sorted(os.listdir(download_path)) == ['_download_state.json', 'calendar.txt', 'routes.txt', 'stop_times.txt', 'stops.txt', 'trips.txt']
+assert stm_server.path_counts['/gtfs_stm.zip'] == 1 or stm_server.not_modified_count > 0
+route_types_df = pd.read_csv(os.path.join(work_path, 'route_types.csv'))
+assert set(route_types_df['route_type']) == {'Day', 'All Day High Frequency', 'Rush Hour High Frequency', 'Night'}
+weather_df = pd.read_csv(os.path.join(work_path, 'weather.csv'))
+assert len(weather_df) % 24 == 0 and weather_df['temperature_2m'].notna().all()
+assert collector.get_stats()['rows'] == collector.get_stats()['updates'] > 0
+print(f'Outputs: {collector.get_stats()["snapshots"]} snapshots, {len(weather_df)} weather rows, {len(route_types_df)} route types, GTFS extracted once and then {stm_server.not_modified_count} times not modified')
+
+# Client errors are not retried
+async def check_not_found() -> None:
+  job = IngestionJob('not_found', 0, None)
+  async def run(client:httpx.AsyncClient, job:IngestionJob) -> None:
+    await get_with_retries(client, f'{stm_url}/missing', job)
+  job.run = run
+  async with httpx.AsyncClient() as client:
+    assert not await run_job_once(job, client)
+  assert job.stats['retries'] == 0 and job.stats['failures'] == 1
+asyncio.run(check_not_found())
+
+# Cron-style polls (new interpreter, imports and connection every time) against polls in the service
+stm_server.failure_rate = 0
+cron_code = (
+  'import requests, sys\n'
+  'from src.trip_update_collector import parse_feed\n'
+  'parse_feed(requests.get(sys.argv[1], timeout=10).content)\n'
+)
+env = {**os.environ, 'PYTHONPATH': str(ROOT_DIR)}
+start = time.perf_counter()
+for _ in range(args.polls):
+  subprocess.run([sys.executable, '-c', cron_code, f'{stm_url}/tripUpdates'], check=True, env=env)
+cron_seconds = (time.perf_counter() - start) / args.polls
+
+async def poll_in_service() -> float:
+  poll_collector = TripUpdateCollector(os.path.join(work_path, 'poll_trip_updates'))
+  job = get_trip_updates_job(poll_collector, 'key', 0, url=f'{stm_url}/tripUpdates')
+  async with httpx.AsyncClient() as client:
+    for _ in range(args.polls):
+      await run_job_once(job, client)
+  return job.get_state()['mean_seconds']
+
+service_seconds = asyncio.run(poll_in_service())
+print(f'Poll: {cron_seconds:.3f} s as a cron process, {service_seconds:.3f} s in the service ({cron_seconds / service_seconds:.1f}x)')
+
+stm_server.shutdown()
+weather_server.shutdown()
+shutil.rmtree(work_path)
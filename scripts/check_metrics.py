@@ -0,0 +1,92 @@
+import argparse
+import os
+import pandas as pd
+import shutil
+import tempfile
+import time
+
+# Import custom code
+from src.open_meteo_stub import start_stub_server
+
+parser = argparse.ArgumentParser(description='Send requests to the app (in process, weather on a stub) and check its metrics, Server-Timing headers and profiles')
+parser.add_argument('--data', help='data directory of the app, e.g. from scripts/generate_synthetic_gtfs.py --model')
+parser.add_argument('--requests', type=int, default=200, help='/predict requests sent')
+parser.add_argument('--spans', type=int, default=100000, help='spans timed to measure their overhead')
+args = parser.parse_args()
+
+weather_server = start_stub_server()
+weather_url = f'http://127.0.0.1:{weather_server.server_port}'
+work_path = tempfile.mkdtemp()
+profile_path = os.path.join(work_path, 'profiles')
+
+# Read by src.constants when the app is imported
+os.environ.update(
+  OPEN_METEO_ARCHIVE_URL=f'{weather_url}/v1/archive', OPEN_METEO_FORECAST_URL=f'{weather_url}/v1/forecast', WEATHER_REFRESH_INTERVAL='0',
+  LOG_FILE=os.path.join(work_path, 'app.log'), PROFILE_HEADER_ENABLED='1', PROFILE_DIR=profile_path,
+)
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+if args.data:
+  os.environ['DATA_DIR'] = os.path.abspath(args.data)
+  os.environ['MODELS_DIR'] = os.path.abspath(os.path.join(args.data, 'models'))
+
+from src.constants import LOCAL_TIMEZONE
+from src.metrics import span
+import app
+
+try:
+  client = app.app.test_client()
+  artifacts = app.bundle_reloader.artifacts
+  route_id = artifacts.schedule_metadata.bus_lines[0]['route_id']
+  direction = client.post('/get-directions', json={'bus_line': route_id}).json[0]['direction_fr']
+  stops = client.post('/get-stops', json={'bus_line': route_id, 'direction': direction}).json
+  now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE).floor('min')
+
+  # Requests at different times, so that some miss the caches and the first ones call the weather stub
+  start = time.perf_counter()
+  for i in range(args.requests):
+    chosen_time = (now_local + pd.Timedelta(minutes=37 * i % (7 * 24 * 60))).strftime('%Y-%m-%dT%H:%M')
+    response = client.post('/predict', data={'bus_line': route_id, 'direction': direction, 'stop': stops[i % len(stops)]['stop_id'], 'chosen_time': chosen_time})
+    assert response.status_code == 200, response.json
+    assert 'trip_info' in response.headers['Server-Timing'], response.headers['Server-Timing']
+  print(f'{args.requests} /predict requests in {time.perf_counter() - start:.2f} s, last Server-Timing: {response.headers["Server-Timing"]}')
+
+  assert client.post('/get-stops', json={'bus_line': 'x'}).status_code == 400
+  assert client.get('/no-such-page').status_code == 404
+
+  # A profiled request writes a collapsed stack file
+  response = client.post('/predict', data={'bus_line': route_id, 'direction': direction, 'stop': stops[0]['stop_id'], 'chosen_time': now_local.strftime('%Y-%m-%dT%H:%M')},
+                         headers={'X-Profile': '1'})
+  assert response.status_code == 200
+  profiles = os.listdir(profile_path) if os.path.isdir(profile_path) else []
+  if profiles:
+    with open(os.path.join(profile_path, profiles[0])) as f:
+      lines = f.read().splitlines()
+    print(f'Profile {profiles[0]}: {len(lines)} stacks, {sum(int(line.rsplit(" ", 1)[1]) for line in lines)} samples')
+  else:
+    print('The profiled request was too short to be sampled')
+
+  metrics = client.get('/metrics').get_data(as_text=True)
+  for expected in [
+    'stm_request_seconds_bucket{endpoint="/predict"', 'stm_responses_total{endpoint="/predict",status="200"}',
+    'stm_responses_total{endpoint="/get-stops",status="400"}', 'stm_responses_total{endpoint="unmatched",status="404"}',
+    'stm_stage_seconds_count{stage="trip_info"}', 'stm_stage_seconds_count{stage="weather"}', 'stm_cache_lookups_total{cache="weather"', 'stm_cache_lookups_total{cache="prediction_grid"',
+  ]:
+    assert expected in metrics, expected
+  print('\n'.join(line for line in metrics.splitlines() if line.startswith(('stm_responses_total', 'stm_cache_lookups_total', 'stm_upstream_requests_total'))))
+
+  # Overhead of a span, against an empty context manager
+  class empty:
+    def __enter__(self): return self
+    def __exit__(self, *exc): pass
+
+  timings = {}
+  for name, context in [('empty', empty), ('span', lambda: span('overhead_check'))]:
+    start = time.perf_counter()
+    for _ in range(args.spans):
+      with context():
+        pass
+    timings[name] = (time.perf_counter() - start) / args.spans
+  print(f'Span overhead: {(timings["span"] - timings["empty"]) * 1e6:.2f} us')
+finally:
+  weather_server.shutdown()
+  shutil.rmtree(work_path)
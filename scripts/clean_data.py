@@ -0,0 +1,55 @@
+import argparse
+import os
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, API_DIR, DOWNLOAD_DIR, TRIP_UPDATES_DIR, CLEANED_DATA_DIR, CLEANING_WORKERS
+from src.cleaning_pipeline import read_cleaned_data, run_cleaning_pipeline
+from src.trip_update_collector import TripUpdateCollector, import_trip_updates_csv
+
+data_path = os.path.join(ROOT_DIR, DATA_DIR)
+
+parser = argparse.ArgumentParser(description='Clean the collected trip updates, one service date at a time (replaces notebooks/data_cleaning.ipynb)')
+parser.add_argument('--trip-updates', default=os.path.join(data_path, API_DIR, TRIP_UPDATES_DIR), help='trip updates Parquet dataset')
+parser.add_argument('--schedule-dir', default=os.path.join(data_path, DOWNLOAD_DIR), help='directory of stop_times.txt and trips.txt')
+parser.add_argument('--stops', default=os.path.join(data_path, 'stops_cleaned.csv'))
+parser.add_argument('--route-types', default=os.path.join(data_path, 'route_types.csv'))
+parser.add_argument('--weather', default=os.path.join(data_path, API_DIR, 'fetched_historical_weather.csv'))
+parser.add_argument('--output', default=os.path.join(data_path, CLEANED_DATA_DIR), help='cleaned dataset directory')
+parser.add_argument('--export', default=os.path.join(data_path, 'stm_weather_merged.parquet'), help='single file read by the preprocessing notebook ("" to skip)')
+parser.add_argument('--workers', type=int, default=CLEANING_WORKERS)
+parser.add_argument('--force', action='store_true', help='clean every service date again')
+parser.add_argument('--import-csv', metavar='CSV', help='first add the trip updates of the cron job CSV to the dataset')
+args = parser.parse_args()
+
+if args.import_csv:
+  stats = import_trip_updates_csv(args.import_csv, TripUpdateCollector(args.trip_updates))
+  print(f'Imported {stats["rows"]:,} trip updates from {args.import_csv}')
+
+schedule_paths = {
+  'stop_times': os.path.join(args.schedule_dir, 'stop_times.txt'),
+  'trips': os.path.join(args.schedule_dir, 'trips.txt'),
+  'stops': args.stops,
+}
+report = run_cleaning_pipeline(
+  args.trip_updates, schedule_paths, args.route_types, args.weather, args.output,
+  max_workers=args.workers, force=args.force,
+)
+
+# Report: seconds and peak resident memory of each stage
+print(f'{len(report["partitions"])} service dates cleaned, {len(report["skipped"])} unchanged, {report["seconds"]:.2f} s')
+print(f'{"stage":<14}{"seconds":>10}{"peak MB":>10}')
+for name, stage in report['stages'].items():
+  print(f'{name:<14}{stage["seconds"]:>10.2f}{stage["peak_mb"]:>10.1f}')
+
+stage_names = list(dict.fromkeys(name for partition in report['partitions'] for name in partition['stages']))
+if report['partitions']:
+  print(f'{"service date":<14}{"updates":>10}{"rows":>10}' + ''.join(f'{name:>12}' for name in stage_names) + f'{"peak MB":>10}')
+  for partition in report['partitions']:
+    stages = partition['stages']
+    peak_mb = max(stage['peak_mb'] for stage in stages.values())
+    print(f'{partition["service_date"]:<14}{partition["trip_updates"]:>10,}{partition["rows"]:>10,}' + ''.join(f'{stages[name]["seconds"]:>12.3f}' for name in stage_names) + f'{peak_mb:>10.1f}')
+
+if args.export:
+  df = read_cleaned_data(args.output)
+  df.to_parquet(args.export, index=False)
+  print(f'Exported {len(df):,} rows to {args.export}')
@@ -1,53 +1,23 @@
-from datetime import datetime
-from glob import glob
+import argparse
+import logging
 import os
-from pathlib import Path
-import re
-import requests
-import zipfile
 
 # Import custom code
-from src.constants import ROOT_DIR, DATA_DIR, DOWNLOAD_DIR, logger
+from src.constants import ROOT_DIR, DATA_DIR, DOWNLOAD_DIR, SNAPSHOT_DIR, STM_GTFS_URL
+from src.gtfs_download import download_gtfs
+from src.gtfs_snapshot import build_snapshot
 
-url = 'https://www.stm.info/sites/default/files/gtfs/gtfs_stm.zip'
+parser = argparse.ArgumentParser(description='Download the STM GTFS schedule if it changed, extract the files used by the app and rebuild the GTFS snapshot')
+parser.add_argument('--url', default=STM_GTFS_URL, help='GTFS archive URL')
+parser.add_argument('--no-snapshot', action='store_true', help='only download and extract the archive')
+args = parser.parse_args()
 
-current_time = datetime.now()
-current_date = current_time.strftime('%Y-%m-%d')
+data_path = os.path.join(ROOT_DIR, DATA_DIR)
+download_path = os.path.join(data_path, DOWNLOAD_DIR)
+snapshot_path = os.path.join(data_path, SNAPSHOT_DIR)
 
-dest_folder = os.path.join(ROOT_DIR, DATA_DIR, DOWNLOAD_DIR)
-zip_file_name = os.path.basename(url)
-zip_file_path = os.path.join(dest_folder, zip_file_name)
+updated = download_gtfs(args.url, download_path)
 
-response = requests.get(url, stream=True)
-
-if response.ok:
-  # Add zipfile to data folder
-  logger.info('Saving file as %s', zip_file_name)
-  with open(zip_file_path, 'wb') as f:
-    for chunk in response.iter_content(chunk_size=1024*8):	
-      if chunk:
-        f.write(chunk)
-        f.flush()
-        os.fsync(f.fileno())
-
-  # Extract archive
-  logger.info('Unzipping %s', zip_file_name)
-  with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-    zip_ref.extractall(dest_folder)
-
-  # Delete zip file
-  logger.info('Deleting %s', zip_file_path)
-  os.remove(zip_file_path)
-
-  txt_files = glob(os.path.join(dest_folder, '*.txt'))
-  txt_files = [path for path in txt_files if re.search(r'[a-z_]+\.txt', path)]
-
-  for file_path in txt_files:
-    stem = Path(file_path).stem
-    basename = os.path.basename(file_path)
-    if (stem not in ['routes', 'stops', 'stop_times', 'trips', 'calendar']):
-      logger.info('Deleting %s', basename)
-      os.remove(file_path) # Delete unrelevant text files
-
-else:
-  logger.error('Download failed: status code %s\n%s', [response.status_code, response.text])
+if updated and not args.no_snapshot:
+  logging.info('Building the GTFS snapshot in %s', snapshot_path)
+  build_snapshot(download_path, data_path, snapshot_path)
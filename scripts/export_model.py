@@ -0,0 +1,29 @@
+import joblib
+import os
+import time
+import xgboost as xgb
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR
+from src.inference import get_model_paths
+
+# Save the pickled booster in XGBoost's native format, which app.py loads first
+native_path, pickle_path = get_model_paths(os.path.join(ROOT_DIR, MODELS_DIR))
+
+booster = joblib.load(pickle_path)
+if isinstance(booster, xgb.XGBModel):
+  booster = booster.get_booster()
+booster.save_model(native_path)
+
+# Compare loading times
+start = time.perf_counter()
+joblib.load(pickle_path)
+pickle_time = time.perf_counter() - start
+
+start = time.perf_counter()
+native_booster = xgb.Booster(model_file=native_path)
+native_time = time.perf_counter() - start
+
+assert native_booster.feature_names == booster.feature_names
+print(f'Saved {native_path} ({booster.num_boosted_rounds()} trees, {len(booster.feature_names or [])} features)')
+print(f'Load time: pickle {pickle_time * 1000:.1f} ms | native {native_time * 1000:.1f} ms')
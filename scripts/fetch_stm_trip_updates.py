@@ -1,65 +1,109 @@
-from datetime import datetime, timezone
+import argparse
 from dotenv import load_dotenv
-from google.transit import gtfs_realtime_pb2
+import glob
 import logging
 import os
 import requests
+import signal
+import sys
 import time
 
 # Import custom code
-from src.constants import ROOT_DIR, DATA_DIR, API_DIR
+from src.constants import ROOT_DIR, DATA_DIR, API_DIR, TRIP_UPDATES_DIR, STM_TRIP_UPDATES_URL, TRIP_UPDATES_POLL_INTERVAL, TRIP_UPDATES_STATE_FILE
 from src.helper_functions import export_to_csv
+from src.trip_update_collector import TripUpdateChanges, TripUpdateCollector, get_trip_update_table, parse_feed, replay_snapshots
 
 csv_path = os.path.join(ROOT_DIR, DATA_DIR, API_DIR, 'fetched_stm_trip_updates.csv')
+parquet_path = os.path.join(ROOT_DIR, DATA_DIR, API_DIR, TRIP_UPDATES_DIR)
+
+parser = argparse.ArgumentParser(description='Fetch STM trip updates: once to CSV (default), continuously to Parquet, or from saved snapshots')
+parser.add_argument('--collect', action='store_true', help='poll the feed until interrupted and write partitioned Parquet')
+parser.add_argument('--replay', metavar='DIR', help='write the .pb snapshots saved in DIR as partitioned Parquet')
+parser.add_argument('--interval', type=float, default=TRIP_UPDATES_POLL_INTERVAL, help='seconds between polls with --collect')
+parser.add_argument('--snapshot-dir', help='with --collect, also save every raw snapshot in this directory')
+parser.add_argument('--output', default=parquet_path, help='Parquet dataset directory')
+parser.add_argument('--every-poll', action='store_true', help='write every stop time update of every poll instead of the predictions that changed')
+parser.add_argument('--end-versions', action='store_true', help='with --replay, also write the predictions still in the last snapshot')
+args = parser.parse_args()
 
 # API KEY
 load_dotenv()
 API_KEY = os.getenv('STM_API_KEY')
 
 # STM trip updates endpoint
-url = 'https://api.stm.info/pub/od/gtfs-rt/ic/v2/tripUpdates'
 headers = {'accept': 'application/x-protobuf', 'apiKey': API_KEY}
 
-# Do 5 attempts in case of connection timeout error
-max_retries = 5
-backoff_factor = 2
-timeout = 10
-
-for attempt in range(1, max_retries + 1):
-  try:
-    response = requests.get(url=url, headers=headers, timeout=timeout)
-    response.raise_for_status()
-    feed = gtfs_realtime_pb2.FeedMessage()
-    feed.ParseFromString(response.content)
-
-    for entity in feed.entity:
-      trip = entity.trip_update.trip
-      
-      trip_updates = []
-
-      for stop_time_update in entity.trip_update.stop_time_update:
-
-        # Get timestamp and convert to datetime
-        current_time = datetime.now(timezone.utc)
-      
-        # Store the trip update and weather data in the list
-        trip_updates.append({
-            'current_time': current_time.timestamp(),
-            'trip_id': trip.trip_id,
-            'route_id': trip.route_id,
-            'start_date': trip.start_date,
-            'stop_id': stop_time_update.stop_id,
-            'arrival_time': stop_time_update.arrival.time,
-            'departure_time': stop_time_update.departure.time,
-            'schedule_relationship': stop_time_update.schedule_relationship,
-        })
-      
-      export_to_csv(trip_updates, csv_path)
-    
-    break # exit loop if attempt is successful
-  except requests.exceptions.RequestException as e:
-    wait = backoff_factor ** attempt
-    logging.error(f'Attempt {attempt} failed: {e}. Retrying in {wait} seconds...')
-    time.sleep(wait)
-else:
+def get_collector() -> TripUpdateCollector:
+  # Keep one row per prediction, with the state saved next to the dataset
+  changes = None
+  if not args.every_poll:
+    os.makedirs(args.output, exist_ok=True)
+    changes = TripUpdateChanges(os.path.join(args.output, TRIP_UPDATES_STATE_FILE))
+  return TripUpdateCollector(args.output, changes=changes)
+
+def fetch_feed(session:requests.Session) -> bytes|None:
+  # Do 5 attempts in case of connection timeout error
+  max_retries = 5
+  backoff_factor = 2
+  timeout = 10
+
+  for attempt in range(1, max_retries + 1):
+    try:
+      response = session.get(url=STM_TRIP_UPDATES_URL, headers=headers, timeout=timeout)
+      response.raise_for_status()
+      return response.content
+    except requests.exceptions.RequestException as e:
+      wait = backoff_factor ** attempt
+      logging.error(f'Attempt {attempt} failed: {e}. Retrying in {wait} seconds...')
+      time.sleep(wait)
+
   logging.error('All retry attempts failed. Consider logging the error or alerting the system administrator.')
+  return None
+
+if args.replay:
+  collector = get_collector()
+  stats = replay_snapshots(collector, glob.glob(os.path.join(args.replay, '*.pb')), end_versions=args.end_versions)
+  print(stats)
+
+elif args.collect:
+  collector = get_collector()
+  if args.snapshot_dir:
+    os.makedirs(args.snapshot_dir, exist_ok=True)
+
+  # Write the buffered rows when the service is stopped
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  # One session, so the connection to the API is kept alive between polls
+  with requests.Session() as session:
+    try:
+      while True:
+        poll_start = time.monotonic()
+        fetched_at = time.time()
+        content = fetch_feed(session)
+
+        if content is not None:
+          if args.snapshot_dir:
+            with open(os.path.join(args.snapshot_dir, f'trip_updates_{int(fetched_at)}.pb'), 'wb') as file:
+              file.write(content)
+          try:
+            collector.add_snapshot(content, fetched_at)
+          except Exception as e:
+            logging.error('Could not parse the trip updates: %s', repr(e))
+          logging.info('Trip updates collector: %s', collector.get_stats())
+
+        time.sleep(max(0, args.interval - (time.monotonic() - poll_start)))
+    except KeyboardInterrupt:
+      pass
+    finally:
+      collector.close()
+
+else:
+  with requests.Session() as session:
+    fetched_at = time.time()
+    content = fetch_feed(session)
+
+  if content is not None:
+    # One timestamp and one append per poll
+    _, columns = parse_feed(content)
+    trip_updates_df = get_trip_update_table(columns, fetched_at).to_pandas().drop('first_seen', axis=1)
+    export_to_csv(trip_updates_df.to_dict(orient='records'), csv_path)
@@ -0,0 +1,30 @@
+import argparse
+import os
+import time
+
+# Import custom code
+from src.constants import MODELS_DIR
+from src.synthetic_data import STM_ROUTES, STM_STOPS, train_stand_in_model, write_synthetic_gtfs
+
+parser = argparse.ArgumentParser(description='Write a synthetic GTFS schedule shaped like the STM one (the same for the same options) in a data directory')
+parser.add_argument('output', help='data directory to write (GTFS files in its download directory)')
+parser.add_argument('--routes', type=int, default=STM_ROUTES, help='number of routes')
+parser.add_argument('--stops', type=int, default=STM_STOPS, help='number of stops')
+parser.add_argument('--stops-per-trip', type=int, default=45, help='mean number of stops of a route')
+parser.add_argument('--weekday-trips', type=int, default=100, help='trips per direction of a route on weekdays')
+parser.add_argument('--start-date', default='20260101', help='first date of the calendar (YYYYMMDD)')
+parser.add_argument('--days', type=int, default=365, help='days covered by the calendar')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--model', action='store_true', help=f'also train a stand-in model in {MODELS_DIR} of the output directory')
+args = parser.parse_args()
+
+start = time.perf_counter()
+rows = write_synthetic_gtfs(args.output, n_routes=args.routes, n_stops=args.stops, stops_per_trip=args.stops_per_trip,
+                            weekday_trips=args.weekday_trips, start_date=args.start_date, n_days=args.days, seed=args.seed)
+for table, n_rows in rows.items():
+  print(f'{table}: {n_rows:,} rows')
+
+if args.model:
+  train_stand_in_model(os.path.join(args.output, MODELS_DIR), seed=args.seed)
+  print(f'Stand-in model written in {os.path.join(args.output, MODELS_DIR)}')
+print(f'Written in {time.perf_counter() - start:.1f} s')
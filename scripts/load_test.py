@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import httpx
+import json
+import numpy as np
+import os
+import pandas as pd
+import psutil
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, MODELS_DIR, DOWNLOAD_DIR, LOCAL_TIMEZONE
+from src.open_meteo_stub import start_stub_server
+
+# Requests logged by /predict (older logs have no direction)
+PREDICT_LOG_PATTERN = re.compile(r'/predict - Route: (\d+) \| (?:Direction: (.+?) \| )?Stop: (\d+) \| Time: (\S+)')
+
+parser = argparse.ArgumentParser(description='Send /predict request mixes to the app at increasing concurrency and report its capacity')
+parser.add_argument('--log', help='replay the /predict requests logged in this file (default: synthetic requests)')
+parser.add_argument('--requests', type=int, default=5000, help='distinct requests in the mix, replayed in a loop')
+parser.add_argument('--mix', default='predict=1', help='share of each request type: predict, departures, get-stops, get-directions, home')
+parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='concurrent clients of each step')
+parser.add_argument('--duration', type=float, default=20, help='seconds of each step')
+parser.add_argument('--timeout', type=float, default=30, help='seconds before a request fails')
+parser.add_argument('--slo-p95', type=float, default=500, help='p95 latency (ms) of a sustained step')
+parser.add_argument('--max-error-rate', type=float, default=0.01, help='error rate of a sustained step, the ramp stops past twice this rate')
+parser.add_argument('--url', help='test a running server instead of starting the app')
+parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug', help='server started for the app')
+parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+parser.add_argument('--data', help='data directory of the app, e.g. from scripts/generate_synthetic_gtfs.py --model')
+parser.add_argument('--weather-latency', type=float, default=0.05, help='latency of the Open-Meteo stub (seconds)')
+parser.add_argument('--weather-failure-rate', type=float, default=0, help='fraction of Open-Meteo stub requests answered with HTTP 503')
+parser.add_argument('--weather-refresh', action='store_true', help='keep the weather store refreshed, so that predictions rarely call the stub')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--output', help='write the results of each step to this JSON file')
+parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+# Threaded development server of the app, started below
+if args.serve:
+  from werkzeug.serving import make_server
+  import app
+  make_server('127.0.0.1', args.serve, app.app, threaded=True).serve_forever()
+
+def get_free_port() -> int:
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def start_app(port:int, weather_url:str, work_path:str) -> subprocess.Popen:
+  '''Starts the app with the weather APIs on the stub and its log in the work directory'''
+  env = dict(os.environ,
+    OPEN_METEO_ARCHIVE_URL=f'{weather_url}/v1/archive',
+    OPEN_METEO_FORECAST_URL=f'{weather_url}/v1/forecast',
+    WEATHER_REFRESH_INTERVAL=os.getenv('WEATHER_REFRESH_INTERVAL', '3600') if args.weather_refresh else '0',
+    LOG_FILE=os.path.join(work_path, 'app.log'),
+    PYTHONPATH=str(ROOT_DIR))
+  if args.data:
+    env['DATA_DIR'] = os.path.abspath(args.data)
+    if os.path.isdir(os.path.join(args.data, MODELS_DIR)):
+      env['MODELS_DIR'] = os.path.abspath(os.path.join(args.data, MODELS_DIR))
+
+  if args.server == 'gunicorn':
+    env.update(SERVING_BIND=f'127.0.0.1:{port}', SERVING_WORKERS=str(args.workers), SERVING_THREADS=str(args.threads))
+    command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT_DIR, 'gunicorn.conf.py')]
+  else:
+    command = [sys.executable, __file__, '--serve', str(port)]
+  return subprocess.Popen(command, env=env, cwd=ROOT_DIR)
+
+def wait_for_server(base_url:str, process:subprocess.Popen|None, timeout:float=600) -> None:
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if process is not None and process.poll() is not None:
+      raise RuntimeError(f'The server stopped with status {process.returncode}')
+    try:
+      if httpx.get(f'{base_url}/health', timeout=5).status_code == 200:
+        return
+    except httpx.HTTPError:
+      pass
+    time.sleep(1)
+  raise TimeoutError(f'{base_url} did not start in {timeout:.0f} s')
+
+def get_worker_processes(pid:int) -> list[psutil.Process]:
+  '''Processes that serve requests: the gunicorn workers, or the server itself'''
+  process = psutil.Process(pid)
+  return process.children() or [process]
+
+def get_cpu_seconds(processes:list[psutil.Process]) -> list[float]:
+  seconds = []
+  for process in processes:
+    try:
+      cpu_times = process.cpu_times()
+      seconds.append(cpu_times.user + cpu_times.system)
+    except psutil.NoSuchProcess:
+      seconds.append(0)
+  return seconds
+
+def get_schedule_keys(base_url:str, route_ids:list[int]) -> list[tuple]:
+  '''Returns the (route, direction, stop) of the schedule, read from /get-directions and /get-stops'''
+  keys = []
+  with httpx.Client(base_url=base_url, timeout=args.timeout) as client:
+    for route_id in route_ids:
+      for direction in client.get('/get-directions', params={'bus_line': route_id}).json():
+        for stop in client.get('/get-stops', params={'bus_line': route_id, 'direction': direction['direction_fr']}).json():
+          keys.append((route_id, direction['direction_fr'], stop['stop_id']))
+  return keys
+
+def get_synthetic_queries(keys:list[tuple], n_queries:int, rng:np.random.Generator) -> list[tuple]:
+  '''
+  Random (route, direction, stop, time) queries: a few stops get most of the
+  requests (Zipf-like), and most times are in the next two hours
+  '''
+  popularity = 1 / np.arange(1, len(keys) + 1) ** 1.1
+  key_positions = rng.permutation(len(keys))[rng.choice(len(keys), n_queries, p=popularity / popularity.sum())]
+
+  now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE).floor('min')
+  soon = rng.random(n_queries) < 0.7
+  offsets = np.where(soon, rng.integers(0, 120, n_queries), rng.integers(0, 13 * 24 * 60, n_queries))
+  chosen_times = now_local + pd.to_timedelta(offsets, unit='min')
+  return [(*keys[position], chosen_time) for position, chosen_time in zip(key_positions, chosen_times)]
+
+def get_logged_queries(log_path:str, keys:list[tuple]) -> list[tuple]:
+  '''
+  Queries of the /predict lines of a log, in order. Each time is moved to the
+  same weekday and time of the coming week, so that it can still be predicted.
+  '''
+  stop_directions = {}
+  for route_id, direction, stop_id in keys:
+    stop_directions.setdefault((route_id, stop_id), direction)
+
+  now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE).floor('min')
+  queries = []
+  with open(log_path) as f:
+    for line in f:
+      match = PREDICT_LOG_PATTERN.search(line)
+      if not match:
+        continue
+      route_id, direction, stop_id, chosen_time = int(match[1]), match[2], int(match[3]), pd.Timestamp(match[4], tz=LOCAL_TIMEZONE)
+      direction = direction or stop_directions.get((route_id, stop_id))
+      if direction is None:
+        continue
+      weeks = np.ceil((now_local - chosen_time) / pd.Timedelta(weeks=1))
+      queries.append((route_id, direction, stop_id, chosen_time + pd.Timedelta(weeks=weeks)))
+  return queries
+
+def get_request(kind:str, route_id:int, direction:str, stop_id:int, chosen_time:pd.Timestamp) -> tuple:
+  time_str = chosen_time.strftime('%Y-%m-%dT%H:%M')
+  match kind:
+    case 'predict':
+      return 'POST', '/predict', {'bus_line': route_id, 'direction': direction, 'stop': stop_id, 'chosen_time': time_str}
+    case 'departures':
+      return 'GET', f'/departures?stop_id={stop_id}&time={time_str}', None
+    case 'get-stops':
+      return 'GET', f'/get-stops?bus_line={route_id}&direction={quote(direction)}', None
+    case 'get-directions':
+      return 'GET', f'/get-directions?bus_line={route_id}', None
+    case 'home':
+      return 'GET', '/', None
+  raise ValueError(f'Unknown request type: {kind}')
+
+async def run_step(base_url:str, requests:list[tuple], concurrency:int, duration:float) -> list[tuple]:
+  '''Closed loop: each client sends its next request as soon as the previous one is answered'''
+  results = []
+  next_position = 0
+  limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+  async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+    stop_at = time.perf_counter() + duration
+
+    async def send_requests() -> None:
+      nonlocal next_position
+      while time.perf_counter() < stop_at:
+        method, path, form = requests[next_position % len(requests)]
+        next_position += 1
+        start = time.perf_counter()
+        try:
+          status = (await client.request(method, path, data=form)).status_code
+        except httpx.HTTPError:
+          status = 0
+        results.append((time.perf_counter() - start, status))
+
+    await asyncio.gather(*(send_requests() for _ in range(concurrency)))
+  return results
+
+work_path = tempfile.mkdtemp()
+weather_server = start_stub_server(latency=args.weather_latency, failure_rate=args.weather_failure_rate)
+process = None
+try:
+  if args.url:
+    base_url = args.url.rstrip('/')
+  else:
+    port = get_free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    process = start_app(port, f'http://127.0.0.1:{weather_server.server_port}', work_path)
+  print(f'Waiting for {base_url}')
+  wait_for_server(base_url, process)
+
+  # Requests of the mix
+  rng = np.random.default_rng(args.seed)
+  routes_df = pd.read_csv(os.path.join(args.data or os.path.join(ROOT_DIR, DATA_DIR), DOWNLOAD_DIR, 'routes.txt'))
+  keys = get_schedule_keys(base_url, routes_df.loc[routes_df['route_type'] == 3, 'route_id'].tolist())
+  if args.log:
+    queries = get_logged_queries(args.log, keys)[:args.requests]
+    print(f'Replaying {len(queries)} /predict requests of {args.log}')
+  else:
+    queries = get_synthetic_queries(keys, args.requests, rng)
+    print(f'{len(queries)} synthetic requests on {len(keys)} stops of the lines')
+
+  mix = {kind: float(share) for kind, share in (item.split('=') for item in args.mix.split(','))}
+  kinds = rng.choice(list(mix), len(queries), p=np.array(list(mix.values())) / sum(mix.values()))
+  requests = [get_request(kind, *query) for kind, query in zip(kinds, queries)]
+
+  workers = get_worker_processes(process.pid) if process else []
+  print(f'Server: {args.server if process else base_url}, {len(workers) or "?"} worker processes; weather stub {args.weather_latency * 1000:.0f} ms, {args.weather_failure_rate:.0%} failures')
+  print(f'{"clients":>8}{"requests":>10}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"errors":>8}{"4xx":>7}{"busy":>7}{"weather":>9}')
+
+  steps = []
+  for concurrency in args.concurrency:
+    workers = get_worker_processes(process.pid) if process else []
+    cpu_start = get_cpu_seconds(workers)
+    weather_start = weather_server.request_count
+    start = time.perf_counter()
+    results = asyncio.run(run_step(base_url, requests, concurrency, args.duration))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    statuses = np.array([status for _, status in results])
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    # Server errors and failed connections, and the client errors (e.g. no arrivals after a time) apart
+    error_rate = np.mean((statuses >= 500) | (statuses == 0))
+    client_error_rate = np.mean((statuses >= 400) & (statuses < 500))
+
+    # Share of the step each worker spent on the CPU (a worker at 100% cannot take more requests)
+    busy = [(end - begin) / elapsed for begin, end in zip(cpu_start, get_cpu_seconds(workers))]
+    step = {
+      'concurrency': concurrency, 'requests': len(results), 'throughput': len(results) / elapsed,
+      'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'error_rate': error_rate, 'client_error_rate': client_error_rate,
+      'worker_busy': float(np.mean(busy)) if busy else None, 'weather_requests': weather_server.request_count - weather_start,
+      'statuses': {str(status): int(count) for status, count in zip(*np.unique(statuses, return_counts=True))},
+    }
+    steps.append(step)
+    busy_str = f'{step["worker_busy"]:.0%}' if busy else '-'
+    print(f'{concurrency:>8}{len(results):>10}{step["throughput"]:>9.1f}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{error_rate:>8.1%}{client_error_rate:>7.1%}{busy_str:>7}{step["weather_requests"]:>9}')
+
+    if error_rate > 2 * args.max_error_rate:
+      print(f'Stopping: {error_rate:.1%} of the requests failed')
+      break
+
+  sustained = [step for step in steps if step['p95_ms'] <= args.slo_p95 and step['error_rate'] <= args.max_error_rate]
+  if sustained:
+    best = max(sustained, key=lambda step: step['throughput'])
+    print(f'Sustained: {best["throughput"]:.1f} req/s with {best["concurrency"]} clients (p95 {best["p95_ms"]:.0f} ms, {best["error_rate"]:.1%} errors)')
+  else:
+    print(f'No step met the p95 of {args.slo_p95:.0f} ms with at most {args.max_error_rate:.1%} errors')
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'args': {key: value for key, value in vars(args).items() if key != 'serve'}, 'steps': steps}, f, indent=2, default=float)
+    print(f'Results written to {args.output}')
+finally:
+  if process is not None:
+    process.terminate()
+    process.wait()
+  weather_server.shutdown()
+  shutil.rmtree(work_path)
@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+from dotenv import load_dotenv
+import logging
+import os
+import signal
+
+# Import custom code
+from src.constants import (
+  ROOT_DIR, DATA_DIR, API_DIR, DOWNLOAD_DIR, SNAPSHOT_DIR, TRIP_UPDATES_DIR, TRIP_UPDATES_STATE_FILE, INGESTION_TRIP_UPDATES_INTERVAL,
+  INGESTION_WEATHER_INTERVAL, INGESTION_SCHEDULE_INTERVAL, INGESTION_ROUTE_TYPES_INTERVAL, INGESTION_MAX_CONCURRENCY
+)
+from src.ingestion import (
+  IngestionScheduler, get_trip_updates_job, get_historical_weather_job, get_schedule_job, get_route_types_job
+)
+from src.trip_update_collector import TripUpdateChanges, TripUpdateCollector
+
+JOBS = ['trip_updates', 'historical_weather', 'schedule', 'route_types']
+
+parser = argparse.ArgumentParser(description='Run the ingestion jobs (replacing the cron scripts) until interrupted')
+parser.add_argument('--jobs', nargs='+', choices=JOBS, default=JOBS, help='jobs to run')
+parser.add_argument('--trip-updates-interval', type=float, default=INGESTION_TRIP_UPDATES_INTERVAL)
+parser.add_argument('--weather-interval', type=float, default=INGESTION_WEATHER_INTERVAL)
+parser.add_argument('--schedule-interval', type=float, default=INGESTION_SCHEDULE_INTERVAL)
+parser.add_argument('--route-types-interval', type=float, default=INGESTION_ROUTE_TYPES_INTERVAL)
+parser.add_argument('--max-concurrency', type=int, default=INGESTION_MAX_CONCURRENCY, help='jobs running at the same time')
+parser.add_argument('--stats-interval', type=float, default=300, help='seconds between job metrics in the log')
+args = parser.parse_args()
+
+# API KEY
+load_dotenv()
+API_KEY = os.getenv('STM_API_KEY')
+
+api_path = os.path.join(ROOT_DIR, DATA_DIR, API_DIR)
+collector = None
+jobs = []
+
+if 'trip_updates' in args.jobs:
+  parquet_path = os.path.join(api_path, TRIP_UPDATES_DIR)
+  os.makedirs(parquet_path, exist_ok=True)
+  collector = TripUpdateCollector(parquet_path, changes=TripUpdateChanges(os.path.join(parquet_path, TRIP_UPDATES_STATE_FILE)))
+  jobs.append(get_trip_updates_job(collector, API_KEY, args.trip_updates_interval))
+if 'historical_weather' in args.jobs:
+  jobs.append(get_historical_weather_job(os.path.join(api_path, 'fetched_historical_weather.csv'), args.weather_interval))
+if 'schedule' in args.jobs:
+  data_path = os.path.join(ROOT_DIR, DATA_DIR)
+  jobs.append(get_schedule_job(os.path.join(data_path, DOWNLOAD_DIR), args.schedule_interval, data_path=data_path, snapshot_path=os.path.join(data_path, SNAPSHOT_DIR)))
+if 'route_types' in args.jobs:
+  jobs.append(get_route_types_job(os.path.join(ROOT_DIR, DATA_DIR, 'route_types.csv'), args.route_types_interval))
+
+scheduler = IngestionScheduler(jobs, max_concurrency=args.max_concurrency)
+
+async def log_stats() -> None:
+  while True:
+    await asyncio.sleep(args.stats_interval)
+    logging.info('Ingestion jobs: %s', scheduler.get_state())
+    if collector is not None:
+      logging.info('Trip updates collector: %s', collector.get_stats())
+
+async def main() -> None:
+  # Stop the jobs when the service is stopped
+  loop = asyncio.get_running_loop()
+  for signum in (signal.SIGTERM, signal.SIGINT):
+    loop.add_signal_handler(signum, scheduler.stop)
+
+  stats_task = asyncio.create_task(log_stats())
+  try:
+    await scheduler.run()
+  finally:
+    stats_task.cancel()
+
+try:
+  asyncio.run(main())
+finally:
+  # Write the buffered trip updates
+  if collector is not None:
+    collector.close()
+  logging.info('Ingestion jobs: %s', scheduler.get_state())
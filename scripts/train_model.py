@@ -0,0 +1,52 @@
+import argparse
+import joblib
+import json
+import os
+import shutil
+import tempfile
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, MODELS_DIR, PREPROCESSED_DATA, TRAINING_BATCH_ROWS
+from src.feature_plan import load_feature_plan
+from src.training import train_model
+
+models_path = os.path.join(ROOT_DIR, MODELS_DIR)
+
+parser = argparse.ArgumentParser(description='Train the delay model on the preprocessed data without loading it in memory (replaces the final model of notebooks/data_modeling.ipynb)')
+parser.add_argument('--data', default=os.path.join(ROOT_DIR, DATA_DIR, PREPROCESSED_DATA), help='preprocessed Parquet file or directory of partitions')
+parser.add_argument('--features', default=os.path.join(models_path, 'best_features.pkl'), help='model features to compute')
+parser.add_argument('--hyperparams', default=os.path.join(models_path, 'best_hyperparams.pkl'))
+parser.add_argument('--output', default=models_path, help='directory of the model artifacts')
+parser.add_argument('--rounds', type=int, default=10000, help='maximum boosting rounds')
+parser.add_argument('--early-stopping', type=int, default=50, help='rounds without improvement of the validation error before stopping')
+parser.add_argument('--external-memory', action='store_true', help='keep the quantized rows on disk instead of in memory')
+parser.add_argument('--cache-dir', help='directory of the external memory pages (default: a temporary directory)')
+parser.add_argument('--batch-rows', type=int, default=TRAINING_BATCH_ROWS, help='rows read from Parquet at a time')
+parser.add_argument('--nthread', type=int, default=0, help='XGBoost threads (0: all cores)')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--verbose', type=int, default=50, help='print the errors every this many rounds (0: never)')
+parser.add_argument('--report', help='write the report to this JSON file')
+args = parser.parse_args()
+
+cache_dir = args.cache_dir or (tempfile.mkdtemp(prefix='xgb-cache-') if args.external_memory else None)
+try:
+  report = train_model(
+    args.data, args.output, load_feature_plan(args.features), joblib.load(args.hyperparams),
+    num_boost_round=args.rounds, early_stopping_rounds=args.early_stopping, external_memory=args.external_memory, cache_dir=cache_dir,
+    batch_rows=args.batch_rows, nthread=args.nthread, seed=args.seed, verbose_eval=args.verbose or False,
+  )
+finally:
+  if cache_dir and not args.cache_dir:
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+rows = report['rows']
+print(f'Trained on {rows["train"]:,} rows ({rows["val"]:,} validation, {rows["test"]:,} test), {report["rounds"]} rounds, in {report["seconds"]:.1f} s')
+print(f'Test set: MAE {report["test"]["MAE"]:.2f} | RMSE {report["test"]["RMSE"]:.2f} | R² {report["test"]["R²"]:.4f}')
+print(f'{"stage":<12}{"seconds":>10}{"peak MB":>10}')
+for name, stage in report['stages'].items():
+  print(f'{name:<12}{stage["seconds"]:>10.2f}{stage["peak_mb"]:>10.1f}')
+print(f'Model artifacts written in {args.output}')
+
+if args.report:
+  with open(args.report, 'w') as f:
+    json.dump(report, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,83 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, MODELS_DIR, PREPROCESSED_DATA, TRAINING_BATCH_ROWS
+from src.feature_plan import load_feature_plan
+from src.tuning import SEARCH_SPACE, get_cache_paths, run_search, write_best_hyperparams
+
+models_path = os.path.join(ROOT_DIR, MODELS_DIR)
+
+parser = argparse.ArgumentParser(description='Search the XGBoost parameters of the delay model with successive halving (replaces the RandomizedSearchCV of notebooks/data_modeling.ipynb)')
+parser.add_argument('--data', default=os.path.join(ROOT_DIR, DATA_DIR, PREPROCESSED_DATA), help='preprocessed Parquet file or directory of partitions')
+parser.add_argument('--features', default=os.path.join(models_path, 'best_features.pkl'), help='model features to compute')
+parser.add_argument('--output', default=os.path.join(ROOT_DIR, DATA_DIR, 'tuning'), help='directory of the cached matrices and trial results (a search started again resumes from it)')
+parser.add_argument('--hyperparams', default=os.path.join(models_path, 'best_hyperparams.pkl'), help='where to write the best parameters')
+parser.add_argument('--candidates', type=int, default=50, help='parameter sets sampled from the search space')
+parser.add_argument('--min-rounds', type=int, default=30, help='boosting rounds of every candidate at the first rung')
+parser.add_argument('--max-rounds', type=int, default=810, help='boosting rounds of the last rung at most')
+parser.add_argument('--eta', type=int, default=3, help='1/eta of the candidates are kept at each rung, trained eta times longer')
+parser.add_argument('--early-stopping', type=int, default=20, help='rounds without improvement of the validation error before a candidate stops')
+parser.add_argument('--sample', type=float, default=0.25, help='share of the train and validation rows used')
+parser.add_argument('--threads', type=int, default=1, help='XGBoost threads of each worker')
+parser.add_argument('--workers', type=int, help='worker processes (default: cores / threads)')
+parser.add_argument('--batch-rows', type=int, default=TRAINING_BATCH_ROWS, help='rows read from Parquet at a time')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--compare-notebook', action='store_true', help="also run the notebook's search on the same sample and compare the times and validation errors")
+parser.add_argument('--report', help='write the report to this JSON file')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+feature_plan = load_feature_plan(args.features)
+n_workers = args.workers or max(1, len(os.sched_getaffinity(0)) // args.threads)
+
+report = run_search(
+  args.data, feature_plan, args.output, n_candidates=args.candidates, min_rounds=args.min_rounds, max_rounds=args.max_rounds, eta=args.eta,
+  early_stopping_rounds=args.early_stopping, sample=args.sample, n_workers=n_workers, n_threads=args.threads, seed=args.seed, batch_rows=args.batch_rows,
+)
+rows = report['cache']['rows']
+print(f'Searched {report["candidates"]} candidates on {rows["train"]:,} rows ({rows["val"]:,} validation), {n_workers} workers x {args.threads} threads, in {report["seconds"]:.1f} s')
+if report['resumed_trials']:
+  print(f'Resumed {report["resumed_trials"]} trials of a previous run')
+print(f'{"rung":<6}{"rounds":>8}{"trials":>8}')
+for index, rung in enumerate(report['rungs']):
+  print(f'{index:<6}{rung["rounds"]:>8}{rung["trials"]:>8}')
+print(f'{report["boosting_rounds"]:,} boosting rounds trained (the notebook trains {args.candidates * 2 * 100 + 100:,}: 2 folds of 100 per candidate and the refit)')
+print(f'Best: validation RMSE {report["score"]:.3f} at {report["best_rounds"]} rounds, {report["params"]}')
+
+write_best_hyperparams(report['params'], args.hyperparams)
+print(f'Best parameters written to {args.hyperparams}')
+
+if args.compare_notebook:
+  import numpy as np
+  import pandas as pd
+  from sklearn.model_selection import RandomizedSearchCV
+  import xgboost as xgb
+
+  # Same sample, with the steps of the modeling notebook: a pandas frame, 2-fold CV of
+  # 100 rounds per candidate, and a refit of the best one
+  start = time.perf_counter()
+  train_path, val_path = get_cache_paths(os.path.join(args.output, 'cache'))
+  dtrain, dval = xgb.DMatrix(train_path), xgb.DMatrix(val_path)
+  X_train_sample = pd.DataFrame(dtrain.get_data().toarray(), columns=dtrain.feature_names)
+  y_train_sample = dtrain.get_label()
+  random_search = RandomizedSearchCV(
+    estimator=xgb.XGBRegressor(objective='reg:squarederror', random_state=42, n_estimators=100, verbosity=0),
+    param_distributions=SEARCH_SPACE, scoring='neg_root_mean_squared_error', cv=2, n_iter=args.candidates, random_state=42,
+  )
+  random_search.fit(X_train_sample, y_train_sample)
+  notebook_seconds = time.perf_counter() - start
+
+  # Both best parameter sets scored on the validation sample
+  y_val = dval.get_label()
+  notebook_rmse = float(np.sqrt(np.mean((random_search.best_estimator_.get_booster().predict(dval) - y_val) ** 2)))
+  print(f'Notebook search: validation RMSE {notebook_rmse:.3f} at 100 rounds, {random_search.best_params_}, in {notebook_seconds:.1f} s')
+  print(f'Successive halving: validation RMSE {report["score"]:.3f}, {notebook_seconds / report["seconds"]:.1f}x faster')
+  report['notebook'] = {'params': random_search.best_params_, 'score': notebook_rmse, 'seconds': notebook_seconds}
+
+if args.report:
+  with open(args.report, 'w') as f:
+    json.dump(report, f, indent=2, ensure_ascii=False)
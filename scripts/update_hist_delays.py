@@ -0,0 +1,33 @@
+import argparse
+import os
+import shutil
+
+# Import custom code
+from src.constants import ROOT_DIR, DATA_DIR, CLEANED_DATA_DIR, HIST_DELAYS_DIR, HIST_DELAYS_HALF_LIFE
+from src.hist_delays import HistDelayAggregator, update_from_cleaned, write_hist_delays
+
+data_path = os.path.join(ROOT_DIR, DATA_DIR)
+
+parser = argparse.ArgumentParser(description='Update the historical average delays with the new cleaned service dates and publish hist_avg_delays.csv')
+parser.add_argument('--cleaned', default=os.path.join(data_path, CLEANED_DATA_DIR), help='cleaned dataset directory (scripts/clean_data.py)')
+parser.add_argument('--state', default=os.path.join(data_path, HIST_DELAYS_DIR), help='aggregator state directory')
+parser.add_argument('--output', default=os.path.join(data_path, 'hist_avg_delays.csv'), help='table read by the app ("" to skip)')
+parser.add_argument('--half-life', type=float, default=HIST_DELAYS_HALF_LIFE, help='days, also keep averages weighted by age (0 to disable)')
+parser.add_argument('--decayed', action='store_true', help='publish the decayed averages instead of the plain ones')
+parser.add_argument('--min-count', type=int, default=1, help='delays needed to publish the average of a (route, stop, hour)')
+parser.add_argument('--rebuild', action='store_true', help='discard the state and add every service date again')
+args = parser.parse_args()
+
+if args.rebuild:
+  shutil.rmtree(args.state, ignore_errors=True)
+
+aggregator = HistDelayAggregator.load(args.state, args.half_life)
+report = update_from_cleaned(aggregator, args.state, args.cleaned)
+print(f'{len(report["added"])} service dates added, {len(report["replaced"])} replaced, {len(report["removed"])} removed | '
+      f'{report["rows"]:,} rows | {report["keys"]:,} keys | {report["seconds"]:.2f} s')
+
+# The app loads the new table on its next check (HIST_DELAYS_RELOAD_INTERVAL)
+if args.output:
+  hist_delays_df = aggregator.get_table(decayed=args.decayed, min_count=args.min_count)
+  write_hist_delays(hist_delays_df, args.output)
+  print(f'Published {len(hist_delays_df):,} historical delays to {args.output}')
@@ -0,0 +1,285 @@
+from datetime import datetime, timezone
+import hashlib
+import joblib
+import json
+import logging
+import os
+import pandas as pd
+import shutil
+import threading
+import time
+
+# Import custom code
+from src.constants import BUNDLE_RELOAD_INTERVAL
+from src.feature_plan import load_feature_plan
+from src.gtfs_snapshot import INDEX_DIR, METADATA_FILE, GtfsSnapshot, build_snapshot, get_source_path, get_source_stats, is_snapshot_current, load_gtfs_tables, load_schedule_lookups, read_manifest
+from src.hist_delays import HistDelayReloader
+from src.inference import get_model_paths, get_model_version, load_booster, load_delay_model
+from src.schedule_index import ScheduleIndex, localize_calendar
+from src.schedule_metadata import ScheduleMetadata
+
+# Increment when the layout of the bundles changes
+BUNDLE_FORMAT_VERSION = 1
+
+MANIFEST_FILE = 'manifest.json'
+CURRENT_FILE = 'CURRENT' # name of the published version, in the bundles directory
+SNAPSHOT_DIR = 'snapshot'
+MODEL_DIR = 'model'
+MODEL_FILES = ['best_features.pkl', 'min_time.pkl', 'sch_rel_weights.pkl']
+LOCAL_VERSION = 'local' # schedule and model read from the data and models directories
+
+def get_schedule_bounds(calendar_df:pd.DataFrame) -> tuple[pd.Timestamp, pd.Timestamp]:
+  '''Returns the first and last minute served by a calendar localized by localize_calendar'''
+  return calendar_df['start_date'].min(), calendar_df['end_date'].max() - pd.Timedelta(minutes=1)
+
+def get_file_checksum(path:str) -> str:
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(2**20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def get_bundle_files(bundle_path:str) -> dict:
+  '''Returns the size and checksum of every file of a bundle but its manifest'''
+  files = {}
+  for dir_path, _, file_names in os.walk(bundle_path):
+    for file_name in file_names:
+      path = os.path.join(dir_path, file_name)
+      relative_path = os.path.relpath(path, bundle_path)
+      if relative_path != MANIFEST_FILE:
+        files[relative_path] = {'size': os.path.getsize(path), 'sha256': get_file_checksum(path)}
+  return dict(sorted(files.items()))
+
+def build_bundle(bundles_path:str, download_path:str, data_path:str, model_dir:str, version:str|None=None) -> dict:
+  '''
+  Copies the GTFS snapshot (with its schedule index), the model and the files
+  it is served with into a new version directory, with a manifest of their
+  checksums. The version is not published.
+  '''
+  version = version or datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+  bundle_path = os.path.join(bundles_path, version)
+  if os.path.exists(bundle_path):
+    raise ValueError(f'Bundle {version} already exists')
+
+  tmp_path = f'{bundle_path}.tmp'
+  shutil.rmtree(tmp_path, ignore_errors=True)
+  os.makedirs(os.path.join(tmp_path, MODEL_DIR))
+
+  # The snapshot includes stops with clusters and historical delays
+  snapshot_manifest = build_snapshot(download_path, data_path, os.path.join(tmp_path, SNAPSHOT_DIR))
+
+  # Native model if it was exported, otherwise the pickled one
+  native_path, pickle_path = get_model_paths(model_dir)
+  model_path = native_path if os.path.exists(native_path) else pickle_path
+  for path in [model_path] + [os.path.join(model_dir, file_name) for file_name in MODEL_FILES]:
+    shutil.copy2(path, os.path.join(tmp_path, MODEL_DIR, os.path.basename(path)))
+
+  schedule_start, schedule_end = get_schedule_bounds(localize_calendar(GtfsSnapshot(os.path.join(tmp_path, SNAPSHOT_DIR)).load_tables()['calendar']))
+  manifest = {
+    'format_version': BUNDLE_FORMAT_VERSION,
+    'version': version,
+    'created_at': datetime.now(timezone.utc).isoformat(),
+    'model_version': get_model_version(load_booster(os.path.join(tmp_path, MODEL_DIR))),
+    'schedule': {'start': schedule_start.isoformat(), 'end': schedule_end.isoformat()},
+    'sources': snapshot_manifest['sources'],
+    'files': get_bundle_files(tmp_path),
+  }
+  with open(os.path.join(tmp_path, MANIFEST_FILE), 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+  os.rename(tmp_path, bundle_path)
+  return manifest
+
+def read_bundle_manifest(bundle_path:str) -> dict:
+  manifest_path = os.path.join(bundle_path, MANIFEST_FILE)
+  if not os.path.isfile(manifest_path):
+    return {}
+
+  with open(manifest_path) as f:
+    return json.load(f)
+
+def verify_bundle(bundle_path:str) -> dict:
+  '''Returns the manifest of a bundle, or raises a ValueError if a file is missing or changed'''
+  manifest = read_bundle_manifest(bundle_path)
+  if manifest.get('format_version') != BUNDLE_FORMAT_VERSION:
+    raise ValueError(f'Unsupported bundle format in {bundle_path}')
+
+  files = get_bundle_files(bundle_path)
+  for relative_path, expected in manifest['files'].items():
+    if files.get(relative_path) != expected:
+      raise ValueError(f'{relative_path} is missing or does not match its checksum in {bundle_path}')
+  return manifest
+
+def read_current_version(bundles_path:str) -> str|None:
+  current_path = os.path.join(bundles_path, CURRENT_FILE)
+  if not os.path.isfile(current_path):
+    return None
+
+  with open(current_path) as f:
+    return f.read().strip() or None
+
+def publish_bundle(bundles_path:str, version:str) -> None:
+  '''Verifies a bundle and makes it the version loaded by the serving processes'''
+  verify_bundle(os.path.join(bundles_path, version))
+
+  current_path = os.path.join(bundles_path, CURRENT_FILE)
+  tmp_path = f'{current_path}.tmp'
+  with open(tmp_path, 'w') as f:
+    f.write(version)
+  os.replace(tmp_path, current_path)
+
+def prune_bundles(bundles_path:str, keep:int) -> list[str]:
+  '''Removes all but the keep most recent versions (never the published one), returns the removed versions'''
+  current_version = read_current_version(bundles_path)
+  versions = sorted(
+    (entry.name for entry in os.scandir(bundles_path) if entry.is_dir() and not entry.name.endswith('.tmp')),
+    key=lambda version: read_bundle_manifest(os.path.join(bundles_path, version)).get('created_at', ''),
+  )
+  removed = [version for version in versions[:max(len(versions) - keep, 0)] if version != current_version]
+  for version in removed:
+    shutil.rmtree(os.path.join(bundles_path, version))
+  return removed
+
+class ServingArtifacts:
+  '''
+  Schedule lookups and model of one version. A request reads everything from
+  the same instance, so it is served by a single version even if a newer one
+  is swapped in meanwhile.
+  '''
+
+  def __init__(self, version:str, tables:dict, schedule_index:ScheduleIndex, schedule_metadata:ScheduleMetadata,
+               model_dir:str, hist_csv_path:str, hist_loaded:bool=True) -> None:
+    self.version = version
+    self.tables = tables
+    self.schedule_index = schedule_index
+    self.schedule_metadata = schedule_metadata
+    self.schedule_start, self.schedule_end = get_schedule_bounds(schedule_index.calendar_df)
+
+    self.model_dir = model_dir
+    self.model = load_delay_model(model_dir)
+    self.feature_plan = load_feature_plan(os.path.join(model_dir, 'best_features.pkl'))
+    self.min_time_local = joblib.load(os.path.join(model_dir, 'min_time.pkl'))
+    self.sch_rel_weights = joblib.load(os.path.join(model_dir, 'sch_rel_weights.pkl'))
+
+    # Features are passed to the model as a plain matrix, so their order must match
+    if self.model.feature_names and self.model.feature_names != self.feature_plan.feature_names:
+      raise ValueError('The features in best_features.pkl do not match the model features')
+
+    # Share of arrivals with schedule_relationship_Scheduled at 1
+    self.scheduled_probability = self.sch_rel_weights['Scheduled'] / sum(self.sch_rel_weights.values())
+
+    # Historical delays published by scripts/update_hist_delays.py are loaded without a restart
+    self.hist_delays_reloader = HistDelayReloader(hist_csv_path, schedule_index, loaded=hist_loaded)
+
+    # Set by the app before the version is served
+    self.prediction_grid = None
+    self.prediction_cache = None
+    self.home_page = None
+
+def load_local_artifacts(download_path:str, data_path:str, snapshot_path:str, model_dir:str) -> ServingArtifacts:
+  '''Loads the schedule and model from the data and models directories, as before bundles'''
+  tables = load_gtfs_tables(download_path, data_path, snapshot_path)
+  schedule_index, schedule_metadata = load_schedule_lookups(tables, download_path, data_path, snapshot_path)
+
+  # A current snapshot keeps the historical delays it was built with, those published since then replace them
+  hist_csv_path = get_source_path('hist_avg_delays', download_path, data_path)
+  hist_loaded = True
+  if is_snapshot_current(snapshot_path, download_path, data_path):
+    hist_loaded = get_source_stats({'hist_avg_delays': hist_csv_path}).get('hist_avg_delays') == read_manifest(snapshot_path)['sources'].get('hist_avg_delays')
+  return ServingArtifacts(LOCAL_VERSION, tables, schedule_index, schedule_metadata, model_dir, hist_csv_path, hist_loaded)
+
+def load_bundle_artifacts(bundle_path:str, hist_csv_path:str) -> ServingArtifacts:
+  '''Verifies a bundle and loads it, with the schedule index memory-mapped from its snapshot'''
+  manifest = verify_bundle(bundle_path)
+  snapshot_path = os.path.join(bundle_path, SNAPSHOT_DIR)
+  tables = GtfsSnapshot(snapshot_path).load_tables()
+  schedule_index = ScheduleIndex.load(os.path.join(snapshot_path, INDEX_DIR), tables['hist_avg_delays'])
+  schedule_metadata = ScheduleMetadata.load(os.path.join(snapshot_path, INDEX_DIR, METADATA_FILE))
+
+  # Historical delays published after the bundle was built replace its own
+  hist_loaded = get_source_stats({'hist_avg_delays': hist_csv_path}).get('hist_avg_delays') == manifest['sources'].get('hist_avg_delays')
+  return ServingArtifacts(manifest['version'], tables, schedule_index, schedule_metadata, os.path.join(bundle_path, MODEL_DIR), hist_csv_path, hist_loaded)
+
+def load_serving_artifacts(bundles_path:str, download_path:str, data_path:str, snapshot_path:str, model_dir:str) -> ServingArtifacts:
+  '''Loads the published bundle, or the data and models directories when no bundle was published'''
+  version = read_current_version(bundles_path)
+  if version is None:
+    return load_local_artifacts(download_path, data_path, snapshot_path, model_dir)
+
+  logging.info('Loading artifact bundle %s', version)
+  return load_bundle_artifacts(os.path.join(bundles_path, version), get_source_path('hist_avg_delays', download_path, data_path))
+
+class BundleReloader:
+  '''
+  Swaps in a newly published bundle without a restart. The CURRENT file is
+  checked at most every reload_interval seconds; a new version is loaded and
+  prepared (see prepare) in a background thread, then replaces the served
+  artifacts in one assignment. Requests that already hold the previous
+  artifacts finish with them.
+  '''
+
+  def __init__(self, bundles_path:str, artifacts:ServingArtifacts, hist_csv_path:str, prepare=None,
+               reload_interval:float=BUNDLE_RELOAD_INTERVAL) -> None:
+    self.bundles_path = bundles_path
+    self.artifacts = artifacts
+    self.hist_csv_path = hist_csv_path
+    self.prepare = prepare # called with the new artifacts before they are served
+    self.reload_interval = reload_interval
+    self._lock = threading.Lock()
+    self._checked_at = time.monotonic()
+    self._loading = None
+    self._failed_version = None # not loaded again until another version is published
+    self.stats = {'swaps': 0, 'errors': 0}
+
+  def get_artifacts(self) -> ServingArtifacts:
+    self.reload_if_changed()
+    return self.artifacts
+
+  def reload_if_changed(self, force:bool=False, wait:bool=False) -> None:
+    now = time.monotonic()
+    if not force and now - self._checked_at < self.reload_interval:
+      return
+    self._checked_at = now
+
+    version = read_current_version(self.bundles_path)
+    if version is None or version in (self.artifacts.version, self._failed_version):
+      return
+
+    with self._lock:
+      if self._loading is None:
+        self._loading = threading.Thread(target=self._load, args=(version,), name='bundle-loader', daemon=True)
+        self._loading.start()
+      loading = self._loading
+
+    if wait:
+      loading.join()
+
+  def _load(self, version:str) -> None:
+    start = time.perf_counter()
+    try:
+      artifacts = load_bundle_artifacts(os.path.join(self.bundles_path, version), self.hist_csv_path)
+      if self.prepare is not None:
+        self.prepare(artifacts)
+
+      previous_version = self.artifacts.version
+      self.artifacts = artifacts
+      self.stats['swaps'] += 1
+      logging.info('Artifact bundle %s replaced %s in %.1f s', version, previous_version, time.perf_counter() - start)
+    except Exception as e:
+      self._failed_version = version
+      self.stats['errors'] += 1
+      logging.error('Could not load artifact bundle %s: %s', version, repr(e))
+    finally:
+      with self._lock:
+        self._loading = None
+
+  def get_state(self) -> dict:
+    artifacts = self.artifacts
+    return {
+      'version': artifacts.version,
+      'model_version': artifacts.model.version,
+      'schedule_start': artifacts.schedule_start.isoformat(),
+      'schedule_end': artifacts.schedule_end.isoformat(),
+      'loading': self._loading is not None,
+      **self.stats,
+    }
@@ -0,0 +1,75 @@
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+  '''
+  Stops calling an upstream service after repeated failures.
+
+  After failure_threshold consecutive failures the breaker opens and every
+  call is refused for reset_timeout seconds. Then a single trial call is let
+  through (half-open): a success closes the breaker, a failure opens it again.
+  '''
+
+  def __init__(self, name:str, failure_threshold:int=3, reset_timeout:float=60) -> None:
+    self.name = name
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self._lock = threading.Lock()
+    self._state = CLOSED
+    self._failures = 0
+    self._opened_at = None
+    self._trial_running = False
+    self._stats = {'successes': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+  def allow_request(self) -> bool:
+    with self._lock:
+      if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+        self._state = HALF_OPEN
+
+      if self._state == CLOSED:
+        return True
+
+      if self._state == HALF_OPEN and not self._trial_running:
+        self._trial_running = True
+        return True
+
+      self._stats['rejected'] += 1
+      return False
+
+  def record_success(self) -> None:
+    with self._lock:
+      self._stats['successes'] += 1
+      self._state = CLOSED
+      self._failures = 0
+      self._trial_running = False
+
+  def record_failure(self) -> None:
+    with self._lock:
+      self._stats['failures'] += 1
+      self._failures += 1
+      self._trial_running = False
+
+      if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+        if self._state != OPEN:
+          self._stats['opened'] += 1
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+
+  def get_state(self) -> dict:
+    with self._lock:
+      state = self._state
+      retry_in = None
+      if state == OPEN:
+        retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+      return {
+        'name': self.name,
+        'state': state,
+        'consecutive_failures': self._failures,
+        'retry_in': retry_in,
+        **self._stats,
+      }
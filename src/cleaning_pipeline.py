@@ -0,0 +1,365 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import re
+import resource
+import time
+
+# Import custom code
+from src.constants import SCHEDULE_RELATIONSHIP, CLEANING_WORKERS
+from src.helper_functions import gtfs_time_to_seconds, parse_gtfs_time
+from src.trip_update_collector import FEED_COLUMNS, write_parquet_atomic
+
+CLEANING_FORMAT_VERSION = 2
+MANIFEST_FILE = '_manifest.json'
+SCHEDULE_FILE = '_schedule_features.parquet'
+EARTH_RADIUS = 6378137 # meters, radius of the Web Mercator projection (EPSG:3857)
+
+def reset_peak_rss() -> None:
+  '''Resets the peak resident memory of the process (Linux), so that it can be read for a stage'''
+  try:
+    with open('/proc/self/clear_refs', 'w') as file:
+      file.write('5')
+  except OSError:
+    pass
+
+def get_peak_rss() -> float:
+  '''Peak resident memory of the process in MB, since the last reset_peak_rss when supported'''
+  try:
+    with open('/proc/self/status') as file:
+      return int(re.search(r'VmHWM:\s+(\d+)', file.read()).group(1)) / 1024
+  except (OSError, AttributeError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageTimer:
+  '''Records the duration and the peak resident memory of each stage of a run'''
+
+  def __init__(self) -> None:
+    self.stages = {}
+
+  @contextmanager
+  def stage(self, name:str):
+    reset_peak_rss()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.stages[name] = {'seconds': time.perf_counter() - start, 'peak_mb': get_peak_rss()}
+
+def get_file_signature(paths:list[str]) -> list:
+  '''Name, size and modification time of input files, to tell whether they changed'''
+  return [(os.path.basename(path), os.path.getsize(path), os.stat(path).st_mtime_ns) for path in paths]
+
+def get_hash(value) -> str:
+  return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def get_stop_distance(prev_lat:pd.Series, prev_lon:pd.Series, lat:pd.Series, lon:pd.Series) -> pd.Series:
+  '''
+  Distance in meters between two points projected to Web Mercator, as
+  computed by the notebook with geopandas (to_crs(epsg=3857).distance)
+  '''
+  def project(lat, lon):
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+  x1, y1 = project(prev_lat.to_numpy(dtype='float64'), prev_lon.to_numpy(dtype='float64'))
+  x2, y2 = project(lat.to_numpy(dtype='float64'), lon.to_numpy(dtype='float64'))
+  return pd.Series(np.hypot(x2 - x1, y2 - y1), index=lat.index)
+
+def get_schedule_features(schedules_df:pd.DataFrame, stops_df:pd.DataFrame, trips_df:pd.DataFrame) -> pd.DataFrame:
+  '''Merges the stop times with their stops and trips and adds the trip features (computed once per schedule)'''
+  # Sort values by stop sequence
+  schedules_df = schedules_df.sort_values(by=['trip_id', 'stop_sequence'])
+
+  # Add trip progress (vehicles further along the trip are more likely to be delayed)
+  total_stops = schedules_df.groupby('trip_id')['stop_id'].transform('count')
+  schedules_df['trip_progress'] = schedules_df['stop_sequence'] / total_stops
+
+  # Merge schedules and stops
+  schedules_stops_df = pd.merge(left=schedules_df, right=stops_df, how='inner', on='stop_id')
+
+  # Get coordinates of previous stop
+  schedules_stops_df = schedules_stops_df.sort_values(by=['trip_id', 'stop_sequence'])
+  prev_lat = schedules_stops_df.groupby('trip_id')['stop_lat'].shift(1)
+  prev_lon = schedules_stops_df.groupby('trip_id')['stop_lon'].shift(1)
+
+  # Parse the GTFS times once per schedule, to seconds past the start of the service date
+  schedules_stops_df['arrival_time'] = gtfs_time_to_seconds(schedules_stops_df['arrival_time'])
+  schedules_stops_df['departure_time'] = gtfs_time_to_seconds(schedules_stops_df['departure_time'])
+
+  # Calculate expected trip duration
+  grouped_seconds = schedules_stops_df['arrival_time'].groupby(schedules_stops_df['trip_id'])
+  schedules_stops_df['exp_trip_duration'] = (grouped_seconds.transform('max') - grouped_seconds.transform('min')).astype('float64')
+
+  # Get first and last stop ids (to see where the vehicle is coming from and where it is going)
+  stop_id_index = schedules_stops_df.columns.get_loc('stop_id')
+  first_stop_id = schedules_stops_df.groupby('trip_id')['stop_id'].transform('first')
+  last_stop_id = schedules_stops_df.groupby('trip_id')['stop_id'].transform('last')
+  schedules_stops_df.insert(stop_id_index + 1, 'first_stop_id', first_stop_id)
+  schedules_stops_df.insert(stop_id_index + 2, 'last_stop_id', last_stop_id)
+
+  # Calculate distance from previous stop (zero for the first stop of the trip)
+  schedules_stops_df['stop_distance'] = get_stop_distance(prev_lat, prev_lon, schedules_stops_df['stop_lat'], schedules_stops_df['stop_lon']).fillna(0)
+
+  # Keep relevant trip columns and translate directions
+  trips_df = trips_df[['trip_id', 'route_id', 'trip_headsign']].rename(columns={'trip_headsign': 'route_direction'})
+  condition_list = [
+    trips_df['route_direction'].str.contains('Nord'),
+    trips_df['route_direction'].str.contains('Sud'),
+    trips_df['route_direction'].str.contains('Ouest'),
+    trips_df['route_direction'].str.contains('Est'),
+  ]
+  label_list = ['North', 'South', 'West', 'East']
+  trips_df = trips_df.assign(route_direction=np.select(condition_list, label_list, default='Metro'))
+
+  # Merge with schedules and stops (wheelchair_boarding is kept as it's stop specific)
+  return pd.merge(left=schedules_stops_df, right=trips_df, how='inner', on='trip_id')
+
+def get_partition_weather(weather_df:pd.DataFrame, service_date:str) -> pd.DataFrame:
+  '''Weather rows that arrivals of a service date can be joined with (trips end the next morning)'''
+  day = datetime.strptime(service_date, '%Y%m%d')
+  start = (day - timedelta(days=1)).strftime('%Y-%m-%d')
+  end = (day + timedelta(days=3)).strftime('%Y-%m-%d')
+  return weather_df[(weather_df['time'] >= start) & (weather_df['time'] < end)].reset_index(drop=True)
+
+def clean_trip_updates(trip_updates_df:pd.DataFrame, scheduled_trips_df:pd.DataFrame, routes_df:pd.DataFrame,
+                       weather_df:pd.DataFrame, timer:StageTimer) -> pd.DataFrame:
+  '''
+  Cleans the trip updates of a service date and merges them with the
+  schedule features, route types and weather, as the data cleaning notebook
+  did for all trip updates. Null delays are kept, read_cleaned_data fills
+  them with the overall average.
+  '''
+  with timer.stage('merge'):
+    # Convert route_id to integer and the keys to the schedule types
+    trip_updates_df['route_id'] = trip_updates_df['route_id'].str.extract(r'(\d+)', expand=False).astype('int64')
+    for column in ['trip_id', 'stop_id']:
+      if pd.api.types.is_integer_dtype(scheduled_trips_df[column]) and not pd.api.types.is_integer_dtype(trip_updates_df[column]):
+        trip_updates_df[column] = pd.to_numeric(trip_updates_df[column], errors='coerce')
+        trip_updates_df = trip_updates_df.dropna(subset=[column]).astype({column: 'int64'})
+
+    # Remove duplicates (the prediction was the same over several polls), keeping the last poll
+    trip_updates_df = trip_updates_df.sort_values('current_time', kind='stable')
+    trip_updates_df = trip_updates_df.drop_duplicates(subset=FEED_COLUMNS, keep='last').reset_index(drop=True)
+    trip_updates_df = trip_updates_df.drop('first_seen', axis=1, errors='ignore')
+
+    # Merge trip updates with schedule
+    trip_updates_df = trip_updates_df.rename(columns={'arrival_time': 'rt_arrival_time', 'departure_time': 'rt_departure_time'})
+    merged_stm_df = pd.merge(left=trip_updates_df, right=scheduled_trips_df, how='inner', on=['trip_id', 'route_id', 'stop_id'])
+
+  with timer.stage('parse_times'):
+    # Convert the scheduled arrival and departure times (seconds past the start of the service date) to UTC
+    merged_stm_df['start_date_dt'] = pd.to_datetime(merged_stm_df['start_date'], format='%Y%m%d')
+    merged_stm_df['sch_arrival_time'] = parse_gtfs_time(merged_stm_df, 'start_date_dt', 'arrival_time').dt.tz_convert(timezone.utc)
+    merged_stm_df['sch_departure_time'] = parse_gtfs_time(merged_stm_df, 'start_date_dt', 'departure_time').dt.tz_convert(timezone.utc)
+
+    # Get number of arrivals per hour
+    merged_stm_df['arrival_hour'] = merged_stm_df['sch_arrival_time'].dt.floor('h')
+    merged_stm_df['arrivals_per_hour'] = merged_stm_df.groupby(['route_id', 'route_direction', 'stop_id', 'arrival_hour']).transform('size')
+
+    # Convert realtime arrival and departure time (0 when unknown) to UTC datetime
+    for column in ['rt_arrival_time', 'rt_departure_time']:
+      merged_stm_df[column] = pd.to_datetime(merged_stm_df[column].replace({0: np.nan}), origin='unix', unit='s', utc=True)
+
+  with timer.stage('delays'):
+    # Calculate delay (realtime - scheduled), with the departure time when the arrival time is null
+    merged_stm_df['delay'] = (merged_stm_df['rt_arrival_time'] - merged_stm_df['sch_arrival_time']) / pd.Timedelta(seconds=1)
+    merged_stm_df['delay'] = merged_stm_df['delay'].fillna((merged_stm_df['rt_departure_time'] - merged_stm_df['sch_departure_time']) / pd.Timedelta(seconds=1))
+
+    # Remove outliers: a delay longer than the expected trip duration is most likely a cancelled trip
+    outlier_mask = (merged_stm_df['delay'] <= merged_stm_df['exp_trip_duration'] * -0.25) | (merged_stm_df['delay'] >= merged_stm_df['exp_trip_duration'])
+    merged_stm_df = merged_stm_df[~outlier_mask].reset_index(drop=True)
+
+    # Remove uneeded columns
+    merged_stm_df = merged_stm_df.drop(['current_time', 'start_date', 'start_date_dt', 'arrival_time', 'departure_time', 'arrival_hour'], axis=1)
+
+  with timer.stage('weather'):
+    stm_df = pd.merge(left=merged_stm_df, right=routes_df, how='inner', on='route_id')
+
+    # Merge with the weather of the arrival time rounded to the nearest hour
+    stm_df['time'] = stm_df['sch_arrival_time'].dt.round('h').dt.strftime('%Y-%m-%dT%H:%M')
+    return pd.merge(left=stm_df, right=weather_df, how='inner', on='time').drop('time', axis=1)
+
+def get_trip_update_partitions(trip_updates_path:str) -> dict:
+  '''Returns the Parquet files of each service date of a trip updates dataset'''
+  partitions = {}
+  if not os.path.isdir(trip_updates_path):
+    return partitions
+
+  for partition_name in sorted(os.listdir(trip_updates_path)):
+    if not partition_name.startswith('service_date='):
+      continue
+    service_date = partition_name.split('=', 1)[1]
+    partition_path = os.path.join(trip_updates_path, partition_name)
+    files = []
+    for root, dirs, names in os.walk(partition_path):
+      dirs.sort()
+      files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.parquet') and not name.startswith(('.', '_')))
+    if files:
+      partitions[service_date] = files
+  return partitions
+
+def build_schedule_features(schedule_paths:dict, schedule_path:str) -> dict:
+  '''Builds the schedule features from the CSV files and writes them to schedule_path. Returns the stage report.'''
+  timer = StageTimer()
+  with timer.stage('schedule'):
+    scheduled_trips_df = get_schedule_features(
+      pd.read_csv(schedule_paths['stop_times']), pd.read_csv(schedule_paths['stops']), pd.read_csv(schedule_paths['trips'])
+    )
+    write_parquet_atomic(pa.Table.from_pandas(scheduled_trips_df, preserve_index=False), schedule_path)
+  return timer.stages['schedule']
+
+# Schedule features loaded by a worker process, kept for its next partitions
+_worker_state = {}
+
+def get_worker_schedule(schedule_path:str) -> pd.DataFrame:
+  if _worker_state.get('schedule_path') != schedule_path:
+    _worker_state['scheduled_trips_df'] = pd.read_parquet(schedule_path)
+    _worker_state['schedule_path'] = schedule_path
+  return _worker_state['scheduled_trips_df']
+
+def clean_partition(service_date:str, files:list[str], schedule_path:str, routes_df:pd.DataFrame, weather_df:pd.DataFrame, output_path:str) -> dict:
+  '''Cleans the trip updates of a service date and writes them to the output dataset. Returns the partition report.'''
+  timer = StageTimer()
+
+  with timer.stage('load'):
+    scheduled_trips_df = get_worker_schedule(schedule_path)
+    trip_updates_df = pa.concat_tables([pq.read_table(path, partitioning=None) for path in files], promote_options='default').to_pandas()
+    n_trip_updates = len(trip_updates_df)
+
+  df = clean_trip_updates(trip_updates_df, scheduled_trips_df, routes_df, weather_df, timer)
+
+  with timer.stage('write'):
+    partition_path = os.path.join(output_path, f'service_date={service_date}')
+    file_path = os.path.join(partition_path, 'part-0.parquet')
+    os.makedirs(partition_path, exist_ok=True)
+    if len(df) > 0:
+      write_parquet_atomic(pa.Table.from_pandas(df, preserve_index=False), file_path)
+    elif os.path.isfile(file_path):
+      os.remove(file_path)
+
+  return {'service_date': service_date, 'trip_updates': n_trip_updates, 'rows': len(df), 'stages': timer.stages}
+
+def read_manifest(output_path:str) -> dict:
+  manifest_path = os.path.join(output_path, MANIFEST_FILE)
+  if os.path.isfile(manifest_path):
+    with open(manifest_path) as file:
+      manifest = json.load(file)
+    if manifest.get('format_version') == CLEANING_FORMAT_VERSION:
+      return manifest
+  return {'format_version': CLEANING_FORMAT_VERSION, 'schedule': None, 'partitions': {}}
+
+def write_manifest(manifest:dict, output_path:str) -> None:
+  manifest_path = os.path.join(output_path, MANIFEST_FILE)
+  tmp_path = os.path.join(output_path, f'.{MANIFEST_FILE}.tmp')
+  with open(tmp_path, 'w') as file:
+    json.dump(manifest, file, indent=2, sort_keys=True)
+  os.replace(tmp_path, manifest_path)
+
+def run_cleaning_pipeline(trip_updates_path:str, schedule_paths:dict, routes_path:str, weather_path:str, output_path:str,
+                          max_workers:int=CLEANING_WORKERS, force:bool=False) -> dict:
+  '''
+  Cleans the trip updates dataset one service date at a time, in parallel
+  across a process pool, into output_path/service_date=YYYYMMDD/.
+
+  schedule_paths has the 'stop_times', 'trips' and 'stops' CSV paths. A
+  service date is skipped when its trip update files, the schedule, the
+  route types and its weather hours are the same as when it was last
+  cleaned (recorded in the manifest). Returns the run report: the seconds
+  and peak resident memory of each stage, by partition.
+  '''
+  start = time.perf_counter()
+  os.makedirs(output_path, exist_ok=True)
+  manifest = read_manifest(output_path)
+  timer = StageTimer()
+
+  with timer.stage('plan'):
+    schedule_fingerprint = get_hash([CLEANING_FORMAT_VERSION, get_file_signature([schedule_paths[name] for name in ['stop_times', 'trips', 'stops']])])
+    schedule_path = os.path.join(output_path, SCHEDULE_FILE)
+    build_schedule = force or manifest['schedule'] != schedule_fingerprint or not os.path.isfile(schedule_path)
+
+    routes_df = pd.read_csv(routes_path)
+    weather_df = pd.read_csv(weather_path)
+    routes_fingerprint = get_hash(pd.util.hash_pandas_object(routes_df, index=False).tolist())
+
+    tasks = {}
+    skipped = []
+    for service_date, files in get_trip_update_partitions(trip_updates_path).items():
+      partition_weather_df = get_partition_weather(weather_df, service_date)
+      fingerprint = get_hash([
+        schedule_fingerprint, routes_fingerprint, get_file_signature(files),
+        pd.util.hash_pandas_object(partition_weather_df, index=False).tolist(),
+      ])
+      previous = manifest['partitions'].get(service_date)
+      if not force and previous is not None and previous['fingerprint'] == fingerprint:
+        skipped.append(service_date)
+      else:
+        tasks[service_date] = (files, partition_weather_df, fingerprint)
+
+  partitions = []
+  def record(report:dict, fingerprint:str) -> None:
+    # The manifest is written after every partition, so an interrupted run keeps its progress
+    manifest['partitions'][report['service_date']] = {'fingerprint': fingerprint, 'rows': report['rows']}
+    write_manifest(manifest, output_path)
+    partitions.append(report)
+    logging.info('Cleaning: service date %s, %d trip updates, %d rows', report['service_date'], report['trip_updates'], report['rows'])
+
+  # The schedule features are built again only when an input file changed. All the
+  # work is done by the workers, so the processes forked later do not inherit it.
+  if max_workers <= 1:
+    if build_schedule:
+      timer.stages['schedule'] = build_schedule_features(schedule_paths, schedule_path)
+    for service_date, (files, partition_weather_df, fingerprint) in tasks.items():
+      record(clean_partition(service_date, files, schedule_path, routes_df, partition_weather_df, output_path), fingerprint)
+    _worker_state.clear()
+  elif build_schedule or tasks:
+    with ProcessPoolExecutor(max_workers) as executor:
+      if build_schedule:
+        timer.stages['schedule'] = executor.submit(build_schedule_features, schedule_paths, schedule_path).result()
+      futures = {
+        executor.submit(clean_partition, service_date, files, schedule_path, routes_df, partition_weather_df, output_path): fingerprint
+        for service_date, (files, partition_weather_df, fingerprint) in tasks.items()
+      }
+      for future in as_completed(futures):
+        record(future.result(), futures[future])
+
+  manifest['schedule'] = schedule_fingerprint
+  write_manifest(manifest, output_path)
+  return {
+    'seconds': time.perf_counter() - start,
+    'stages': timer.stages,
+    'partitions': sorted(partitions, key=lambda report: report['service_date']),
+    'skipped': skipped,
+  }
+
+def read_cleaned_data(output_path:str) -> pd.DataFrame:
+  '''
+  Reads the cleaned partitions and applies the steps that need every row,
+  which gives the data the cleaning notebook exported to
+  stm_weather_merged.parquet.
+  '''
+  df = pd.read_parquet(output_path).drop('service_date', axis=1)
+  df = df.sort_values('sch_arrival_time', kind='stable').reset_index(drop=True)
+
+  # Replace the null delays with the overall average delay
+  df['delay'] = df['delay'].fillna(df['delay'].mean())
+
+  # Remove columns with constant values or with more than 50% missing values
+  df = df.loc[:, (df.nunique() > 1) & (df.isna().mean() < 0.5)]
+
+  # Convert wheelchair_boarding to boolean and schedule_relationship to categories
+  if 'wheelchair_boarding' in df.columns:
+    df['wheelchair_boarding'] = (df['wheelchair_boarding'] == 1).astype('int64')
+  if 'schedule_relationship' in df.columns:
+    df['schedule_relationship'] = df['schedule_relationship'].map(SCHEDULE_RELATIONSHIP).fillna('Unknown')
+
+  return df
@@ -4,11 +4,15 @@ from pathlib import Path
 
 # Directories and files
 ROOT_DIR = Path(__file__).parent.parent.resolve()
-DATA_DIR = 'data'
+DATA_DIR = os.getenv('DATA_DIR', 'data') # relative to the root directory
 API_DIR = 'api'
 DOWNLOAD_DIR = 'download'
-MODELS_DIR = 'models'
-LOG_FILE = os.path.join(ROOT_DIR, 'stm_api_errors.log')
+SNAPSHOT_DIR = 'snapshot'
+PREDICTION_GRID_DIR = 'prediction_grid'
+TRIP_UPDATES_DIR = 'trip_updates'
+MODELS_DIR = os.getenv('MODELS_DIR', 'models') # relative to the root directory
+LOG_FILE = os.getenv('LOG_FILE', os.path.join(ROOT_DIR, 'stm_api_errors.log'))
+WEATHER_DB_FILE = os.path.join(ROOT_DIR, DATA_DIR, 'weather.sqlite')
 
 # Logger
 logging.getLogger('stm.delay_prediction')
@@ -25,6 +29,110 @@ MTL_COORDS = {
   'longitude':  -73.561668
 }
 
+# Open-Meteo endpoints (can point to a local server for testing)
+OPEN_METEO_ARCHIVE_URL = os.getenv('OPEN_METEO_ARCHIVE_URL', 'https://archive-api.open-meteo.com/v1/archive')
+OPEN_METEO_FORECAST_URL = os.getenv('OPEN_METEO_FORECAST_URL', 'https://api.open-meteo.com/v1/forecast')
+
+# Weather features used by the model
+WEATHER_ATTRIBUTES = [
+  'cloud_cover',
+  'relative_humidity_2m',
+  'temperature_2m',
+  'wind_direction_10m',
+  'wind_speed_10m',
+  'weathercode'
+]
+
+# Weather store refresh settings
+WEATHER_REFRESH_INTERVAL = int(os.getenv('WEATHER_REFRESH_INTERVAL', 3600)) # seconds, 0 disables the refresher
+WEATHER_CACHE_TTL = 300 # seconds
+WEATHER_FORECAST_MAX_AGE = 3 * 3600 # seconds
+WEATHER_FORECAST_DAYS = 16
+WEATHER_ARCHIVE_DAYS = 7
+
+# Weather fetch limits during a prediction request
+WEATHER_FETCH_BUDGET = float(os.getenv('WEATHER_FETCH_BUDGET', 2)) # seconds
+WEATHER_BREAKER_THRESHOLD = 3 # consecutive failures before failing fast
+WEATHER_BREAKER_RESET = 60 # seconds before trying the API again
+WEATHER_NEAREST_MAX_HOURS = 24
+
+# Model inference
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', 1)) # threads per prediction, keep low when serving concurrent requests
+INFERENCE_BATCH_SIZE = 65536 # rows per inplace_predict call in batched predictions
+PREDICT_BATCH_MAX_QUERIES = 1000
+DEPARTURES_DEFAULT_COUNT = 10
+DEPARTURES_MAX_COUNT = 50
+TREE_EVALUATOR_MAX_WORK = 1024 # up to this many rows x trees, predictions walk the flattened trees in NumPy
+
+# Serving with several workers (gunicorn.conf.py)
+SERVING_PRELOAD = os.getenv('SERVING_PRELOAD') == '1' # set by gunicorn.conf.py, the app is loaded once and the workers are forked from it
+
+# Versioned artifact bundles (scripts/build_bundle.py)
+BUNDLES_DIR = 'bundles' # one directory per version and the CURRENT file, in the data directory
+BUNDLE_RELOAD_INTERVAL = 30 # seconds between checks for a newly published version
+
+# Precomputed predictions
+PREDICTION_GRID_DAYS = 15 # service dates from today, /predict accepts times up to two weeks ahead
+PREDICTION_GRID_RELOAD_INTERVAL = 60 # seconds between checks for a newer grid
+
+# Metrics and profiling (see src/metrics.py and src/profiler.py)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0)) # fraction of requests profiled, 0 disables the random profiles
+PROFILE_HEADER_ENABLED = os.getenv('PROFILE_HEADER_ENABLED') == '1' # requests with an X-Profile: 1 header are profiled
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.001)) # seconds between two stack samples
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(ROOT_DIR, 'profiles'))
+
+# Prediction mode: 'expected' weights the predictions with and without schedule_relationship_Scheduled, 'sampled' draws it at random
+PREDICTION_MODE = os.getenv('PREDICTION_MODE', 'expected')
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', 100000)) # predictions, 0 disables the cache (always disabled in sampled mode)
+PREDICTION_CACHE_TTL = 3600 # seconds
+
+# GTFS-RT trip updates collector
+STM_TRIP_UPDATES_URL = os.getenv('STM_TRIP_UPDATES_URL', 'https://api.stm.info/pub/od/gtfs-rt/ic/v2/tripUpdates')
+TRIP_UPDATES_POLL_INTERVAL = 60 # seconds between polls in collector mode
+TRIP_UPDATES_FLUSH_ROWS = 500000 # buffered rows before writing Parquet files
+TRIP_UPDATES_FLUSH_INTERVAL = 900 # seconds of polls kept in the buffer before writing
+TRIP_UPDATES_EXPIRE_AFTER = 600 # seconds a stop time update can be missing from the feed before its prediction is written
+TRIP_UPDATES_STATE_FILE = '_trip_update_state.parquet' # in the dataset directory, ignored by Parquet readers
+
+# Cleaning pipeline (scripts/clean_data.py)
+CLEANED_DATA_DIR = 'stm_weather_merged' # partitioned by service date, in the data directory
+CLEANING_WORKERS = int(os.getenv('CLEANING_WORKERS', os.cpu_count() or 1)) # processes cleaning service dates in parallel
+
+# Model training (scripts/train_model.py)
+PREPROCESSED_DATA = 'preprocessed.parquet' # file or directory of partitions, in the data directory
+TRAINING_BATCH_ROWS = int(os.getenv('TRAINING_BATCH_ROWS', 100000)) # rows read from Parquet at a time
+
+# Historical average delays (scripts/update_hist_delays.py)
+HIST_DELAYS_DIR = 'hist_delays' # aggregator state, in the data directory
+HIST_DELAYS_HALF_LIFE = float(os.getenv('HIST_DELAYS_HALF_LIFE', 0)) # days, 0 keeps plain averages only
+HIST_DELAYS_RELOAD_INTERVAL = 60 # seconds between checks for a newer hist_avg_delays.csv
+
+# STM schedule and route types pages (can point to a local server for testing)
+STM_GTFS_URL = os.getenv('STM_GTFS_URL', 'https://www.stm.info/sites/default/files/gtfs/gtfs_stm.zip')
+STM_ROUTE_TYPES_URL = os.getenv('STM_ROUTE_TYPES_URL', 'https://www.stm.info/en/info/networks/bus')
+
+# Ingestion service (scripts/run_ingestion.py), intervals in seconds
+INGESTION_TRIP_UPDATES_INTERVAL = 30
+INGESTION_WEATHER_INTERVAL = 24 * 3600
+INGESTION_SCHEDULE_INTERVAL = 24 * 3600
+INGESTION_ROUTE_TYPES_INTERVAL = 7 * 24 * 3600
+INGESTION_MAX_CONCURRENCY = 4 # jobs running at the same time
+INGESTION_MAX_CONNECTIONS = 10
+INGESTION_MAX_RETRIES = 5
+INGESTION_BACKOFF_BASE = 1 # seconds, doubled on every retry (with full jitter)
+INGESTION_BACKOFF_MAX = 60 # seconds
+INGESTION_TIMEOUT = 10 # seconds per HTTP request
+
+# Montreal monthly climate normals (January to December), used when no weather data is available
+WEATHER_CLIMATE_NORMALS = {
+  'cloud_cover': [62, 58, 58, 59, 57, 54, 50, 50, 53, 60, 69, 69],
+  'relative_humidity_2m': [72, 69, 66, 62, 62, 66, 67, 70, 72, 71, 74, 75],
+  'temperature_2m': [-9.7, -7.7, -2.0, 6.4, 13.4, 18.6, 21.2, 20.1, 15.5, 8.5, 2.3, -5.4],
+  'wind_direction_10m': [250, 250, 240, 230, 220, 230, 240, 240, 240, 240, 250, 250],
+  'wind_speed_10m': [16.0, 15.5, 15.6, 15.2, 13.3, 12.0, 11.0, 10.7, 11.8, 13.5, 15.0, 15.8],
+  'weathercode': [3, 3, 3, 3, 2, 2, 2, 2, 2, 3, 3, 3],
+}
+
 SCHEDULE_RELATIONSHIP = {
   0: 'Scheduled',
   1: 'Skipped',
@@ -0,0 +1,63 @@
+import joblib
+import numpy as np
+import pandas as pd
+
+class FeaturePlan:
+  '''
+  Computes the model features from the base features in one vectorized step.
+
+  Feature names follow PolynomialFeatures.get_feature_names_out: either a
+  base feature ('hist_avg_delay') or the product of two base features
+  separated by a space ('hist_avg_delay route_bearing').
+  '''
+
+  def __init__(self, feature_names:list[str]) -> None:
+    self.feature_names = list(feature_names)
+
+    # Parse interaction names into pairs of base features
+    terms = [name.split(' ') for name in self.feature_names]
+    for name, factors in zip(self.feature_names, terms):
+      if len(factors) not in (1, 2):
+        raise ValueError(f'Unsupported feature: {name}')
+
+    self.base_features = sorted({factor for factors in terms for factor in factors})
+    base_index = {feature: index for index, feature in enumerate(self.base_features)}
+
+    # Single features are multiplied by a column of ones appended to the base matrix
+    ones_index = len(self.base_features)
+    self.left_index = np.array([base_index[factors[0]] for factors in terms], dtype='intp')
+    self.right_index = np.array([base_index[factors[1]] if len(factors) == 2 else ones_index for factors in terms], dtype='intp')
+
+  def get_base_matrix(self, records:list[dict]) -> np.ndarray:
+    '''Returns the base features of each record as a float64 matrix with a trailing column of ones'''
+    base = np.ones((len(records), len(self.base_features) + 1), dtype='float64')
+    if records:
+      base[:, :-1] = [[record[feature] for feature in self.base_features] for record in records]
+    return base
+
+  def get_base_matrix_from_frame(self, df:pd.DataFrame) -> np.ndarray:
+    base = np.ones((len(df), len(self.base_features) + 1), dtype='float64')
+    base[:, :-1] = df[self.base_features].to_numpy(dtype='float64')
+    return base
+
+  def transform(self, base:np.ndarray, out:np.ndarray|None=None) -> np.ndarray:
+    '''
+    Fills a float32 matrix (N rows x number of features) from a base matrix
+    returned by get_base_matrix. The products are computed in float64 and
+    rounded once, like a pandas DataFrame converted to a DMatrix.
+    '''
+    if out is None:
+      out = np.empty((base.shape[0], len(self.feature_names)), dtype='float32')
+    np.multiply(base[:, self.left_index], base[:, self.right_index], out=out)
+    return out
+
+  def transform_records(self, records:list[dict], out:np.ndarray|None=None) -> np.ndarray:
+    return self.transform(self.get_base_matrix(records), out=out)
+
+  def transform_frame(self, df:pd.DataFrame) -> pd.DataFrame:
+    '''Returns the features of a DataFrame of base features (e.g. for training)'''
+    features = self.transform(self.get_base_matrix_from_frame(df))
+    return pd.DataFrame(features, columns=self.feature_names, index=df.index)
+
+def load_feature_plan(best_features_path:str) -> FeaturePlan:
+  return FeaturePlan(joblib.load(best_features_path))
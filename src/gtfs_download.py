@@ -0,0 +1,174 @@
+from datetime import datetime, timezone
+import hashlib
+import json
+import logging
+import os
+import requests
+import shutil
+import zipfile
+
+# GTFS files used by the app and the notebooks
+GTFS_FILES = ['routes', 'stops', 'stop_times', 'trips', 'calendar']
+
+DOWNLOAD_STATE_FILE = '_download_state.json' # validators and checksum of the last archive, in the download directory
+WRITE_BUFFER_SIZE = 1024 * 1024 # bytes
+DOWNLOAD_TIMEOUT = 60 # seconds without data before a download fails
+
+class DownloadWriter:
+  '''
+  Writes a download through a large buffer under a temporary name. The file
+  is synced once and renamed when the download completes, and removed if it
+  fails. Its size and SHA-256 checksum are computed on the way.
+  '''
+
+  def __init__(self, path:str) -> None:
+    self.path = path
+    self.tmp_path = f'{path}.tmp'
+    self.size = 0
+    self._digest = hashlib.sha256()
+    self._file = None
+
+  def __enter__(self) -> 'DownloadWriter':
+    self._file = open(self.tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE)
+    return self
+
+  def write(self, chunk:bytes) -> None:
+    self._file.write(chunk)
+    self._digest.update(chunk)
+    self.size += len(chunk)
+
+  @property
+  def sha256(self) -> str:
+    return self._digest.hexdigest()
+
+  def __exit__(self, exc_type, exc, traceback) -> None:
+    try:
+      if exc_type is None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+    finally:
+      self._file.close()
+
+    if exc_type is None:
+      os.replace(self.tmp_path, self.path)
+    elif os.path.exists(self.tmp_path):
+      os.remove(self.tmp_path)
+
+def read_download_state(dest_folder:str) -> dict:
+  state_path = os.path.join(dest_folder, DOWNLOAD_STATE_FILE)
+  if not os.path.isfile(state_path):
+    return {}
+
+  with open(state_path) as f:
+    return json.load(f)
+
+def write_download_state(state:dict, dest_folder:str) -> None:
+  state_path = os.path.join(dest_folder, DOWNLOAD_STATE_FILE)
+  tmp_path = f'{state_path}.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(state, f, indent=2)
+  os.replace(tmp_path, state_path)
+
+def get_conditional_headers(state:dict, url:str) -> dict:
+  '''Returns the validators of the last archive downloaded from url, so that the server can answer 304 Not Modified'''
+  if state.get('url') != url:
+    return {}
+
+  headers = {}
+  if state.get('etag'):
+    headers['If-None-Match'] = state['etag']
+  if state.get('last_modified'):
+    headers['If-Modified-Since'] = state['last_modified']
+  return headers
+
+def get_zip_path(url:str, dest_folder:str) -> str:
+  '''The archive is downloaded next to the download directory, which is replaced by the extraction'''
+  return os.path.join(os.path.dirname(os.path.abspath(dest_folder)), os.path.basename(url))
+
+def replace_folder(tmp_folder:str, dest_folder:str) -> None:
+  '''Replaces a directory by another one with renames, then removes the previous one'''
+  old_folder = f'{dest_folder}.old'
+  shutil.rmtree(old_folder, ignore_errors=True)
+  if os.path.exists(dest_folder):
+    os.rename(dest_folder, old_folder)
+  os.rename(tmp_folder, dest_folder)
+  shutil.rmtree(old_folder, ignore_errors=True)
+
+def extract_gtfs(zip_file_path:str, dest_folder:str, state:dict|None=None) -> None:
+  '''
+  Streams the GTFS_FILES out of a GTFS archive into a temporary directory,
+  which then replaces the download directory. The other members (e.g. the
+  large shapes.txt) are never written. The archive is deleted.
+  '''
+  tmp_folder = f'{dest_folder}.tmp'
+  shutil.rmtree(tmp_folder, ignore_errors=True)
+  os.makedirs(tmp_folder)
+
+  logging.info('Unzipping %s', os.path.basename(zip_file_path))
+  with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+    members = {os.path.basename(info.filename): info for info in zip_ref.infolist() if not info.is_dir()}
+    file_names = [f'{name}.txt' for name in GTFS_FILES]
+    missing = [file_name for file_name in file_names if file_name not in members]
+    if missing:
+      shutil.rmtree(tmp_folder)
+      raise ValueError(f'{", ".join(missing)} missing from {zip_file_path}')
+
+    for file_name in file_names:
+      with zip_ref.open(members[file_name]) as source, open(os.path.join(tmp_folder, file_name), 'wb') as target:
+        shutil.copyfileobj(source, target, WRITE_BUFFER_SIZE)
+        target.flush()
+        os.fsync(target.fileno())
+
+  if state is not None:
+    write_download_state(state, tmp_folder)
+  replace_folder(tmp_folder, dest_folder)
+
+  logging.info('Deleting %s', zip_file_path)
+  os.remove(zip_file_path)
+
+def install_gtfs(zip_file_path:str, dest_folder:str, state:dict, previous_state:dict) -> bool:
+  '''
+  Extracts a downloaded archive unless it is the one already extracted (a
+  server without validators sends it again). Returns whether the GTFS files
+  changed.
+  '''
+  if state['sha256'] == previous_state.get('sha256') and os.path.isdir(dest_folder):
+    logging.info('GTFS archive unchanged (%s), keeping the extracted files', state['sha256'][:16])
+    os.remove(zip_file_path)
+    write_download_state(state, dest_folder)
+    return False
+
+  extract_gtfs(zip_file_path, dest_folder, state)
+  return True
+
+def get_download_state(url:str, headers, writer:DownloadWriter) -> dict:
+  return {
+    'url': url,
+    'etag': headers.get('ETag'),
+    'last_modified': headers.get('Last-Modified'),
+    'size': writer.size,
+    'sha256': writer.sha256,
+    'downloaded_at': datetime.now(timezone.utc).isoformat(),
+  }
+
+def download_gtfs(url:str, dest_folder:str, session:requests.Session|None=None) -> bool:
+  '''
+  Downloads the GTFS archive with a conditional request and extracts it.
+  Returns whether the GTFS files changed (False on 304 Not Modified).
+  '''
+  previous_state = read_download_state(dest_folder)
+  headers = get_conditional_headers(previous_state, url)
+  zip_file_path = get_zip_path(url, dest_folder)
+
+  with (session or requests).get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+    if response.status_code == 304:
+      logging.info('GTFS archive not modified since %s', previous_state.get('downloaded_at'))
+      return False
+    response.raise_for_status()
+
+    logging.info('Saving file as %s', zip_file_path)
+    with DownloadWriter(zip_file_path) as writer:
+      for chunk in response.iter_content(chunk_size=WRITE_BUFFER_SIZE):
+        writer.write(chunk)
+
+  return install_gtfs(zip_file_path, dest_folder, get_download_state(url, response.headers, writer), previous_state)
@@ -0,0 +1,233 @@
+from datetime import datetime, timezone
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import shutil
+
+# Import custom code
+from src.helper_functions import gtfs_time_to_seconds
+from src.schedule_index import ScheduleIndex, localize_calendar
+from src.schedule_metadata import ScheduleMetadata
+
+# Increment when the layout of the snapshot changes
+SNAPSHOT_FORMAT_VERSION = 1
+
+MANIFEST_FILE = 'manifest.json'
+INDEX_DIR = 'index' # schedule index and metadata built from the snapshot
+METADATA_FILE = 'metadata.pkl'
+
+# Source files and the columns kept from each of them
+SNAPSHOT_TABLES = {
+  'routes': ('download', 'routes.txt', ['route_id', 'route_long_name', 'route_type', 'route_color', 'route_text_color']),
+  'trips': ('download', 'trips.txt', ['route_id', 'service_id', 'trip_id', 'trip_headsign']),
+  'stop_times': ('download', 'stop_times.txt', ['trip_id', 'arrival_time', 'stop_id', 'stop_sequence']),
+  'calendar': ('download', 'calendar.txt', None),
+  'stops': ('data', 'stops_with_clusters.csv', None),
+  'hist_avg_delays': ('data', 'hist_avg_delays.csv', None),
+}
+
+# Tables whose source is published on its own schedule and loaded again by the app when it changes
+# (see HistDelayReloader), so a newer file does not make the snapshot and its index outdated
+RELOADED_TABLES = ['hist_avg_delays']
+
+def get_source_path(table:str, download_path:str, data_path:str) -> str:
+  folder, file_name, _ = SNAPSHOT_TABLES[table]
+  return os.path.join(download_path if folder == 'download' else data_path, file_name)
+
+def get_narrow_dtype(values:np.ndarray) -> np.dtype:
+  '''Returns the smallest signed integer type that holds all the values'''
+  if len(values) == 0:
+    return np.dtype('int8')
+
+  min_value, max_value = values.min(), values.max()
+  for dtype in ['int8', 'int16', 'int32']:
+    info = np.iinfo(dtype)
+    if min_value >= info.min and max_value <= info.max:
+      return np.dtype(dtype)
+
+  return np.dtype('int64')
+
+def get_source_stats(source_paths:dict) -> dict:
+  stats = {}
+  for table, path in source_paths.items():
+    if os.path.isfile(path):
+      file_stat = os.stat(path)
+      stats[table] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+  return stats
+
+def load_csv_tables(download_path:str, data_path:str) -> dict:
+  '''Reads the GTFS feed and derived CSV files with pandas defaults'''
+  return {
+    'routes': pd.read_csv(get_source_path('routes', download_path, data_path)),
+    'trips': pd.read_csv(get_source_path('trips', download_path, data_path)),
+    'stop_times': pd.read_csv(get_source_path('stop_times', download_path, data_path)),
+    'calendar': pd.read_csv(get_source_path('calendar', download_path, data_path), parse_dates=['start_date', 'end_date'], date_format='%Y%m%d'),
+    'stops': pd.read_csv(get_source_path('stops', download_path, data_path)),
+    'hist_avg_delays': pd.read_csv(get_source_path('hist_avg_delays', download_path, data_path)),
+  }
+
+def write_table(df:pd.DataFrame, table_path:str) -> dict:
+  '''Writes each column as a .npy file (strings as category codes) and returns its schema'''
+  os.makedirs(table_path)
+  columns = {}
+
+  for column in df.columns:
+    values = df[column]
+
+    if pd.api.types.is_integer_dtype(values) and not values.isna().any():
+      array = values.to_numpy()
+      array = array.astype(get_narrow_dtype(array))
+      np.save(os.path.join(table_path, f'{column}.npy'), array)
+      columns[column] = {'kind': 'numeric', 'dtype': array.dtype.str}
+    elif pd.api.types.is_numeric_dtype(values):
+      array = values.to_numpy(dtype='float64')
+      np.save(os.path.join(table_path, f'{column}.npy'), array)
+      columns[column] = {'kind': 'numeric', 'dtype': array.dtype.str}
+    else:
+      codes, categories = pd.factorize(values.astype('string'), sort=True)
+      codes = codes.astype(get_narrow_dtype(codes))
+      np.save(os.path.join(table_path, f'{column}.codes.npy'), codes)
+      np.save(os.path.join(table_path, f'{column}.categories.npy'), np.asarray(categories, dtype='str'))
+      columns[column] = {'kind': 'categorical', 'dtype': codes.dtype.str, 'categories': len(categories)}
+
+  return {'rows': len(df), 'columns': columns}
+
+def build_snapshot(download_path:str, data_path:str, snapshot_path:str) -> dict:
+  '''
+  Converts the downloaded GTFS feed and the derived CSV files into a
+  columnar snapshot that can be memory-mapped at startup.
+  '''
+  source_paths = {table: get_source_path(table, download_path, data_path) for table in SNAPSHOT_TABLES}
+  tmp_path = f'{snapshot_path}.tmp'
+  shutil.rmtree(tmp_path, ignore_errors=True)
+  os.makedirs(tmp_path)
+
+  tables = {}
+  for table, (_, _, columns) in SNAPSHOT_TABLES.items():
+    logging.info('Adding %s to GTFS snapshot', source_paths[table])
+    df = pd.read_csv(source_paths[table], usecols=columns)
+
+    # Parse scheduled arrival times once
+    if table == 'stop_times':
+      df['arrival_secs'] = gtfs_time_to_seconds(df['arrival_time'])
+      df = df.drop('arrival_time', axis=1)
+
+    tables[table] = write_table(df, os.path.join(tmp_path, table))
+
+  manifest = {
+    'format_version': SNAPSHOT_FORMAT_VERSION,
+    'created_at': datetime.now(timezone.utc).isoformat(),
+    'sources': get_source_stats(source_paths),
+    'tables': tables,
+  }
+  with open(os.path.join(tmp_path, MANIFEST_FILE), 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+  # Build the lookups of the serving processes once, so that they only map them
+  save_schedule_lookups(tmp_path)
+
+  # Replace previous snapshot
+  shutil.rmtree(snapshot_path, ignore_errors=True)
+  os.rename(tmp_path, snapshot_path)
+
+  return manifest
+
+def read_manifest(snapshot_path:str) -> dict:
+  manifest_path = os.path.join(snapshot_path, MANIFEST_FILE)
+  if not os.path.isfile(manifest_path):
+    return {}
+
+  with open(manifest_path) as f:
+    return json.load(f)
+
+def is_snapshot_current(snapshot_path:str, download_path:str, data_path:str) -> bool:
+  '''
+  Checks that the snapshot has the current format and that none of the
+  source files still on disk changed since it was built (except the
+  RELOADED_TABLES ones).
+  '''
+  manifest = read_manifest(snapshot_path)
+  if manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+    return False
+
+  source_paths = {table: get_source_path(table, download_path, data_path) for table in SNAPSHOT_TABLES if table not in RELOADED_TABLES}
+  current_stats = get_source_stats(source_paths)
+  return all(manifest['sources'].get(table) == stats for table, stats in current_stats.items())
+
+class GtfsSnapshot:
+  '''Lazy, memory-mapped reader of a snapshot written by build_snapshot'''
+
+  def __init__(self, snapshot_path:str) -> None:
+    self.snapshot_path = snapshot_path
+    self.manifest = read_manifest(snapshot_path)
+    self._tables = {}
+
+    if self.manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+      raise ValueError(f'Unsupported GTFS snapshot format in {snapshot_path}')
+
+  def load_table(self, table:str) -> pd.DataFrame:
+    if table not in self._tables:
+      table_path = os.path.join(self.snapshot_path, table)
+      data = {}
+
+      for column, schema in self.manifest['tables'][table]['columns'].items():
+        if schema['kind'] == 'categorical':
+          codes = np.load(os.path.join(table_path, f'{column}.codes.npy'), mmap_mode='r')
+          categories = np.load(os.path.join(table_path, f'{column}.categories.npy'))
+          data[column] = pd.Categorical.from_codes(codes, categories=categories)
+        else:
+          data[column] = np.load(os.path.join(table_path, f'{column}.npy'), mmap_mode='r')
+
+      self._tables[table] = pd.DataFrame(data, copy=False)
+
+    return self._tables[table]
+
+  def load_tables(self) -> dict:
+    tables = {table: self.load_table(table) for table in SNAPSHOT_TABLES}
+
+    # Match the CSV loader
+    calendar_df = tables['calendar'].copy()
+    calendar_df['start_date'] = pd.to_datetime(calendar_df['start_date'].astype('int64').astype('str'), format='%Y%m%d')
+    calendar_df['end_date'] = pd.to_datetime(calendar_df['end_date'].astype('int64').astype('str'), format='%Y%m%d')
+    tables['calendar'] = calendar_df
+
+    return tables
+
+def load_gtfs_tables(download_path:str, data_path:str, snapshot_path:str) -> dict:
+  '''Loads the schedule tables from the snapshot when it is current, otherwise from the CSV files'''
+  if is_snapshot_current(snapshot_path, download_path, data_path):
+    logging.info('Loading GTFS snapshot from %s', snapshot_path)
+    return GtfsSnapshot(snapshot_path).load_tables()
+
+  logging.info('Loading GTFS CSV files from %s', download_path)
+  return load_csv_tables(download_path, data_path)
+
+def get_schedule_lookups(tables:dict) -> tuple[ScheduleIndex, ScheduleMetadata]:
+  schedule_index = ScheduleIndex(tables['trips'], tables['stop_times'], tables['stops'], localize_calendar(tables['calendar']), tables['hist_avg_delays'])
+  schedule_metadata = ScheduleMetadata(tables['routes'], tables['trips'], tables['stop_times'], tables['stops'])
+  return schedule_index, schedule_metadata
+
+def save_schedule_lookups(snapshot_path:str) -> None:
+  '''Builds the schedule index and metadata of a snapshot and saves them in its index directory'''
+  schedule_index, schedule_metadata = get_schedule_lookups(GtfsSnapshot(snapshot_path).load_tables())
+  index_path = os.path.join(snapshot_path, INDEX_DIR)
+  schedule_index.save(index_path)
+  schedule_metadata.save(os.path.join(index_path, METADATA_FILE))
+
+def load_schedule_lookups(tables:dict, download_path:str, data_path:str, snapshot_path:str) -> tuple[ScheduleIndex, ScheduleMetadata]:
+  '''
+  Returns the schedule index and metadata saved in the snapshot when it is
+  current (their arrays are memory-mapped, so the serving processes share
+  them), otherwise builds them from the tables
+  '''
+  index_path = os.path.join(snapshot_path, INDEX_DIR)
+  if os.path.isdir(index_path) and is_snapshot_current(snapshot_path, download_path, data_path):
+    try:
+      schedule_index = ScheduleIndex.load(index_path, tables['hist_avg_delays'])
+      return schedule_index, ScheduleMetadata.load(os.path.join(index_path, METADATA_FILE))
+    except (OSError, ValueError) as e:
+      logging.error('Could not load the schedule index from %s: %s', index_path, repr(e))
+
+  return get_schedule_lookups(tables)
@@ -1,12 +1,15 @@
 import logging
 import math
+import numpy as np
 import os
 import pandas as pd
 import requests
 import time
 
 # Import custom code
-from src.constants import MTL_COORDS, LOCAL_TIMEZONE
+from src.circuit_breaker import CircuitBreaker
+from src.constants import MTL_COORDS, LOCAL_TIMEZONE, OPEN_METEO_ARCHIVE_URL, OPEN_METEO_FORECAST_URL
+from src.metrics import UPSTREAM_REQUESTS
 
 def export_to_csv(dict_list:list, csv_path:str) -> None:
   df = pd.DataFrame(dict_list)
@@ -15,46 +18,86 @@ def export_to_csv(dict_list:list, csv_path:str) -> None:
   else:
     df.to_csv(csv_path, index=False, header=False, mode='a')
 
-def fetch_weather(start_date:str, end_date:str, attribute_list:list[str], forecast:bool=False) -> list:
-  root_url = 'https://archive-api.open-meteo.com/v1/archive?' \
-    if forecast == False else 'https://api.open-meteo.com/v1/forecast?'
-  
+def get_weather_url(start_date:str, end_date:str, attribute_list:list[str], forecast:bool=False) -> str:
+  root_url = OPEN_METEO_FORECAST_URL if forecast else OPEN_METEO_ARCHIVE_URL
   attributes = ','.join(attribute_list)
-  
-  weather_url = (
-    f'{root_url}'
+
+  return (
+    f'{root_url}?'
     f'latitude={MTL_COORDS["latitude"]}&longitude={MTL_COORDS["longitude"]}'
     f'&hourly={attributes}'
     f'&start_date={start_date}&end_date={end_date}'
     f'&timezone=America%2FToronto'
   )
+
+def parse_hourly_weather(data:dict, attribute_list:list[str]) -> list:
+  '''Returns one dict (time and attributes) per hour of an Open-Meteo response'''
+  if 'hourly' not in data.keys():
+    return []
+
+  hourly = data['hourly']
+  columns = ['time', *attribute_list]
+  return [dict(zip(columns, values)) for values in zip(*[hourly[column] for column in columns])]
+
+def fetch_weather(start_date:str, end_date:str, attribute_list:list[str], forecast:bool=False,
+                  budget:float|None=None, breaker:CircuitBreaker|None=None) -> list:
+  '''
+  Fetches hourly weather from Open-Meteo. With a budget (in seconds), the
+  timeouts and retries stop at the deadline instead of blocking the caller.
+  A circuit breaker makes the call fail fast while the API is down.
+  '''
+  root_url = OPEN_METEO_FORECAST_URL if forecast else OPEN_METEO_ARCHIVE_URL
+  weather_url = get_weather_url(start_date, end_date, attribute_list, forecast)
   
   weather_list = []
+
+  if breaker is not None and not breaker.allow_request():
+    logging.warning('Circuit breaker %s is open, skipping %s', breaker.name, root_url)
+    UPSTREAM_REQUESTS.labels('open-meteo', 'rejected').inc()
+    return weather_list
+
   # Do 5 attempts in case of connection timeout error
   max_retries = 5
   backoff_factor = 2
   timeout = 10
-
-  for attempt in range(1, max_retries + 1):
-    try:
-      response = requests.get(weather_url, timeout=timeout)
-      if response.ok :
-        data = response.json()
-        if 'hourly' in data.keys():
-          for i in range(len(data['hourly']['time'])):
-            weather = {}
-            weather['time'] = data['hourly']['time'][i]
-            for attribute in attribute_list:
-              weather[attribute] = data['hourly'][attribute][i]
-            weather_list.append(weather)
-      break # exit loop if attempt is successful
-    except requests.exceptions.RequestException as e:
-      wait = backoff_factor ** attempt
-      logging.error(f'Attempt {attempt} failed: {e}. Retrying in {wait} seconds...')
-      time.sleep(wait)
-  else:
+  deadline = None if budget is None else time.monotonic() + budget
+  succeeded = False
+
+  # Any exception (e.g., an invalid response) still counts as a failure of the breaker
+  try:
+    for attempt in range(1, max_retries + 1):
+      attempt_timeout = timeout if deadline is None else min(timeout, deadline - time.monotonic())
+      if attempt_timeout <= 0:
+        break
+
+      try:
+        response = requests.get(weather_url, timeout=attempt_timeout)
+        if response.status_code == 429 or response.status_code >= 500:
+          response.raise_for_status()
+        if response.ok :
+          weather_list = parse_hourly_weather(response.json(), attribute_list)
+        succeeded = True
+        UPSTREAM_REQUESTS.labels('open-meteo', 'success').inc()
+        break # exit loop if attempt is successful
+      except requests.exceptions.RequestException as e:
+        wait = backoff_factor ** attempt
+        if deadline is not None and time.monotonic() + wait >= deadline:
+          logging.error(f'Attempt {attempt} failed: {e}. No time left for a retry.')
+          UPSTREAM_REQUESTS.labels('open-meteo', 'error').inc()
+          break
+        logging.error(f'Attempt {attempt} failed: {e}. Retrying in {wait} seconds...')
+        UPSTREAM_REQUESTS.labels('open-meteo', 'retry' if attempt < max_retries else 'error').inc()
+        time.sleep(wait)
+  finally:
+    if not succeeded:
       logging.error('All retry attempts failed. Consider logging the error or alerting the system administrator.')
-     
+
+    if breaker is not None:
+      if succeeded:
+        breaker.record_success()
+      else:
+        breaker.record_failure()
+
   return weather_list
 
 def get_redundant_pairs(df: pd.DataFrame) -> set:
@@ -85,31 +128,68 @@ def get_route_bearing(destination_lon, origin_lon, destination_lat, origin_lat)
 	
 	return bearing
 
-def parse_gtfs_time(df:pd.DataFrame, date_column:str, time_column:str, unit:str) -> pd.Series:
+def gtfs_time_to_seconds(time_series:pd.Series) -> pd.Series:
   '''
-  Converts GTFS time string (e.g., '25:30:00') to localized datetime
-  based on the arrival or departure time.
+  Converts GTFS time strings (e.g., '25:30:00') to int32 seconds past the
+  start of the service day. Fixed-width 'HH:MM:SS' strings are converted
+  with byte arithmetic; other strings (e.g., '5:30:00') are split, and a
+  missing time gives a float64 series with NaN.
   '''
-  time_columns = ['hours', 'minutes', 'seconds']
-  split_cols = df[time_column].str.split(':', expand=True).apply(pd.to_numeric)
-  split_cols.columns = time_columns
-  seconds_delta = (split_cols['hours'] * 3600) + (split_cols['minutes'] * 60) + split_cols['seconds']
-	
-	# Convert datetime to seconds
-  if unit == 'ms':# milliseconds
-    start_seconds = df[date_column].astype('int64') / 10**3
-  elif unit == 'us':# microseconds
-    start_seconds = df[date_column].astype('int64') / 10**6
-  elif unit == 'ns':# nanoseconds
-    start_seconds = df[date_column].astype('int64') / 10**9
-
-	# Add seconds 
-  total_seconds = start_seconds + seconds_delta
-
-	# Convert to datetime
-  parsed_time = pd.to_datetime(total_seconds, origin='unix', unit='s').dt.tz_localize(LOCAL_TIMEZONE)
-
-  return parsed_time
+  # One byte more than 'HH:MM:SS' to tell longer strings apart
+  chars = np.asarray(time_series.to_numpy(), dtype='S9').view('uint8').reshape(-1, 9)
+  digits = chars[:, [0, 1, 3, 4, 6, 7]] - np.uint8(ord('0')) # non digits wrap around above 9
+  is_fixed = (digits <= 9).all(axis=1) & (chars[:, 2] == ord(':')) & (chars[:, 5] == ord(':')) & (chars[:, 8] == 0)
+
+  digits = digits.astype('int32')
+  seconds = (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 2] * 10 + digits[:, 3]) * 60 + digits[:, 4] * 10 + digits[:, 5]
+  if is_fixed.all():
+    return pd.Series(seconds, index=time_series.index)
+
+  # Split the other strings, and cast their seconds to the type of the result before merging them
+  other_times = time_series[~is_fixed]
+  split_cols = other_times.str.split(':', expand=True).reindex(columns=range(3)).apply(pd.to_numeric, errors='coerce')
+  other_seconds = (split_cols[0] * 3600 + split_cols[1] * 60 + split_cols[2]).to_numpy(dtype='float64')
+  if np.isnan(other_seconds).any():
+    seconds = seconds.astype('float64')
+  seconds[~is_fixed] = other_seconds.astype(seconds.dtype)
+  return pd.Series(seconds, index=time_series.index)
+
+def get_service_day_starts(service_dates:pd.Series) -> pd.Series:
+  '''
+  Returns the instant GTFS times of each service date are measured from:
+  noon minus 12h, local time. It is midnight, but on the days of a time
+  change, when it is 23:00 or 01:00, so every GTFS time is one instant.
+  '''
+  # Localize each distinct date once (noon always exists and is never ambiguous)
+  codes, dates = pd.factorize(service_dates)
+  noons = (pd.DatetimeIndex(dates).as_unit('ns') + pd.Timedelta(hours=12)).tz_localize(LOCAL_TIMEZONE)
+  starts = noons.asi8 - 12 * 3600 * 10**9
+  return pd.Series(starts[codes], index=service_dates.index)
+
+def get_service_day_start(service_date:pd.Timestamp) -> pd.Timestamp:
+  '''Returns the local instant GTFS times of one service date (naive, at midnight) are measured from, as get_service_day_starts'''
+  return (service_date + pd.Timedelta(hours=12)).tz_localize(LOCAL_TIMEZONE) - pd.Timedelta(hours=12)
+
+def gtfs_seconds_to_datetime(service_dates:pd.Series, seconds:pd.Series) -> pd.Series:
+  '''Converts seconds past the start of service dates (naive dates at midnight) to local datetimes'''
+  seconds_values = seconds.to_numpy(dtype='float64')
+  missing = np.isnan(seconds_values)
+  instants = get_service_day_starts(service_dates).to_numpy() + np.where(missing, 0, seconds_values).astype('int64') * 10**9
+  instants = instants.astype('datetime64[ns]')
+  instants[missing] = np.datetime64('NaT')
+  return pd.Series(instants, index=seconds.index).dt.tz_localize('UTC').dt.tz_convert(LOCAL_TIMEZONE)
+
+def parse_gtfs_time(df:pd.DataFrame, date_column:str, time_column:str, unit:str|None=None) -> pd.Series:
+  '''
+  Converts GTFS times (e.g., '25:30:00', or seconds already converted by
+  gtfs_time_to_seconds) of service dates to localized datetimes. The unit is
+  ignored (the result is always in nanoseconds) and only kept for the calls
+  of notebooks/data_cleaning.ipynb.
+  '''
+  seconds = df[time_column]
+  if not pd.api.types.is_numeric_dtype(seconds):
+    seconds = gtfs_time_to_seconds(seconds)
+  return gtfs_seconds_to_datetime(df[date_column], seconds)
 
 
 
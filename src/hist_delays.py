@@ -0,0 +1,310 @@
+import io
+import json
+import logging
+import math
+import numpy as np
+import os
+import pandas as pd
+import threading
+import time
+
+# Import custom code
+from src.constants import LOCAL_TIMEZONE, HIST_DELAYS_HALF_LIFE, HIST_DELAYS_RELOAD_INTERVAL
+from src.cleaning_pipeline import read_manifest as read_cleaning_manifest
+from src.schedule_index import ScheduleIndex, get_hist_key
+
+HIST_DELAYS_FORMAT_VERSION = 1
+STATE_FILE = 'state.npz'
+SOURCES_DIR = 'sources'
+HIST_COLUMNS = ['route_id', 'stop_id', 'hour', 'hist_avg_delay']
+ARRAYS = ['keys', 'sums', 'counts', 'decayed_sums', 'decayed_weights']
+
+def split_hist_keys(hist_keys:np.ndarray) -> tuple:
+  '''Returns the route_id, stop_id and hour packed in keys by get_hist_key'''
+  return hist_keys >> 32, (hist_keys >> 5) & ((1 << 27) - 1), hist_keys & 31
+
+def get_decay(half_life:float, elapsed:np.ndarray|float) -> np.ndarray|float:
+  '''Weight of a delay observed elapsed days earlier'''
+  return np.exp(-math.log(2) * np.asarray(elapsed, dtype='float64') / half_life)
+
+def get_empty_batch() -> dict:
+  batch = {name: np.empty(0, dtype='int64' if name in ['keys', 'counts'] else 'float64') for name in ARRAYS}
+  batch['decay_time'] = None
+  return batch
+
+def get_batch(route_ids:np.ndarray, stop_ids:np.ndarray, hours:np.ndarray, delays:np.ndarray,
+              days:np.ndarray|None=None, half_life:float|None=None) -> dict:
+  '''
+  Sums the delays of a batch by (route_id, stop_id, hour) key. Null delays
+  are left out, like a groupby mean. With a half-life (in days), the sums
+  weighted by the decay of each delay are kept as well, relative to the
+  latest day of the batch (days counted from the epoch).
+  '''
+  delays = np.asarray(delays, dtype='float64')
+  mask = ~np.isnan(delays)
+  if not mask.any():
+    return get_empty_batch()
+
+  hist_keys = get_hist_key(np.asarray(route_ids)[mask], np.asarray(stop_ids)[mask], np.asarray(hours)[mask])
+  keys, codes = np.unique(hist_keys, return_inverse=True)
+  delays = delays[mask]
+  batch = {
+    'keys': keys,
+    'sums': np.bincount(codes, weights=delays, minlength=len(keys)),
+    'counts': np.bincount(codes, minlength=len(keys)).astype('int64'),
+    'decayed_sums': np.zeros(len(keys), dtype='float64'),
+    'decayed_weights': np.zeros(len(keys), dtype='float64'),
+    'decay_time': None,
+  }
+
+  if half_life:
+    days = np.asarray(days, dtype='float64')[mask]
+    batch['decay_time'] = float(days.max())
+    weights = get_decay(half_life, batch['decay_time'] - days)
+    batch['decayed_sums'] = np.bincount(codes, weights=delays * weights, minlength=len(keys))
+    batch['decayed_weights'] = np.bincount(codes, weights=weights, minlength=len(keys))
+  return batch
+
+def get_frame_batch(df:pd.DataFrame, half_life:float|None=None) -> dict:
+  '''
+  Returns the batch of cleaned trip updates (route_id, stop_id,
+  sch_arrival_time in UTC and delay), by local hour of the scheduled arrival
+  like the preprocessing notebook
+  '''
+  arrival_times = pd.to_datetime(df['sch_arrival_time'], utc=True)
+  hours = arrival_times.dt.tz_convert(LOCAL_TIMEZONE).dt.hour.to_numpy()
+  days = arrival_times.to_numpy(dtype='datetime64[ns]').astype('int64') / (86400 * 10**9)
+  return get_batch(df['route_id'].to_numpy(), df['stop_id'].to_numpy(), hours, df['delay'].to_numpy(dtype='float64'), days, half_life)
+
+def read_batch(path:str) -> tuple[dict, dict]:
+  '''Returns the batch and the info dict of a file written by write_batch'''
+  with np.load(path) as data:
+    batch = {name: data[name] for name in ARRAYS}
+    batch['decay_time'] = None if np.isnan(data['decay_time']) else float(data['decay_time'])
+    info = json.loads(str(data['info']))
+  return batch, info
+
+def write_batch(batch:dict, path:str, info:dict|None=None) -> None:
+  '''Writes a batch (and a JSON-serializable info dict) to an .npz file, replaced atomically'''
+  buffer = io.BytesIO()
+  np.savez(
+    buffer, decay_time=np.nan if batch['decay_time'] is None else batch['decay_time'], info=json.dumps(info or {}),
+    **{name: batch[name] for name in ARRAYS},
+  )
+  tmp_path = f'{path}.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(buffer.getvalue())
+  os.replace(tmp_path, path)
+
+class HistDelayAggregator:
+  '''
+  Running sums and counts of the delays of each (route_id, stop_id, hour),
+  kept in arrays sorted by get_hist_key, from which hist_avg_delays is read
+  without going over the history again.
+
+  Batches come from cleaned service date partitions (sources): the sums of
+  each source are kept, so a source cleaned again replaces its previous
+  sums instead of being counted twice. With a half-life in days, delays are
+  also weighted by their age for a decayed average, the weights being
+  relative to the latest day seen (decay_time).
+  '''
+
+  def __init__(self, half_life:float|None=HIST_DELAYS_HALF_LIFE) -> None:
+    self.half_life = half_life or None
+    self.state = get_empty_batch()
+    self.sources = {} # source name -> fingerprint of its batch
+
+  def __len__(self) -> int:
+    return len(self.state['keys'])
+
+  def merge(self, batch:dict, sign:int=1) -> None:
+    '''Adds a batch to the sums (or removes it with sign=-1)'''
+    if len(batch['keys']) == 0:
+      return
+
+    state = self.state
+    keys = np.union1d(state['keys'], batch['keys'])
+    state_index = np.searchsorted(keys, state['keys'])
+    batch_index = np.searchsorted(keys, batch['keys'])
+
+    # Decayed sums are brought to the latest decay time before being added
+    decay_time = state['decay_time']
+    state_decay, batch_decay = 1.0, 1.0
+    if self.half_life and batch['decay_time'] is not None:
+      decay_time = batch['decay_time'] if decay_time is None else max(decay_time, batch['decay_time'])
+      if state['decay_time'] is not None:
+        state_decay = get_decay(self.half_life, decay_time - state['decay_time'])
+      batch_decay = get_decay(self.half_life, decay_time - batch['decay_time'])
+
+    merged = {'decay_time': decay_time}
+    for name in ARRAYS[1:]:
+      values = np.zeros(len(keys), dtype=state[name].dtype)
+      values[state_index] = state[name] * (state_decay if name.startswith('decayed') else 1)
+      values[batch_index] += sign * batch[name] * (batch_decay if name.startswith('decayed') else 1) # batch keys are unique
+      merged[name] = values
+
+    # Keys without delays left (after a removal) are dropped
+    keep = merged['counts'] > 0
+    merged['keys'] = keys[keep]
+    for name in ARRAYS[1:]:
+      merged[name] = merged[name][keep]
+    self.state = merged
+
+  def update(self, route_ids:np.ndarray, stop_ids:np.ndarray, hours:np.ndarray, delays:np.ndarray, days:np.ndarray|None=None) -> dict:
+    '''Adds a batch of delays (days from the epoch are needed with a half-life). Returns the batch.'''
+    batch = get_batch(route_ids, stop_ids, hours, delays, days, self.half_life)
+    self.merge(batch)
+    return batch
+
+  def replace_source(self, name:str, batch:dict|None, previous_batch:dict|None=None, fingerprint:str|None=None) -> None:
+    '''Replaces the batch of a source (a previous batch of None adds it, a batch of None removes it)'''
+    if previous_batch is not None:
+      self.merge(previous_batch, sign=-1)
+    if batch is None:
+      self.sources.pop(name, None)
+    else:
+      self.merge(batch)
+      self.sources[name] = fingerprint
+
+  def get_table(self, decayed:bool=False, min_count:int=1) -> pd.DataFrame:
+    '''Returns the hist_avg_delays table: the average (or decayed average) delay of each key with min_count delays'''
+    state = self.state
+    if decayed and not self.half_life:
+      raise ValueError('The decayed average needs a half-life')
+
+    mask = state['counts'] >= min_count
+    if decayed:
+      mask &= state['decayed_weights'] > 0
+    route_ids, stop_ids, hours = split_hist_keys(state['keys'][mask])
+    if decayed:
+      averages = state['decayed_sums'][mask] / state['decayed_weights'][mask]
+    else:
+      averages = state['sums'][mask] / state['counts'][mask]
+    return pd.DataFrame({'route_id': route_ids, 'stop_id': stop_ids, 'hour': hours, 'hist_avg_delay': averages})
+
+  def save(self, state_path:str) -> None:
+    '''Writes the sums with the source fingerprints in the same file, so that they are always consistent'''
+    os.makedirs(state_path, exist_ok=True)
+    info = {'format_version': HIST_DELAYS_FORMAT_VERSION, 'half_life': self.half_life, 'sources': self.sources}
+    write_batch(self.state, os.path.join(state_path, STATE_FILE), info)
+
+  @classmethod
+  def load(cls, state_path:str, half_life:float|None=HIST_DELAYS_HALF_LIFE) -> 'HistDelayAggregator':
+    '''Reads a saved aggregator, or returns an empty one if there is none or it used another half-life'''
+    aggregator = cls(half_life)
+    file_path = os.path.join(state_path, STATE_FILE)
+    if not os.path.isfile(file_path):
+      return aggregator
+
+    state, info = read_batch(file_path)
+    if info.get('format_version') != HIST_DELAYS_FORMAT_VERSION or info.get('half_life') != aggregator.half_life:
+      logging.info('Historical delays: %s was built with another format or half-life, starting over', state_path)
+      return aggregator
+
+    aggregator.state = state
+    aggregator.sources = info['sources']
+    return aggregator
+
+def get_source_path(state_path:str, name:str, fingerprint:str) -> str:
+  return os.path.join(state_path, SOURCES_DIR, f'{name}_{fingerprint}.npz')
+
+def update_from_cleaned(aggregator:HistDelayAggregator, state_path:str, cleaned_path:str) -> dict:
+  '''
+  Adds the service date partitions of the cleaned dataset
+  (run_cleaning_pipeline) that are new or were cleaned again since the last
+  update, and removes the deleted ones. The batch of each partition is kept
+  in state_path/sources, named by its fingerprint, so that the sums saved
+  with the previous fingerprints can still be subtracted after an
+  interrupted update. Returns the update report.
+  '''
+  start = time.perf_counter()
+  partitions = read_cleaning_manifest(cleaned_path)['partitions']
+  report = {'added': [], 'replaced': [], 'removed': [], 'rows': 0}
+
+  names = sorted(set(partitions) | set(aggregator.sources))
+  for name in names:
+    fingerprint = partitions[name]['fingerprint'] if name in partitions else None
+    previous_fingerprint = aggregator.sources.get(name)
+    if fingerprint == previous_fingerprint:
+      continue
+
+    previous_batch = None
+    if previous_fingerprint is not None:
+      previous_batch, _ = read_batch(get_source_path(state_path, name, previous_fingerprint))
+
+    batch = None
+    if fingerprint is not None:
+      file_path = os.path.join(cleaned_path, f'service_date={name}', 'part-0.parquet')
+      df = pd.read_parquet(file_path, columns=['route_id', 'stop_id', 'sch_arrival_time', 'delay']) if os.path.isfile(file_path) else None
+      batch = get_empty_batch() if df is None else get_frame_batch(df, aggregator.half_life)
+      os.makedirs(os.path.join(state_path, SOURCES_DIR), exist_ok=True)
+      write_batch(batch, get_source_path(state_path, name, fingerprint))
+      report['rows'] += 0 if df is None else len(df)
+
+    aggregator.replace_source(name, batch, previous_batch, fingerprint)
+    report['removed' if batch is None else 'added' if previous_batch is None else 'replaced'].append(name)
+
+  aggregator.save(state_path)
+
+  # Remove the batches that the saved state no longer uses
+  used_files = {os.path.basename(get_source_path(state_path, name, fingerprint)) for name, fingerprint in aggregator.sources.items()}
+  sources_path = os.path.join(state_path, SOURCES_DIR)
+  for file_name in os.listdir(sources_path) if os.path.isdir(sources_path) else []:
+    if file_name not in used_files:
+      os.remove(os.path.join(sources_path, file_name))
+
+  report['keys'] = len(aggregator)
+  report['seconds'] = time.perf_counter() - start
+  return report
+
+def write_hist_delays(hist_delays_df:pd.DataFrame, csv_path:str) -> None:
+  '''Writes the hist_avg_delays table, replaced atomically so that a serving process never reads it half written'''
+  tmp_path = f'{csv_path}.tmp'
+  hist_delays_df[HIST_COLUMNS].to_csv(tmp_path, index=False)
+  os.replace(tmp_path, csv_path)
+
+class HistDelayReloader:
+  '''
+  Loads hist_avg_delays.csv into a schedule index again when the file
+  changes, so that a serving process uses the table published by
+  scripts/update_hist_delays.py without a restart. The modification time is
+  checked at most every reload_interval seconds.
+  '''
+
+  def __init__(self, csv_path:str, schedule_index:ScheduleIndex, reload_interval:float=HIST_DELAYS_RELOAD_INTERVAL, loaded:bool=True) -> None:
+    self.csv_path = csv_path
+    self.schedule_index = schedule_index
+    self.reload_interval = reload_interval
+    self._lock = threading.Lock()
+    self._checked_at = time.monotonic() if loaded else 0
+    self._mtime = self.get_mtime() if loaded else 0 # loaded: the schedule index was built with the current file
+    self.stats = {'reloads': 0, 'errors': 0}
+
+  def get_mtime(self) -> int|None:
+    return os.stat(self.csv_path).st_mtime_ns if os.path.isfile(self.csv_path) else None
+
+  def reload_if_changed(self, force:bool=False) -> None:
+    now = time.monotonic()
+    if not force and now - self._checked_at < self.reload_interval:
+      return
+    self._checked_at = now
+
+    if self.get_mtime() == self._mtime:
+      return
+
+    with self._lock:
+      mtime = self.get_mtime()
+      if mtime == self._mtime or mtime is None:
+        return
+
+      self._mtime = mtime
+      try:
+        self.schedule_index.set_hist_delays(pd.read_csv(self.csv_path, usecols=HIST_COLUMNS))
+        self.stats['reloads'] += 1
+        logging.info('Historical delays: loaded %d keys from %s', len(self.schedule_index.hist_keys), self.csv_path)
+      except Exception as e:
+        self.stats['errors'] += 1
+        logging.error('Historical delays: could not load %s: %s', self.csv_path, repr(e))
+
+  def get_state(self) -> dict:
+    return {'keys': len(self.schedule_index.hist_keys), **self.stats}
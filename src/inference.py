@@ -0,0 +1,165 @@
+import hashlib
+import joblib
+import json
+import logging
+import numpy as np
+import os
+import xgboost as xgb
+
+# Import custom code
+from src.constants import INFERENCE_THREADS, INFERENCE_BATCH_SIZE, TREE_EVALUATOR_MAX_WORK
+
+# Objectives whose prediction is the raw sum of the trees (no link function)
+IDENTITY_OBJECTIVES = {'reg:squarederror', 'reg:squaredlogerror', 'reg:pseudohubererror', 'reg:absoluteerror', 'reg:quantileerror'}
+
+MODEL_NAME = 'regression_model'
+
+class TreeEvaluator:
+  '''
+  Evaluates a gbtree booster from flattened tree arrays with NumPy.
+
+  Every tree is padded to the same number of nodes and the nodes of all trees
+  are stored in flat arrays, so a batch of rows walks every tree at once:
+  one gather and one comparison per level of depth. Leaves point to
+  themselves, so rows that reach a leaf early stay there.
+  '''
+
+  def __init__(self, trees:list[dict], base_score:float) -> None:
+    self.n_trees = len(trees)
+    self.base_score = base_score
+    n_nodes = max(len(tree['left_children']) for tree in trees)
+
+    self.left = np.zeros((self.n_trees, n_nodes), dtype='intp')
+    self.right = np.zeros((self.n_trees, n_nodes), dtype='intp')
+    self.feature = np.zeros((self.n_trees, n_nodes), dtype='intp')
+    self.threshold = np.zeros((self.n_trees, n_nodes), dtype='float32') # split value, or leaf value for leaves
+    self.default_left = np.zeros((self.n_trees, n_nodes), dtype='bool')
+    self.depth = 0
+
+    for tree_index, tree in enumerate(trees):
+      left = np.array(tree['left_children'])
+      right = np.array(tree['right_children'])
+      is_leaf = left == -1
+      nodes = np.arange(len(left))
+      offset = tree_index * n_nodes
+
+      self.left[tree_index, :len(left)] = np.where(is_leaf, nodes, left) + offset
+      self.right[tree_index, :len(left)] = np.where(is_leaf, nodes, right) + offset
+      self.feature[tree_index, :len(left)] = tree['split_indices']
+      self.threshold[tree_index, :len(left)] = tree['split_conditions']
+      self.default_left[tree_index, :len(left)] = np.array(tree['default_left'], dtype='bool')
+      self.depth = max(self.depth, get_tree_depth(left, right))
+
+    # Flatten so that a node is addressed by a single index
+    self.left = self.left.ravel()
+    self.right = self.right.ravel()
+    self.feature = self.feature.ravel()
+    self.threshold = self.threshold.ravel()
+    self.default_left = self.default_left.ravel()
+    self.roots = np.arange(self.n_trees) * n_nodes
+
+  def predict(self, features:np.ndarray) -> np.ndarray:
+    features = np.asarray(features, dtype='float32')
+    rows = np.arange(features.shape[0])[:, None]
+    nodes = np.repeat(self.roots[None, :], features.shape[0], axis=0)
+
+    for _ in range(self.depth):
+      values = features[rows, self.feature[nodes]]
+      # XGBoost goes left when value < split, missing values follow the default direction
+      go_left = np.where(np.isnan(values), self.default_left[nodes], values < self.threshold[nodes])
+      nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+    predictions = self.threshold[nodes].sum(axis=1, dtype='float64') + self.base_score
+    return predictions.astype('float32')
+
+def get_tree_depth(left:np.ndarray, right:np.ndarray) -> int:
+  depth = 0
+  stack = [(0, 0)]
+  while stack:
+    node, node_depth = stack.pop()
+    depth = max(depth, node_depth)
+    if left[node] != -1:
+      stack.append((left[node], node_depth + 1))
+      stack.append((right[node], node_depth + 1))
+  return depth
+
+def get_tree_evaluator(booster:xgb.Booster) -> TreeEvaluator|None:
+  '''Returns a TreeEvaluator for the booster, or None if the model uses features it does not support'''
+  learner = json.loads(booster.save_raw(raw_format='json'))['learner']
+  objective = learner['objective']['name']
+  gradient_booster = learner['gradient_booster']
+  model_param = learner['learner_model_param']
+
+  if gradient_booster['name'] != 'gbtree' or objective not in IDENTITY_OBJECTIVES:
+    return None
+  if int(model_param.get('num_target', 1)) != 1 or int(model_param.get('num_class', 0)) > 1:
+    return None
+
+  trees = gradient_booster['model']['trees']
+  if not trees or any(any(tree.get('split_type', [])) for tree in trees):
+    return None # categorical splits
+
+  base_score = float(model_param['base_score'].strip('[]'))
+  return TreeEvaluator(trees, base_score)
+
+class DelayModel:
+  '''
+  Predicts delays from feature matrices without building a DMatrix.
+
+  Small batches (a /predict request) go through the flattened tree
+  evaluator, whose cost grows with rows x trees, larger ones through
+  booster.inplace_predict in chunks of batch_size rows. Both take float32
+  features in the booster's feature order.
+  '''
+
+  def __init__(self, booster:xgb.Booster, n_threads:int=INFERENCE_THREADS, batch_size:int=INFERENCE_BATCH_SIZE, evaluator_max_work:int=TREE_EVALUATOR_MAX_WORK) -> None:
+    self.booster = booster
+    self.version = get_model_version(booster)
+    self.booster.set_param({'nthread': n_threads})
+    self.feature_names = booster.feature_names
+    self.batch_size = batch_size
+    self.tree_evaluator = get_tree_evaluator(booster)
+    self.evaluator_max_rows = 0
+
+    if self.tree_evaluator is not None:
+      self.evaluator_max_rows = evaluator_max_work // self.tree_evaluator.n_trees
+    else:
+      logging.info('The tree evaluator does not support this model, using inplace_predict only')
+
+  def predict(self, features:np.ndarray) -> np.ndarray:
+    if features.shape[0] <= self.evaluator_max_rows:
+      return self.tree_evaluator.predict(features)
+    return self.predict_batch(features)
+
+  def predict_batch(self, features:np.ndarray, out:np.ndarray|None=None) -> np.ndarray:
+    features = np.asarray(features, dtype='float32')
+    if out is None:
+      out = np.empty(features.shape[0], dtype='float32')
+
+    for start in range(0, features.shape[0], self.batch_size):
+      end = start + self.batch_size
+      out[start:end] = self.booster.inplace_predict(features[start:end])
+    return out
+
+def get_model_version(booster:xgb.Booster) -> str:
+  '''Returns a hash of the trees and parameters of the model (the same for the pickled and native files)'''
+  return hashlib.sha1(booster.save_raw(raw_format='ubj')).hexdigest()[:16]
+
+def get_model_paths(model_dir:str) -> tuple[str, str]:
+  '''Returns the paths of the native (UBJSON) and pickled models'''
+  return os.path.join(model_dir, f'{MODEL_NAME}.ubj'), os.path.join(model_dir, f'{MODEL_NAME}.pkl')
+
+def load_booster(model_dir:str) -> xgb.Booster:
+  '''Loads the native model if it was exported, otherwise the pickled one'''
+  native_path, pickle_path = get_model_paths(model_dir)
+
+  if os.path.exists(native_path):
+    return xgb.Booster(model_file=native_path)
+
+  booster = joblib.load(pickle_path)
+  if isinstance(booster, xgb.XGBModel):
+    booster = booster.get_booster()
+  return booster
+
+def load_delay_model(model_dir:str, n_threads:int=INFERENCE_THREADS) -> DelayModel:
+  return DelayModel(load_booster(model_dir), n_threads=n_threads)
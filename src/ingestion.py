@@ -0,0 +1,255 @@
+import asyncio
+from bs4 import BeautifulSoup
+from datetime import datetime, timedelta, timezone
+import httpx
+import logging
+import os
+import random
+import time
+
+# Import custom code
+from src.constants import (
+  STM_TRIP_UPDATES_URL, STM_GTFS_URL, STM_ROUTE_TYPES_URL, INGESTION_MAX_CONCURRENCY, INGESTION_MAX_CONNECTIONS,
+  INGESTION_MAX_RETRIES, INGESTION_BACKOFF_BASE, INGESTION_BACKOFF_MAX, INGESTION_TIMEOUT
+)
+from src.gtfs_download import WRITE_BUFFER_SIZE, DownloadWriter, get_conditional_headers, get_download_state, get_zip_path, install_gtfs, read_download_state
+from src.gtfs_snapshot import build_snapshot
+from src.helper_functions import export_to_csv, get_weather_url, parse_hourly_weather
+from src.trip_update_collector import TripUpdateCollector
+
+# Hourly attributes of fetched_historical_weather.csv
+HISTORICAL_WEATHER_ATTRIBUTES = [
+  'temperature_2m',
+  'relative_humidity_2m',
+  'precipitation',
+  'pressure_msl',
+  'cloud_cover',
+  'wind_speed_10m',
+  'wind_direction_10m',
+]
+
+class IngestionJob:
+  '''
+  A task run every interval seconds by the IngestionScheduler. run is a
+  coroutine function called with the shared HTTP client and the job (for its
+  retry counter); it fails by raising.
+  '''
+
+  def __init__(self, name:str, interval:float, run, timeout:float=300) -> None:
+    self.name = name
+    self.interval = interval
+    self.run = run
+    self.timeout = timeout
+    self.stats = {
+      'runs': 0, 'failures': 0, 'retries': 0,
+      'last_seconds': None, 'max_seconds': 0.0, 'total_seconds': 0.0,
+      'last_success': None, 'last_error': None,
+    }
+
+  def get_state(self) -> dict:
+    state = {'interval': self.interval, **self.stats}
+    state['mean_seconds'] = self.stats['total_seconds'] / self.stats['runs'] if self.stats['runs'] else None
+    return state
+
+class IngestionScheduler:
+  '''
+  Runs ingestion jobs on their own cadences in one event loop.
+
+  All jobs share one httpx client, so connections to the same host are kept
+  alive between runs. At most max_concurrency jobs run at the same time and
+  a job is never run again before its previous run ends. Blocking work
+  (parsing, writing files) is done in threads by the jobs.
+  '''
+
+  def __init__(self, jobs:list[IngestionJob], max_concurrency:int=INGESTION_MAX_CONCURRENCY,
+               max_connections:int=INGESTION_MAX_CONNECTIONS, timeout:float=INGESTION_TIMEOUT) -> None:
+    self.jobs = jobs
+    self.max_concurrency = max_concurrency
+    self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    self.timeout = timeout
+    self._stop = None
+
+  async def run(self, start_jitter:float=5) -> None:
+    '''Runs the jobs until stop() is called. The first runs are spread over start_jitter seconds.'''
+    self._stop = asyncio.Event()
+    semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async with httpx.AsyncClient(limits=self.limits, timeout=self.timeout, follow_redirects=True) as client:
+      tasks = [asyncio.create_task(self._run_job(job, client, semaphore, random.uniform(0, start_jitter))) for job in self.jobs]
+      await self._stop.wait()
+
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+  def stop(self) -> None:
+    if self._stop is not None:
+      self._stop.set()
+
+  async def _run_job(self, job:IngestionJob, client:httpx.AsyncClient, semaphore:asyncio.Semaphore, delay:float) -> None:
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(delay)
+
+    while True:
+      started_at = loop.time()
+      async with semaphore:
+        await run_job_once(job, client)
+      await asyncio.sleep(max(0, job.interval - (loop.time() - started_at)))
+
+  def get_state(self) -> dict:
+    return {job.name: job.get_state() for job in self.jobs}
+
+async def run_job_once(job:IngestionJob, client:httpx.AsyncClient) -> bool:
+  '''Runs a job and records its duration and outcome. Returns whether it succeeded.'''
+  start = time.perf_counter()
+  succeeded = False
+  try:
+    await asyncio.wait_for(job.run(client, job), job.timeout)
+    succeeded = True
+  except asyncio.CancelledError:
+    raise
+  except Exception as e:
+    job.stats['failures'] += 1
+    job.stats['last_error'] = repr(e)
+    logging.error('Ingestion job %s failed: %s', job.name, repr(e))
+
+  seconds = time.perf_counter() - start
+  job.stats['runs'] += 1
+  job.stats['last_seconds'] = seconds
+  job.stats['total_seconds'] += seconds
+  job.stats['max_seconds'] = max(job.stats['max_seconds'], seconds)
+  if succeeded:
+    job.stats['last_success'] = time.time()
+    logging.info('Ingestion job %s: %.2f s', job.name, seconds)
+  return succeeded
+
+def get_backoff(attempt:int) -> float:
+  '''Exponential backoff with full jitter, so retrying clients do not call back in sync'''
+  return random.uniform(0, min(INGESTION_BACKOFF_MAX, INGESTION_BACKOFF_BASE * 2 ** attempt))
+
+def is_retryable(e:Exception) -> bool:
+  if isinstance(e, httpx.HTTPStatusError):
+    return e.response.status_code == 429 or e.response.status_code >= 500
+  return isinstance(e, httpx.TransportError)
+
+async def with_retries(job:IngestionJob|None, request, max_retries:int=INGESTION_MAX_RETRIES):
+  '''Awaits request() until it succeeds, retrying timeouts, connection errors, 429 and 5xx'''
+  for attempt in range(1, max_retries + 1):
+    try:
+      return await request()
+    except Exception as e:
+      if attempt == max_retries or not is_retryable(e):
+        raise
+      wait = get_backoff(attempt)
+      if job is not None:
+        job.stats['retries'] += 1
+      logging.warning(f'Attempt {attempt} failed: {e!r}. Retrying in {wait:.1f} seconds...')
+      await asyncio.sleep(wait)
+
+async def get_with_retries(client:httpx.AsyncClient, url:str, job:IngestionJob|None=None, **kwargs) -> httpx.Response:
+  async def request() -> httpx.Response:
+    response = await client.get(url, **kwargs)
+    response.raise_for_status()
+    return response
+  return await with_retries(job, request)
+
+async def download_with_retries(client:httpx.AsyncClient, url:str, path:str, job:IngestionJob|None=None, headers:dict|None=None) -> dict|None:
+  '''
+  Streams a file to disk through a DownloadWriter (large writes, one fsync,
+  then a rename). Returns its download state, or None if the server answered
+  304 Not Modified to the conditional headers.
+  '''
+  async def request() -> dict|None:
+    async with client.stream('GET', url, headers=headers) as response:
+      if response.status_code == 304:
+        return None
+      response.raise_for_status()
+      with DownloadWriter(path) as writer:
+        async for chunk in response.aiter_bytes(chunk_size=WRITE_BUFFER_SIZE):
+          writer.write(chunk)
+    return get_download_state(url, response.headers, writer)
+  return await with_retries(job, request)
+
+def parse_route_types(html:bytes|str) -> list:
+  '''Returns the route_id and route_type of each line in the STM bus network page'''
+  soup = BeautifulSoup(html, 'html.parser')
+
+  table = soup.find('table', {'class': 'bus-list'})
+  rows = table.find_all('tr')
+
+  bus_list = []
+
+  for row in rows:
+    route_type = None
+    route_id = row.find('span', {'class': 'fam-line-number'}).text
+
+    if row.find('span', {'class': 'family-jour'}):
+      route_type = 'Day'
+    elif row.find('span', {'class': 'family-freq-toute-journee'}):
+      route_type = 'All Day High Frequency'
+    elif row.find('span', {'class': 'family-freq-periode-pointe'}):
+      route_type = 'Rush Hour High Frequency'
+    elif row.find('span', {'class': 'family-nuit'}):
+      route_type = 'Night'
+
+    bus_list.append({
+      'route_id': int(route_id),
+      'route_type': route_type
+    })
+
+  return bus_list
+
+def get_trip_updates_job(collector:TripUpdateCollector, api_key:str|None, interval:float, url:str=STM_TRIP_UPDATES_URL) -> IngestionJob:
+  '''Polls the GTFS-RT trip updates into a collector'''
+  headers = {'accept': 'application/x-protobuf', 'apiKey': api_key or ''}
+
+  async def run(client:httpx.AsyncClient, job:IngestionJob) -> None:
+    fetched_at = time.time()
+    response = await get_with_retries(client, url, job, headers=headers)
+    await asyncio.to_thread(collector.add_snapshot, response.content, fetched_at)
+
+  return IngestionJob('trip_updates', interval, run, timeout=max(interval, 120))
+
+def get_historical_weather_job(csv_path:str, interval:float) -> IngestionJob:
+  '''Appends the archived weather of 3 days ago (the latest day in the archive) to a CSV'''
+  async def run(client:httpx.AsyncClient, job:IngestionJob) -> None:
+    three_days_before = datetime.now(timezone.utc) - timedelta(days=3)
+    start_date = three_days_before.strftime('%Y-%m-%d')
+    weather_url = get_weather_url(start_date, start_date, HISTORICAL_WEATHER_ATTRIBUTES)
+
+    response = await get_with_retries(client, weather_url, job)
+    weather_list = parse_hourly_weather(response.json(), HISTORICAL_WEATHER_ATTRIBUTES)
+    if len(weather_list) > 0:
+      await asyncio.to_thread(export_to_csv, weather_list, csv_path)
+
+  return IngestionJob('historical_weather', interval, run)
+
+def get_schedule_job(dest_folder:str, interval:float, url:str=STM_GTFS_URL, data_path:str|None=None, snapshot_path:str|None=None) -> IngestionJob:
+  '''
+  Downloads the STM GTFS schedule when it changed and extracts the files used
+  by the app, then builds the GTFS snapshot from them if snapshot_path is given
+  '''
+  async def run(client:httpx.AsyncClient, job:IngestionJob) -> None:
+    zip_file_path = get_zip_path(url, dest_folder)
+    os.makedirs(os.path.dirname(zip_file_path), exist_ok=True)
+    previous_state = read_download_state(dest_folder)
+    state = await download_with_retries(client, url, zip_file_path, job, headers=get_conditional_headers(previous_state, url))
+    if state is None:
+      logging.info('GTFS archive not modified since %s', previous_state.get('downloaded_at'))
+      return
+
+    updated = await asyncio.to_thread(install_gtfs, zip_file_path, dest_folder, state, previous_state)
+    if updated and snapshot_path is not None:
+      await asyncio.to_thread(build_snapshot, dest_folder, data_path, snapshot_path)
+
+  return IngestionJob('schedule', interval, run, timeout=1800)
+
+def get_route_types_job(csv_path:str, interval:float, url:str=STM_ROUTE_TYPES_URL) -> IngestionJob:
+  '''Scrapes the type (day, night, high frequency) of each bus line'''
+  async def run(client:httpx.AsyncClient, job:IngestionJob) -> None:
+    response = await get_with_retries(client, url, job)
+    bus_list = await asyncio.to_thread(parse_route_types, response.content)
+    if len(bus_list) > 0:
+      await asyncio.to_thread(export_to_csv, bus_list, csv_path)
+
+  return IngestionJob('route_types', interval, run)
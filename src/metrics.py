@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+# Latency buckets (seconds), from a cached lookup to a weather fetch at the end of its budget
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_SECONDS = Histogram('stm_request_seconds', 'Time to answer a request', ['endpoint'], buckets=LATENCY_BUCKETS)
+RESPONSES = Counter('stm_responses', 'Responses by endpoint and status code', ['endpoint', 'status'])
+STAGE_SECONDS = Histogram('stm_stage_seconds', 'Time spent in each stage of a request', ['stage'], buckets=LATENCY_BUCKETS)
+CACHE_LOOKUPS = Counter('stm_cache_lookups', 'Lookups in the prediction grid and cache, and weather by source', ['cache', 'result'])
+UPSTREAM_REQUESTS = Counter('stm_upstream_requests', 'Attempts to call an upstream API by result (success, error, retry, rejected)', ['upstream', 'result'])
+
+# Spans of the request handled by the current thread, for its Server-Timing header
+_local = threading.local()
+
+# Histogram of each stage, so that a span does not look up its labels
+_stage_histograms = {}
+
+def start_request_spans() -> None:
+  _local.spans = []
+
+def pop_request_spans() -> list[tuple[str, float]]:
+  spans = getattr(_local, 'spans', None) or []
+  _local.spans = None
+  return spans
+
+class span:
+  '''Times a stage of a request in the stm_stage_seconds histogram (and the Server-Timing header of the request)'''
+
+  def __init__(self, stage:str) -> None:
+    self.stage = stage
+    self.histogram = _stage_histograms.get(stage)
+    if self.histogram is None:
+      self.histogram = _stage_histograms[stage] = STAGE_SECONDS.labels(stage)
+
+  def __enter__(self) -> 'span':
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, traceback) -> None:
+    seconds = time.perf_counter() - self.start
+    self.histogram.observe(seconds)
+    spans = getattr(_local, 'spans', None)
+    if spans is not None:
+      spans.append((self.stage, seconds))
+
+def get_server_timing(spans:list[tuple[str, float]]) -> str:
+  '''Returns a Server-Timing header value, with the total time of each stage in milliseconds'''
+  totals = {}
+  for stage, seconds in spans:
+    totals[stage] = totals.get(stage, 0) + seconds
+  return ', '.join(f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in totals.items())
+
+def get_metrics() -> tuple[bytes, str]:
+  '''
+  Returns the metrics in the Prometheus text format and its content type.
+  Under gunicorn (PROMETHEUS_MULTIPROC_DIR is set by gunicorn.conf.py) they
+  are the sum of all the workers.
+  '''
+  if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+  else:
+    registry = REGISTRY
+  return generate_latest(registry), CONTENT_TYPE_LATEST
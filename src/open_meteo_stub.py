@@ -0,0 +1,122 @@
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+def get_hourly_value(attribute:str, day_index:int, hour:int) -> float:
+  '''Deterministic weather values that follow a daily cycle'''
+  cycle = math.sin((hour - 9) / 24 * 2 * math.pi)
+  match attribute:
+    case 'temperature_2m':
+      return round(12 + 8 * cycle + (day_index % 5), 1)
+    case 'relative_humidity_2m':
+      return float(70 - round(20 * cycle))
+    case 'cloud_cover':
+      return float((day_index * 37 + hour * 11) % 101)
+    case 'wind_speed_10m':
+      return round(10 + 5 * abs(cycle), 1)
+    case 'wind_direction_10m':
+      return float((day_index * 45 + hour * 5) % 360)
+    case 'weathercode':
+      return [0, 1, 2, 3, 61, 80][(day_index + hour // 6) % 6]
+    case 'precipitation':
+      return 0.0
+    case 'pressure_msl':
+      return 1013.0
+  return 0.0
+
+class OpenMeteoStubHandler(BaseHTTPRequestHandler):
+  '''Serves Open-Meteo shaped JSON for /v1/archive and /v1/forecast'''
+
+  def do_GET(self) -> None:
+    server = self.server
+    url = urlparse(self.path)
+    params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+    with server.lock:
+      server.request_count += 1
+
+    if server.latency > 0:
+      time.sleep(server.latency)
+
+    if url.path not in ('/v1/archive', '/v1/forecast'):
+      self.send_json(404, {'error': True, 'reason': 'Not found'})
+      return
+
+    if random.random() < server.failure_rate:
+      self.send_json(503, {'error': True, 'reason': 'Stub failure'})
+      return
+
+    attributes = params.get('hourly', '').split(',')
+    start_date = date.fromisoformat(params['start_date'])
+    end_date = date.fromisoformat(params['end_date'])
+
+    hourly = {'time': []}
+    for attribute in attributes:
+      hourly[attribute] = []
+
+    day = start_date
+    while day <= end_date:
+      day_index = day.toordinal()
+      for hour in range(24):
+        hourly['time'].append(f'{day.isoformat()}T{hour:02d}:00')
+        for attribute in attributes:
+          hourly[attribute].append(get_hourly_value(attribute, day_index, hour))
+      day += timedelta(days=1)
+
+    self.send_json(200, {
+      'latitude': float(params.get('latitude', 0)),
+      'longitude': float(params.get('longitude', 0)),
+      'timezone': params.get('timezone', 'GMT'),
+      'hourly_units': {attribute: '' for attribute in ['time', *attributes]},
+      'hourly': hourly,
+    })
+
+  def send_json(self, status:int, body:dict) -> None:
+    content = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+def start_stub_server(port:int=0, latency:float=0, failure_rate:float=0) -> ThreadingHTTPServer:
+  '''
+  Starts the stub in a background thread and returns the server
+  (its URL is http://127.0.0.1:{server.server_port}).
+  '''
+  server = ThreadingHTTPServer(('127.0.0.1', port), OpenMeteoStubHandler)
+  server.daemon_threads = True
+  server.latency = latency
+  server.failure_rate = failure_rate
+  server.request_count = 0
+  server.lock = threading.Lock()
+
+  thread = threading.Thread(target=server.serve_forever, name='open-meteo-stub', daemon=True)
+  thread.start()
+  return server
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Local stand-in for the Open-Meteo archive and forecast APIs')
+  parser.add_argument('--port', type=int, default=8090)
+  parser.add_argument('--latency', type=float, default=0, help='delay added to each response (seconds)')
+  parser.add_argument('--failure-rate', type=float, default=0, help='fraction of requests answered with HTTP 503')
+  args = parser.parse_args()
+
+  server = start_stub_server(args.port, args.latency, args.failure_rate)
+  print(f'Open-Meteo stub listening on http://127.0.0.1:{server.server_port}')
+  print(f'export OPEN_METEO_ARCHIVE_URL=http://127.0.0.1:{server.server_port}/v1/archive')
+  print(f'export OPEN_METEO_FORECAST_URL=http://127.0.0.1:{server.server_port}/v1/forecast')
+
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    server.shutdown()
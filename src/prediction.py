@@ -0,0 +1,274 @@
+from datetime import timezone
+import logging
+import numpy as np
+import pandas as pd
+
+# Import custom code
+from src.constants import LOCAL_TIMEZONE, WEATHER_CONDITIONS
+from src.feature_plan import FeaturePlan
+from src.inference import DelayModel
+from src.metrics import CACHE_LOOKUPS, span
+from src.prediction_cache import PredictionCache, get_cache_key
+from src.prediction_grid import PredictionGrid
+from src.schedule_index import get_service_key
+from src.artifact_bundle import ServingArtifacts
+from src.trip_functions import get_departures_info, get_trip_info, get_weather_info, serving_artifacts
+
+def get_time_error(chosen_time_local:pd.Timestamp, min_time_local:pd.Timestamp, now_local:pd.Timestamp) -> str|None:
+  '''
+  Returns an error message if the chosen time is earlier than the minimum date
+  of the preprocessed data or later than two weeks from now
+  '''
+  chosen_time_utc = chosen_time_local.tz_convert(tz=timezone.utc)
+  now_utc = now_local.tz_convert(tz=timezone.utc)
+  two_weeks_later_utc = now_utc + pd.Timedelta(weeks=2) # the weather forecast only goes 2 weeks from now
+  min_time_utc = min_time_local.tz_convert(tz=timezone.utc)
+  two_weeks_later_local = two_weeks_later_utc.tz_convert(tz=LOCAL_TIMEZONE)
+
+  if (chosen_time_utc < min_time_utc) | (chosen_time_utc > two_weeks_later_utc):
+    dt_format = '%Y-%m-%d'
+    return f'The date should not be earlier than {min_time_local.strftime(dt_format)} or later than {two_weeks_later_local.strftime(dt_format)}'
+  return None
+
+def use_forecast(arrival_time_utc:pd.Timestamp|pd.DatetimeIndex, now_local:pd.Timestamp) -> bool|np.ndarray:
+  '''Arrivals from the last 3 days onward use the forecast, older ones the archive'''
+  three_days_before_utc = now_local.tz_convert(tz=timezone.utc) - pd.Timedelta(days=3)
+  return arrival_time_utc > three_days_before_utc
+
+def get_delay_status(predicted_time:pd.Timestamp, arrival_time:pd.Timestamp) -> str:
+  if predicted_time < arrival_time:
+    return 'Early'
+  elif predicted_time > arrival_time:
+    return 'Late'
+  return 'On Time'
+
+def format_prediction(trip_result:dict, weather_data:dict, prediction:float) -> dict:
+  '''Returns the /predict response for a trip, its weather and the predicted delay (in seconds)'''
+  next_arrival_time = trip_result['next_arrival_time']
+  predicted_time = next_arrival_time + pd.Timedelta(seconds=prediction)
+  return get_result(trip_result, weather_data, next_arrival_time.round('min'), predicted_time.round('min'))
+
+def get_result(trip_result:dict, weather_data:dict, rounded_next_arrival_time:pd.Timestamp, rounded_predicted_time:pd.Timestamp) -> dict:
+  result = {}
+
+  ## Weather data
+  weathercode = int(weather_data['weathercode'])
+  result['weather_condition'] = WEATHER_CONDITIONS[weathercode]
+  result['temperature'] = weather_data['temperature_2m']
+  result['weather_source'] = weather_data['weather_source']
+
+  ## Trip data
+  result['next_arrival_time'] = rounded_next_arrival_time.strftime('%Y-%m-%d %H:%M')
+  result['predicted_time'] = rounded_predicted_time.strftime('%Y-%m-%d %H:%M')
+  result['hist_avg_delay'] = trip_result['hist_avg_delay']
+  result['status'] = get_delay_status(rounded_predicted_time, rounded_next_arrival_time)
+
+  return result
+
+def get_error(status_code:int, message:str) -> dict:
+  return {'status_code': status_code, 'message': message}
+
+def parse_query(query:dict) -> tuple[int, str, int, pd.Timestamp]:
+  '''Returns the route_id, direction, stop_id and local time of a batch query, or raises a ValueError'''
+  if not isinstance(query, dict):
+    raise ValueError('The query should be an object.')
+
+  missing = [field for field in ['bus_line', 'direction', 'stop', 'chosen_time'] if query.get(field) is None]
+  if missing:
+    raise ValueError(f'Missing fields: {", ".join(missing)}.')
+
+  try:
+    route_id = int(query['bus_line'])
+    stop_id = int(query['stop'])
+    chosen_time_local = pd.Timestamp(query['chosen_time'], tz=LOCAL_TIMEZONE)
+  except Exception:
+    raise ValueError('bus_line and stop should be integers and chosen_time a local date and time.')
+
+  return route_id, str(query['direction']), stop_id, chosen_time_local
+
+def predict_delays(records:list[dict], model:DelayModel, feature_plan:FeaturePlan, scheduled_probability:float|None=None) -> np.ndarray:
+  '''
+  Returns the predicted delays of records of weather and trip data. Records
+  whose schedule_relationship_Scheduled is None get the expected delay: the
+  predictions with the value at 1 and 0 (from the same model call), weighted
+  by how often each value occurs (scheduled_probability, by default the one
+  of the artifacts loaded at startup).
+  '''
+  if scheduled_probability is None:
+    scheduled_probability = serving_artifacts.scheduled_probability
+
+  with span('features'):
+    base = feature_plan.get_base_matrix(records)
+    expected = []
+    if 'schedule_relationship_Scheduled' in feature_plan.base_features:
+      column = feature_plan.base_features.index('schedule_relationship_Scheduled')
+      expected = np.flatnonzero(np.isnan(base[:, column]))
+    if not len(expected):
+      features = feature_plan.transform(base)
+    else:
+      # Append the expected rows again, with the value at 1, after the rows with it at 0
+      scheduled_base = base[expected]
+      scheduled_base[:, column] = 1
+      base[expected, column] = 0
+      features = feature_plan.transform(np.vstack([base, scheduled_base]))
+
+  with span('model'):
+    predictions = model.predict(features)
+  if not len(expected):
+    return predictions
+
+  delays = predictions[:len(base)]
+  delays[expected] = scheduled_probability * predictions[len(base):].astype('float64') + (1 - scheduled_probability) * delays[expected].astype('float64')
+  return delays
+
+def get_predictions(trip_results:list, weather_results:list, model:DelayModel, feature_plan:FeaturePlan,
+                    prediction_grid:PredictionGrid|None=None, prediction_cache:PredictionCache|None=None, scheduled_probability:float|None=None) -> np.ndarray:
+  '''
+  Returns the predicted delay of each trip result (from get_trip_info) with its
+  weather: from the prediction grid, then the prediction cache, and the model
+  runs once on the remaining ones, whose predictions are cached.
+  '''
+  predictions = np.full(len(trip_results), np.nan, dtype='float32')
+  cache_keys = {}
+  grid_hits = cache_hits = 0
+  with span('prediction_lookup'):
+    for position, (trip_result, weather_data) in enumerate(zip(trip_results, weather_results)):
+      prediction = None
+      if prediction_grid is not None:
+        prediction = prediction_grid.lookup(trip_result, weather_data)
+        grid_hits += prediction is not None
+      if prediction is None and prediction_cache is not None:
+        cache_keys[position] = get_cache_key(trip_result, weather_data, model.version)
+        prediction = prediction_cache.get(cache_keys[position])
+        cache_hits += prediction is not None
+      if prediction is not None:
+        predictions[position] = prediction
+
+  if prediction_grid is not None:
+    CACHE_LOOKUPS.labels('prediction_grid', 'hit').inc(grid_hits)
+    CACHE_LOOKUPS.labels('prediction_grid', 'miss').inc(len(trip_results) - grid_hits)
+  if prediction_cache is not None:
+    CACHE_LOOKUPS.labels('prediction_cache', 'hit').inc(cache_hits)
+    CACHE_LOOKUPS.labels('prediction_cache', 'miss').inc(len(cache_keys) - cache_hits)
+
+  misses = np.flatnonzero(np.isnan(predictions))
+  if len(misses):
+    records = [{**weather_results[position], **trip_results[position]['trip_data']} for position in misses]
+    predictions[misses] = predict_delays(records, model, feature_plan, scheduled_probability)
+
+    if prediction_cache is not None:
+      for position in misses:
+        prediction_cache.put(cache_keys[position], float(predictions[position]))
+
+  return predictions
+
+def predict_batch(queries:list, model:DelayModel, feature_plan:FeaturePlan, min_time_local:pd.Timestamp, now_local:pd.Timestamp|None=None,
+                  prediction_grid:PredictionGrid|None=None, prediction_cache:PredictionCache|None=None, artifacts:ServingArtifacts|None=None) -> list[dict]:
+  '''
+  Predicts the next arrival of many (bus_line, direction, stop, chosen_time)
+  queries. The active services are resolved once per service date, each
+  weather hour is read once and the model runs once on all the queries.
+
+  Returns one result per query, in input order: the /predict response with
+  status_code 200, or status_code 400/404/500 and a message.
+  '''
+  if now_local is None:
+    now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE)
+  artifacts = artifacts or serving_artifacts
+  results = [None] * len(queries)
+
+  # Parse queries and group them by service date
+  service_groups = {}
+  for index, query in enumerate(queries):
+    try:
+      route_id, direction, stop_id, chosen_time_local = parse_query(query)
+    except ValueError as e:
+      results[index] = get_error(400, str(e))
+      continue
+
+    time_error = get_time_error(chosen_time_local, min_time_local, now_local)
+    if time_error:
+      results[index] = get_error(400, time_error)
+      continue
+
+    service_groups.setdefault(get_service_key(chosen_time_local), []).append((index, route_id, direction, stop_id, chosen_time_local))
+
+  # Get trip data
+  trip_results = {}
+  for group in service_groups.values():
+    active_services = artifacts.schedule_index.get_active_services(group[0][4])
+
+    for index, route_id, direction, stop_id, chosen_time_local in group:
+      try:
+        trip_result = get_trip_info(route_id, direction, stop_id, chosen_time_local, active_services, artifacts)
+      except KeyError:
+        results[index] = get_error(404, 'There is no historical delay for this stop at this hour.')
+        continue
+      except Exception as e:
+        logging.error('An error occured: %s', repr(e))
+        results[index] = get_error(500, 'An error occured.')
+        continue
+
+      if not trip_result:
+        results[index] = get_error(404, 'There are no arrivals after this time.')
+        continue
+      trip_results[index] = trip_result
+
+  # Predict the trips that were found
+  for index, result in predict_trips(trip_results, model, feature_plan, now_local, prediction_grid, prediction_cache, artifacts.scheduled_probability).items():
+    results[index] = {'status_code': 200, **result}
+
+  return results
+
+def predict_trips(trip_results:dict, model:DelayModel, feature_plan:FeaturePlan, now_local:pd.Timestamp,
+                  prediction_grid:PredictionGrid|None=None, prediction_cache:PredictionCache|None=None, scheduled_probability:float|None=None) -> dict:
+  '''
+  Returns the /predict response of each trip result (from get_trip_info), with
+  the same keys. Each weather hour is read once and the predictions come from
+  get_predictions.
+  '''
+  if not trip_results:
+    return {}
+
+  next_arrival_times = pd.DatetimeIndex([trip_result['next_arrival_time'] for trip_result in trip_results.values()]).tz_convert(tz=timezone.utc)
+
+  # Get weather data, once per hour
+  weather_keys = zip(next_arrival_times.round('h').asi8, use_forecast(next_arrival_times, now_local))
+  weather_hours = {}
+  weather_results = []
+  for position, weather_key in enumerate(weather_keys):
+    if weather_key not in weather_hours:
+      weather_hours[weather_key] = get_weather_info(next_arrival_times[position], forecast=bool(weather_key[1]))
+    weather_results.append(weather_hours[weather_key])
+
+  # Make predictions
+  predictions = get_predictions(list(trip_results.values()), weather_results, model, feature_plan, prediction_grid, prediction_cache, scheduled_probability)
+
+  # Round all the times at once (in UTC, where no local time is ambiguous)
+  predicted_times = (next_arrival_times + pd.to_timedelta(predictions.astype('float64'), unit='s')).round('min').tz_convert(tz=LOCAL_TIMEZONE)
+  rounded_next_arrival_times = next_arrival_times.round('min').tz_convert(tz=LOCAL_TIMEZONE)
+
+  results = {}
+  for (key, trip_result), weather_data, next_arrival_time, predicted_time in zip(trip_results.items(), weather_results, rounded_next_arrival_times, predicted_times):
+    results[key] = get_result(trip_result, weather_data, next_arrival_time, predicted_time)
+  return results
+
+def predict_departures(stop_id:int, chosen_time_local:pd.Timestamp, n:int, model:DelayModel, feature_plan:FeaturePlan, now_local:pd.Timestamp|None=None,
+                       prediction_grid:PredictionGrid|None=None, prediction_cache:PredictionCache|None=None, artifacts:ServingArtifacts|None=None) -> list|None:
+  '''
+  Returns the next n arrivals at a stop across all routes and directions with
+  their predicted time, or None if no trip serves the stop
+  '''
+  if now_local is None:
+    now_local = pd.Timestamp.now(tz=LOCAL_TIMEZONE)
+
+  artifacts = artifacts or serving_artifacts
+  departures = get_departures_info(stop_id, chosen_time_local, n, artifacts)
+  if departures is None:
+    return None
+
+  results = predict_trips(dict(enumerate(departures)), model, feature_plan, now_local, prediction_grid, prediction_cache, artifacts.scheduled_probability)
+  return [
+    {'bus_line': trip_result['route_id'], 'direction': trip_result['direction'], **results[index]}
+    for index, trip_result in enumerate(departures)
+  ]
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import threading
+import time
+
+# Import custom code
+from src.constants import WEATHER_ATTRIBUTES, PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL
+
+class PredictionCache:
+  '''
+  Bounded LRU cache of predicted delays whose entries expire after ttl seconds.
+
+  Keys include everything a prediction depends on (see get_cache_key), so a
+  new model or forecast gives new keys and the old entries are never read
+  again: they are evicted as the least recently used or when they expire.
+  '''
+
+  def __init__(self, max_size:int=PREDICTION_CACHE_SIZE, ttl:float=PREDICTION_CACHE_TTL) -> None:
+    self.max_size = max_size
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._entries = OrderedDict()
+    self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+  def get(self, key:tuple) -> float|None:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self._stats['misses'] += 1
+        return None
+
+      expires_at, value = entry
+      if expires_at <= time.monotonic():
+        del self._entries[key]
+        self._stats['expirations'] += 1
+        self._stats['misses'] += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self._stats['hits'] += 1
+      return value
+
+  def put(self, key:tuple, value:float) -> None:
+    if self.max_size <= 0:
+      return
+
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self._stats['evictions'] += 1
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+
+  def get_state(self) -> dict:
+    with self._lock:
+      return {'size': len(self._entries), 'max_size': self.max_size, **self._stats}
+
+def get_cache_key(trip_result:dict, weather_data:dict, model_version:str) -> tuple:
+  '''
+  Returns the cache key of a deterministic prediction: the arrival (its trip
+  and stop on a service date, by position in the schedule index), its hourly
+  frequency and historical delay, the weather hour and values, and the model
+  version.
+  '''
+  service_date, arrival_index = trip_result['arrival_key']
+  weather_values = tuple(weather_data[attribute] for attribute in WEATHER_ATTRIBUTES)
+  trip_data = trip_result['trip_data']
+  return (service_date, arrival_index, trip_data['arrivals_per_hour'], trip_data['hist_avg_delay'], weather_data.get('time'), weather_values, model_version)
@@ -0,0 +1,333 @@
+from datetime import date, timedelta
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import threading
+import time
+
+# Import custom code
+from src.constants import LOCAL_TIMEZONE, WEATHER_ATTRIBUTES, PREDICTION_GRID_DAYS, PREDICTION_GRID_RELOAD_INTERVAL
+from src.feature_plan import FeaturePlan
+from src.helper_functions import get_service_day_start
+from src.inference import DelayModel
+from src.schedule_index import ScheduleIndex, get_hist_key
+from src.weather_store import WeatherStore, FORECAST
+
+GRID_FORMAT_VERSION = 3
+MANIFEST_FILE = 'manifest.json'
+DAY_COLUMNS = ['arrival_index', 'weather_hour', 'arrivals_per_hour', 'hist_avg_delay', 'delays']
+
+def get_schedule_fingerprint(schedule_index:ScheduleIndex) -> str:
+  '''
+  Returns a hash of the schedule index arrays that the grid rows depend on.
+  The historical delays are left out: they are reloaded while serving, so
+  each row keeps the value it was computed with instead.
+  '''
+  digest = hashlib.sha1()
+  for array in [
+    schedule_index.arrival_secs, schedule_index.arrival_trip_ids, schedule_index.arrival_services, schedule_index.key_offsets,
+    schedule_index.key_route_ids, schedule_index.key_stop_ids, schedule_index.trip_ids, schedule_index.trip_route_bearings,
+    schedule_index.trip_durations, schedule_index.stop_ids, schedule_index.stop_clusters,
+  ]:
+    digest.update(np.ascontiguousarray(array).tobytes())
+  digest.update(pd.util.hash_pandas_object(schedule_index.calendar_df.astype(str), index=False).to_numpy().tobytes())
+  digest.update(repr(schedule_index.service_ids.tolist()).encode())
+  return digest.hexdigest()[:16]
+
+def get_weather_time(weather_hour:int) -> str:
+  '''Returns the weather store time of an hour counted from the epoch (UTC)'''
+  return pd.Timestamp(int(weather_hour) * 3600, unit='s').strftime('%Y-%m-%dT%H:%M')
+
+def get_date_arrivals(schedule_index:ScheduleIndex, service_date:date) -> pd.DataFrame:
+  '''
+  Returns every arrival scheduled on a service date with the trip features
+  get_arrival_info would compute for it, sorted by position in the arrival
+  arrays. The arrival times are localized from noon minus 12h, like
+  get_trip_info, so on the days of a time change each one is an instant and
+  its hour is the local one. Arrivals without a historical delay are left out
+  (they go through live inference).
+  '''
+  # Services running after midnight on that date
+  date_local = pd.Timestamp(service_date, tz=LOCAL_TIMEZONE)
+  active_services = schedule_index.get_active_services(date_local + pd.Timedelta(hours=12))
+  positions = np.flatnonzero(np.isin(schedule_index.arrival_services, active_services))
+  arrival_secs = schedule_index.arrival_secs[positions].astype('int64')
+  key_codes = np.searchsorted(schedule_index.key_offsets, positions, side='right') - 1
+
+  # Localize arrival times and get their local hour and weather hour (UTC, rounded like get_weather_info)
+  arrival_times = get_service_day_start(date_local.tz_localize(None)) + pd.to_timedelta(arrival_secs, unit='s')
+  weather_hours = arrival_times.tz_convert('UTC').round('h').asi8 // (3600 * 10**9)
+  hours = arrival_times.hour.to_numpy()
+
+  # Count the arrivals of the same route, direction and stop within the hour
+  composite = (key_codes.astype('int64') << 20) | arrival_secs
+  sorted_composite = np.sort(composite)
+  hour_start = (key_codes.astype('int64') << 20) | (arrival_secs - arrival_secs % 3600)
+  arrivals_per_hour = np.searchsorted(sorted_composite, hour_start + 3600) - np.searchsorted(sorted_composite, hour_start)
+
+  # Historical average delay
+  hist_keys, hist_values = schedule_index.hist_delays
+  arrival_hist_keys = get_hist_key(schedule_index.key_route_ids[key_codes], schedule_index.key_stop_ids[key_codes], hours)
+  hist_index = np.minimum(np.searchsorted(hist_keys, arrival_hist_keys), len(hist_keys) - 1)
+  has_hist = hist_keys[hist_index] == arrival_hist_keys
+
+  # Stop cluster (NaN for stops without one)
+  stop_ids = schedule_index.key_stop_ids[key_codes]
+  stop_index = np.minimum(np.searchsorted(schedule_index.stop_ids, stop_ids), len(schedule_index.stop_ids) - 1)
+  stop_clusters = np.where(schedule_index.stop_ids[stop_index] == stop_ids, schedule_index.stop_clusters[stop_index], np.nan)
+
+  # Route bearing and expected trip duration
+  trip_index = np.searchsorted(schedule_index.trip_ids, schedule_index.arrival_trip_ids[positions])
+
+  arrivals_df = pd.DataFrame({
+    'arrival_index': positions.astype('int32'),
+    'weather_hour': weather_hours.astype('int32'),
+    'arrivals_per_hour': arrivals_per_hour.astype('int32'),
+    'stop_cluster': stop_clusters,
+    'route_bearing': schedule_index.trip_route_bearings[trip_index],
+    'exp_trip_duration': schedule_index.trip_durations[trip_index],
+    'hist_avg_delay': hist_values[hist_index],
+  })
+  return arrivals_df[has_hist].reset_index(drop=True)
+
+def predict_arrivals(arrivals_df:pd.DataFrame, weather_values:dict, model:DelayModel, feature_plan:FeaturePlan) -> np.ndarray:
+  '''Returns the predicted delays of the arrivals with schedule_relationship_Scheduled at 0 and 1 (N x 2)'''
+  base_df = arrivals_df.copy()
+  hours, hour_codes = np.unique(arrivals_df['weather_hour'], return_inverse=True)
+  hour_values = np.array([weather_values[get_weather_time(hour)] for hour in hours], dtype='float64').reshape(-1, len(WEATHER_ATTRIBUTES))
+  for column, attribute in enumerate(WEATHER_ATTRIBUTES):
+    base_df[attribute] = hour_values[hour_codes, column]
+
+  delays = np.empty((len(base_df), 2), dtype='float32')
+  for sch_rel in [0, 1]:
+    base_df['schedule_relationship_Scheduled'] = sch_rel
+    features = feature_plan.transform(feature_plan.get_base_matrix_from_frame(base_df))
+    model.predict_batch(features, out=delays[:, sch_rel])
+  return delays
+
+def read_manifest(grid_path:str) -> dict:
+  manifest_path = os.path.join(grid_path, MANIFEST_FILE)
+  if not os.path.isfile(manifest_path):
+    return {}
+
+  with open(manifest_path) as f:
+    return json.load(f)
+
+def load_day(grid_path:str, day_dir:str) -> dict:
+  # Plain ndarray views of the memory maps (np.memmap adds overhead to every scalar access)
+  return {column: np.asarray(np.load(os.path.join(grid_path, day_dir, f'{column}.npy'), mmap_mode='r')) for column in DAY_COLUMNS}
+
+def write_day(grid_path:str, day_dir:str, day:dict) -> None:
+  day_path = os.path.join(grid_path, day_dir)
+  shutil.rmtree(day_path, ignore_errors=True) # left over by an interrupted build
+  os.makedirs(day_path)
+  for column in DAY_COLUMNS:
+    np.save(os.path.join(day_path, f'{column}.npy'), day[column])
+
+def refresh_prediction_grid(grid_path:str, schedule_index:ScheduleIndex, weather_store:WeatherStore, model:DelayModel,
+                            feature_plan:FeaturePlan, start_date:date, n_days:int=PREDICTION_GRID_DAYS, full:bool=False) -> dict:
+  '''
+  Precomputes the predicted delay of every scheduled arrival on n_days
+  service dates from start_date, with the forecast in the weather store.
+
+  Unless full is True, a grid built for the same schedule and model is
+  updated in place: only the arrivals whose forecast hour or historical
+  delay changed (or that are new) go through the model. Each service date is a directory of .npy
+  files sorted by arrival_index, and the manifest keeps the forecast used
+  for each hour. Returns build statistics.
+  '''
+  start = time.perf_counter()
+  schedule_fingerprint = get_schedule_fingerprint(schedule_index)
+  manifest = read_manifest(grid_path)
+  build_id = manifest.get('build_id', 0) + 1
+  is_compatible = (
+    manifest.get('format_version') == GRID_FORMAT_VERSION
+    and manifest.get('schedule_fingerprint') == schedule_fingerprint
+    and manifest.get('model_version') == model.version
+    and manifest.get('feature_names') == feature_plan.feature_names
+  )
+  if full or not is_compatible:
+    manifest = {}
+
+  previous_days = manifest.get('days', {})
+  previous_weather = manifest.get('weather', {})
+  os.makedirs(grid_path, exist_ok=True)
+
+  days = {}
+  weather_values = {}
+  changed_hours = set()
+  stats = {'days': 0, 'rows': 0, 'computed_rows': 0}
+
+  for day_offset in range(n_days):
+    service_date = start_date + timedelta(days=day_offset)
+    date_key = service_date.strftime('%Y%m%d')
+    arrivals_df = get_date_arrivals(schedule_index, service_date)
+
+    # Current forecast of each hour (arrivals without one are left to live inference)
+    hours = np.unique(arrivals_df['weather_hour'])
+    for hour in hours:
+      weather_time = get_weather_time(hour)
+      if weather_time not in weather_values:
+        weather = weather_store.get(FORECAST, weather_time)
+        weather_values[weather_time] = None if weather is None else [weather[attribute] for attribute in WEATHER_ATTRIBUTES]
+        if weather_values[weather_time] is not None and weather_values[weather_time] != previous_weather.get(weather_time):
+          changed_hours.add(int(hour))
+
+    hours_with_weather = [hour for hour in hours if weather_values[get_weather_time(hour)] is not None]
+    arrivals_df = arrivals_df[np.isin(arrivals_df['weather_hour'], hours_with_weather)].reset_index(drop=True)
+
+    # Reuse the predictions of unchanged arrivals
+    compute_mask = np.ones(len(arrivals_df), dtype='bool')
+    delays = np.empty((len(arrivals_df), 2), dtype='float32')
+
+    if date_key in previous_days:
+      previous_day = load_day(grid_path, previous_days[date_key])
+      previous_index = np.minimum(np.searchsorted(previous_day['arrival_index'], arrivals_df['arrival_index']), max(len(previous_day['arrival_index']) - 1, 0))
+      if len(previous_day['arrival_index']):
+        found = previous_day['arrival_index'][previous_index] == arrivals_df['arrival_index'].to_numpy()
+        hist_changed = previous_day['hist_avg_delay'][previous_index] != arrivals_df['hist_avg_delay'].to_numpy()
+        compute_mask = ~found | hist_changed | np.isin(arrivals_df['weather_hour'], list(changed_hours))
+        delays[~compute_mask] = previous_day['delays'][previous_index[~compute_mask]]
+
+      # Keep the directory of a date that did not change
+      if not compute_mask.any() and len(previous_day['arrival_index']) == len(arrivals_df):
+        days[date_key] = previous_days[date_key]
+        stats['days'] += 1
+        stats['rows'] += len(arrivals_df)
+        continue
+
+    if compute_mask.any():
+      delays[compute_mask] = predict_arrivals(arrivals_df[compute_mask], weather_values, model, feature_plan)
+
+    day_dir = f'{date_key}_{build_id}'
+    write_day(grid_path, day_dir, {
+      'arrival_index': arrivals_df['arrival_index'].to_numpy(),
+      'weather_hour': arrivals_df['weather_hour'].to_numpy(),
+      'arrivals_per_hour': arrivals_df['arrivals_per_hour'].to_numpy(),
+      'hist_avg_delay': arrivals_df['hist_avg_delay'].to_numpy(),
+      'delays': delays,
+    })
+    days[date_key] = day_dir
+    stats['days'] += 1
+    stats['rows'] += len(arrivals_df)
+    stats['computed_rows'] += int(compute_mask.sum())
+
+  # Write the manifest last, then remove the directories it no longer uses
+  manifest = {
+    'format_version': GRID_FORMAT_VERSION,
+    'build_id': build_id,
+    'built_at': pd.Timestamp.now(tz=LOCAL_TIMEZONE).isoformat(),
+    'schedule_fingerprint': schedule_fingerprint,
+    'model_version': model.version,
+    'feature_names': feature_plan.feature_names,
+    'days': days,
+    'weather': {weather_time: values for weather_time, values in weather_values.items() if values is not None},
+  }
+  manifest_tmp_path = os.path.join(grid_path, f'{MANIFEST_FILE}.tmp')
+  with open(manifest_tmp_path, 'w') as f:
+    json.dump(manifest, f)
+  os.replace(manifest_tmp_path, os.path.join(grid_path, MANIFEST_FILE))
+
+  for entry in os.listdir(grid_path):
+    if os.path.isdir(os.path.join(grid_path, entry)) and entry not in days.values():
+      shutil.rmtree(os.path.join(grid_path, entry), ignore_errors=True)
+
+  stats['changed_hours'] = len(changed_hours)
+  stats['seconds'] = time.perf_counter() - start
+  return stats
+
+class PredictionGrid:
+  '''
+  Memory-mapped reader of the grid written by refresh_prediction_grid.
+
+  A stored prediction is only returned if the arrival's hourly frequency,
+  historical delay and forecast are the ones the grid was computed with, so a stale grid gives
+  misses (live inference) rather than outdated predictions. The grid is
+  reloaded when the manifest changes.
+  '''
+
+  def __init__(self, grid_path:str, schedule_fingerprint:str, model_version:str, feature_names:list[str], scheduled_probability:float,
+               reload_interval:float=PREDICTION_GRID_RELOAD_INTERVAL) -> None:
+    self.grid_path = grid_path
+    self.schedule_fingerprint = schedule_fingerprint
+    self.model_version = model_version
+    self.feature_names = feature_names
+    self.scheduled_probability = scheduled_probability # weight of the delays with schedule_relationship_Scheduled at 1
+    self.reload_interval = reload_interval
+    self._lock = threading.Lock()
+    self._manifest_mtime = None
+    self._checked_at = 0
+    self.days = {}
+    self.weather = {} # hour from the epoch -> (weather store time, forecast values)
+    self.stats = {'hits': 0, 'misses': 0}
+    self.reload_if_changed(force=True)
+
+  def reload_if_changed(self, force:bool=False) -> None:
+    now = time.monotonic()
+    if not force and now - self._checked_at < self.reload_interval:
+      return
+    self._checked_at = now
+
+    manifest_path = os.path.join(self.grid_path, MANIFEST_FILE)
+    manifest_mtime = os.stat(manifest_path).st_mtime_ns if os.path.isfile(manifest_path) else None
+    if manifest_mtime == self._manifest_mtime:
+      return
+
+    with self._lock:
+      self._manifest_mtime = manifest_mtime
+      try:
+        manifest = read_manifest(self.grid_path)
+        if (manifest.get('format_version') != GRID_FORMAT_VERSION or manifest.get('schedule_fingerprint') != self.schedule_fingerprint
+            or manifest.get('model_version') != self.model_version or manifest.get('feature_names') != self.feature_names):
+          if manifest:
+            logging.info('Prediction grid: %s was built for another schedule or model, ignoring it', self.grid_path)
+          self.days, self.weather = {}, {}
+          return
+
+        self.days = {int(date_key): load_day(self.grid_path, day_dir) for date_key, day_dir in manifest['days'].items()}
+        self.weather = {
+          int(pd.Timestamp(weather_time).value // (3600 * 10**9)): (weather_time, tuple(values))
+          for weather_time, values in manifest['weather'].items()
+        }
+        logging.info('Prediction grid: loaded %d days built at %s', len(self.days), manifest['built_at'])
+      except Exception as e:
+        logging.error('Prediction grid: could not load %s: %s', self.grid_path, repr(e))
+
+  def lookup(self, trip_result:dict, weather_data:dict) -> float|None:
+    '''Returns the stored delay of an arrival from get_trip_info with its weather, or None on a miss'''
+    self.reload_if_changed()
+    prediction = self._lookup(trip_result, weather_data)
+    self.stats['misses' if prediction is None else 'hits'] += 1
+    return prediction
+
+  def _lookup(self, trip_result:dict, weather_data:dict) -> float|None:
+    service_date, arrival_index = trip_result['arrival_key']
+    day = self.days.get(service_date)
+    if day is None:
+      return None
+
+    index = np.searchsorted(day['arrival_index'], np.int32(arrival_index)) # same dtype, or the whole column is cast
+    if index == len(day['arrival_index']) or day['arrival_index'][index] != arrival_index:
+      return None
+
+    trip_data = trip_result['trip_data']
+    if day['arrivals_per_hour'][index] != trip_data['arrivals_per_hour'] or day['hist_avg_delay'][index] != trip_data['hist_avg_delay']:
+      return None
+
+    weather_time, weather_values = self.weather.get(int(day['weather_hour'][index]), (None, None))
+    if weather_data.get('time') != weather_time or weather_values != tuple(weather_data[attribute] for attribute in WEATHER_ATTRIBUTES):
+      return None
+
+    not_scheduled_delay, scheduled_delay = day['delays'][index].tolist()
+    sch_rel = trip_data['schedule_relationship_Scheduled']
+    if sch_rel is None:
+      # Expected delay, rounded to float32 like predict_delays
+      return float(np.float32(self.scheduled_probability * scheduled_delay + (1 - self.scheduled_probability) * not_scheduled_delay))
+    return scheduled_delay if sch_rel else not_scheduled_delay
+
+  def get_state(self) -> dict:
+    return {'days': len(self.days), **self.stats}
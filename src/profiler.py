@@ -0,0 +1,85 @@
+from collections import Counter
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+# Import custom code
+from src.constants import ROOT_DIR, PROFILE_SAMPLE_RATE, PROFILE_HEADER_ENABLED, PROFILE_INTERVAL, PROFILE_DIR
+
+def should_profile(header_value:str|None) -> bool:
+  '''A request is profiled at random (PROFILE_SAMPLE_RATE), or when it asks with X-Profile: 1 and PROFILE_HEADER_ENABLED is set'''
+  if PROFILE_HEADER_ENABLED and header_value == '1':
+    return True
+  return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def get_frame_name(frame) -> str:
+  code = frame.f_code
+  file_name = code.co_filename
+  if file_name.startswith(str(ROOT_DIR)):
+    file_name = os.path.relpath(file_name, ROOT_DIR)
+  return f'{code.co_name} ({file_name}:{code.co_firstlineno})'.replace(';', ',')
+
+class SamplingProfiler:
+  '''
+  Samples the stack of one thread every interval seconds from a background
+  thread, and counts each stack. The profile is written in the collapsed
+  format ('root;caller;callee count' lines) read by flamegraph.pl and
+  speedscope. The profiled thread is not slowed down, apart from the GIL
+  taken by each sample.
+  '''
+
+  def __init__(self, thread_id:int|None=None, interval:float=PROFILE_INTERVAL) -> None:
+    self.thread_id = thread_id or threading.get_ident()
+    self.interval = interval
+    self.stacks = Counter()
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+  def start(self) -> 'SamplingProfiler':
+    self.started_at = time.perf_counter()
+    self._thread.start()
+    return self
+
+  def stop(self) -> Counter:
+    self._stop_event.set()
+    self._thread.join()
+    self.seconds = time.perf_counter() - self.started_at
+    return self.stacks
+
+  def _run(self) -> None:
+    while not self._stop_event.wait(self.interval):
+      frame = sys._current_frames().get(self.thread_id)
+      if frame is None:
+        break
+
+      names = []
+      while frame is not None:
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+      self.stacks[';'.join(reversed(names))] += 1
+
+  def write(self, name:str, profile_dir:str=PROFILE_DIR) -> str|None:
+    '''Writes the collapsed stacks to profile_dir and returns the file path (None without samples)'''
+    if not self.stacks:
+      return None
+
+    os.makedirs(profile_dir, exist_ok=True)
+    now = time.time()
+    prefix = f'{time.strftime("%Y%m%dT%H%M%S", time.localtime(now))}.{int(now * 1000) % 1000:03d}-{name}-{os.getpid()}-{self.thread_id}'
+
+    # Never overwrite a profile of the same request thread written in the same millisecond
+    for attempt in itertools.count():
+      path = os.path.join(profile_dir, f'{prefix}.folded' if attempt == 0 else f'{prefix}-{attempt}.folded')
+      try:
+        f = open(path, 'x')
+        break
+      except FileExistsError:
+        continue
+
+    with f:
+      for stack, count in self.stacks.most_common():
+        f.write(f'{stack} {count}\n')
+    return path
@@ -0,0 +1,347 @@
+import json
+import math
+import numpy as np
+import os
+import pandas as pd
+import shutil
+
+# Import custom code
+from src.constants import LOCAL_TIMEZONE
+from src.helper_functions import get_route_bearing, get_service_day_start, gtfs_time_to_seconds
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Increment when the arrays of the index change
+INDEX_FORMAT_VERSION = 1
+INDEX_MANIFEST_FILE = 'manifest.json'
+
+# Arrays saved by ScheduleIndex.save and memory-mapped by ScheduleIndex.load (the other ones are small and loaded)
+MAPPED_ARRAYS = [
+  'arrival_secs', 'arrival_trip_ids', 'arrival_services', 'key_offsets', 'key_route_ids', 'key_stop_ids', 'stop_arrivals',
+  'arrival_stop_ids', 'stop_offsets', 'trip_ids', 'trip_route_bearings', 'trip_durations', 'stop_ids', 'stop_clusters',
+]
+LOADED_ARRAYS = ['service_ids', 'key_headsigns']
+
+def get_hist_key(route_id, stop_id, hour):
+  '''Packs (route_id, stop_id, hour) into a single int64 lookup key'''
+  return (np.int64(route_id) << 32) | (np.int64(stop_id) << 5) | np.int64(hour)
+
+def localize_calendar(calendar_df:pd.DataFrame) -> pd.DataFrame:
+  '''Returns the calendar with its start and end dates as local times, the end date included'''
+  calendar_df = calendar_df.copy()
+  calendar_df['start_date'] = calendar_df['start_date'].dt.tz_localize(LOCAL_TIMEZONE)
+  calendar_df['end_date'] = calendar_df['end_date'].dt.tz_localize(LOCAL_TIMEZONE) + pd.Timedelta(days=1)
+  return calendar_df
+
+def get_service_key(chosen_time_local:pd.Timestamp) -> tuple:
+  '''
+  Times with the same key have the same active services: the same date, and
+  midnight is kept apart because the calendar bounds are compared inclusively.
+  '''
+  start_date = chosen_time_local.normalize()
+  return (start_date, chosen_time_local == start_date)
+
+def get_chosen_secs(chosen_time_local:pd.Timestamp) -> int:
+  '''
+  Returns the seconds from the start of the service day (noon minus 12h, like
+  the GTFS times) to the chosen time, rounded up. Both are instants, so on the
+  days of a time change the chosen time is compared with the arrivals that
+  really come after it, also between midnight and the change.
+  '''
+  service_day_start = get_service_day_start(chosen_time_local.tz_localize(None).normalize())
+  return math.ceil((chosen_time_local - service_day_start) / pd.Timedelta(seconds=1))
+
+class ScheduleIndex:
+  '''
+  Lookup structures over the GTFS schedule, built once at startup.
+
+  Scheduled arrivals are stored as flat arrays sorted by
+  (route_id, trip_headsign, stop_id, service_id, arrival seconds), so finding
+  the next arrival at a stop is a binary search instead of a merge of the
+  whole stop_times table.
+  '''
+
+  def __init__(self, trips_df:pd.DataFrame, stop_times_df:pd.DataFrame, stops_df:pd.DataFrame,
+               calendar_df:pd.DataFrame, avg_delay_df:pd.DataFrame) -> None:
+    self.calendar_df = calendar_df
+    self._service_cache = {}
+
+    # Encode service ids
+    self.service_ids = np.sort(pd.unique(trips_df['service_id'].to_numpy()))
+
+    # Scheduled arrivals with their route, direction and service
+    # (snapshots store arrival times already parsed as seconds)
+    arrival_column = 'arrival_secs' if 'arrival_secs' in stop_times_df.columns else 'arrival_time'
+    arrivals_df = stop_times_df[['trip_id', arrival_column, 'stop_id', 'stop_sequence']]
+    trips_reduced = trips_df[['trip_id', 'route_id', 'trip_headsign', 'service_id']]
+    arrivals_df = pd.merge(left=arrivals_df, right=trips_reduced, how='inner', on='trip_id')
+    arrivals_df['service_code'] = np.searchsorted(self.service_ids, arrivals_df['service_id'])
+    if arrival_column == 'arrival_time':
+      arrivals_df['arrival_secs'] = gtfs_time_to_seconds(arrivals_df['arrival_time'])
+
+    self._build_trips(arrivals_df, stops_df)
+    self._build_arrivals(arrivals_df)
+    self._build_stops(stops_df)
+    self.set_hist_delays(avg_delay_df)
+
+  def _build_arrivals(self, arrivals_df:pd.DataFrame) -> None:
+    sort_columns = ['route_id', 'trip_headsign', 'stop_id', 'service_code', 'arrival_secs']
+    arrivals_df = arrivals_df.sort_values(sort_columns, kind='stable', ignore_index=True)
+
+    self.arrival_secs = arrivals_df['arrival_secs'].to_numpy(dtype='int32')
+    self.arrival_trip_ids = arrivals_df['trip_id'].to_numpy(dtype='int64')
+    self.arrival_services = arrivals_df['service_code'].to_numpy(dtype='int32')
+
+    # Get boundaries of each (route_id, trip_headsign, stop_id) group
+    key_columns = arrivals_df[['route_id', 'trip_headsign', 'stop_id']]
+    new_key = (key_columns != key_columns.shift()).any(axis=1).to_numpy()
+    starts = np.flatnonzero(new_key)
+    self.key_offsets = np.append(starts, len(arrivals_df)).astype('int64')
+
+    keys = list(key_columns.iloc[starts].itertuples(index=False, name=None))
+    self.key_route_ids = np.array([route_id for route_id, _, _ in keys], dtype='int64')
+    self.key_headsigns = np.array([headsign for _, headsign, _ in keys], dtype='object')
+    self.key_stop_ids = np.array([stop_id for _, _, stop_id in keys], dtype='int64')
+    self._build_key_codes()
+
+    # Positions of the arrivals sorted by (stop_id, service_code, arrival seconds), for stop departure boards
+    stop_ids = arrivals_df['stop_id'].to_numpy(dtype='int64')
+    self.stop_arrivals = np.lexsort((self.arrival_secs, self.arrival_services, stop_ids)).astype('int64')
+    sorted_stop_ids = stop_ids[self.stop_arrivals]
+    stop_starts = np.flatnonzero(np.r_[True, sorted_stop_ids[1:] != sorted_stop_ids[:-1]]) if len(stop_ids) else np.array([], dtype='int64')
+    self.arrival_stop_ids = sorted_stop_ids[stop_starts]
+    self.stop_offsets = np.append(stop_starts, len(stop_ids)).astype('int64')
+
+  def _build_key_codes(self) -> None:
+    self._key_codes = {
+      (int(route_id), headsign, int(stop_id)): code
+      for code, (route_id, headsign, stop_id) in enumerate(zip(self.key_route_ids.tolist(), self.key_headsigns.tolist(), self.key_stop_ids.tolist()))
+    }
+
+  def _build_trips(self, arrivals_df:pd.DataFrame, stops_df:pd.DataFrame) -> None:
+    trip_stops = arrivals_df.sort_values(['trip_id', 'stop_sequence'])
+    trip_groups = trip_stops.groupby('trip_id', sort=True)
+
+    # Expected trip duration
+    trip_df = trip_groups['arrival_secs'].agg(['min', 'max'])
+    trip_df['first_stop_id'] = trip_groups['stop_id'].first()
+    trip_df['last_stop_id'] = trip_groups['stop_id'].last()
+
+    # Get first and last stop coordinates
+    coords_df = stops_df[['stop_id', 'stop_lat', 'stop_lon']].drop_duplicates('stop_id')
+    first_coords = pd.merge(trip_df[['first_stop_id']], coords_df, how='left', left_on='first_stop_id', right_on='stop_id')
+    last_coords = pd.merge(trip_df[['last_stop_id']], coords_df, how='left', left_on='last_stop_id', right_on='stop_id')
+
+    bearings = [
+      get_route_bearing(dest_lon, origin_lon, dest_lat, origin_lat)
+      for dest_lon, origin_lon, dest_lat, origin_lat in zip(
+        last_coords['stop_lon'], first_coords['stop_lon'], last_coords['stop_lat'], first_coords['stop_lat'])
+    ]
+
+    self.trip_ids = trip_df.index.to_numpy(dtype='int64')
+    self.trip_route_bearings = np.array(bearings, dtype='float64')
+    self.trip_durations = (trip_df['max'] - trip_df['min']).to_numpy(dtype='float64')
+
+  def _build_stops(self, stops_df:pd.DataFrame) -> None:
+    clusters_df = stops_df[['stop_id', 'stop_cluster']].drop_duplicates('stop_id').sort_values('stop_id')
+    self.stop_ids = clusters_df['stop_id'].to_numpy(dtype='int64')
+    self.stop_clusters = clusters_df['stop_cluster'].to_numpy(dtype='float64')
+
+  def set_hist_delays(self, avg_delay_df:pd.DataFrame) -> None:
+    '''
+    Replaces the historical delays. Keys and values are swapped as one tuple,
+    so concurrent lookups see either the old or the new table.
+    '''
+    hist_keys = get_hist_key(avg_delay_df['route_id'].to_numpy(), avg_delay_df['stop_id'].to_numpy(), avg_delay_df['hour'].to_numpy())
+    hist_keys, first_index = np.unique(hist_keys, return_index=True)
+    self.hist_delays = (hist_keys, avg_delay_df['hist_avg_delay'].to_numpy(dtype='float64')[first_index])
+
+  def save(self, index_path:str) -> None:
+    '''
+    Writes the arrays of the index (without the historical delays, which are
+    reloaded while serving) as .npy files, replacing index_path.
+    '''
+    tmp_path = f'{index_path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    for name in MAPPED_ARRAYS:
+      np.save(os.path.join(tmp_path, f'{name}.npy'), np.ascontiguousarray(getattr(self, name)))
+    for name in LOADED_ARRAYS:
+      np.save(os.path.join(tmp_path, f'{name}.npy'), getattr(self, name).astype('str'))
+    self.calendar_df.to_pickle(os.path.join(tmp_path, 'calendar.pkl'))
+
+    # String service ids are saved as str, keep their type to compare them with the calendar
+    manifest = {'format_version': INDEX_FORMAT_VERSION, 'service_id_dtype': self.service_ids.dtype.str if self.service_ids.dtype != object else 'object'}
+    with open(os.path.join(tmp_path, INDEX_MANIFEST_FILE), 'w') as f:
+      json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(index_path, ignore_errors=True)
+    os.rename(tmp_path, index_path)
+
+  @classmethod
+  def load(cls, index_path:str, avg_delay_df:pd.DataFrame) -> 'ScheduleIndex':
+    '''
+    Returns the index saved by save. The large arrays are memory-mapped
+    read-only, so processes serving the same index share their pages.
+    '''
+    with open(os.path.join(index_path, INDEX_MANIFEST_FILE)) as f:
+      manifest = json.load(f)
+    if manifest.get('format_version') != INDEX_FORMAT_VERSION:
+      raise ValueError(f'Unsupported schedule index format in {index_path}')
+
+    schedule_index = cls.__new__(cls)
+    schedule_index._service_cache = {}
+    for name in MAPPED_ARRAYS:
+      # Plain ndarray views of the memory maps (np.memmap adds overhead to every scalar access)
+      setattr(schedule_index, name, np.asarray(np.load(os.path.join(index_path, f'{name}.npy'), mmap_mode='r')))
+    schedule_index.service_ids = np.load(os.path.join(index_path, 'service_ids.npy')).astype(manifest['service_id_dtype'])
+    schedule_index.key_headsigns = np.load(os.path.join(index_path, 'key_headsigns.npy')).astype('object')
+    schedule_index.calendar_df = pd.read_pickle(os.path.join(index_path, 'calendar.pkl'))
+    schedule_index._build_key_codes()
+    schedule_index.set_hist_delays(avg_delay_df)
+    return schedule_index
+
+  @property
+  def hist_keys(self) -> np.ndarray:
+    return self.hist_delays[0]
+
+  @property
+  def hist_values(self) -> np.ndarray:
+    return self.hist_delays[1]
+
+  def get_active_services(self, chosen_time_local:pd.Timestamp) -> np.ndarray:
+    '''Returns the codes of the services running at the chosen time (memoized per date)'''
+    cache_key = get_service_key(chosen_time_local)
+
+    if cache_key not in self._service_cache:
+      day_mask = self.calendar_df[WEEKDAYS[chosen_time_local.day_of_week]] == 1
+      date_mask = (chosen_time_local >= self.calendar_df['start_date']) & (chosen_time_local <= self.calendar_df['end_date'])
+      service_ids = pd.unique(self.calendar_df[day_mask & date_mask]['service_id'].to_numpy())
+      service_ids = service_ids[np.isin(service_ids, self.service_ids)]
+      self._service_cache[cache_key] = np.searchsorted(self.service_ids, service_ids)
+
+    return self._service_cache[cache_key]
+
+  def get_service_slices(self, start:int, end:int, services:np.ndarray, active_services:np.ndarray) -> list[tuple[int, int]]:
+    '''Returns the (lo, hi) bounds of each active service within services[start:end], sorted by service'''
+    service_slices = []
+    for service_code in active_services:
+      lo = start + np.searchsorted(services[start:end], service_code, side='left')
+      hi = start + np.searchsorted(services[start:end], service_code, side='right')
+      if lo < hi:
+        service_slices.append((int(lo), int(hi)))
+    return service_slices
+
+  def count_arrivals_in_hour(self, service_slices:list[tuple[int, int]], arrival_secs:int) -> int:
+    '''Counts the arrivals of the service slices within the hour of arrival_secs'''
+    hour_start = arrival_secs - (arrival_secs % 3600)
+    arrivals_per_hour = 0
+    for lo, hi in service_slices:
+      service_secs = self.arrival_secs[lo:hi]
+      arrivals_per_hour += int(np.searchsorted(service_secs, hour_start + 3600) - np.searchsorted(service_secs, hour_start))
+    return arrivals_per_hour
+
+  def find_next_arrival(self, route_id:int, direction:str, stop_id:int, chosen_time_local:pd.Timestamp,
+                        active_services:np.ndarray|None=None) -> dict:
+    '''
+    Returns the position in the arrival arrays, trip_id, scheduled seconds past
+    midnight and hourly frequency of the next arrival at a stop, or an empty
+    dict if there is none.
+    Queries on the same date can pass the result of get_active_services.
+    '''
+    key_code = self._key_codes.get((route_id, direction, stop_id))
+    if key_code is None:
+      return {}
+
+    if active_services is None:
+      active_services = self.get_active_services(chosen_time_local)
+
+    # Slice each active service and search its sorted arrival times
+    chosen_secs = get_chosen_secs(chosen_time_local)
+    service_slices = self.get_service_slices(self.key_offsets[key_code], self.key_offsets[key_code + 1], self.arrival_services, active_services)
+    next_index = None
+    for lo, hi in service_slices:
+      index = lo + np.searchsorted(self.arrival_secs[lo:hi], chosen_secs, side='left')
+      if index < hi and (next_index is None or self.arrival_secs[index] < self.arrival_secs[next_index]):
+        next_index = index
+
+    if next_index is None:
+      return {}
+
+    arrival_secs = int(self.arrival_secs[next_index])
+    return {
+      'arrival_index': int(next_index),
+      'trip_id': int(self.arrival_trip_ids[next_index]),
+      'arrival_secs': arrival_secs,
+      'arrivals_per_hour': self.count_arrivals_in_hour(service_slices, arrival_secs),
+    }
+
+  def find_next_departures(self, stop_id:int, chosen_time_local:pd.Timestamp, n:int,
+                           active_services:np.ndarray|None=None) -> list[dict]|None:
+    '''
+    Returns the next n arrivals at a stop across all routes and directions,
+    in the format of find_next_arrival plus route_id and direction.
+    Returns None if no trip serves the stop.
+    '''
+    stop_index = np.searchsorted(self.arrival_stop_ids, stop_id)
+    if stop_index == len(self.arrival_stop_ids) or self.arrival_stop_ids[stop_index] != stop_id:
+      return None
+
+    if active_services is None:
+      active_services = self.get_active_services(chosen_time_local)
+
+    # Arrivals at the stop, sorted by service then time
+    start = self.stop_offsets[stop_index]
+    end = self.stop_offsets[stop_index + 1]
+    positions = self.stop_arrivals[start:end]
+    stop_services = self.arrival_services[positions]
+    stop_secs = self.arrival_secs[positions]
+
+    # Take up to n arrivals after the chosen time from each active service, then keep the first n overall
+    chosen_secs = get_chosen_secs(chosen_time_local)
+    candidates = []
+    for lo, hi in self.get_service_slices(0, len(positions), stop_services, active_services):
+      first = lo + np.searchsorted(stop_secs[lo:hi], chosen_secs, side='left')
+      candidates.append(positions[first:min(first + n, hi)])
+
+    if not candidates:
+      return []
+    candidates = np.concatenate(candidates)
+    candidates = candidates[np.argsort(self.arrival_secs[candidates], kind='stable')[:n]]
+
+    # Get route, direction and hourly frequency of each arrival
+    key_codes = np.searchsorted(self.key_offsets, candidates, side='right') - 1
+    departures = []
+    for position, key_code in zip(candidates, key_codes):
+      arrival_secs = int(self.arrival_secs[position])
+      service_slices = self.get_service_slices(self.key_offsets[key_code], self.key_offsets[key_code + 1], self.arrival_services, active_services)
+      departures.append({
+        'route_id': int(self.key_route_ids[key_code]),
+        'direction': self.key_headsigns[key_code],
+        'arrival_index': int(position),
+        'trip_id': int(self.arrival_trip_ids[position]),
+        'arrival_secs': arrival_secs,
+        'arrivals_per_hour': self.count_arrivals_in_hour(service_slices, arrival_secs),
+      })
+
+    return departures
+
+  def get_trip_features(self, trip_id:int) -> tuple[float, float]:
+    '''Returns the route bearing and expected duration (in seconds) of a trip'''
+    index = np.searchsorted(self.trip_ids, trip_id)
+    return float(self.trip_route_bearings[index]), float(self.trip_durations[index])
+
+  def get_stop_cluster(self, stop_id:int) -> float:
+    index = np.searchsorted(self.stop_ids, stop_id)
+    if index < len(self.stop_ids) and self.stop_ids[index] == stop_id:
+      return float(self.stop_clusters[index])
+    return float('nan')
+
+  def get_hist_avg_delay(self, route_id:int, stop_id:int, hour:int) -> float:
+    hist_key = get_hist_key(route_id, stop_id, hour)
+    hist_keys, hist_values = self.hist_delays
+    index = np.searchsorted(hist_keys, hist_key)
+    if index < len(hist_keys) and hist_keys[index] == hist_key:
+      return float(hist_values[index])
+    raise KeyError(f'No historical delay for route {route_id}, stop {stop_id} at hour {hour}')
@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import json
+import pandas as pd
+import pickle
+
+DIRECTION_TRANSLATIONS = [('Nord', 'North'), ('Sud', 'South'), ('Ouest', 'West'), ('Est', 'East')]
+
+class ResponseBody:
+  '''A response body serialized and gzipped once, with the ETag of its content'''
+
+  def __init__(self, body:bytes, content_type:str='application/json') -> None:
+    self.body = body
+    self.gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+    self.content_type = content_type
+    self.etag = hashlib.sha1(body).hexdigest()[:16]
+
+def get_json_body(data:list|dict) -> ResponseBody:
+  '''Serializes data like Flask's jsonify, so responses are unchanged'''
+  return ResponseBody(f'{json.dumps(data, sort_keys=True, separators=(",", ":"))}\n'.encode())
+
+def translate_direction(direction:str) -> dict:
+  data = {}
+  data['direction_fr'] = direction
+
+  for french, english in DIRECTION_TRANSLATIONS:
+    if french in direction:
+      data['direction_en'] = direction.replace(french, english)
+      break
+
+  return data
+
+class ScheduleMetadata:
+  '''
+  Bus lines, directions and stops of the GTFS schedule, built once when the
+  schedule loads. The directions of each route and the stops of each
+  (route, direction) are kept as serialized JSON, so the dropdowns of the UI
+  are a dictionary lookup.
+  '''
+
+  def __init__(self, routes_df:pd.DataFrame, trips_df:pd.DataFrame, stop_times_df:pd.DataFrame, stops_df:pd.DataFrame) -> None:
+    # Bus lines
+    bus_lines_df = routes_df[routes_df['route_type'] == 3]
+    bus_lines_df = bus_lines_df[['route_id', 'route_long_name', 'route_color', 'route_text_color']]
+    self.bus_lines = bus_lines_df.to_dict(orient='records')
+
+    # Directions of each route, sorted by French name
+    self.no_directions = get_json_body([])
+    self.directions = {}
+    for route_id, headsigns in trips_df.groupby('route_id', observed=True)['trip_headsign']:
+      directions = headsigns.sort_values().unique().tolist()
+      self.directions[int(route_id)] = get_json_body([translate_direction(direction) for direction in directions])
+
+    # Stops of the first trip of each route and direction, in stop_times order
+    first_trips_df = trips_df.drop_duplicates(['route_id', 'trip_headsign'])[['trip_id', 'route_id', 'trip_headsign']]
+    trip_stops_df = stop_times_df.loc[stop_times_df['trip_id'].isin(first_trips_df['trip_id']), ['trip_id', 'stop_id', 'stop_sequence']]
+    merged_stops_df = pd.merge(trip_stops_df, stops_df[['stop_id', 'stop_name']], how='inner', on='stop_id')
+    merged_stops_df = pd.merge(merged_stops_df, first_trips_df, how='inner', on='trip_id')
+
+    self.stops = {}
+    for (route_id, direction), trip_stops_df in merged_stops_df.groupby(['route_id', 'trip_headsign'], sort=False, observed=True):
+      stops = trip_stops_df[['stop_id', 'stop_sequence', 'stop_name']].to_dict(orient='records')
+      self.stops[(int(route_id), direction)] = get_json_body(stops)
+
+  def save(self, metadata_path:str) -> None:
+    with open(metadata_path, 'wb') as f:
+      pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def load(cls, metadata_path:str) -> 'ScheduleMetadata':
+    '''Returns the metadata saved by save, without the schedule tables'''
+    schedule_metadata = cls.__new__(cls)
+    with open(metadata_path, 'rb') as f:
+      schedule_metadata.__dict__.update(pickle.load(f))
+    return schedule_metadata
+
+  def get_directions(self, route_id:int) -> ResponseBody:
+    return self.directions.get(route_id, self.no_directions)
+
+  def get_stops(self, route_id:int, direction:str) -> ResponseBody|None:
+    return self.stops.get((route_id, direction))
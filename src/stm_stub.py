@@ -0,0 +1,184 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+from email.utils import formatdate, parsedate_to_datetime
+from google.transit import gtfs_realtime_pb2
+import hashlib
+import io
+import random
+import threading
+import time
+import zipfile
+
+# Lines served by the stub, with the class of their family icon on the STM bus network page
+STUB_ROUTES = [
+  (10, 'family-jour'),
+  (18, 'family-freq-toute-journee'),
+  (51, 'family-freq-periode-pointe'),
+  (121, 'family-freq-toute-journee'),
+  (355, 'family-nuit'),
+]
+
+def get_trip_updates(timestamp:int, n_trips:int=200, n_stops:int=30) -> bytes:
+  '''A GTFS-RT FeedMessage whose arrival times move every minute'''
+  feed = gtfs_realtime_pb2.FeedMessage()
+  feed.header.gtfs_realtime_version = '2.0'
+  feed.header.timestamp = timestamp
+  start_date = time.strftime('%Y%m%d', time.localtime(timestamp))
+  minute = timestamp // 60
+
+  for trip_index in range(n_trips):
+    route_id, _ = STUB_ROUTES[trip_index % len(STUB_ROUTES)]
+    entity = feed.entity.add()
+    entity.id = str(trip_index)
+    trip = entity.trip_update.trip
+    trip.trip_id = f'{300000000 + trip_index}'
+    trip.route_id = str(route_id)
+    trip.start_date = start_date
+
+    for stop_index in range(n_stops):
+      stop_time_update = entity.trip_update.stop_time_update.add()
+      stop_time_update.stop_sequence = stop_index + 1
+      stop_time_update.stop_id = f'{50000 + stop_index}'
+      arrival_time = minute * 60 + trip_index * 10 + stop_index * 90 + (minute + trip_index) % 3 * 30
+      stop_time_update.arrival.time = arrival_time
+      stop_time_update.departure.time = arrival_time
+
+  return feed.SerializeToString()
+
+def get_gtfs_zip() -> bytes:
+  '''A small GTFS archive, with a file the download job should delete'''
+  files = {
+    'routes.txt': 'route_id,route_short_name,route_type\n' + ''.join(f'{route_id},{route_id},3\n' for route_id, _ in STUB_ROUTES),
+    'trips.txt': 'route_id,service_id,trip_id,trip_headsign,direction_id,shape_id\n10,WK,1,10-Nord,0,1\n',
+    'stops.txt': 'stop_id,stop_code,stop_name,stop_lat,stop_lon\n1,50000,Stop,45.5,-73.6\n',
+    'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n1,08:00:00,08:00:00,1,1\n',
+    'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\nWK,1,1,1,1,1,0,0,20250101,20251231\n',
+    'shapes.txt': 'shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n1,45.5,-73.6,1\n',
+  }
+  buffer = io.BytesIO()
+  with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    for name, content in files.items():
+      zip_file.writestr(name, content)
+  return buffer.getvalue()
+
+def get_etag(content:bytes) -> str:
+  return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+def get_route_types_html() -> bytes:
+  '''The bus list table of the STM bus network page'''
+  rows = ''.join(
+    f'<tr><td><span class="fam-line-number">{route_id}</span></td><td><span class="{family}"></span></td></tr>'
+    for route_id, family in STUB_ROUTES
+  )
+  return f'<html><body><table class="bus-list">{rows}</table></body></html>'.encode()
+
+class STMStubHandler(BaseHTTPRequestHandler):
+  '''Serves the GTFS-RT trip updates, the GTFS archive and the bus network page'''
+
+  def do_GET(self) -> None:
+    server = self.server
+    path = self.path.split('?')[0]
+
+    with server.lock:
+      server.request_count += 1
+      server.path_counts[path] = server.path_counts.get(path, 0) + 1
+
+    if server.latency > 0:
+      time.sleep(server.latency)
+
+    match path:
+      case '/tripUpdates':
+        content_type = 'application/x-protobuf'
+        get_content = lambda: get_trip_updates(int(time.time()))
+      case '/gtfs_stm.zip':
+        if self.send_not_modified(server):
+          return
+        content_type = 'application/zip'
+        get_content = lambda: server.gtfs_zip
+      case '/en/info/networks/bus':
+        content_type = 'text/html; charset=utf-8'
+        get_content = get_route_types_html
+      case _:
+        self.send_content(404, b'Not found', 'text/plain')
+        return
+
+    if random.random() < server.failure_rate:
+      self.send_content(503, b'Stub failure', 'text/plain')
+      return
+
+    self.send_content(200, get_content(), content_type)
+
+  def send_not_modified(self, server:ThreadingHTTPServer) -> bool:
+    '''Answers 304 Not Modified to a conditional request for the current GTFS archive'''
+    if not server.gtfs_validators:
+      return False
+
+    etag = get_etag(server.gtfs_zip)
+    if 'If-None-Match' in self.headers:
+      not_modified = self.headers['If-None-Match'] == etag
+    elif 'If-Modified-Since' in self.headers:
+      not_modified = parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp() >= int(server.gtfs_modified)
+    else:
+      not_modified = False
+
+    if not_modified:
+      with server.lock:
+        server.not_modified_count += 1
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.end_headers()
+    return not_modified
+
+  def send_content(self, status:int, content:bytes, content_type:str) -> None:
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    if status == 200 and content_type == 'application/zip' and self.server.gtfs_validators:
+      self.send_header('ETag', get_etag(content))
+      self.send_header('Last-Modified', formatdate(self.server.gtfs_modified, usegmt=True))
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+def start_stub_server(port:int=0, latency:float=0, failure_rate:float=0, gtfs_validators:bool=True) -> ThreadingHTTPServer:
+  '''
+  Starts the stub in a background thread and returns the server
+  (its URL is http://127.0.0.1:{server.server_port}). The GTFS archive is
+  sent with an ETag and a Last-Modified date unless gtfs_validators is False;
+  replace server.gtfs_zip and server.gtfs_modified to publish a new one.
+  '''
+  server = ThreadingHTTPServer(('127.0.0.1', port), STMStubHandler)
+  server.daemon_threads = True
+  server.latency = latency
+  server.failure_rate = failure_rate
+  server.request_count = 0
+  server.path_counts = {}
+  server.gtfs_zip = get_gtfs_zip()
+  server.gtfs_modified = time.time()
+  server.gtfs_validators = gtfs_validators
+  server.not_modified_count = 0
+  server.lock = threading.Lock()
+
+  thread = threading.Thread(target=server.serve_forever, name='stm-stub', daemon=True)
+  thread.start()
+  return server
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Local stand-in for the STM trip updates API, GTFS archive and bus network page')
+  parser.add_argument('--port', type=int, default=8091)
+  parser.add_argument('--latency', type=float, default=0, help='delay added to each response (seconds)')
+  parser.add_argument('--failure-rate', type=float, default=0, help='fraction of requests answered with HTTP 503')
+  args = parser.parse_args()
+
+  server = start_stub_server(args.port, args.latency, args.failure_rate)
+  print(f'STM stub listening on http://127.0.0.1:{server.server_port}')
+  print(f'export STM_TRIP_UPDATES_URL=http://127.0.0.1:{server.server_port}/tripUpdates')
+  print(f'export STM_GTFS_URL=http://127.0.0.1:{server.server_port}/gtfs_stm.zip')
+  print(f'export STM_ROUTE_TYPES_URL=http://127.0.0.1:{server.server_port}/en/info/networks/bus')
+
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    server.shutdown()
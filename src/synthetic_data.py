@@ -0,0 +1,227 @@
+import joblib
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import xgboost as xgb
+
+# Import custom code
+from src.constants import ROOT_DIR, MODELS_DIR, DOWNLOAD_DIR
+from src.feature_plan import load_feature_plan
+from src.inference import MODEL_NAME
+
+# Size of the STM network: about 235 routes and 8,900 stops, and 5M stop times with the default trips
+STM_ROUTES = 235
+STM_STOPS = 8900
+
+# Area covered by the stops
+MTL_BOUNDS = {'lat': (45.41, 45.70), 'lon': (-73.97, -73.48)}
+
+# Headsigns of the two directions of a route
+DIRECTION_PAIRS = [('Nord', 'Sud'), ('Est', 'Ouest')]
+
+# Service days and number of trips (relative to weekdays) of each service
+SERVICES = {
+  'WK': ([1, 1, 1, 1, 1, 0, 0], 1.0),
+  'SA': ([0, 0, 0, 0, 0, 1, 0], 0.6),
+  'SU': ([0, 0, 0, 0, 0, 0, 1], 0.5),
+}
+
+# Model files copied from the models directory with the stand-in model
+MODEL_SUPPORT_FILES = ['best_features.pkl', 'min_time.pkl', 'sch_rel_weights.pkl']
+
+def format_gtfs_times(seconds:np.ndarray) -> np.ndarray:
+  '''Formats seconds past the start of the service day as 'HH:MM:SS' (hours past 23 after midnight), built as bytes'''
+  chars = np.full((len(seconds), 8), ord(':'), dtype='uint8')
+  for column, value in zip([0, 1, 3, 4, 6, 7], [seconds // 36000, seconds // 3600 % 10, seconds // 600 % 6, seconds // 60 % 10, seconds // 10 % 6, seconds % 10]):
+    chars[:, column] = ord('0') + value
+  return chars.view('S8').ravel().astype('U8')
+
+def generate_stops(n_stops:int, rng:np.random.Generator) -> pd.DataFrame:
+  '''Stops spread over the island, clustered by area as in stops_with_clusters.csv'''
+  stop_lat = rng.uniform(*MTL_BOUNDS['lat'], n_stops)
+  stop_lon = rng.uniform(*MTL_BOUNDS['lon'], n_stops)
+  lat_bins = np.digitize(stop_lat, np.linspace(*MTL_BOUNDS['lat'], 3)[1:-1])
+  lon_bins = np.digitize(stop_lon, np.linspace(*MTL_BOUNDS['lon'], 6)[1:-1])
+  stop_ids = 50000 + np.arange(n_stops)
+
+  return pd.DataFrame({
+    'stop_cluster': lat_bins * 5 + lon_bins,
+    'stop_id': stop_ids,
+    'stop_name': [f'Stop {stop_id}' for stop_id in stop_ids],
+    'neighbourhood': '',
+    'stop_lat': stop_lat,
+    'stop_lon': stop_lon,
+    'location_type': 0,
+    'wheelchair_boarding': 1,
+  })
+
+def generate_gtfs(n_routes:int=STM_ROUTES, n_stops:int=STM_STOPS, stops_per_trip:int=45, weekday_trips:int=100,
+                  start_date:str='20260101', n_days:int=365, service_hours:tuple[int, int]=(5, 25), seed:int=0) -> dict:
+  '''
+  Returns a GTFS schedule shaped like the STM one, the same for the same
+  arguments: the routes, trips, stop_times, calendar and stops tables, the
+  stops with clusters and the historical average delays. Each route runs
+  weekday_trips trips per direction on weekdays (fewer on weekends) between
+  the service_hours (GTFS hours, default: 5:00 to 25:00) along stops_per_trip
+  stops on average.
+  '''
+  rng = np.random.default_rng(seed)
+  stops_df = generate_stops(n_stops, rng)
+  stop_ids = stops_df['stop_id'].to_numpy()
+
+  route_ids = 10 + np.arange(n_routes)
+  routes_df = pd.DataFrame({
+    'route_id': route_ids,
+    'agency_id': 'STM',
+    'route_short_name': route_ids,
+    'route_long_name': [f'Route {route_id}' for route_id in route_ids],
+    'route_type': 3,
+    'route_url': '',
+    'route_color': '009EE0',
+    'route_text_color': 'FFFFFF',
+  })
+
+  trips, stop_times, hist_delays = [], [], []
+  next_trip_id = 200000000
+  for route_id in route_ids:
+    # Stops of the route and running time between them, the same in both directions
+    n_route_stops = int(np.clip(rng.normal(stops_per_trip, stops_per_trip * 0.3), 5, n_stops))
+    route_stop_ids = rng.choice(stop_ids, n_route_stops, replace=False)
+    link_secs = rng.integers(60, 180, n_route_stops - 1)
+    directions = DIRECTION_PAIRS[route_id % len(DIRECTION_PAIRS)]
+
+    for direction_id, headsign in enumerate(directions):
+      pattern_stop_ids = route_stop_ids if direction_id == 0 else route_stop_ids[::-1]
+      offsets = np.r_[0, np.cumsum(link_secs if direction_id == 0 else link_secs[::-1])]
+
+      for service_id, (_, trip_share) in SERVICES.items():
+        n_trips = max(1, round(weekday_trips * trip_share))
+        starts = np.linspace(service_hours[0] * 3600, service_hours[1] * 3600, n_trips, endpoint=False).astype('int64') + rng.integers(0, 120, n_trips)
+        trip_ids = next_trip_id + np.arange(n_trips)
+        next_trip_id += n_trips
+
+        trips.append(pd.DataFrame({
+          'route_id': route_id, 'service_id': service_id, 'trip_id': trip_ids, 'trip_headsign': headsign, 'direction_id': direction_id,
+        }))
+        stop_times.append(pd.DataFrame({
+          'trip_id': np.repeat(trip_ids, len(offsets)),
+          'arrival_secs': (starts[:, None] + offsets[None, :]).ravel(),
+          'stop_id': np.tile(pattern_stop_ids, n_trips),
+          'stop_sequence': np.tile(np.arange(1, len(offsets) + 1), n_trips),
+        }))
+
+    # Delays grow along the route and at rush hours
+    hours = np.arange(24)
+    rush = np.exp(-((hours - 8) / 1.5) ** 2) + np.exp(-((hours - 17) / 2) ** 2)
+    delays = 30 + rng.gamma(2, 30, (n_route_stops, 1)) + 120 * rush[None, :] + rng.normal(0, 15, (n_route_stops, 24))
+    hist_delays.append(pd.DataFrame({
+      'route_id': route_id,
+      'stop_id': np.repeat(route_stop_ids, 24),
+      'hour': np.tile(hours, n_route_stops),
+      'hist_avg_delay': delays.ravel(),
+    }))
+
+  stop_times_df = pd.concat(stop_times, ignore_index=True)
+  times = format_gtfs_times(stop_times_df.pop('arrival_secs').to_numpy())
+  stop_times_df.insert(1, 'arrival_time', times)
+  stop_times_df.insert(2, 'departure_time', times)
+
+  start = pd.Timestamp(start_date)
+  end = start + pd.Timedelta(days=n_days - 1)
+  calendar_df = pd.DataFrame(
+    [[service_id, *days, int(start.strftime('%Y%m%d')), int(end.strftime('%Y%m%d'))] for service_id, (days, _) in SERVICES.items()],
+    columns=['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'])
+
+  return {
+    'routes': routes_df,
+    'trips': pd.concat(trips, ignore_index=True),
+    'stop_times': stop_times_df,
+    'calendar': calendar_df,
+    'stops': stops_df[['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'location_type', 'wheelchair_boarding']],
+    'stops_with_clusters': stops_df,
+    'hist_avg_delays': pd.concat(hist_delays, ignore_index=True),
+  }
+
+def write_synthetic_gtfs(data_path:str, **kwargs) -> dict:
+  '''
+  Writes a schedule from generate_gtfs (same keyword arguments) as the GTFS
+  files of data_path/download and the CSV files of data_path, and returns the
+  number of rows of each table.
+  '''
+  tables = generate_gtfs(**kwargs)
+  download_path = os.path.join(data_path, DOWNLOAD_DIR)
+  os.makedirs(download_path, exist_ok=True)
+
+  for table, df in tables.items():
+    if table in ['stops_with_clusters', 'hist_avg_delays']:
+      df.to_csv(os.path.join(data_path, f'{table}.csv'), index=False)
+    else:
+      df.to_csv(os.path.join(download_path, f'{table}.txt'), index=False)
+
+  return {table: len(df) for table, df in tables.items()}
+
+def generate_base_features(n_rows:int, rng:np.random.Generator) -> pd.DataFrame:
+  '''Returns random base features of the model in the ranges of the real ones'''
+  return pd.DataFrame({
+    'arrivals_per_hour': rng.integers(1, 12, n_rows),
+    'cloud_cover': rng.uniform(0, 100, n_rows),
+    'exp_trip_duration': rng.uniform(600, 5400, n_rows),
+    'hist_avg_delay': rng.gamma(2, 60, n_rows),
+    'relative_humidity_2m': rng.uniform(20, 100, n_rows),
+    'route_bearing': rng.uniform(0, 360, n_rows),
+    'schedule_relationship_Scheduled': rng.integers(0, 2, n_rows),
+    'stop_cluster': rng.integers(0, 10, n_rows),
+    'temperature_2m': rng.uniform(-25, 30, n_rows),
+    'wind_direction_10m': rng.uniform(0, 360, n_rows),
+    'wind_speed_10m': rng.uniform(0, 50, n_rows),
+  })
+
+def get_synthetic_delays(base_df:pd.DataFrame, rng:np.random.Generator) -> pd.Series:
+  return base_df['hist_avg_delay'] * (1 + base_df['cloud_cover'] / 400) + base_df['exp_trip_duration'] / 60 + rng.normal(0, 60, len(base_df))
+
+def write_synthetic_preprocessed(output_path:str, n_rows:int, n_days:int=30, start_date:str='20250101', seed:int=0) -> int:
+  '''
+  Writes random rows shaped like data/preprocessed.parquet (the base
+  features, other columns of the preprocessing notebook and the delay) as a
+  dataset partitioned by service date, one day at a time. Returns the number
+  of rows.
+  '''
+  rng = np.random.default_rng(seed)
+  dates = pd.date_range(start_date, periods=n_days, freq='D').strftime('%Y%m%d')
+  day_rows = np.diff(np.linspace(0, n_rows, n_days + 1).astype('int64'))
+  for service_date, rows in zip(dates, day_rows):
+    df = generate_base_features(rows, rng).astype('float64')
+    df['delay'] = get_synthetic_delays(df, rng)
+    time_of_day = rng.integers(0, 4, rows)
+    df = df.assign(
+      is_peak_hour=rng.integers(0, 2, rows), is_weekend=rng.integers(0, 2, rows), precipitation=rng.exponential(0.3, rows),
+      pressure_msl=rng.normal(1015, 8, rows), stop_distance=rng.gamma(2, 150, rows), trip_progress=rng.uniform(0, 1, rows),
+      time_of_day_evening=(time_of_day == 1).astype('float64'), time_of_day_morning=(time_of_day == 2).astype('float64'),
+      time_of_day_night=(time_of_day == 3).astype('float64'), wheelchair_boarding=rng.integers(0, 2, rows),
+    )
+    partition_path = os.path.join(output_path, f'service_date={service_date}')
+    os.makedirs(partition_path, exist_ok=True)
+    df[sorted(df.columns)].to_parquet(os.path.join(partition_path, 'part-0.parquet'), index=False)
+  return int(day_rows.sum())
+
+def train_stand_in_model(model_dir:str, n_rows:int=100000, n_rounds:int=50, seed:int=0) -> None:
+  '''
+  Trains a model with the features of best_features.pkl and the parameters of
+  best_hyperparams.pkl on random base features, so that inference can be
+  measured without the trained model. Its predictions mean nothing.
+  '''
+  source_dir = os.path.join(ROOT_DIR, MODELS_DIR)
+  os.makedirs(model_dir, exist_ok=True)
+  for file_name in MODEL_SUPPORT_FILES:
+    shutil.copy(os.path.join(source_dir, file_name), model_dir)
+
+  rng = np.random.default_rng(seed)
+  base_df = generate_base_features(n_rows, rng)
+  delays = get_synthetic_delays(base_df, rng)
+
+  feature_plan = load_feature_plan(os.path.join(model_dir, 'best_features.pkl'))
+  features_df = feature_plan.transform_frame(base_df)
+  params = {**joblib.load(os.path.join(source_dir, 'best_hyperparams.pkl')), 'objective': 'reg:squarederror', 'seed': seed, 'nthread': 1}
+  booster = xgb.train(params, xgb.DMatrix(features_df, label=delays), num_boost_round=n_rounds)
+  booster.save_model(os.path.join(model_dir, f'{MODEL_NAME}.ubj'))
@@ -0,0 +1,221 @@
+import joblib
+import numpy as np
+import os
+import pyarrow.dataset as ds
+import time
+import xgboost as xgb
+
+# Import custom code
+from src.cleaning_pipeline import StageTimer
+from src.constants import TRAINING_BATCH_ROWS
+from src.feature_plan import FeaturePlan
+from src.inference import get_model_paths
+
+TARGET = 'delay'
+
+# Shares of the rows of each delay decile in each split, like the 80/10/10 split of the modeling notebook
+SPLITS = {'train': 0.8, 'val': 0.1, 'test': 0.1}
+N_STRATA = 10
+
+# Rows of a stratum are dealt to the splits along this low-discrepancy sequence
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+
+# Batches are decoded one at a time in the calling thread: on every pass, read-ahead and
+# decoding threads kept hundreds of MB of buffers for no gain in speed
+SCAN_OPTIONS = {'use_threads': False, 'batch_readahead': 0, 'fragment_readahead': 0}
+
+def get_parquet_files(data_path:str) -> list[str]:
+  '''Returns the Parquet files of a file or a (partitioned) directory, in a stable order'''
+  if os.path.isfile(data_path):
+    return [data_path]
+
+  files = []
+  for root, dirs, names in os.walk(data_path):
+    dirs.sort()
+    files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.parquet') and not name.startswith(('.', '_')))
+  if not files:
+    raise FileNotFoundError(f'No Parquet files in {data_path}')
+  return files
+
+def get_delay_edges(dataset:ds.Dataset, n_strata:int=N_STRATA, sample_size:int=1000000, batch_rows:int=TRAINING_BATCH_ROWS, seed:int=42) -> np.ndarray:
+  '''
+  Returns the inner edges of the delay quantiles (like pd.qcut with
+  duplicates='drop'), estimated on a uniform sample of the delays so that
+  only the sample is kept in memory.
+  '''
+  rng = np.random.default_rng(seed)
+  fraction = min(1, sample_size / max(dataset.count_rows(), 1))
+  samples = []
+  for batch in dataset.to_batches(columns=[TARGET], batch_size=batch_rows, **SCAN_OPTIONS):
+    delays = batch.column(0).to_numpy(zero_copy_only=False)
+    samples.append(delays[rng.random(len(delays)) < fraction] if fraction < 1 else delays)
+
+  edges = np.quantile(np.concatenate(samples), np.linspace(0, 1, n_strata + 1)[1:-1])
+  return np.unique(edges)
+
+class SplitReader:
+  '''
+  Reads the base features and delays of a Parquet dataset in batches and
+  assigns each row to a split. The delays are cut at the quantile edges, and
+  the rows of each stratum are dealt to the splits in turn, so every split
+  gets its share of each stratum (within a row), as a stratified split would,
+  without keeping the rows in memory. The same dataset always gives the same
+  splits.
+  '''
+
+  def __init__(self, data_path:str, feature_plan:FeaturePlan, edges:np.ndarray|None=None, batch_rows:int=TRAINING_BATCH_ROWS, seed:int=42) -> None:
+    self.dataset = ds.dataset(get_parquet_files(data_path), format='parquet')
+    self.feature_plan = feature_plan
+    self.columns = feature_plan.base_features + [TARGET]
+    missing = set(self.columns) - set(self.dataset.schema.names)
+    if missing:
+      raise ValueError(f'Missing columns in {data_path}: {sorted(missing)}')
+
+    self.edges = get_delay_edges(self.dataset, batch_rows=batch_rows, seed=seed) if edges is None else edges
+    self.batch_rows = batch_rows
+    self.split_bounds = np.cumsum(list(SPLITS.values()))[:-1]
+    self.stratum_offsets = np.random.default_rng(seed).random(len(self.edges) + 1)
+
+  def get_splits(self, delays:np.ndarray, counts:np.ndarray) -> np.ndarray:
+    '''Returns the split code (position in SPLITS) of each row, counts holds the rows seen so far in each stratum'''
+    strata = np.searchsorted(self.edges, delays, side='left')
+    order = np.argsort(strata, kind='stable')
+    sorted_strata = strata[order]
+    starts = np.searchsorted(sorted_strata, np.arange(len(counts)))
+
+    # Position of each row in its stratum, over all the batches read so far
+    ranks = np.empty(len(delays), dtype='int64')
+    ranks[order] = np.arange(len(delays)) - starts[sorted_strata] + counts[sorted_strata]
+    counts += np.bincount(strata, minlength=len(counts))
+
+    positions = np.modf(ranks * GOLDEN_RATIO + self.stratum_offsets[strata])[0]
+    return np.searchsorted(self.split_bounds, positions, side='right')
+
+  def __iter__(self):
+    '''Yields the split codes, features (float32) and delays of each batch'''
+    counts = np.zeros(len(self.edges) + 1, dtype='int64')
+    for batch in self.dataset.to_batches(columns=self.columns, batch_size=self.batch_rows, **SCAN_OPTIONS):
+      delays = batch.column(TARGET).to_numpy(zero_copy_only=False).astype('float32')
+      base = np.ones((batch.num_rows, len(self.feature_plan.base_features) + 1), dtype='float64')
+      for position, feature in enumerate(self.feature_plan.base_features):
+        base[:, position] = batch.column(feature).to_numpy(zero_copy_only=False)
+      yield self.get_splits(delays, counts), self.feature_plan.transform(base), delays
+
+class SplitIter(xgb.DataIter):
+  '''Feeds the rows of one split to XGBoost, batch by batch'''
+
+  def __init__(self, reader:SplitReader, split:str, cache_prefix:str|None=None) -> None:
+    self.reader = reader
+    self.split_code = list(SPLITS).index(split)
+    self.rows = 0
+    self._batches = None
+    super().__init__(cache_prefix=cache_prefix)
+
+  def reset(self) -> None:
+    self._batches = None
+
+  def next(self, input_data) -> bool:
+    if self._batches is None:
+      self._batches = iter(self.reader)
+      self.rows = 0
+
+    for splits, features, delays in self._batches:
+      mask = splits == self.split_code
+      if mask.any():
+        self.rows += int(mask.sum())
+        input_data(data=features[mask], label=delays[mask], feature_names=self.reader.feature_plan.feature_names)
+        return True
+    return False
+
+def get_split_matrices(reader:SplitReader, external_memory:bool=False, cache_dir:str|None=None, nthread:int=0, max_bin:int=256) -> tuple:
+  '''
+  Returns the quantized train and validation matrices. With external_memory,
+  the pages of quantized rows are kept in cache_dir instead of memory.
+  '''
+  if external_memory:
+    os.makedirs(cache_dir, exist_ok=True)
+    train_iter = SplitIter(reader, 'train', cache_prefix=os.path.join(cache_dir, 'train'))
+    val_iter = SplitIter(reader, 'val', cache_prefix=os.path.join(cache_dir, 'val'))
+    dtrain = xgb.ExtMemQuantileDMatrix(train_iter, nthread=nthread, max_bin=max_bin)
+    dval = xgb.ExtMemQuantileDMatrix(val_iter, nthread=nthread, max_bin=max_bin, ref=dtrain)
+  else:
+    train_iter, val_iter = SplitIter(reader, 'train'), SplitIter(reader, 'val')
+    dtrain = xgb.QuantileDMatrix(train_iter, nthread=nthread, max_bin=max_bin)
+    dval = xgb.QuantileDMatrix(val_iter, nthread=nthread, max_bin=max_bin, ref=dtrain)
+  return dtrain, dval
+
+def evaluate_split(booster:xgb.Booster, reader:SplitReader, split:str='test') -> dict:
+  '''Returns the MAE, RMSE and R² of a split, accumulated batch by batch'''
+  split_code = list(SPLITS).index(split)
+  n_rows = 0
+  sums = np.zeros(4, dtype='float64') # absolute errors, squared errors, delays, squared delays
+  for splits, features, delays in reader:
+    mask = splits == split_code
+    if not mask.any():
+      continue
+    y_true = delays[mask].astype('float64')
+    errors = booster.inplace_predict(features[mask]).astype('float64') - y_true
+    sums += [np.abs(errors).sum(), np.square(errors).sum(), y_true.sum(), np.square(y_true).sum()]
+    n_rows += len(y_true)
+
+  total_squares = sums[3] - sums[2] ** 2 / n_rows
+  return {'rows': n_rows, 'MAE': sums[0] / n_rows, 'RMSE': np.sqrt(sums[1] / n_rows), 'R²': 1 - sums[1] / total_squares}
+
+def write_model_artifacts(model_dir:str, booster:xgb.Booster, hyperparams:dict, feature_names:list[str]) -> None:
+  '''Writes the files exported by the modeling notebook, and the native model loaded first by the app'''
+  os.makedirs(model_dir, exist_ok=True)
+  native_path, pickle_path = get_model_paths(model_dir)
+  for path, write in [
+    (pickle_path, lambda path: joblib.dump(booster, path)),
+    (native_path, lambda path: booster.save_model(path)),
+    (os.path.join(model_dir, 'best_hyperparams.pkl'), lambda path: joblib.dump(hyperparams, path)),
+    (os.path.join(model_dir, 'best_features.pkl'), lambda path: joblib.dump(feature_names, path)),
+  ]:
+    # Keep the extension, save_model picks the format from it
+    tmp_path = f'{path}.tmp{os.path.splitext(path)[1]}'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def train_model(data_path:str, model_dir:str, feature_plan:FeaturePlan, hyperparams:dict, num_boost_round:int=10000, early_stopping_rounds:int=50,
+                external_memory:bool=False, cache_dir:str|None=None, batch_rows:int=TRAINING_BATCH_ROWS, nthread:int=0, seed:int=42, verbose_eval:int|bool=50) -> dict:
+  '''
+  Trains the delay model on a preprocessed Parquet dataset (a file or a
+  directory of partitions) without loading it in memory. Only the base
+  features of the plan and the delays are read, the model features are
+  computed batch by batch, and XGBoost keeps the quantized rows (one byte per
+  feature) instead of the float matrices. Writes the model artifacts to
+  model_dir and returns a report with the split sizes, test metrics and the
+  seconds and peak resident memory of each stage.
+  '''
+  timer = StageTimer()
+  start = time.perf_counter()
+
+  with timer.stage('quantiles'):
+    reader = SplitReader(data_path, feature_plan, batch_rows=batch_rows, seed=seed)
+
+  with timer.stage('matrices'):
+    dtrain, dval = get_split_matrices(reader, external_memory=external_memory, cache_dir=cache_dir, nthread=nthread)
+
+  with timer.stage('training'):
+    params = {**hyperparams, 'objective': 'reg:squarederror', 'tree_method': 'hist', 'seed': seed, 'nthread': nthread}
+    booster = xgb.train(params, dtrain, num_boost_round=num_boost_round, evals=[(dtrain, 'train'), (dval, 'validation')],
+                        early_stopping_rounds=early_stopping_rounds, verbose_eval=verbose_eval)
+    # The trees after the best iteration only made the validation error worse
+    booster = booster[:booster.best_iteration + 1]
+    rows = {'train': dtrain.num_row(), 'val': dval.num_row()}
+    del dtrain, dval
+
+  with timer.stage('evaluation'):
+    test_metrics = evaluate_split(booster, reader, 'test')
+    rows['test'] = test_metrics.pop('rows')
+
+  write_model_artifacts(model_dir, booster, hyperparams, feature_plan.feature_names)
+  return {
+    'rows': rows,
+    'rounds': booster.num_boosted_rounds(),
+    'test': test_metrics,
+    'external_memory': external_memory,
+    'seconds': time.perf_counter() - start,
+    'peak_mb': max(stage['peak_mb'] for stage in timer.stages.values()),
+    'stages': timer.stages,
+  }
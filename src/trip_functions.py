@@ -1,202 +1,152 @@
-import joblib
 import logging
+import numpy as np
 import os
 import pandas as pd
 import random
 
 # Import custom code
-from src.constants import ROOT_DIR, DATA_DIR, MODELS_DIR, DOWNLOAD_DIR, LOCAL_TIMEZONE
-from src.helper_functions import fetch_weather, parse_gtfs_time, get_route_bearing
+from src.artifact_bundle import ServingArtifacts, load_serving_artifacts
+from src.constants import ROOT_DIR, DATA_DIR, MODELS_DIR, DOWNLOAD_DIR, SNAPSHOT_DIR, BUNDLES_DIR, WEATHER_DB_FILE, WEATHER_FORECAST_MAX_AGE, WEATHER_FETCH_BUDGET, PREDICTION_MODE
+from src.gtfs_snapshot import get_source_path
+from src.helper_functions import get_service_day_start
+from src.metrics import CACHE_LOOKUPS, span
+from src.weather_store import WeatherStore, ARCHIVE, FORECAST
 
 # File paths
 data_path = os.path.join(ROOT_DIR, DATA_DIR)
 download_path = os.path.join(data_path, DOWNLOAD_DIR)
-routes_path = os.path.join(download_path, 'routes.txt')
-trips_path = os.path.join(download_path, 'trips.txt')
-stop_times_path = os.path.join(download_path, 'stop_times.txt')
-calendar_path = os.path.join(download_path, 'calendar.txt')
-stops_path = os.path.join(data_path, 'stops_with_clusters.csv')
-avg_delay_path = os.path.join(data_path, 'hist_avg_delays.csv')
-sch_rel_path = os.path.join(ROOT_DIR, MODELS_DIR, 'sch_rel_weights.pkl')
-
-# Load data
-routes_df = pd.read_csv(routes_path)
-trips_df = pd.read_csv(trips_path)
-stop_times_df = pd.read_csv(stop_times_path)
-stops_df = pd.read_csv(stops_path)
-calendar_df = pd.read_csv(calendar_path, parse_dates=['start_date', 'end_date'], date_format='%Y%m%d')
-avg_delay_df = pd.read_csv(avg_delay_path)
-sch_rel_weights = joblib.load(sch_rel_path)
-
-# Convert calendar start and end date to local timezone
-calendar_df['start_date'] = calendar_df['start_date'].dt.tz_localize(LOCAL_TIMEZONE)
-calendar_df['end_date'] = calendar_df['end_date'].dt.tz_localize(LOCAL_TIMEZONE) + pd.Timedelta(days=1)
-
-def get_bus_lines() -> list:
-  bus_lines_df = routes_df[routes_df['route_type'] == 3]
-  bus_lines_df = bus_lines_df[['route_id', 'route_long_name', 'route_color', 'route_text_color']]
-  
-  return bus_lines_df.to_dict(orient='records')
-
-def get_bus_directions(bus_line:str) -> list:
-  route_id = int(bus_line)
-  trip_headsign = trips_df[trips_df['route_id'] == route_id]['trip_headsign']
-
-  directions_fr = trip_headsign.sort_values().unique().tolist()
-  
-  # Translate directions
-  directions = []
-  for direction in directions_fr:
-    data = {}
-    data['direction_fr'] = direction
-       
-    if 'Nord' in direction:
-      data['direction_en'] = direction.replace('Nord', 'North')
-    elif 'Sud' in direction:
-      data['direction_en'] = direction.replace('Sud', 'South')
-    elif 'Ouest' in direction:
-      data['direction_en'] = direction.replace('Ouest', 'West')
-    elif 'Est' in direction:
-      data['direction_en'] = direction.replace('Est', 'East')
-    
-    directions.append(data)
-
-  return directions
-
-def get_bus_stops(bus_line:str, direction:str) -> list:
-  route_id = int(bus_line)
-  trip_id = trips_df[(trips_df['route_id'] == route_id) & (trips_df['trip_headsign'] == direction)].iloc[0]['trip_id']
-  trip_stops_df = stop_times_df[stop_times_df['trip_id'] == trip_id][['stop_id', 'stop_sequence']]
-  stops_df_reduced = stops_df[['stop_id', 'stop_name']]
-  merged_stops_df = pd.merge(trip_stops_df, stops_df_reduced, how='inner', on='stop_id')
-  
-  return merged_stops_df.to_dict(orient='records')
-
-def get_trip_info(route_id:int, direction:str, stop_id:int, chosen_time_local:pd.Timestamp) -> dict:
+snapshot_path = os.path.join(data_path, SNAPSHOT_DIR)
+bundles_path = os.path.join(data_path, BUNDLES_DIR)
+model_dir = os.path.join(ROOT_DIR, MODELS_DIR)
+hist_delays_path = get_source_path('hist_avg_delays', download_path, data_path)
+
+# Schedule and model of the published bundle, or of the data and models directories without one
+# (the app swaps in newer bundles, the functions below use these when they are not given other artifacts)
+serving_artifacts = load_serving_artifacts(bundles_path, download_path, data_path, snapshot_path, model_dir)
+routes_df = serving_artifacts.tables['routes']
+trips_df = serving_artifacts.tables['trips']
+stop_times_df = serving_artifacts.tables['stop_times']
+stops_df = serving_artifacts.tables['stops']
+calendar_df = serving_artifacts.tables['calendar']
+avg_delay_df = serving_artifacts.tables['hist_avg_delays']
+schedule_index = serving_artifacts.schedule_index
+schedule_metadata = serving_artifacts.schedule_metadata
+sch_rel_weights = serving_artifacts.sch_rel_weights
+scheduled_probability = serving_artifacts.scheduled_probability
+hist_delays_reloader = serving_artifacts.hist_delays_reloader
+
+# Hourly weather shared by all workers
+weather_store = WeatherStore(WEATHER_DB_FILE)
+
+def get_trip_info(route_id:int, direction:str, stop_id:int, chosen_time_local:pd.Timestamp, active_services:np.ndarray|None=None,
+                  artifacts:ServingArtifacts|None=None) -> dict:
+  artifacts = artifacts or serving_artifacts
+
+  with span('trip_info'):
+    # Get next arrival after chosen time
+    artifacts.hist_delays_reloader.reload_if_changed()
+    next_arrival = artifacts.schedule_index.find_next_arrival(route_id, direction, stop_id, chosen_time_local, active_services)
+
+    if not next_arrival:
+      return {}
+
+    # Localize scheduled arrival time (measured from noon minus 12h, so it is never ambiguous or skipped on the days of a time change)
+    service_day_start = get_service_day_start(chosen_time_local.tz_localize(None).normalize())
+    next_arrival_time = service_day_start + pd.Timedelta(seconds=next_arrival['arrival_secs'])
+
+    return get_arrival_info(route_id, stop_id, next_arrival, next_arrival_time, get_service_date(chosen_time_local), artifacts)
+
+def get_departures_info(stop_id:int, chosen_time_local:pd.Timestamp, n:int, artifacts:ServingArtifacts|None=None) -> list|None:
+  '''
+  Returns the trip info of the next n arrivals at a stop across all routes and
+  directions, or None if no trip serves the stop. Arrivals without a
+  historical delay cannot be predicted: they are skipped and the next ones
+  take their place, so fewer than n are returned only when the service date
+  has no more arrivals at the stop.
+  '''
+  artifacts = artifacts or serving_artifacts
+  artifacts.hist_delays_reloader.reload_if_changed()
+  service_day_start = get_service_day_start(chosen_time_local.tz_localize(None).normalize())
+  service_date = get_service_date(chosen_time_local)
+
+  n_candidates = n
+  while True:
+    with span('departures_lookup'):
+      next_departures = artifacts.schedule_index.find_next_departures(stop_id, chosen_time_local, n_candidates)
+
+    if next_departures is None:
+      return None
+
+    # Localize scheduled arrival times
+    arrival_secs = [next_arrival['arrival_secs'] for next_arrival in next_departures]
+    next_arrival_times = service_day_start + pd.to_timedelta(arrival_secs, unit='s')
+
+    departures = []
+    for next_arrival, next_arrival_time in zip(next_departures, next_arrival_times):
+      try:
+        trip_result = get_arrival_info(next_arrival['route_id'], stop_id, next_arrival, next_arrival_time, service_date, artifacts)
+      except KeyError:
+        continue
+
+      trip_result['route_id'] = next_arrival['route_id']
+      trip_result['direction'] = next_arrival['direction']
+      departures.append(trip_result)
+      if len(departures) == n:
+        return departures
+
+    # Some arrivals were skipped: look twice as far, unless the stop has no more arrivals
+    if len(next_departures) < n_candidates:
+      return departures
+    n_candidates *= 2
+
+def get_service_date(chosen_time_local:pd.Timestamp) -> int:
+  '''Returns the date whose services are searched for a chosen time, as YYYYMMDD'''
+  return chosen_time_local.year * 10000 + chosen_time_local.month * 100 + chosen_time_local.day
+
+def get_arrival_info(route_id:int, stop_id:int, next_arrival:dict, next_arrival_time:pd.Timestamp, service_date:int, artifacts:ServingArtifacts) -> dict:
+  '''
+  Returns the arrival time and model features of a scheduled arrival found by
+  the schedule index. arrival_key (service date, position in the arrival
+  arrays) identifies the arrival in the prediction grid.
+  '''
+  schedule_index = artifacts.schedule_index
   trip_data = {}
 
-  # Create day of week filters
-  day_mask = False
-  day_of_week = chosen_time_local.day_of_week
-  match day_of_week:
-    case 0:
-      day_mask = calendar_df['monday'] == 1
-    case 1:
-      day_mask = calendar_df['tuesday'] == 1
-    case 2:
-      day_mask = calendar_df['wednesday'] == 1
-    case 3:
-      day_mask = calendar_df['thursday'] == 1
-    case 4:
-      day_mask = calendar_df['friday'] == 1
-    case 5:
-      day_mask = calendar_df['saturday'] == 1
-    case 6:
-      day_mask = calendar_df['sunday'] == 1
-  
-  # Filter calendar
-  date_mask = (chosen_time_local >= calendar_df['start_date']) & (chosen_time_local <= calendar_df['end_date'])
-  filtered_calendar = calendar_df[day_mask & date_mask]
-  service_ids = filtered_calendar['service_id'].unique().tolist()
-
-  # Filter trips
-  filtered_trips_df = trips_df[trips_df['service_id'].isin(service_ids)]
-
-  # Merge stop times with trips
-  merged_stop_times = pd.merge(left=stop_times_df, right=filtered_trips_df, how='inner', on='trip_id')
-
-  # Add chosen time and start date
-  merged_stop_times['chosen_time'] = chosen_time_local
-  merged_stop_times['start_date'] = pd.to_datetime(merged_stop_times['chosen_time'].dt.date)
-
-  # Parse scheduled arrival time
-  merged_stop_times['sch_arrival_time'] = parse_gtfs_time(merged_stop_times, 'start_date', 'arrival_time', unit='ns')
-
-  # Add arrival hour
-  merged_stop_times['arrival_hour'] = merged_stop_times['sch_arrival_time'].dt.floor('h')
-
-  # Merge stops
-  scheduled_trips_df = pd.merge(left=merged_stop_times, right=stops_df, how='left', on='stop_id')
-
-  # Filter route_id and direction
-  trip_mask = (scheduled_trips_df['route_id'] == route_id) & (scheduled_trips_df['trip_headsign'] == direction)
-  filtered_schedule_df = scheduled_trips_df[trip_mask]
-
-  # Filter by stop_id
-  filtered_by_stop_df = filtered_schedule_df[filtered_schedule_df['stop_id'] == stop_id]
-  filtered_by_stop_df = filtered_by_stop_df.sort_values('sch_arrival_time')
-
-  # Add hourly frequency
-  filtered_by_stop_df['arrivals_per_hour'] = filtered_by_stop_df.groupby('arrival_hour').transform('size')
-
-  # Get arrivals after chosen time
-  next_arrivals_filter = filtered_by_stop_df['sch_arrival_time'] >= filtered_by_stop_df['chosen_time']
-  next_arrivals = filtered_by_stop_df[next_arrivals_filter].sort_values('sch_arrival_time')
-
-  if len(next_arrivals) == 0:
-    return {}
-
-  # Get next arrival
-  next_arrival = next_arrivals.head(1).squeeze()
-  next_trip_id = int(next_arrival['trip_id'])
-  next_arrival_time = next_arrival['sch_arrival_time']
-
-  # Get current trip
-  current_trip = filtered_schedule_df[filtered_schedule_df['trip_id'] == next_trip_id].sort_values('stop_sequence')
-
   # Add stop cluster
-  stop_location_group = float(next_arrival['stop_cluster'])
-  trip_data['stop_cluster'] = stop_location_group
-
-  # Get first and last stop coordinates
-  origin_lat = current_trip.iloc[0]['stop_lat']
-  origin_lon = current_trip.iloc[0]['stop_lon']
-  dest_lat = current_trip.iloc[-1]['stop_lat']
-  dest_lon = current_trip.iloc[-1]['stop_lon']
+  trip_data['stop_cluster'] = schedule_index.get_stop_cluster(stop_id)
 
-  # Add route bearing
-  bearing = get_route_bearing(dest_lon, origin_lon, dest_lat, origin_lat)
+  # Add route bearing and expected trip duration
+  bearing, exp_trip_duration = schedule_index.get_trip_features(next_arrival['trip_id'])
   trip_data['route_bearing'] = bearing
-
-  # Add expected trip duration
-  trip_start = current_trip['sch_arrival_time'].min()
-  trip_end = current_trip['sch_arrival_time'].max()
-  trip_data['exp_trip_duration'] = (trip_end - trip_start) / pd.Timedelta(seconds=1)
+  trip_data['exp_trip_duration'] = exp_trip_duration
 
   # Add historical average delay
-  hour = next_arrival['sch_arrival_time'].hour
-  hist_filter = (avg_delay_df['route_id'] == route_id) & (avg_delay_df['stop_id'] == stop_id) & (avg_delay_df['hour'] == hour)
-  filtered_avg_delay = avg_delay_df[hist_filter]
-  hist_avg_delay = float(filtered_avg_delay['hist_avg_delay'].iloc[0])
+  hist_avg_delay = schedule_index.get_hist_avg_delay(route_id, stop_id, next_arrival_time.hour)
   trip_data['hist_avg_delay'] = hist_avg_delay
 
   # Add arrivals per hour
-  arrivals_per_hour = int(next_arrival['arrivals_per_hour'])
-  trip_data['arrivals_per_hour'] = arrivals_per_hour
+  trip_data['arrivals_per_hour'] = next_arrival['arrivals_per_hour']
 
-  # Add schedule_relationship one-hot value (at random)
-  sch_rel = random.choices([1, 0], weights=sch_rel_weights.values(), k=1)[0]
+  # Add schedule_relationship one-hot value (at random), or None when predictions weight both values
+  sch_rel = None
+  if PREDICTION_MODE == 'sampled':
+    sch_rel = random.choices([1, 0], weights=artifacts.sch_rel_weights.values(), k=1)[0]
   trip_data['schedule_relationship_Scheduled'] = sch_rel
 
   return {
     'next_arrival_time': next_arrival_time,
     'trip_data' : trip_data,
     'hist_avg_delay': round(hist_avg_delay / 60),
+    'arrival_key': (service_date, next_arrival['arrival_index']),
   }
 
 def get_weather_info(arrival_time_utc:pd.Timestamp, forecast:bool=False) -> dict:
-  weather_start_date = arrival_time_utc.strftime('%Y-%m-%d')
   weather_time = arrival_time_utc.round('h').strftime('%Y-%m-%dT%H:%M')
-       
-  attributes = [
-    'cloud_cover',
-    'relative_humidity_2m',
-    'temperature_2m',
-    'wind_direction_10m',
-    'wind_speed_10m',
-    'weathercode'
-  ]
-
-  weather_list = fetch_weather(weather_start_date, weather_start_date, attributes, forecast=forecast)
-
-  return [item for item in weather_list if item['time'] == weather_time][0]
\ No newline at end of file
+  source = FORECAST if forecast else ARCHIVE
+  max_age = WEATHER_FORECAST_MAX_AGE if forecast else None
+
+  # Read from the local store, with a bounded live fetch and fallbacks on a miss
+  with span('weather'):
+    weather_data = weather_store.lookup(source, weather_time, max_age=max_age, budget=WEATHER_FETCH_BUDGET)
+  CACHE_LOOKUPS.labels('weather', weather_data['weather_source']).inc()
+  return weather_data
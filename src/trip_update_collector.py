@@ -0,0 +1,302 @@
+from google.transit import gtfs_realtime_pb2
+import logging
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import time
+import uuid
+
+# Import custom code
+from src.constants import LOCAL_TIMEZONE, TRIP_UPDATES_FLUSH_ROWS, TRIP_UPDATES_FLUSH_INTERVAL, TRIP_UPDATES_EXPIRE_AFTER
+
+# Columns of the CSV written by the cron job, then first_seen: current_time is the last poll
+# that returned the row and first_seen the first one (the same unless changes are tracked)
+TRIP_UPDATE_SCHEMA = pa.schema([
+  ('current_time', pa.float64()),
+  ('trip_id', pa.string()),
+  ('route_id', pa.string()),
+  ('start_date', pa.string()),
+  ('stop_id', pa.string()),
+  ('arrival_time', pa.int64()),
+  ('departure_time', pa.int64()),
+  ('schedule_relationship', pa.int8()),
+  ('first_seen', pa.float64()),
+])
+FEED_COLUMNS = ['trip_id', 'route_id', 'start_date', 'stop_id', 'arrival_time', 'departure_time', 'schedule_relationship']
+
+def parse_feed(content:bytes) -> tuple[gtfs_realtime_pb2.FeedMessage, dict]:
+  '''Returns the parsed feed and its stop time updates as columns (lists), one row per stop time update'''
+  feed = gtfs_realtime_pb2.FeedMessage()
+  feed.ParseFromString(content)
+
+  columns = {name: [] for name in FEED_COLUMNS}
+  for entity in feed.entity:
+    trip = entity.trip_update.trip
+    stop_time_updates = entity.trip_update.stop_time_update
+    n_updates = len(stop_time_updates)
+    if not n_updates:
+      continue
+
+    columns['trip_id'].extend([trip.trip_id] * n_updates)
+    columns['route_id'].extend([trip.route_id] * n_updates)
+    columns['start_date'].extend([trip.start_date] * n_updates)
+    for stop_time_update in stop_time_updates:
+      columns['stop_id'].append(stop_time_update.stop_id)
+      columns['arrival_time'].append(stop_time_update.arrival.time)
+      columns['departure_time'].append(stop_time_update.departure.time)
+      columns['schedule_relationship'].append(stop_time_update.schedule_relationship)
+
+  return feed, columns
+
+def get_trip_update_table(columns:dict, fetched_at:float|None=None) -> pa.Table:
+  '''Returns the table of columns from parse_feed polled at fetched_at, or of rows from TripUpdateChanges'''
+  if fetched_at is not None:
+    n_rows = len(columns['trip_id'])
+    columns = {**columns, 'current_time': [fetched_at] * n_rows, 'first_seen': [fetched_at] * n_rows}
+  return pa.Table.from_pydict(columns, schema=TRIP_UPDATE_SCHEMA)
+
+def get_partition_dir(service_date:str, hour:int) -> str:
+  '''Hive-style partition directory, read back as columns by pandas.read_parquet and pyarrow.dataset'''
+  return os.path.join(f'service_date={service_date}', f'hour={hour:02d}')
+
+def write_parquet_atomic(table:pa.Table, path:str) -> int:
+  '''Writes a Parquet file under a hidden temporary name, then renames it. Returns the file size.'''
+  tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+  pq.write_table(table, tmp_path, compression='zstd')
+  os.replace(tmp_path, path)
+  return os.path.getsize(path)
+
+class TripUpdateChanges:
+  '''
+  Latest version (arrival, departure and schedule_relationship) of each stop
+  time update, by (trip_id, start_date, stop_id), so that a prediction
+  repeated over many polls is written once.
+
+  A version ends when a poll gives the stop another arrival, departure or
+  schedule_relationship, or when the stop has not been in the feed for
+  expire_after seconds (the bus passed it). Ended versions are returned as
+  rows with the first and last poll that saw them (first_seen and
+  current_time). The state can be saved so that a restarted collector does
+  not write the versions it already saw again.
+  '''
+
+  def __init__(self, state_path:str|None=None, expire_after:float=TRIP_UPDATES_EXPIRE_AFTER) -> None:
+    self.state_path = state_path
+    self.expire_after = expire_after
+    self.versions = {} # (trip_id, start_date, stop_id) -> [route_id, arrival_time, departure_time, schedule_relationship, first_seen, last_seen]
+
+    if state_path is not None and os.path.isfile(state_path):
+      self.load()
+
+  def update(self, columns:dict, fetched_at:float) -> list[tuple]:
+    '''Adds the stop time updates of a poll (columns from parse_feed) and returns the rows of the versions that ended'''
+    versions = self.versions
+    ended = []
+
+    for trip_id, route_id, start_date, stop_id, arrival_time, departure_time, schedule_relationship in zip(*[columns[name] for name in FEED_COLUMNS]):
+      key = (trip_id, start_date, stop_id)
+      version = versions.get(key)
+      if version is not None:
+        if version[1] == arrival_time and version[2] == departure_time and version[3] == schedule_relationship:
+          version[5] = fetched_at
+          continue
+        ended.append(get_version_row(key, version))
+      versions[key] = [route_id, arrival_time, departure_time, schedule_relationship, fetched_at, fetched_at]
+
+    # Stops that left the feed
+    cutoff = fetched_at - self.expire_after
+    for key in [key for key, version in versions.items() if version[5] < cutoff]:
+      ended.append(get_version_row(key, versions.pop(key)))
+
+    return ended
+
+  def end_all(self) -> list[tuple]:
+    '''Ends every version (e.g. at the end of a replay) and returns their rows'''
+    ended = [get_version_row(key, version) for key, version in self.versions.items()]
+    self.versions = {}
+    return ended
+
+  def save(self) -> None:
+    rows = [get_version_row(key, version) for key, version in self.versions.items()]
+    write_parquet_atomic(get_rows_table(rows), self.state_path)
+
+  def load(self) -> None:
+    state_df = pq.read_table(self.state_path).to_pandas()
+    self.versions = {
+      (row.trip_id, row.start_date, row.stop_id): [row.route_id, row.arrival_time, row.departure_time, row.schedule_relationship, row.first_seen, row.current_time]
+      for row in state_df.itertuples(index=False)
+    }
+    logging.info('Trip updates: loaded %d stop time updates from %s', len(self.versions), self.state_path)
+
+def get_version_row(key:tuple, version:list) -> tuple:
+  '''Returns a row in TRIP_UPDATE_SCHEMA order'''
+  trip_id, start_date, stop_id = key
+  route_id, arrival_time, departure_time, schedule_relationship, first_seen, last_seen = version
+  return (last_seen, trip_id, route_id, start_date, stop_id, arrival_time, departure_time, schedule_relationship, first_seen)
+
+def get_rows_table(rows:list[tuple]) -> pa.Table:
+  if not rows:
+    return TRIP_UPDATE_SCHEMA.empty_table()
+  return get_trip_update_table(dict(zip(TRIP_UPDATE_SCHEMA.names, zip(*rows))))
+
+class TripUpdateCollector:
+  '''
+  Buffers GTFS-RT trip update snapshots as Arrow tables and writes them as
+  zstd-compressed Parquet, partitioned by service date (the trip's
+  start_date) and local hour of the poll.
+
+  Buffered rows are written when there are flush_rows of them, when the
+  buffer spans flush_interval seconds of polls, or on flush()/close(). Each
+  write produces one file per partition, renamed into place once complete,
+  so readers never see a partial file.
+
+  With a TripUpdateChanges, only the versions that ended are written instead
+  of every stop time update of every poll, and its state is saved with
+  every write.
+  '''
+
+  def __init__(self, output_path:str, flush_rows:int=TRIP_UPDATES_FLUSH_ROWS, flush_interval:float=TRIP_UPDATES_FLUSH_INTERVAL,
+               changes:TripUpdateChanges|None=None) -> None:
+    self.output_path = output_path
+    self.changes = changes
+    self.flush_rows = flush_rows
+    self.flush_interval = flush_interval
+    self._partitions = {} # (service_date, hour) -> list of tables
+    self._buffered_rows = 0
+    self._buffer_start = None
+    self.last_fetched_at = None
+    self.stats = {
+      'snapshots': 0, 'entities': 0, 'updates': 0, 'rows': 0, 'flushes': 0, 'files': 0, 'bytes_written': 0,
+      'parse_seconds': 0.0, 'write_seconds': 0.0,
+    }
+
+  def add_snapshot(self, content:bytes, fetched_at:float|None=None) -> int:
+    '''
+    Adds a serialized FeedMessage polled at fetched_at (a Unix timestamp, by
+    default the feed header timestamp, as when replaying saved snapshots).
+    Returns the number of rows added.
+    '''
+    start = time.perf_counter()
+    feed, columns = parse_feed(content)
+    if fetched_at is None:
+      fetched_at = float(feed.header.timestamp or time.time())
+    if self.changes is not None:
+      table = get_rows_table(self.changes.update(columns, fetched_at))
+    else:
+      table = get_trip_update_table(columns, fetched_at)
+    self.stats['parse_seconds'] += time.perf_counter() - start
+
+    self.last_fetched_at = fetched_at
+    self.stats['snapshots'] += 1
+    self.stats['entities'] += len(feed.entity)
+    self.stats['updates'] += len(columns['trip_id'])
+    self.add_table(table, fetched_at)
+    return table.num_rows
+
+  def add_table(self, table:pa.Table, fetched_at:float) -> None:
+    if self._buffer_start is not None and fetched_at - self._buffer_start >= self.flush_interval:
+      self.flush()
+
+    if table.num_rows:
+      poll_time_local = pd.Timestamp(fetched_at, unit='s', tz='UTC').tz_convert(LOCAL_TIMEZONE)
+      fallback_date = poll_time_local.strftime('%Y%m%d') # trips without a start_date
+
+      for service_date in pc.unique(table['start_date']).to_pylist():
+        service_table = table.filter(pc.equal(table['start_date'], service_date))
+        self._partitions.setdefault((service_date or fallback_date, poll_time_local.hour), []).append(service_table)
+
+      self.stats['rows'] += table.num_rows
+      self._buffered_rows += table.num_rows
+      if self._buffer_start is None:
+        self._buffer_start = fetched_at
+
+    if self._buffered_rows >= self.flush_rows:
+      self.flush()
+
+  def end_all_versions(self, fetched_at:float) -> None:
+    '''Buffers every tracked version as ended (e.g. at the end of a replay)'''
+    if self.changes is not None:
+      self.add_table(get_rows_table(self.changes.end_all()), fetched_at)
+
+  def flush(self) -> int:
+    '''
+    Writes the buffered rows, then the state of the tracked changes, and
+    returns the number of files written. The state is only saved once every
+    partition is written, so a failed write never loses the changes of its
+    rows; the partitions already written are not buffered again.
+    '''
+    if not self._partitions:
+      self._buffer_start = None
+      self._save_changes()
+      return 0
+
+    start = time.perf_counter()
+    n_files = 0
+    n_rows = self._buffered_rows
+    for partition, tables in list(self._partitions.items()):
+      service_date, hour = partition
+      partition_path = os.path.join(self.output_path, get_partition_dir(service_date, hour))
+      os.makedirs(partition_path, exist_ok=True)
+      file_name = f'part-{int(self._buffer_start * 1000)}-{uuid.uuid4().hex[:8]}.parquet'
+      self.stats['bytes_written'] += write_parquet_atomic(pa.concat_tables(tables), os.path.join(partition_path, file_name))
+      del self._partitions[partition]
+      self._buffered_rows -= sum(table.num_rows for table in tables)
+      n_files += 1
+
+    self.stats['write_seconds'] += time.perf_counter() - start
+    self.stats['flushes'] += 1
+    self.stats['files'] += n_files
+    logging.info('Trip updates: wrote %d rows to %d files', n_rows, n_files)
+
+    self._buffer_start = None
+    self._save_changes()
+    return n_files
+
+  def _save_changes(self) -> None:
+    '''Saves the state of the tracked changes, if they have a state file'''
+    if self.changes is not None and self.changes.state_path is not None:
+      self.changes.save()
+
+  def close(self) -> None:
+    self.flush()
+
+  def get_stats(self) -> dict:
+    stats = {**self.stats, 'buffered_rows': self._buffered_rows}
+    stats['updates_per_second'] = stats['updates'] / stats['parse_seconds'] if stats['parse_seconds'] else 0.0
+    if self.changes is not None:
+      stats['tracked_updates'] = len(self.changes.versions)
+    return stats
+
+def replay_snapshots(collector:TripUpdateCollector, snapshot_paths:list[str], end_versions:bool=False) -> dict:
+  '''
+  Feeds saved .pb snapshots to a collector in file name order, then flushes
+  it. With end_versions, the versions still tracked after the last snapshot
+  are written as well.
+  '''
+  fetched_at = None
+  for snapshot_path in sorted(snapshot_paths):
+    with open(snapshot_path, 'rb') as file:
+      collector.add_snapshot(file.read())
+    fetched_at = collector.last_fetched_at
+
+  if end_versions and fetched_at is not None:
+    collector.end_all_versions(fetched_at)
+  collector.close()
+  return collector.get_stats()
+
+def import_trip_updates_csv(csv_path:str, collector:TripUpdateCollector, chunksize:int=1000000) -> dict:
+  '''
+  Adds the rows of the CSV written by the cron job to a collector (every
+  poll), by hour of current_time, so that earlier collections can be read
+  as a partitioned dataset. Returns the collector stats.
+  '''
+  dtype = {'trip_id': str, 'route_id': str, 'start_date': str, 'stop_id': str}
+  for chunk in pd.read_csv(csv_path, dtype=dtype, chunksize=chunksize):
+    chunk['first_seen'] = chunk['current_time']
+    chunk['start_date'] = chunk['start_date'].fillna('')
+    for hour, hour_df in chunk.groupby(chunk['current_time'] // 3600, sort=True):
+      collector.add_table(pa.Table.from_pandas(hour_df[TRIP_UPDATE_SCHEMA.names], schema=TRIP_UPDATE_SCHEMA, preserve_index=False), hour * 3600)
+  collector.close()
+  return collector.get_stats()
@@ -0,0 +1,282 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import joblib
+import json
+import logging
+import math
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import time
+import xgboost as xgb
+
+# Import custom code
+from src.cleaning_pipeline import get_file_signature, get_hash
+from src.constants import TRAINING_BATCH_ROWS
+from src.feature_plan import FeaturePlan
+from src.training import SPLITS, SplitReader, get_parquet_files
+
+TUNING_FORMAT_VERSION = 1
+CACHE_FILE = 'cache.json'
+SEARCH_FILE = 'search.json'
+TRIALS_FILE = 'trials.jsonl'
+MODELS_DIR = 'trials' # partly trained booster of each candidate, continued at the next rung
+
+# Search space of XGBoost in the modeling notebook
+SEARCH_SPACE = {
+  'max_depth': [3, 5, 7],
+  'learning_rate': [0.01, 0.1, 0.2],
+  'subsample': [0.6, 0.8, 1.0],
+  'colsample_bytree': [0.6, 0.8, 1.0],
+  'alpha': [0, 1, 2, 3, 4, 5],
+  'lambda': [0, 1, 2, 3, 4, 5],
+}
+
+def sample_candidates(n_candidates:int, seed:int=42) -> list[dict]:
+  '''Returns distinct random parameter sets of the search space (all of them if there are fewer)'''
+  n_combinations = math.prod(len(values) for values in SEARCH_SPACE.values())
+  rng = np.random.default_rng(seed)
+  candidates = {}
+  while len(candidates) < min(n_candidates, n_combinations):
+    params = {name: values[rng.integers(len(values))] for name, values in SEARCH_SPACE.items()}
+    candidates.setdefault(json.dumps(params, sort_keys=True), params)
+  return list(candidates.values())
+
+def get_rungs(min_rounds:int, max_rounds:int, eta:int) -> list[int]:
+  '''Returns the boosting rounds of each rung: min_rounds multiplied by eta up to max_rounds'''
+  rungs = [min_rounds]
+  while rungs[-1] * eta <= max_rounds:
+    rungs.append(rungs[-1] * eta)
+  return rungs
+
+def get_cache_paths(cache_dir:str) -> tuple[str, str]:
+  return os.path.join(cache_dir, 'train.buffer'), os.path.join(cache_dir, 'val.buffer')
+
+def get_cache_fingerprint(data_path:str, feature_plan:FeaturePlan, sample:float, seed:int) -> str:
+  return get_hash([TUNING_FORMAT_VERSION, get_file_signature(get_parquet_files(data_path)), feature_plan.feature_names, sample, seed])
+
+def build_tuning_cache(data_path:str, feature_plan:FeaturePlan, cache_dir:str, sample:float=0.25, seed:int=42, batch_rows:int=TRAINING_BATCH_ROWS) -> dict:
+  '''
+  Samples the train and validation splits of the preprocessed data (like the
+  25% train sample of the modeling notebook) and saves them as XGBoost binary
+  buffers, which load without parsing. The cache is built again only when the
+  data files, features, sample or seed change. Returns the cache description.
+  '''
+  fingerprint = get_cache_fingerprint(data_path, feature_plan, sample, seed)
+  cache_path = os.path.join(cache_dir, CACHE_FILE)
+  if os.path.isfile(cache_path):
+    with open(cache_path) as f:
+      cache = json.load(f)
+    if cache['fingerprint'] == fingerprint and all(os.path.isfile(path) for path in get_cache_paths(cache_dir)):
+      return cache
+
+  # Rows are drawn batch by batch, so only the sample is kept in memory
+  start = time.perf_counter()
+  rng = np.random.default_rng(seed)
+  split_codes = [list(SPLITS).index('train'), list(SPLITS).index('val')]
+  features, delays = {code: [] for code in split_codes}, {code: [] for code in split_codes}
+  for splits, batch_features, batch_delays in SplitReader(data_path, feature_plan, batch_rows=batch_rows, seed=seed):
+    sampled = rng.random(len(splits)) < sample
+    for code in split_codes:
+      mask = sampled & (splits == code)
+      features[code].append(batch_features[mask])
+      delays[code].append(batch_delays[mask])
+
+  os.makedirs(cache_dir, exist_ok=True)
+  rows = {}
+  for code, path in zip(split_codes, get_cache_paths(cache_dir)):
+    dmatrix = xgb.DMatrix(np.concatenate(features.pop(code)), np.concatenate(delays.pop(code)), feature_names=feature_plan.feature_names, nthread=1)
+    rows[list(SPLITS)[code]] = dmatrix.num_row()
+    dmatrix.save_binary(f'{path}.tmp', silent=True)
+    os.replace(f'{path}.tmp', path)
+
+  cache = {'fingerprint': fingerprint, 'rows': rows, 'sample': sample, 'seconds': time.perf_counter() - start}
+  with open(f'{cache_path}.tmp', 'w') as f:
+    json.dump(cache, f, indent=2)
+  os.replace(f'{cache_path}.tmp', cache_path)
+  return cache
+
+# Matrices and threads of a worker process, kept for its next trials
+_worker_state = {}
+
+def init_worker(cache_dir:str, n_threads:int, cpu_sets=None) -> None:
+  '''
+  Pins the worker to its own cores (taken from the cpu_sets queue), so that
+  the workers do not compete for the same cores, and limits XGBoost to as
+  many threads.
+  '''
+  if cpu_sets is not None and hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, cpu_sets.get())
+  _worker_state.update(cache_dir=cache_dir, n_threads=n_threads)
+
+def get_worker_matrices() -> tuple[xgb.DMatrix, xgb.DMatrix]:
+  '''
+  Loads the cached matrices once per worker. XGBoost quantizes a matrix on its
+  first training and keeps the result, so the next trials of the worker
+  reuse it instead of quantizing the data again.
+  '''
+  if 'dtrain' not in _worker_state:
+    train_path, val_path = get_cache_paths(_worker_state['cache_dir'])
+    _worker_state['dtrain'] = xgb.DMatrix(train_path, nthread=_worker_state['n_threads'])
+    _worker_state['dval'] = xgb.DMatrix(val_path, nthread=_worker_state['n_threads'])
+  return _worker_state['dtrain'], _worker_state['dval']
+
+def run_trial(trial:int, params:dict, rung:int, rounds:int, models_path:str, early_stopping_rounds:int=20, previous:dict|None=None, seed:int=42) -> dict:
+  '''
+  Trains a candidate up to rounds boosting rounds, continuing its booster of
+  the previous rung, and returns its best validation RMSE. Training stops
+  early when the error did not improve for early_stopping_rounds rounds; the
+  candidate is then not trained again at later rungs.
+  '''
+  start = time.perf_counter()
+  dtrain, dval = get_worker_matrices()
+  model_path = os.path.join(models_path, f'{trial}.ubj')
+  booster = xgb.Booster(model_file=model_path) if previous is not None and os.path.isfile(model_path) else None
+  trained_rounds = booster.num_boosted_rounds() if booster is not None else 0
+
+  booster = xgb.train(
+    {**params, 'objective': 'reg:squarederror', 'tree_method': 'hist', 'seed': seed, 'nthread': _worker_state['n_threads']},
+    dtrain, num_boost_round=max(rounds - trained_rounds, 0), evals=[(dval, 'validation')],
+    early_stopping_rounds=early_stopping_rounds, xgb_model=booster, verbose_eval=False,
+  )
+  tmp_path = f'{model_path}.tmp.ubj'
+  booster.save_model(tmp_path)
+  os.replace(tmp_path, model_path)
+
+  # Early stopping only compares the rounds of this call, the best score can be from an earlier rung
+  score, best_rounds = float(booster.attr('best_score')), int(booster.attr('best_iteration')) + 1
+  if previous is not None and previous['score'] <= score:
+    score, best_rounds = previous['score'], previous['best_rounds']
+  return {
+    'trial': trial, 'rung': rung, 'rounds': rounds, 'params': params, 'score': score, 'best_rounds': best_rounds,
+    'trained_rounds': booster.num_boosted_rounds() - trained_rounds, 'stopped': booster.num_boosted_rounds() < rounds,
+    'seconds': time.perf_counter() - start,
+  }
+
+def read_trials(output_path:str, fingerprint:str) -> dict:
+  '''Returns the trial results of a previous run of the same search, by (trial, rung)'''
+  search_path = os.path.join(output_path, SEARCH_FILE)
+  trials_path = os.path.join(output_path, TRIALS_FILE)
+  if os.path.isfile(search_path):
+    with open(search_path) as f:
+      if json.load(f).get('fingerprint') == fingerprint and os.path.isfile(trials_path):
+        results = {}
+        with open(trials_path, 'rb+') as trials_file:
+          for line in iter(trials_file.readline, b''):
+            # The last line is incomplete if a run was killed while writing it: drop it
+            if not line.endswith(b'\n'):
+              trials_file.truncate(trials_file.tell() - len(line))
+              break
+            result = json.loads(line)
+            results[(result['trial'], result['rung'])] = result
+        return results
+
+  # Another search: start over
+  for path in [trials_path, os.path.join(output_path, MODELS_DIR)]:
+    if os.path.isdir(path):
+      shutil.rmtree(path)
+    elif os.path.isfile(path):
+      os.remove(path)
+  os.makedirs(os.path.join(output_path, MODELS_DIR), exist_ok=True)
+  with open(f'{search_path}.tmp', 'w') as f:
+    json.dump({'format_version': TUNING_FORMAT_VERSION, 'fingerprint': fingerprint}, f)
+  os.replace(f'{search_path}.tmp', search_path)
+  return {}
+
+def get_cpu_sets(n_workers:int, n_threads:int) -> list[set]:
+  '''Splits the cores available to the process between the workers (sharing them when there are not enough)'''
+  cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+  return [{cpus[(worker * n_threads + thread) % len(cpus)] for thread in range(n_threads)} for worker in range(n_workers)]
+
+def run_search(data_path:str, feature_plan:FeaturePlan, output_path:str, n_candidates:int=50, min_rounds:int=30, max_rounds:int=810, eta:int=3,
+               early_stopping_rounds:int=20, sample:float=0.25, n_workers:int=1, n_threads:int=1, seed:int=42, batch_rows:int=TRAINING_BATCH_ROWS) -> dict:
+  '''
+  Searches the XGBoost parameters with successive halving. Every candidate
+  is trained for min_rounds rounds on the cached train sample, the best 1/eta
+  are trained eta times longer, and so on up to max_rounds, so weak
+  candidates only cost a few rounds. Trials run across n_workers processes of
+  n_threads threads each. Each result is appended to trials.jsonl in
+  output_path as soon as it is known, and a run of the same search started
+  again goes on from there. Returns the best parameters, their validation RMSE
+  and the run report.
+  '''
+  start = time.perf_counter()
+  cache_dir = os.path.join(output_path, 'cache')
+  models_path = os.path.join(output_path, MODELS_DIR)
+  os.makedirs(output_path, exist_ok=True)
+
+  candidates = sample_candidates(n_candidates, seed)
+  rungs = get_rungs(min_rounds, max_rounds, eta)
+  cache_fingerprint = get_cache_fingerprint(data_path, feature_plan, sample, seed)
+  results = read_trials(output_path, get_hash([cache_fingerprint, candidates, rungs, early_stopping_rounds]))
+  resumed = len(results)
+
+  trials_file = open(os.path.join(output_path, TRIALS_FILE), 'a')
+  def record(result:dict) -> None:
+    results[(result['trial'], result['rung'])] = result
+    trials_file.write(json.dumps(result) + '\n')
+    trials_file.flush()
+    logging.info('Tuning: trial %d, rung %d (%d rounds), RMSE %.3f, %.1f s', result['trial'], result['rung'], result['rounds'], result['score'], result['seconds'])
+
+  executor = None
+  try:
+    # The cache is built and the trials are trained in the workers, so the processes
+    # forked later do not inherit XGBoost's threads
+    if n_workers <= 1:
+      cache = build_tuning_cache(data_path, feature_plan, cache_dir, sample, seed, batch_rows)
+      init_worker(cache_dir, n_threads)
+    else:
+      cpu_sets = multiprocessing.Queue()
+      for cpu_set in get_cpu_sets(n_workers, n_threads):
+        cpu_sets.put(cpu_set)
+      executor = ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(cache_dir, n_threads, cpu_sets))
+      cache = executor.submit(build_tuning_cache, data_path, feature_plan, cache_dir, sample, seed, batch_rows).result()
+
+    active = list(range(len(candidates)))
+    for rung, rounds in enumerate(rungs):
+      tasks = []
+      for trial in active:
+        if (trial, rung) in results:
+          continue
+        previous = results.get((trial, rung - 1))
+        if previous is not None and previous['stopped']:
+          # Stopped early at a previous rung: more rounds would not help
+          record({**previous, 'rung': rung, 'rounds': rounds, 'trained_rounds': 0, 'seconds': 0})
+        else:
+          tasks.append((trial, candidates[trial], rung, rounds, models_path, early_stopping_rounds, previous, seed))
+
+      if executor is None:
+        for task in tasks:
+          record(run_trial(*task))
+      else:
+        for future in as_completed([executor.submit(run_trial, *task) for task in tasks]):
+          record(future.result())
+
+      # Keep the best 1/eta for the next rung
+      active.sort(key=lambda trial: (results[(trial, rung)]['score'], trial))
+      if rung < len(rungs) - 1:
+        active = active[:max(1, math.ceil(len(active) / eta))]
+  finally:
+    trials_file.close()
+    if executor is not None:
+      executor.shutdown()
+    _worker_state.clear()
+
+  best = results[(active[0], len(rungs) - 1)]
+  return {
+    'params': candidates[active[0]],
+    'score': best['score'],
+    'best_rounds': best['best_rounds'],
+    'candidates': len(candidates),
+    'rungs': [{'rounds': rounds, 'trials': sum(1 for (_, rung) in results if rung == index)} for index, rounds in enumerate(rungs)],
+    'boosting_rounds': sum(result['trained_rounds'] for result in results.values()),
+    'resumed_trials': resumed,
+    'cache': cache,
+    'seconds': time.perf_counter() - start,
+  }
+
+def write_best_hyperparams(params:dict, path:str) -> None:
+  '''Writes the parameters like the best_params_ of the notebook's RandomizedSearchCV (same keys, in the same order)'''
+  tmp_path = f'{path}.tmp'
+  joblib.dump({name: params[name] for name in sorted(params, reverse=True)}, tmp_path)
+  os.replace(tmp_path, path)
@@ -0,0 +1,225 @@
+from datetime import timedelta
+import logging
+import os
+import pandas as pd
+import sqlite3
+import threading
+import time
+
+# Import custom code
+from src.circuit_breaker import CircuitBreaker
+from src.constants import (
+  LOCAL_TIMEZONE, WEATHER_ATTRIBUTES, WEATHER_CACHE_TTL, WEATHER_FORECAST_DAYS, WEATHER_ARCHIVE_DAYS,
+  WEATHER_REFRESH_INTERVAL, WEATHER_BREAKER_THRESHOLD, WEATHER_BREAKER_RESET, WEATHER_NEAREST_MAX_HOURS,
+  WEATHER_CLIMATE_NORMALS
+)
+from src.helper_functions import fetch_weather
+from src.metrics import span
+
+ARCHIVE = 'archive'
+FORECAST = 'forecast'
+
+# Where the weather of a prediction came from, in fallback order
+SOURCE_STORE = 'store'
+SOURCE_LIVE = 'live'
+SOURCE_STALE = 'stale'
+SOURCE_NEAREST = 'nearest'
+SOURCE_CLIMATOLOGY = 'climatology'
+
+class WeatherStore:
+  '''
+  Hourly weather shared by all the workers through a SQLite file, with a
+  small in-process TTL cache in front of it.
+
+  Records are keyed by source (archive or forecast) and by the Open-Meteo
+  hourly time string, e.g. ('forecast', '2025-05-18T11:00').
+  '''
+
+  def __init__(self, db_path:str, cache_ttl:float=WEATHER_CACHE_TTL) -> None:
+    self.db_path = db_path
+    self.cache_ttl = cache_ttl
+    self._cache = {}
+    self._local = threading.local()
+    self.breaker = CircuitBreaker('open-meteo', WEATHER_BREAKER_THRESHOLD, WEATHER_BREAKER_RESET)
+
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    attribute_columns = ', '.join(f'{attribute} REAL' for attribute in WEATHER_ATTRIBUTES)
+    with self._connect() as conn:
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute(f'CREATE TABLE IF NOT EXISTS weather (source TEXT, time TEXT, fetched_at REAL, {attribute_columns}, PRIMARY KEY (source, time))')
+      conn.execute('CREATE INDEX IF NOT EXISTS weather_time ON weather (time)')
+      conn.execute('CREATE TABLE IF NOT EXISTS refresh_log (job TEXT PRIMARY KEY, refreshed_at REAL)')
+
+    # Workers forked from a preloaded app open their own connections
+    os.register_at_fork(after_in_child=self._reset_after_fork)
+
+  def _reset_after_fork(self) -> None:
+    self._local = threading.local()
+    self._cache = {}
+
+  def _connect(self) -> sqlite3.Connection:
+    '''Returns the connection of the current thread (SQLite connections cannot be shared)'''
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.db_path, timeout=10)
+      conn.row_factory = sqlite3.Row
+      self._local.conn = conn
+    return conn
+
+  def get(self, source:str, weather_time:str, max_age:float|None=None) -> dict|None:
+    '''Returns the weather of an hour, or None if it is missing or older than max_age seconds'''
+    now = time.time()
+    cache_key = (source, weather_time)
+    cached = self._cache.get(cache_key)
+
+    if cached is not None and cached[0] > now:
+      record = cached[1]
+    else:
+      row = self._connect().execute('SELECT * FROM weather WHERE source = ? AND time = ?', (source, weather_time)).fetchone()
+      if row is None:
+        return None
+      record = dict(row)
+      self._cache[cache_key] = (now + self.cache_ttl, record)
+
+    if max_age is not None and now - record['fetched_at'] > max_age:
+      return None
+
+    return {attribute: record[attribute] for attribute in ['time', *WEATHER_ATTRIBUTES]}
+
+  def put_many(self, source:str, weather_list:list[dict]) -> int:
+    fetched_at = time.time()
+    columns = ['source', 'time', 'fetched_at', *WEATHER_ATTRIBUTES]
+    rows = [(source, weather['time'], fetched_at, *[weather.get(attribute) for attribute in WEATHER_ATTRIBUTES]) for weather in weather_list]
+
+    conn = self._connect()
+    with conn:
+      conn.executemany(f'INSERT OR REPLACE INTO weather ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+
+    # Drop stale entries of this process
+    for weather in weather_list:
+      self._cache.pop((source, weather['time']), None)
+
+    return len(rows)
+
+  def fetch_days(self, source:str, start_date:str, end_date:str, budget:float|None=None) -> int:
+    '''Fetches every hour between two dates (inclusive) from Open-Meteo and stores them'''
+    with span('weather_fetch'):
+      weather_list = fetch_weather(start_date, end_date, WEATHER_ATTRIBUTES, forecast=source == FORECAST, budget=budget, breaker=self.breaker)
+    return self.put_many(source, weather_list)
+
+  def get_last_known(self, weather_time:str) -> dict|None:
+    '''Returns the most recently fetched weather of an hour from any source, however old'''
+    row = self._connect().execute('SELECT * FROM weather WHERE time = ? ORDER BY fetched_at DESC LIMIT 1', (weather_time,)).fetchone()
+    return None if row is None else {attribute: row[attribute] for attribute in ['time', *WEATHER_ATTRIBUTES]}
+
+  def get_nearest(self, weather_time:str, max_hours:float=WEATHER_NEAREST_MAX_HOURS) -> dict|None:
+    '''Returns the stored hour closest to weather_time, if it is within max_hours'''
+    conn = self._connect()
+    candidates = [
+      conn.execute('SELECT * FROM weather WHERE time < ? ORDER BY time DESC LIMIT 1', (weather_time,)).fetchone(),
+      conn.execute('SELECT * FROM weather WHERE time > ? ORDER BY time ASC LIMIT 1', (weather_time,)).fetchone(),
+    ]
+
+    target = pd.Timestamp(weather_time)
+    nearest = None
+    nearest_hours = max_hours
+    for row in candidates:
+      if row is None:
+        continue
+      hours = abs(pd.Timestamp(row['time']) - target) / pd.Timedelta(hours=1)
+      if hours <= nearest_hours:
+        nearest = row
+        nearest_hours = hours
+
+    return None if nearest is None else {attribute: nearest[attribute] for attribute in ['time', *WEATHER_ATTRIBUTES]}
+
+  def lookup(self, source:str, weather_time:str, max_age:float|None=None, budget:float|None=None) -> dict:
+    '''
+    Returns the weather of an hour with the source it came from, in this order:
+    the store, a live fetch of the whole day (within budget seconds), the
+    last-known value for that hour, the nearest stored hour and finally the
+    monthly climate normals.
+    '''
+    weather = self.get(source, weather_time, max_age=max_age)
+    if weather is not None:
+      return {**weather, 'weather_source': SOURCE_STORE}
+
+    weather_date = weather_time[:10]
+    if self.fetch_days(source, weather_date, weather_date, budget=budget) > 0:
+      weather = self.get(source, weather_time)
+      if weather is not None:
+        return {**weather, 'weather_source': SOURCE_LIVE}
+
+    weather = self.get_last_known(weather_time)
+    if weather is not None:
+      return {**weather, 'weather_source': SOURCE_STALE}
+
+    weather = self.get_nearest(weather_time)
+    if weather is not None:
+      return {**weather, 'time': weather_time, 'weather_source': SOURCE_NEAREST}
+
+    month_index = int(weather_time[5:7]) - 1
+    weather = {attribute: WEATHER_CLIMATE_NORMALS[attribute][month_index] for attribute in WEATHER_ATTRIBUTES}
+    return {'time': weather_time, **weather, 'weather_source': SOURCE_CLIMATOLOGY}
+
+  def claim_refresh(self, job:str, interval:float) -> bool:
+    '''
+    Returns True if no worker refreshed this job within the interval, and
+    records the refresh so that the other workers skip it.
+    '''
+    now = time.time()
+    conn = self._connect()
+    with conn:
+      conn.execute('BEGIN IMMEDIATE')
+      row = conn.execute('SELECT refreshed_at FROM refresh_log WHERE job = ?', (job,)).fetchone()
+      if row is not None and now - row['refreshed_at'] < interval:
+        return False
+      conn.execute('INSERT OR REPLACE INTO refresh_log (job, refreshed_at) VALUES (?, ?)', (job, now))
+    return True
+
+  def release_refresh(self, job:str) -> None:
+    conn = self._connect()
+    with conn:
+      conn.execute('DELETE FROM refresh_log WHERE job = ?', (job,))
+
+  def refresh(self, interval:float=0) -> None:
+    '''Bulk-pulls the full forecast window and the most recent archive days'''
+    today = pd.Timestamp.now(tz=LOCAL_TIMEZONE).date()
+
+    # The forecast endpoint also covers the last days that are not archived yet
+    archive_end = today - timedelta(days=3)
+    date_ranges = {
+      FORECAST: (archive_end, today + timedelta(days=WEATHER_FORECAST_DAYS - 1)),
+      ARCHIVE: (archive_end - timedelta(days=WEATHER_ARCHIVE_DAYS - 1), archive_end),
+    }
+
+    for source, (start_date, end_date) in date_ranges.items():
+      if not self.claim_refresh(source, interval):
+        continue
+
+      count = self.fetch_days(source, start_date.isoformat(), end_date.isoformat())
+      logging.info('Weather store: %d %s hours refreshed', count, source)
+
+      # Let the next worker retry
+      if count == 0:
+        self.release_refresh(source)
+
+class WeatherRefresher(threading.Thread):
+  '''Background thread that keeps the weather store up to date'''
+
+  def __init__(self, store:WeatherStore, interval:float=WEATHER_REFRESH_INTERVAL) -> None:
+    super().__init__(name='weather-refresher', daemon=True)
+    self.store = store
+    self.interval = interval
+    self._stop_event = threading.Event()
+
+  def run(self) -> None:
+    while not self._stop_event.is_set():
+      try:
+        self.store.refresh(self.interval)
+      except Exception as e:
+        logging.error('Weather refresh failed: %s', repr(e))
+      self._stop_event.wait(self.interval)
+
+  def stop(self) -> None:
+    self._stop_event.set()